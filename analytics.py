@@ -0,0 +1,163 @@
+import re
+import sqlite3
+import datetime
+from invoice_store import SQLiteBlobStore
+from database import rebuild_product_sales_monthly
+from report_cache import log_rebuild
+
+# "2         Alicate Universal             SN1005         LPS 7.99       LPS 15.98"
+INVOICE_LINE = re.compile(r'^\s*(\d+)\s+(.+?)\s+(\S+)\s+(?:LPS|L)\s*([\d,.]+)\s+(?:LPS|L)\s*([\d,.]+)\s*$')
+
+
+def parse_invoice_lines(content):
+    """Extract (quantity, name, serial, price, subtotal) lines from an invoice text file."""
+    lines = []
+    for line in content.splitlines():
+        match = INVOICE_LINE.match(line)
+        if match:
+            qty, name, serial, price, subtotal = match.groups()
+            lines.append((int(qty), name.strip(), serial,
+                          float(price.replace(",", "")), float(subtotal.replace(",", ""))))
+    return lines
+
+
+class SalesAnalytics:
+    """Per-product sales analytics computed in SQL over the product_sales_daily rollup."""
+
+    def __init__(self, db_name="inventory.db"):
+        self.db_name = db_name
+
+    def top_products(self, start, end, limit=10, by="revenue"):
+        """Top products between two dates, by 'revenue' or 'units'.
+        Returns (product_id, serial_number, name, units, revenue)."""
+        order = "units" if by == "units" else "revenue"
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT s.product_id, COALESCE(p.serial_number, ''), COALESCE(p.name, '(eliminado)'),
+                       s.units, s.revenue
+                FROM (
+                    SELECT product_id, SUM(units) AS units, SUM(revenue) AS revenue
+                    FROM product_sales_daily
+                    WHERE day BETWEEN date(?) AND date(?)
+                    GROUP BY product_id
+                ) s
+                LEFT JOIN products p ON p.id = s.product_id
+                ORDER BY s.{order} DESC
+                LIMIT ?
+            """, (start, end, limit))
+            return cursor.fetchall()
+
+    def sales_velocity(self, windows=(7, 30, 90), as_of=None):
+        """Average units sold per day over each sliding window, ending at as_of (today by default).
+        Returns (product_id, serial_number, name, quantity, velocity per window..., days of cover)."""
+        as_of = as_of or datetime.date.today().isoformat()
+        windows = sorted(windows)
+        rates = ", ".join(
+            f"COALESCE(SUM(CASE WHEN d.day > date(:as_of, '-{w} days') THEN d.units END), 0) * 1.0 / {w}"
+            for w in windows
+        )
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT p.id, p.serial_number, p.name, p.quantity, {rates}
+                FROM products p
+                JOIN product_sales_daily d ON d.product_id = p.id
+                WHERE d.day > date(:as_of, '-{windows[-1]} days') AND d.day <= date(:as_of)
+                GROUP BY p.id
+                ORDER BY 5 DESC
+            """, {"as_of": as_of})
+            rows = cursor.fetchall()
+        result = []
+        for row in rows:
+            # Days of cover use the shortest window, the best estimate of current demand
+            rate = row[4]
+            cover = row[3] / rate if rate > 0 else None
+            result.append(row + (cover,))
+        return result
+
+    def dead_stock(self, days=90, as_of=None):
+        """Products in stock with no sales in the last `days` days.
+        Returns (product_id, serial_number, name, quantity, stock value at cost, last sale day)."""
+        as_of = as_of or datetime.date.today().isoformat()
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            # Both subqueries are answered from the (product_id, day) primary key
+            cursor.execute("""
+                SELECT p.id, p.serial_number, p.name, p.quantity, p.quantity * p.cost,
+                       (SELECT MAX(day) FROM product_sales_daily WHERE product_id = p.id)
+                FROM products p
+                WHERE p.quantity > 0
+                AND NOT EXISTS (
+                    SELECT 1 FROM product_sales_daily d
+                    WHERE d.product_id = p.id AND d.day > date(?, ?)
+                )
+                ORDER BY p.quantity * p.cost DESC
+            """, (as_of, f"-{int(days)} days"))
+            return cursor.fetchall()
+
+    def rebuild_rollup(self):
+        """Recompute product_sales_daily (and its monthly copy) from invoice_items, net of credit notes."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            # Days of archived years are kept: their line items are no longer here
+            cursor.execute("DELETE FROM product_sales_daily WHERE substr(day, 1, 4) NOT IN (SELECT year FROM invoice_archives)")
+            cursor.execute("""
+                INSERT INTO product_sales_daily (product_id, day, units, revenue)
+                SELECT product_id, day, SUM(units), SUM(revenue) FROM (
+                    SELECT i.product_id, date(v.date) AS day, i.quantity AS units, i.subtotal AS revenue
+                    FROM invoice_items i JOIN invoices v ON v.id = i.invoice_id
+                    WHERE i.product_id IS NOT NULL
+                    UNION ALL
+                    SELECT c.product_id, date(n.date), -c.quantity, -c.subtotal
+                    FROM credit_note_items c JOIN credit_notes n ON n.id = c.credit_note_id
+                    WHERE c.product_id IS NOT NULL
+                )
+                WHERE substr(day, 1, 4) NOT IN (SELECT year FROM invoice_archives)
+                GROUP BY product_id, day
+            """)
+            rebuild_product_sales_monthly(cursor)
+            log_rebuild(cursor, "product_sales_daily")
+            conn.commit()
+
+    def backfill_invoice_items(self, progress=None):
+        """
+        Create invoice_items for invoices saved before line items were stored,
+        by parsing their documents, then rebuild the rollup. Returns (filled, failed).
+        """
+        store = SQLiteBlobStore(self.db_name)  # Reads file paths and blob references
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT serial_number, id FROM products")
+            product_ids = dict(cursor.fetchall())
+            cursor.execute("""
+                SELECT id, file_path FROM invoices v
+                WHERE NOT EXISTS (SELECT 1 FROM invoice_items i WHERE i.invoice_id = v.id)
+                ORDER BY id
+            """)
+            pending = cursor.fetchall()
+        filled = failed = 0
+        batch = []
+        with sqlite3.connect(self.db_name) as conn:
+            for n, (invoice_id, ref) in enumerate(pending, 1):
+                try:
+                    lines = parse_invoice_lines(store.load(ref))
+                except Exception:
+                    lines = []
+                if lines:
+                    batch.extend((invoice_id, product_ids.get(serial), serial, name, qty, price, subtotal)
+                                 for qty, name, serial, price, subtotal in lines)
+                    filled += 1
+                else:
+                    failed += 1
+                if len(batch) >= 1000 or n == len(pending):
+                    conn.executemany("""
+                        INSERT INTO invoice_items (invoice_id, product_id, serial_number, name, quantity, price, subtotal)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, batch)
+                    conn.commit()
+                    batch = []
+                    if progress:
+                        progress(n, len(pending))
+        self.rebuild_rollup()
+        return filled, failed
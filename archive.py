@@ -0,0 +1,225 @@
+import os
+import sqlite3
+import datetime
+from urllib.parse import quote
+
+# Invoices moved per transaction, so a checkout never waits long for the write lock
+ARCHIVE_BATCH = 2000
+
+INVOICE_FIELDS = "id, client_id, client_name, date, subtotal, tax, total, file_path"
+INVOICE_ITEM_FIELDS = "id, invoice_id, product_id, serial_number, name, quantity, price, subtotal, cost"
+CREDIT_NOTE_FIELDS = "id, invoice_id, client_id, client_name, date, subtotal, tax, total, reason"
+CREDIT_NOTE_ITEM_FIELDS = "id, credit_note_id, product_id, serial_number, name, quantity, price, subtotal, cost"
+
+# Tables of a yearly archive file; same columns (and ids) as in the hot database
+ARCHIVE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS invoices (
+        id INTEGER PRIMARY KEY, client_id INTEGER, client_name TEXT NOT NULL, date TEXT NOT NULL,
+        subtotal REAL NOT NULL, tax REAL NOT NULL, total REAL NOT NULL, file_path TEXT NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS invoice_items (
+        id INTEGER PRIMARY KEY, invoice_id INTEGER NOT NULL, product_id INTEGER, serial_number TEXT NOT NULL,
+        name TEXT NOT NULL, quantity INTEGER NOT NULL, price REAL NOT NULL, subtotal REAL NOT NULL,
+        cost REAL NOT NULL DEFAULT 0)""",
+    """CREATE TABLE IF NOT EXISTS credit_notes (
+        id INTEGER PRIMARY KEY, invoice_id INTEGER NOT NULL, client_id INTEGER, client_name TEXT NOT NULL,
+        date TEXT NOT NULL, subtotal REAL NOT NULL, tax REAL NOT NULL, total REAL NOT NULL, reason TEXT)""",
+    """CREATE TABLE IF NOT EXISTS credit_note_items (
+        id INTEGER PRIMARY KEY, credit_note_id INTEGER NOT NULL, product_id INTEGER, serial_number TEXT NOT NULL,
+        name TEXT NOT NULL, quantity INTEGER NOT NULL, price REAL NOT NULL, subtotal REAL NOT NULL,
+        cost REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices(date)",
+    "CREATE INDEX IF NOT EXISTS idx_invoices_client ON invoices(client_id, date)",
+    "CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice ON invoice_items(invoice_id)",
+    "CREATE INDEX IF NOT EXISTS idx_credit_notes_date ON credit_notes(date)",
+    "CREATE INDEX IF NOT EXISTS idx_credit_notes_invoice ON credit_notes(invoice_id)",
+    "CREATE INDEX IF NOT EXISTS idx_credit_note_items_note ON credit_note_items(credit_note_id)",
+]
+
+
+def connect_with_archives(db_name):
+    """Connection to the hot database that can attach archive files read-only."""
+    return sqlite3.connect("file:" + quote(os.path.abspath(db_name)), uri=True)
+
+
+def _resolve(db_name, path):
+    return os.path.join(os.path.dirname(os.path.abspath(db_name)), path)
+
+
+def attach_archives(cursor, db_name, start=None, end=None):
+    """
+    Attach read-only the archives of the years overlapping start..end (dates or datetimes;
+    None leaves that side open). Returns the schemas to query, "main" first; with no
+    archived year in the range nothing is attached and only the hot database is read.
+    The cursor must come from connect_with_archives().
+    """
+    cursor.execute("""
+        SELECT year, path FROM invoice_archives
+        WHERE (? IS NULL OR year >= substr(?, 1, 4)) AND (? IS NULL OR year <= substr(?, 1, 4))
+        ORDER BY year
+    """, (start, start, end, end))
+    schemas = ["main"]
+    for year, path in cursor.fetchall():
+        schema = f"archive_{year}"
+        full = _resolve(db_name, path)
+        if os.path.exists(full):
+            cursor.execute("ATTACH DATABASE ? AS " + schema, ("file:" + quote(full) + "?mode=ro",))
+            schemas.append(schema)
+    return schemas
+
+
+def union_all(schemas, select):
+    """The same SELECT (with a {schema} placeholder and named parameters) over every partition."""
+    return " UNION ALL ".join(select.format(schema=schema) for schema in schemas)
+
+
+def partition(schemas, table, fields):
+    """A table, or the union of its partitions as a subquery, for use in a FROM clause."""
+    if len(schemas) == 1:
+        return table
+    return "(" + union_all(schemas, f"SELECT {fields} FROM {{schema}}.{table}") + ")"
+
+
+class InvoiceArchive:
+    """
+    Moves the invoices and credit notes of closed years out of the hot database into one
+    SQLite file per year (archive/<name>_<year>.db next to the database). The sales and
+    client rollups keep covering archived years, so reports built on them are unchanged;
+    queries over invoice rows attach the yearly files only when their date range reaches
+    an archived year.
+
+    Each batch is first copied into the archive and committed there, then removed from the
+    hot database in a second transaction that checks the copy; an interrupted run leaves
+    every invoice in at least one of both and simply continues when run again.
+    """
+
+    def __init__(self, db_name="inventory.db", folder="archive"):
+        self.db_name = db_name
+        self.folder = folder
+
+    def path(self, year):
+        stem = os.path.splitext(os.path.basename(self.db_name))[0]
+        return os.path.join(self.folder, f"{stem}_{year}.db")
+
+    def archived(self):
+        """[(year, path, archived_at, invoices, credit notes)] of the archived years."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT year, path, archived_at, invoices, credit_notes FROM invoice_archives ORDER BY year")
+            return cursor.fetchall()
+
+    def archivable_years(self):
+        """[(year, invoices, total)] of closed years that still have invoices in the hot database."""
+        first_open = f"{datetime.date.today().year}-01-01"
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT substr(date, 1, 4), COUNT(*), SUM(total) FROM invoices
+                WHERE date < ? GROUP BY 1 ORDER BY 1
+            """, (first_open,))
+            return cursor.fetchall()
+
+    def archive_year(self, year, progress=None):
+        """
+        Move a closed year into its archive file. progress(done, total) is called after each
+        batch. Returns (True, (invoices, credit notes) moved) or (False, error message).
+        """
+        year = str(year)
+        if not (year.isdigit() and len(year) == 4) or int(year) >= datetime.date.today().year:
+            return False, "Solo se pueden archivar años ya cerrados."
+        start, end = f"{year}-01-01", f"{int(year) + 1}-01-01"
+        relative = self.path(year)
+        full = _resolve(self.db_name, relative)
+        try:
+            with connect_with_archives(self.db_name) as conn:
+                cursor = conn.cursor()
+                # Oldest first, so the returns of an invoice never sit in an older partition than it
+                cursor.execute("SELECT substr(MIN(date), 1, 4) FROM invoices WHERE date < ?", (start,))
+                older = cursor.fetchone()[0]
+                if older is not None:
+                    return False, f"Archive primero el año {older}."
+                os.makedirs(os.path.dirname(full), exist_ok=True)
+                with sqlite3.connect(full) as archive:
+                    for statement in ARCHIVE_SCHEMA:
+                        archive.execute(statement)
+                    archive.commit()
+                cursor.execute("ATTACH DATABASE ? AS arc", (full,))
+                cursor.execute("SELECT COUNT(*) FROM invoices WHERE date >= ? AND date < ?", (start, end))
+                total = cursor.fetchone()[0]
+                cursor.execute("SELECT COUNT(*) FROM credit_notes WHERE date >= ? AND date < ?", (start, end))
+                total += cursor.fetchone()[0]
+                moved = {"invoices": 0, "credit_notes": 0}
+                for table, items, key in (("invoices", "invoice_items", "invoice_id"),
+                                          ("credit_notes", "credit_note_items", "credit_note_id")):
+                    while True:
+                        cursor.execute(f"SELECT id FROM main.{table} WHERE date >= ? AND date < ? ORDER BY id LIMIT ?",
+                                       (start, end, ARCHIVE_BATCH))
+                        ids = [row[0] for row in cursor.fetchall()]
+                        if not ids:
+                            break
+                        self._copy_batch(conn, table, items, key, ids)
+                        moved[table] += self._remove_batch(conn, table, items, key, ids)
+                        if progress:
+                            progress(moved["invoices"] + moved["credit_notes"], total)
+                cursor.execute("""
+                    INSERT INTO invoice_archives (year, path, archived_at, invoices, credit_notes)
+                    SELECT ?, ?, ?, (SELECT COUNT(*) FROM arc.invoices), (SELECT COUNT(*) FROM arc.credit_notes) WHERE 1
+                    ON CONFLICT(year) DO UPDATE SET path = excluded.path, archived_at = excluded.archived_at,
+                        invoices = excluded.invoices, credit_notes = excluded.credit_notes
+                """, (year, relative, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+                conn.commit()
+                return True, (moved["invoices"], moved["credit_notes"])
+        except (sqlite3.Error, OSError) as e:
+            return False, str(e)
+
+    def _copy_batch(self, conn, table, items, key, ids):
+        """Copy rows and their lines into the archive; committed on their own (only arc is written)."""
+        fields = INVOICE_FIELDS if table == "invoices" else CREDIT_NOTE_FIELDS
+        item_fields = INVOICE_ITEM_FIELDS if table == "invoices" else CREDIT_NOTE_ITEM_FIELDS
+        marks = ",".join("?" * len(ids))
+        cursor = conn.cursor()
+        cursor.execute(f"INSERT OR IGNORE INTO arc.{table} ({fields}) SELECT {fields} FROM main.{table} WHERE id IN ({marks})",
+                       ids)
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO arc.{items} ({item_fields})
+            SELECT {item_fields} FROM main.{items} WHERE {key} IN ({marks})
+        """, ids)
+        conn.commit()
+
+    def _remove_batch(self, conn, table, items, key, ids):
+        """Delete from the hot database the rows of a batch already in the archive; returns how many."""
+        marks = ",".join("?" * len(ids))
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(f"SELECT id FROM arc.{table} WHERE id IN ({marks})", ids)
+        copied = [row[0] for row in cursor.fetchall()]
+        marks = ",".join("?" * len(copied))
+        if table == "invoices":
+            # Lifetime client totals of the archived invoices, for rebuilding client_stats
+            cursor.execute(f"""
+                INSERT INTO archived_client_totals (client_id, invoices, total, first_purchase, last_purchase)
+                SELECT client_id, COUNT(*), SUM(total), MIN(date), MAX(date) FROM main.invoices
+                WHERE id IN ({marks}) AND client_id IS NOT NULL GROUP BY client_id
+                ON CONFLICT(client_id) DO UPDATE SET invoices = invoices + excluded.invoices,
+                    total = total + excluded.total,
+                    first_purchase = COALESCE(MIN(first_purchase, excluded.first_purchase), excluded.first_purchase),
+                    last_purchase = COALESCE(MAX(last_purchase, excluded.last_purchase), excluded.last_purchase)
+            """, copied)
+        else:
+            cursor.execute(f"""
+                INSERT INTO archived_client_totals (client_id, invoices, total, first_purchase, last_purchase)
+                SELECT client_id, 0, -SUM(total), NULL, NULL FROM main.credit_notes
+                WHERE id IN ({marks}) AND client_id IS NOT NULL GROUP BY client_id
+                ON CONFLICT(client_id) DO UPDATE SET total = total + excluded.total
+            """, copied)
+        # Moving is not deleting: branch sync must neither send tombstones nor export the rows
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sync_state'")
+        syncing = cursor.fetchone() is not None
+        if syncing:
+            cursor.execute("UPDATE sync_state SET applying = 1")
+            cursor.execute(f"DELETE FROM sync_rows WHERE tbl = '{table}' AND row_id IN ({marks})", copied)
+        cursor.execute(f"DELETE FROM main.{items} WHERE {key} IN ({marks})", copied)
+        cursor.execute(f"DELETE FROM main.{table} WHERE id IN ({marks})", copied)
+        if syncing:
+            cursor.execute("UPDATE sync_state SET applying = 0")
+        conn.commit()
+        return len(copied)
@@ -1,5 +1,5 @@
 import os
-import shutil
+import sqlite3
 import datetime
 from PyQt6.QtCore import QObject, QTimer, pyqtSignal
 import smtplib
@@ -7,6 +7,23 @@ import ssl
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
+from maintenance import DatabaseMaintenance
+
+def copy_database(source, target, standalone=False):
+    """
+    Copy a database with SQLite's online backup API. Unlike copying the file, this
+    includes changes still in the WAL file and never sees a half-written transaction.
+    standalone switches the copy out of WAL mode so it is a single self-contained file.
+    """
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst, pages=1024)  # In steps, so writers are only held up briefly
+        if standalone:
+            dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
 
 class BackupManager(QObject):
     backup_completed = pyqtSignal(str)  # Signal emitted when backup is completed
@@ -27,6 +44,8 @@ class BackupManager(QObject):
     def check_backup_schedule(self):
         """Check if it's time to perform an automatic backup."""
         try:
+            if self.settings_manager.get_setting("database_backend", "local") == "server":
+                return  # The database is backed up on the inventory server's computer
             backup_frequency = self.settings_manager.get_setting("backup_frequency", "daily")
             last_backup = self.settings_manager.get_setting("last_backup")
             
@@ -52,6 +71,9 @@ class BackupManager(QObject):
     def create_backup(self):
         """Create a backup of the database and send it via email."""
         try:
+            if self.settings_manager.get_setting("database_backend", "local") == "server":
+                self.backup_failed.emit("Los backups se crean en el equipo del servidor de inventario")
+                return
             # Get backup recipient email from settings
             recipient_email = self.settings_manager.get_setting("backup_recipient_email")
             if not recipient_email:
@@ -66,8 +88,8 @@ class BackupManager(QObject):
             timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
             backup_file = f"{backup_dir}/backup_{timestamp}.db"
 
-            # Copy database file
-            shutil.copy2("inventory.db", backup_file)
+            # Copy database file (consistent even while other threads are writing)
+            copy_database("inventory.db", backup_file, standalone=True)
 
             # Send email with backup
             self.send_backup_email(backup_file, recipient_email)
@@ -165,11 +187,57 @@ Este es un backup automático de su base de datos. Por favor, guarde este archiv
             timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
             current_backup = f"backups/pre_restore_backup_{timestamp}.db"
             os.makedirs("backups", exist_ok=True)
-            shutil.copy2("inventory.db", current_backup)
+            copy_database("inventory.db", current_backup, standalone=True)
 
             # Restore the selected backup
-            shutil.copy2(backup_file, "inventory.db")
+            copy_database(backup_file, "inventory.db")
             
             return True, "Backup restaurado exitosamente"
         except Exception as e:
-            return False, f"Error al restaurar backup: {str(e)}" 
\ No newline at end of file
+            return False, f"Error al restaurar backup: {str(e)}" 
+
+
+class MaintenanceManager(QObject):
+    """
+    Schedules DatabaseMaintenance like BackupManager schedules backups: a timer checks
+    every few minutes and, when nothing was written since the previous check, runs the
+    due tasks on the executor's background thread.
+    """
+    maintenance_completed = pyqtSignal(list)  # [(task, seconds, bytes before, bytes after, detail)]
+    maintenance_failed = pyqtSignal(str)
+
+    CHECK_INTERVAL = 300000  # 5 minutes
+
+    def __init__(self, settings_manager, executor):
+        super().__init__()
+        self.settings_manager = settings_manager
+        self.executor = executor
+        self.maintenance = DatabaseMaintenance(executor.db.db_name)
+        self.last_seq = None  # change_log sequence at the previous check
+        self.running = False
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.check_maintenance_schedule)
+
+    def start_maintenance_timer(self):
+        """Start checking for idle periods."""
+        self.timer.start(self.CHECK_INTERVAL)
+
+    def check_maintenance_schedule(self):
+        """Run the due maintenance if the database has been idle since the last check."""
+        if self.settings_manager.get_setting("database_backend", "local") == "server":
+            return  # The inventory server's computer maintains its own file
+        if self.running:
+            return
+        self.running = True
+        self.executor.background(self.maintenance.run_if_idle, self.last_seq).then(
+            self.on_maintenance_finished, self.on_maintenance_error)
+
+    def on_maintenance_finished(self, outcome):
+        self.running = False
+        self.last_seq, results = outcome
+        if results:
+            self.maintenance_completed.emit(results)
+
+    def on_maintenance_error(self, error):
+        self.running = False
+        self.maintenance_failed.emit(f"Error en el mantenimiento de la base de datos: {error}")
@@ -0,0 +1,161 @@
+from PyQt6.QtCore import QObject, pyqtSignal
+from database import Database
+from change_bus import ChangeBus
+
+
+class Catalog(QObject):
+    """
+    Process-wide in-memory cache of products and clients.
+    Rows are kept as Product/Client records (tuples without a per-row dict), indexed by id,
+    serial number and identity id. The cache is loaded once and then patched from ChangeBus events,
+    so lookups are dictionary hits instead of queries.
+    """
+    changed = pyqtSignal(str, str, list)  # Re-emitted after the cache is patched
+    reset = pyqtSignal()
+
+    _instance = None
+
+    @classmethod
+    def instance(cls, db_name="inventory.db", db=None):
+        if cls._instance is None:
+            cls._instance = cls(db_name, db)
+        return cls._instance
+
+    def __init__(self, db_name="inventory.db", db=None):
+        super().__init__()
+        self.db = db or Database(db_name)  # Or a RemoteDatabase in server mode
+        self._products = None         # id -> Product
+        self._products_by_serial = {}
+        self._product_list = None     # sorted by name, rebuilt on demand
+        self._clients = None          # id -> Client
+        self._clients_by_identity = {}
+        self._client_list = None
+        self.change_bus = ChangeBus.instance(db_name)
+        self.change_bus.changed.connect(self.on_changed)
+        self.change_bus.reset.connect(self.on_reset)
+
+    # --- Loading and patching ---
+    def _load_products(self):
+        if self._products is None:
+            rows = self.db.get_all_products()
+            self._products = {p.id: p for p in rows}
+            self._products_by_serial = {p.serial_number: p for p in rows}
+            self._product_list = rows
+        return self._products
+
+    def _load_clients(self):
+        if self._clients is None:
+            rows = self.db.get_all_clients()
+            self._clients = {c.id: c for c in rows}
+            self._clients_by_identity = {c.identity_id: c for c in rows}
+            self._client_list = rows
+        return self._clients
+
+    def _patch(self, by_id, by_key, key, op, ids, fetch):
+        for record_id in ids:
+            old = by_id.pop(record_id, None)
+            if old is not None and by_key.get(getattr(old, key)) is old:
+                del by_key[getattr(old, key)]
+        if op != "delete":
+            for record in fetch(ids):
+                by_id[record.id] = record
+                by_key[getattr(record, key)] = record
+
+    def on_changed(self, table, op, ids):
+        if table == "products" and self._products is not None:
+            self._patch(self._products, self._products_by_serial, "serial_number", op, ids,
+                        self.db.get_products_by_ids)
+            self._product_list = None
+        elif table == "clients" and self._clients is not None:
+            self._patch(self._clients, self._clients_by_identity, "identity_id", op, ids,
+                        self.db.get_clients_by_ids)
+            self._client_list = None
+        self.changed.emit(table, op, ids)
+
+    def refresh(self):
+        """Pick up committed changes right away (call after a write) instead of at the next poll."""
+        self.change_bus.poll()
+
+    def on_reset(self):
+        self.invalidate()
+        self.reset.emit()
+
+    def invalidate(self):
+        """Drop everything; the next lookup reloads from the database."""
+        self._products = self._product_list = None
+        self._clients = self._client_list = None
+        self._products_by_serial = {}
+        self._clients_by_identity = {}
+
+    # --- Products ---
+    def products(self):
+        """All products ordered by name."""
+        products = self._load_products()
+        if self._product_list is None:
+            self._product_list = sorted(products.values(), key=lambda p: p.name)
+        return self._product_list
+
+    def product(self, product_id):
+        return self._load_products().get(product_id)
+
+    def product_by_serial(self, serial_number):
+        self._load_products()
+        return self._products_by_serial.get(serial_number)
+
+    def products_by_ids(self, ids):
+        products = self._load_products()
+        return sorted((products[i] for i in ids if i in products), key=lambda p: p.name)
+
+    def search_products(self, search_term, search_type):
+        """Same results as Database.search_products, answered from memory."""
+        if search_type == "ID":
+            try:
+                product = self.product(int(search_term))
+            except ValueError:
+                return []
+            return [product] if product else []
+        term = search_term.lower()
+        if search_type == "Número de Serie":
+            matches = sorted((p for p in self.products() if term in p.serial_number.lower()),
+                             key=lambda p: p.serial_number)
+            exact = self.product_by_serial(search_term)
+            if exact is not None:
+                matches.remove(exact)
+                matches.insert(0, exact)
+            return matches
+        return [p for p in self.products() if term in p.name.lower()]
+
+    # --- Clients ---
+    def clients(self):
+        """All clients ordered by name."""
+        clients = self._load_clients()
+        if self._client_list is None:
+            self._client_list = sorted(clients.values(), key=lambda c: c.name)
+        return self._client_list
+
+    def client(self, client_id):
+        return self._load_clients().get(client_id)
+
+    def client_by_identity(self, identity_id):
+        self._load_clients()
+        return self._clients_by_identity.get(identity_id)
+
+    def clients_by_ids(self, ids):
+        clients = self._load_clients()
+        return sorted((clients[i] for i in ids if i in clients), key=lambda c: c.name)
+
+    def search_clients(self, search_term, search_type):
+        """Same results as Database.search_clients, answered from memory."""
+        field = {"Nombre": "name", "ID": "identity_id", "RTN": "rtn"}.get(search_type)
+        if field is None:
+            return []
+        term = search_term.lower()
+        matches = [c for c in self.clients() if getattr(c, field) and term in getattr(c, field).lower()]
+        if field != "name":
+            matches.sort(key=lambda c: getattr(c, field))
+        if field == "identity_id":
+            exact = self.client_by_identity(search_term)
+            if exact is not None:
+                matches.remove(exact)
+                matches.insert(0, exact)
+        return matches
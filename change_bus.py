@@ -0,0 +1,152 @@
+import sqlite3
+from PyQt6.QtCore import QObject, QTimer, pyqtSignal
+
+# Entries kept in change_log after they are delivered, for other processes that poll less often
+KEEP_ENTRIES = 5000
+
+
+class ChangeBus(QObject):
+    """
+    Publishes row-level changes (table, op, ids) made to the database by any connection
+    or process. Triggers fill change_log (see Database.create_change_log_triggers); a persistent
+    connection polls PRAGMA data_version, which only changes when someone else
+    committed, and then reads the new change_log entries.
+    """
+    changed = pyqtSignal(str, str, list)  # table, 'insert' | 'update' | 'delete', row ids
+    reset = pyqtSignal()                  # the database was replaced; views must reload
+
+    _instance = None
+
+    @classmethod
+    def instance(cls, db_name="inventory.db"):
+        """Process-wide bus, created on first use (from the GUI thread)."""
+        if cls._instance is None:
+            cls._instance = cls(db_name)
+        return cls._instance
+
+    def __init__(self, db_name="inventory.db", interval=300):
+        super().__init__()
+        self.db_name = db_name
+        self.conn = sqlite3.connect(db_name)
+        self._version = 0
+        self._data_version = None
+        self.last_seq = self._max_seq()
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(interval)
+
+    def version(self):
+        """Counter increased every time changes are published."""
+        return self._version
+
+    def _max_seq(self):
+        try:
+            return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0  # Table not created yet
+
+    def poll(self):
+        """Publish the changes committed since the last poll. Cheap when nothing changed."""
+        try:
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+            cursor = self.conn.execute("SELECT COALESCE(MIN(seq), 0), COALESCE(MAX(seq), 0) FROM change_log")
+            first, last = cursor.fetchone()
+            if last < self.last_seq or (first > self.last_seq + 1 and last > self.last_seq):
+                # Log went backwards (restored backup) or was pruned past us
+                self.resync()
+                return
+            if last == self.last_seq:
+                return
+            rows = self.conn.execute("""
+                SELECT tbl, op, row_id FROM change_log WHERE seq > ? ORDER BY seq
+            """, (self.last_seq,)).fetchall()
+            self.last_seq = last
+        except sqlite3.Error:
+            return
+        self._publish(rows)
+        if first < last - 2 * KEEP_ENTRIES:
+            self.prune()
+
+    def _publish(self, rows):
+        self._version += 1
+        # Consecutive entries for the same table and operation are published together
+        batch_key, ids = None, {}
+        for tbl, op, row_id in rows:
+            if (tbl, op) != batch_key:
+                if ids:
+                    self.changed.emit(batch_key[0], batch_key[1], list(ids))
+                batch_key, ids = (tbl, op), {}
+            ids[row_id] = None
+        if ids:
+            self.changed.emit(batch_key[0], batch_key[1], list(ids))
+
+    def resync(self):
+        """Skip to the end of the log and ask every view to reload."""
+        self.last_seq = self._max_seq()
+        self._data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self._version += 1
+        self.reset.emit()
+
+    def prune(self):
+        if self.last_seq <= KEEP_ENTRIES:
+            return
+        try:
+            self.conn.execute("DELETE FROM change_log WHERE seq <= ?", (self.last_seq - KEEP_ENTRIES,))
+            self.conn.commit()
+        except sqlite3.Error:
+            pass
+
+
+class RemoteChangeBus(ChangeBus):
+    """
+    ChangeBus of a terminal working against the inventory server: the change_log entries
+    are read from the server's /changes endpoint instead of a local database.
+    The server prunes its own log.
+    """
+
+    @classmethod
+    def install(cls, remote, interval=1000):
+        """Make this the process-wide bus returned by ChangeBus.instance()."""
+        ChangeBus._instance = cls(remote, interval)
+        return ChangeBus._instance
+
+    def __init__(self, remote, interval=1000):
+        QObject.__init__(self)
+        self.remote = remote
+        self.db_name = remote.db_name
+        self._version = 0
+        self.last_seq = self._max_seq()
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(interval)
+
+    def _max_seq(self):
+        try:
+            return self.remote.changes(2 ** 62)["last"]  # No entries after this, only the bounds
+        except Exception:
+            return 0  # Server not reachable yet; the first poll catches up
+
+    def poll(self):
+        try:
+            log = self.remote.changes(self.last_seq)
+        except Exception:
+            return  # Retried at the next tick
+        first, last = log["first"], log["last"]
+        if last < self.last_seq or (first > self.last_seq + 1 and last > self.last_seq):
+            self.resync()
+            return
+        if last == self.last_seq:
+            return
+        self.last_seq = last
+        self._publish(log["changes"])
+
+    def resync(self):
+        self.last_seq = self._max_seq()
+        self._version += 1
+        self.reset.emit()
+
+    def prune(self):
+        pass
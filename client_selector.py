@@ -0,0 +1,95 @@
+from PyQt6.QtCore import Qt, QTimer, QStringListModel, pyqtSignal
+from PyQt6.QtWidgets import QLineEdit, QCompleter
+from change_bus import ChangeBus
+from db_executor import DatabaseExecutor
+
+
+class ClientSelector(QLineEdit):
+    """
+    Client picker that queries matching clients as the user types instead of
+    listing every client. Suggestions come from an indexed prefix lookup on the
+    name (or identity id) and the chosen client's id is kept apart from the text.
+    """
+    client_changed = pyqtSignal(object)  # selected client id, or None
+
+    def __init__(self, db_name="inventory.db", limit=20, parent=None):
+        super().__init__(parent)
+        self.db = DatabaseExecutor.instance(db_name).db  # Local file or inventory server
+        self.limit = limit
+        self._client = None   # selected Client record
+        self._matches = {}    # suggestion text -> Client
+        self.setPlaceholderText("Escriba el nombre o ID del cliente...")
+        self.model = QStringListModel(self)
+        self.completer = QCompleter(self.model, self)
+        # The model already holds only the matches; the completer must not filter again
+        self.completer.setCompletionMode(QCompleter.CompletionMode.UnfilteredPopupCompletion)
+        self.completer.setCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+        self.completer.setWidget(self)
+        self.completer.activated.connect(self.on_activated)
+        # Wait for a pause in typing before querying
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(150)
+        self.timer.timeout.connect(self.update_matches)
+        self.textEdited.connect(self.on_text_edited)
+        ChangeBus.instance(db_name).changed.connect(self.on_data_changed)
+
+    @staticmethod
+    def label(client):
+        return f"{client.name} (ID: {client.identity_id})"
+
+    def on_text_edited(self, text):
+        if self._client is not None:
+            self._set_client(None)  # Editing the text drops the previous selection
+        self.timer.start()
+
+    def update_matches(self):
+        prefix = self.text().strip()
+        if not prefix:
+            self.model.setStringList([])
+            return
+        clients = self.db.find_clients_by_prefix(prefix, self.limit)
+        self._matches = {self.label(c): c for c in clients}
+        self.model.setStringList(list(self._matches))
+        if clients:
+            self.completer.complete()
+
+    def on_activated(self, text):
+        client = self._matches.get(text)
+        if client is not None:
+            self.setText(self.label(client))
+            self._set_client(client)
+
+    def on_data_changed(self, table, op, ids):
+        """Keep the selected client in step with edits made elsewhere."""
+        if table != "clients" or self._client is None or self._client.id not in ids:
+            return
+        if op == "delete":
+            self.clear_selection()
+            return
+        updated = self.db.get_clients_by_ids([self._client.id])
+        if updated:
+            self._client = updated[0]
+            self.setText(self.label(updated[0]))
+
+    def _set_client(self, client):
+        self._client = client
+        self.client_changed.emit(client.id if client else None)
+
+    def set_client(self, client):
+        """Select a Client record programmatically."""
+        self.setText(self.label(client) if client else "")
+        self._set_client(client)
+
+    def clear_selection(self):
+        self.clear()
+        self._matches = {}
+        self.model.setStringList([])
+        self._set_client(None)
+
+    def client(self):
+        """The selected Client record, or None."""
+        return self._client
+
+    def client_id(self):
+        return self._client.id if self._client else None
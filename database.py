@@ -1,17 +1,63 @@
 import sqlite3
+import datetime
 from typing import List, Tuple, Optional
+from valuation import add_cost_layer, consume_layers, ensure_opening_layer
+from stock_ledger import record_movement, record_movements, record_opening_stock
+from archive import connect_with_archives, attach_archives, union_all
+from migrations import Migrator
+from records import Product, Client, Invoice, CreditNote, ClientStats, columns, as_records, as_record
+
+# Tables whose row changes are logged in change_log for the open views, with their key column
+CHANGE_LOG_TABLES = {"products": "id", "clients": "id", "invoices": "id", "client_stats": "client_id",
+                     "credit_notes": "id"}
+
+# Explicit column lists so added columns never shift the record fields
+PRODUCT_COLUMNS = columns(Product)
+CLIENT_COLUMNS = columns(Client)
+INVOICE_COLUMNS = columns(Invoice)
+CREDIT_NOTE_COLUMNS = columns(CreditNote)
+CLIENT_STATS_COLUMNS = columns(ClientStats)
+
+
+def rebuild_product_sales_monthly(cursor):
+    """Recompute product_sales_monthly from the daily rollup."""
+    cursor.execute("DELETE FROM product_sales_monthly")
+    cursor.execute("""
+        INSERT INTO product_sales_monthly (product_id, month, units, revenue)
+        SELECT product_id, substr(day, 1, 7), SUM(units), SUM(revenue)
+        FROM product_sales_daily
+        GROUP BY product_id, substr(day, 1, 7)
+    """)
+
+
+def rebuild_client_sales_monthly(cursor):
+    """Recompute client_sales_monthly from the daily rollup."""
+    cursor.execute("DELETE FROM client_sales_monthly")
+    cursor.execute("""
+        INSERT INTO client_sales_monthly (client_id, month, invoices, subtotal, tax, total)
+        SELECT client_id, substr(day, 1, 7), SUM(invoices), SUM(subtotal), SUM(tax), SUM(total)
+        FROM client_sales_daily
+        GROUP BY client_id, substr(day, 1, 7)
+    """)
+
 
 class Database:
     def __init__(self, db_name: str = "inventory.db"):
         self.db_name = db_name
         self.create_tables()
+        Migrator(db_name).upgrade()  # Schema changes only; their backfills run in the background
+        self.create_change_log_triggers()
         self.add_sample_products_if_empty()
         self.add_sample_clients_if_empty()
     
     def create_tables(self):
-        """Create necessary tables if they don't exist."""
+        """Create the base tables if they don't exist; later tables come with their migration (migrations.py)."""
         with sqlite3.connect(self.db_name) as conn:
             cursor = conn.cursor()
+            # New files free deleted pages in small steps (DatabaseMaintenance); no effect on existing ones
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            # WAL (persistent in the file): readers keep working while a write is in progress
+            cursor.execute("PRAGMA journal_mode=WAL")
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS products (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -46,7 +92,228 @@ class Database:
                     FOREIGN KEY(client_id) REFERENCES clients(id)
                 )
             """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS invoice_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    invoice_id INTEGER NOT NULL,
+                    product_id INTEGER,
+                    serial_number TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    price REAL NOT NULL,
+                    subtotal REAL NOT NULL,
+                    FOREIGN KEY(invoice_id) REFERENCES invoices(id)
+                )
+            """)
+            self._ensure_column(cursor, "invoice_items", "cost", "REAL NOT NULL DEFAULT 0")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice ON invoice_items(invoice_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_invoice_items_product ON invoice_items(product_id)")
+            # Returns against an invoice; counted in the sales rollups as negative sales on their own date
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS credit_notes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    invoice_id INTEGER NOT NULL,
+                    client_id INTEGER,
+                    client_name TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    subtotal REAL NOT NULL,
+                    tax REAL NOT NULL,
+                    total REAL NOT NULL,
+                    reason TEXT
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_credit_notes_invoice ON credit_notes(invoice_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_credit_notes_date ON credit_notes(date)")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS credit_note_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    credit_note_id INTEGER NOT NULL,
+                    product_id INTEGER,
+                    serial_number TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    price REAL NOT NULL,
+                    subtotal REAL NOT NULL,
+                    cost REAL NOT NULL,
+                    FOREIGN KEY(credit_note_id) REFERENCES credit_notes(id)
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_credit_note_items_note ON credit_note_items(credit_note_id)")
+            # Closed years moved to their own files by InvoiceArchive, and the lifetime
+            # client totals of what was moved (client_stats is rebuilt from both)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS invoice_archives (
+                    year TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    archived_at TEXT NOT NULL,
+                    invoices INTEGER NOT NULL,
+                    credit_notes INTEGER NOT NULL
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS archived_client_totals (
+                    client_id INTEGER PRIMARY KEY,
+                    invoices INTEGER NOT NULL,
+                    total REAL NOT NULL,
+                    first_purchase TEXT,
+                    last_purchase TEXT
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices(date)")
+            # Case-insensitive name index for prefix lookups (client selector)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_clients_name ON clients(name COLLATE NOCASE)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_invoices_client ON invoices(client_id, date)")
+            # Received stock with its unit cost; sales consume the open layers
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS cost_layers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    product_id INTEGER NOT NULL,
+                    received_at TEXT NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    remaining INTEGER NOT NULL,
+                    unit_cost REAL NOT NULL,
+                    source TEXT NOT NULL,
+                    FOREIGN KEY(product_id) REFERENCES products(id)
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_cost_layers_product ON cost_layers(product_id, remaining)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_cost_layers_received ON cost_layers(received_at)")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS valuation_periods (
+                    period TEXT PRIMARY KEY,
+                    closed_at TEXT NOT NULL,
+                    revenue REAL NOT NULL,
+                    cogs REAL NOT NULL,
+                    receipts REAL NOT NULL,
+                    closing_value REAL NOT NULL
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS valuation_snapshots (
+                    period TEXT NOT NULL,
+                    product_id INTEGER NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (period, product_id)
+                ) WITHOUT ROWID
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS invoice_documents (
+                    hash TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    created TEXT NOT NULL
+                )
+            """)
+            # Physical count sessions; each counter's counts are saved at checkpoints (stocktake.py)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS stocktake_sessions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    started_at TEXT NOT NULL,
+                    start_movement INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    closed_at TEXT
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS stocktake_counts (
+                    session_id INTEGER NOT NULL,
+                    product_id INTEGER NOT NULL,
+                    counter TEXT NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    counted_at TEXT NOT NULL,
+                    PRIMARY KEY (session_id, product_id, counter)
+                ) WITHOUT ROWID
+            """)
+            # Purchase orders and the goods receipts posted against them (purchasing.py)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS purchase_orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    supplier TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    notes TEXT
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchase_orders_status ON purchase_orders(status)")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS purchase_order_lines (
+                    order_id INTEGER NOT NULL,
+                    product_id INTEGER NOT NULL,
+                    ordered INTEGER NOT NULL,
+                    received INTEGER NOT NULL DEFAULT 0,
+                    unit_cost REAL NOT NULL,
+                    PRIMARY KEY (order_id, product_id)
+                ) WITHOUT ROWID
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS goods_receipts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_id INTEGER NOT NULL,
+                    received_at TEXT NOT NULL,
+                    reference TEXT,
+                    lines INTEGER NOT NULL,
+                    units INTEGER NOT NULL,
+                    cost REAL NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_goods_receipts_order ON goods_receipts(order_id)")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS goods_receipt_lines (
+                    receipt_id INTEGER NOT NULL,
+                    product_id INTEGER NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    unit_cost REAL NOT NULL,
+                    PRIMARY KEY (receipt_id, product_id)
+                ) WITHOUT ROWID
+            """)
+            # Runs of DatabaseMaintenance, with the file sizes before and after
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS maintenance_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    started_at TEXT NOT NULL,
+                    task TEXT NOT NULL,
+                    duration REAL NOT NULL,
+                    size_before INTEGER NOT NULL,
+                    size_after INTEGER NOT NULL,
+                    wal_before INTEGER NOT NULL,
+                    wal_after INTEGER NOT NULL,
+                    detail TEXT
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_maintenance_log_task ON maintenance_log(task, started_at)")
+            # Row-level change log read by ChangeBus; filled by triggers so every writer is covered
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS change_log (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tbl TEXT NOT NULL,
+                    op TEXT NOT NULL,
+                    row_id INTEGER NOT NULL
+                )
+            """)
+            conn.commit()
+
+    def create_change_log_triggers(self):
+        """Triggers filling change_log; run after the migrations, which create some of the logged tables."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            for table, key in CHANGE_LOG_TABLES.items():
+                for op, ref in (("insert", "NEW"), ("update", "NEW"), ("delete", "OLD")):
+                    cursor.execute(f"""
+                        CREATE TRIGGER IF NOT EXISTS {table}_{op}_log AFTER {op.upper()} ON {table}
+                        BEGIN
+                            INSERT INTO change_log (tbl, op, row_id) VALUES ('{table}', '{op}', {ref}.{key});
+                        END
+                    """)
             conn.commit()
+
+    def _ensure_column(self, cursor, table, column, declaration):
+        """Add a column to an existing table if it is missing."""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
     
     def add_product(self, serial_number: str, name: str, quantity: int, cost: float, price: float) -> bool:
         """Add a new product to the database."""
@@ -57,53 +324,82 @@ class Database:
                     INSERT INTO products (serial_number, name, quantity, cost, price)
                     VALUES (?, ?, ?, ?, ?)
                 """, (serial_number, name, quantity, cost, price))
+                product_id = cursor.lastrowid
+                add_cost_layer(cursor, product_id, quantity, cost, "initial")
+                record_movement(cursor, product_id, quantity, "receipt")
                 conn.commit()
                 return True
         except sqlite3.IntegrityError:
             return False
     
-    def search_products(self, search_term: str, search_type: str) -> List[Tuple]:
+    def search_products(self, search_term: str, search_type: str) -> List[Product]:
         """Search products based on the search term and type."""
         with sqlite3.connect(self.db_name) as conn:
             cursor = conn.cursor()
             
             if search_type == "Nombre":
-                cursor.execute("""
-                    SELECT * FROM products 
+                cursor.execute(f"""
+                    SELECT {PRODUCT_COLUMNS} FROM products 
                     WHERE name LIKE ?
                     ORDER BY name
                 """, (f"%{search_term}%",))
             elif search_type == "Número de Serie":
-                cursor.execute("""
-                    SELECT * FROM products 
+                cursor.execute(f"""
+                    SELECT {PRODUCT_COLUMNS} FROM products 
                     WHERE serial_number LIKE ?
                     ORDER BY serial_number
                 """, (f"%{search_term}%",))
             elif search_type == "ID":
                 try:
                     product_id = int(search_term)
-                    cursor.execute("""
-                        SELECT * FROM products 
+                    cursor.execute(f"""
+                        SELECT {PRODUCT_COLUMNS} FROM products 
                         WHERE id = ?
                     """, (product_id,))
                 except ValueError:
                     return []
             
-            return cursor.fetchall()
+            return as_records(Product, cursor.fetchall())
     
-    def get_all_products(self) -> List[Tuple]:
+    def _rows_by_ids(self, table, record_type, ids, order_by):
+        """Records of `table` with the given ids, in chunks below SQLite's parameter limit."""
+        rows = []
+        ids = list(ids)
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                cursor.execute(f"SELECT {columns(record_type)} FROM {table} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+                rows.extend(as_records(record_type, cursor.fetchall()))
+        rows.sort(key=order_by)
+        return rows
+
+    def get_products_by_ids(self, ids) -> List[Product]:
+        """Get the products with the given ids (missing ids are skipped)."""
+        return self._rows_by_ids("products", Product, ids, lambda p: p.name)
+
+    def get_all_products(self) -> List[Product]:
         """Get all products from the database."""
         with sqlite3.connect(self.db_name) as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM products ORDER BY name")
-            return cursor.fetchall()
+            cursor.execute(f"SELECT {PRODUCT_COLUMNS} FROM products ORDER BY name")
+            return as_records(Product, cursor.fetchall())
     
     def update_product(self, product_id: int, serial_number: str, name: str, 
-                      quantity: int, cost: float, price: float) -> bool:
-        """Update an existing product."""
+                      quantity: int, cost: float, price: float, costing_method: str = "average") -> bool:
+        """Update an existing product. Quantity changes add or consume cost layers."""
         try:
             with sqlite3.connect(self.db_name) as conn:
                 cursor = conn.cursor()
+                cursor.execute("SELECT quantity FROM products WHERE id = ?", (product_id,))
+                row = cursor.fetchone()
+                if row is not None:
+                    ensure_opening_layer(cursor, product_id, row[0])
+                    if quantity > row[0]:
+                        add_cost_layer(cursor, product_id, quantity - row[0], cost, "adjustment")
+                    elif quantity < row[0]:
+                        consume_layers(cursor, product_id, row[0] - quantity, costing_method)
+                    record_movement(cursor, product_id, quantity - row[0], "adjustment")
                 cursor.execute("""
                     UPDATE products 
                     SET serial_number = ?, name = ?, quantity = ?, cost = ?, price = ?
@@ -114,6 +410,94 @@ class Database:
         except sqlite3.IntegrityError:
             return False
     
+    def update_products(self, products, costing_method: str = "average") -> Tuple[bool, object]:
+        """
+        Save several edited products in one transaction. products: (id, serial_number, name,
+        quantity, cost, price) rows. Quantity changes add or consume cost layers as in
+        update_product. Returns (True, products saved) or (False, error message), in which
+        case nothing is saved.
+        """
+        products = list(products)
+        try:
+            with sqlite3.connect(self.db_name) as conn:
+                cursor = conn.cursor()
+                ids = [p[0] for p in products]
+                current = {}
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    cursor.execute(f"SELECT id, quantity FROM products WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+                    current.update(cursor.fetchall())
+                moved = []
+                for product_id, serial_number, name, quantity, cost, price in products:
+                    if product_id not in current:
+                        return False, f"Producto con ID {product_id} no encontrado."
+                    old = current[product_id]
+                    if quantity != old:
+                        ensure_opening_layer(cursor, product_id, old)
+                        if quantity > old:
+                            add_cost_layer(cursor, product_id, quantity - old, cost, "adjustment")
+                        else:
+                            consume_layers(cursor, product_id, old - quantity, costing_method)
+                        moved.append((product_id, quantity - old))
+                cursor.executemany("""
+                    UPDATE products SET serial_number = ?, name = ?, quantity = ?, cost = ?, price = ?
+                    WHERE id = ?
+                """, [(serial_number, name, quantity, cost, price, product_id)
+                      for product_id, serial_number, name, quantity, cost, price in products])
+                record_movements(cursor, moved, "adjustment")
+                conn.commit()
+                return True, len(products)
+        except sqlite3.IntegrityError as e:
+            return False, f"Número de serie repetido ({e})."
+
+    def _product_filter(self, search_term, search_type):
+        """WHERE clause and parameters matching search_products (every product without a term)."""
+        if not search_term:
+            return "1", ()
+        if search_type == "ID":
+            try:
+                return "id = ?", (int(search_term),)
+            except ValueError:
+                return "0", ()
+        column = "serial_number" if search_type == "Número de Serie" else "name"
+        return f"{column} LIKE ?", (f"%{search_term}%",)
+
+    def adjust_prices(self, percent: float, field: str = "price", search_term: str = "",
+                      search_type: str = "Nombre") -> int:
+        """
+        Raise (or lower, with a negative percent) the price or cost of every product matching
+        a search, in a single UPDATE. Returns the number of products changed.
+        """
+        if field not in ("price", "cost"):
+            raise ValueError(f"Campo no válido: {field}")
+        where, params = self._product_filter(search_term, search_type)
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            # Prices stay positive, as the product form requires
+            cursor.execute(f"UPDATE products SET {field} = MAX(ROUND({field} * ?, 2), 0.01) WHERE {where}",
+                           (1 + percent / 100.0,) + params)
+            conn.commit()
+            return cursor.rowcount
+
+    def receive_stock(self, product_id: int, quantity: int, unit_cost: float, source: str = "receipt") -> bool:
+        """Add received stock as a new cost layer and update the product's last cost."""
+        try:
+            with sqlite3.connect(self.db_name) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT quantity FROM products WHERE id = ?", (product_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return False
+                ensure_opening_layer(cursor, product_id, row[0])
+                add_cost_layer(cursor, product_id, quantity, unit_cost, source)
+                cursor.execute("UPDATE products SET quantity = quantity + ?, cost = ? WHERE id = ?",
+                               (quantity, unit_cost, product_id))
+                record_movement(cursor, product_id, quantity, "receipt", source)
+                conn.commit()
+                return True
+        except sqlite3.Error:
+            return False
+
     def delete_product(self, product_id: int) -> bool:
         """Delete a product from the database."""
         try:
@@ -158,6 +542,7 @@ class Database:
                     "INSERT INTO products (serial_number, name, quantity, cost, price) VALUES (?, ?, ?, ?, ?)",
                     products
                 )
+                record_opening_stock(cursor)
                 conn.commit()
     
     def add_client(self, name: str, identity_id: str, rtn: str, phone: str, email: str, city: str) -> bool:
@@ -174,38 +559,65 @@ class Database:
         except sqlite3.IntegrityError:
             return False
 
-    def get_all_clients(self) -> List[Tuple]:
+    def get_clients_by_ids(self, ids) -> List[Client]:
+        """Get the clients with the given ids (missing ids are skipped)."""
+        return self._rows_by_ids("clients", Client, ids, lambda c: c.name)
+
+    def get_all_clients(self) -> List[Client]:
         """Get all clients from the database."""
         with sqlite3.connect(self.db_name) as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM clients ORDER BY name")
-            return cursor.fetchall()
+            cursor.execute(f"SELECT {CLIENT_COLUMNS} FROM clients ORDER BY name")
+            return as_records(Client, cursor.fetchall())
 
-    def search_clients(self, search_term: str, search_type: str) -> List[Tuple]:
+    def search_clients(self, search_term: str, search_type: str) -> List[Client]:
         """Search clients based on the search term and type."""
         with sqlite3.connect(self.db_name) as conn:
             cursor = conn.cursor()
             
             if search_type == "Nombre":
-                cursor.execute("""
-                    SELECT * FROM clients 
+                cursor.execute(f"""
+                    SELECT {CLIENT_COLUMNS} FROM clients 
                     WHERE name LIKE ?
                     ORDER BY name
                 """, (f"%{search_term}%",))
             elif search_type == "ID":
-                cursor.execute("""
-                    SELECT * FROM clients 
+                cursor.execute(f"""
+                    SELECT {CLIENT_COLUMNS} FROM clients 
                     WHERE identity_id LIKE ?
                     ORDER BY identity_id
                 """, (f"%{search_term}%",))
             elif search_type == "RTN":
-                cursor.execute("""
-                    SELECT * FROM clients 
+                cursor.execute(f"""
+                    SELECT {CLIENT_COLUMNS} FROM clients 
                     WHERE rtn LIKE ?
                     ORDER BY rtn
                 """, (f"%{search_term}%",))
             
-            return cursor.fetchall()
+            return as_records(Client, cursor.fetchall())
+
+    def find_clients_by_prefix(self, prefix: str, limit: int = 20) -> List[Client]:
+        """
+        Clients whose name starts with prefix (case-insensitive), or whose identity id does
+        when the prefix starts with a digit. Both are index range scans, so the first
+        matches come back in milliseconds whatever the number of clients.
+        """
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            if prefix[:1].isdigit():
+                cursor.execute(f"""
+                    SELECT {CLIENT_COLUMNS} FROM clients
+                    WHERE identity_id >= ? AND identity_id < ?
+                    ORDER BY identity_id LIMIT ?
+                """, (prefix, prefix + "\uffff", limit))
+            else:
+                pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                cursor.execute(f"""
+                    SELECT {CLIENT_COLUMNS} FROM clients
+                    WHERE name LIKE ? ESCAPE '\\'
+                    ORDER BY name COLLATE NOCASE LIMIT ?
+                """, (pattern, limit))
+            return as_records(Client, cursor.fetchall())
 
     def update_client(self, client_id: int, name: str, identity_id: str, 
                      rtn: str, phone: str, email: str, city: str) -> bool:
@@ -279,6 +691,149 @@ class Database:
                 )
                 conn.commit()
 
+    def _add_client_sale(self, cursor, client_id, date, total):
+        """Count a new invoice in the client's lifetime statistics."""
+        if client_id is None:
+            return
+        cursor.execute("""
+            INSERT INTO client_stats (client_id, invoice_count, lifetime_total, first_purchase, last_purchase)
+            VALUES (?, 1, ?, ?, ?)
+            ON CONFLICT(client_id) DO UPDATE SET
+                invoice_count = invoice_count + 1,
+                lifetime_total = lifetime_total + excluded.lifetime_total,
+                first_purchase = MIN(first_purchase, excluded.first_purchase),
+                last_purchase = MAX(last_purchase, excluded.last_purchase)
+        """, (client_id, total, date, date))
+
+    def _remove_client_sale(self, cursor, client_id, total):
+        """Take a deleted invoice out of the client's statistics (call after deleting the row)."""
+        if client_id is None:
+            return
+        # First and last purchase come from the (client_id, date) index and the archived totals
+        cursor.execute("""
+            UPDATE client_stats SET
+                invoice_count = invoice_count - 1,
+                lifetime_total = lifetime_total - :total,
+                first_purchase = COALESCE((SELECT MIN(d) FROM (
+                    SELECT MIN(date) AS d FROM invoices WHERE client_id = :client
+                    UNION ALL SELECT first_purchase FROM archived_client_totals WHERE client_id = :client
+                )), first_purchase),
+                last_purchase = COALESCE((SELECT MAX(d) FROM (
+                    SELECT MAX(date) AS d FROM invoices WHERE client_id = :client
+                    UNION ALL SELECT last_purchase FROM archived_client_totals WHERE client_id = :client
+                )), last_purchase)
+            WHERE client_id = :client
+        """, {"total": total, "client": client_id})
+        cursor.execute("DELETE FROM client_stats WHERE client_id = ? AND invoice_count <= 0", (client_id,))
+
+    def _add_client_sales_day(self, cursor, client_id, date, subtotal, tax, total, sign=1, invoices=None):
+        """
+        Add (sign=1) or remove (sign=-1) an invoice from the client_sales_daily/monthly rollups.
+        A credit note is removed with invoices=0: its amounts come off, the invoice count stays.
+        """
+        invoices = sign if invoices is None else invoices
+        for table, period in (("client_sales_daily", "day"), ("client_sales_monthly", "month")):
+            bucket = "date(?)" if period == "day" else "substr(date(?), 1, 7)"
+            cursor.execute(f"""
+                INSERT INTO {table} (client_id, {period}, invoices, subtotal, tax, total)
+                VALUES (?, {bucket}, ?, ?, ?, ?)
+                ON CONFLICT(client_id, {period}) DO UPDATE SET
+                    invoices = invoices + excluded.invoices,
+                    subtotal = subtotal + excluded.subtotal,
+                    tax = tax + excluded.tax,
+                    total = total + excluded.total
+            """, (client_id or 0, date, invoices, sign * subtotal, sign * tax, sign * total))
+            if sign < 0:
+                # Days with only credit notes keep their (negative) row
+                cursor.execute(f"""
+                    DELETE FROM {table} WHERE client_id = ? AND {period} = {bucket}
+                    AND invoices <= 0 AND ABS(total) < 0.005
+                """, (client_id or 0, date))
+
+    def _rebuild_client_sales_daily(self, cursor):
+        # Days of archived years are kept: their invoices are no longer here
+        cursor.execute("DELETE FROM client_sales_daily WHERE substr(day, 1, 4) NOT IN (SELECT year FROM invoice_archives)")
+        cursor.execute("""
+            INSERT INTO client_sales_daily (client_id, day, invoices, subtotal, tax, total)
+            SELECT client_id, day, SUM(invoices), SUM(subtotal), SUM(tax), SUM(total) FROM (
+                SELECT COALESCE(client_id, 0) AS client_id, date(date) AS day, 1 AS invoices, subtotal, tax, total
+                FROM invoices
+                UNION ALL
+                SELECT COALESCE(client_id, 0), date(date), 0, -subtotal, -tax, -total FROM credit_notes
+            )
+            WHERE substr(day, 1, 4) NOT IN (SELECT year FROM invoice_archives)
+            GROUP BY client_id, day
+        """)
+        rebuild_client_sales_monthly(cursor)
+
+    def _rebuild_client_stats(self, cursor):
+        cursor.execute("DELETE FROM client_stats")
+        cursor.execute("""
+            INSERT INTO client_stats (client_id, invoice_count, lifetime_total, first_purchase, last_purchase)
+            SELECT client_id, SUM(invoices), SUM(total), MIN(first_purchase), MAX(last_purchase) FROM (
+                SELECT client_id, COUNT(*) AS invoices, SUM(total) AS total,
+                       MIN(date) AS first_purchase, MAX(date) AS last_purchase
+                FROM invoices WHERE client_id IS NOT NULL GROUP BY client_id
+                UNION ALL
+                SELECT client_id, 0, -SUM(total), NULL, NULL FROM credit_notes
+                WHERE client_id IS NOT NULL GROUP BY client_id
+                UNION ALL
+                SELECT client_id, invoices, total, first_purchase, last_purchase FROM archived_client_totals
+            )
+            GROUP BY client_id HAVING SUM(invoices) > 0
+        """)
+
+    def rebuild_client_stats(self):
+        """Recompute client_stats and client_sales_daily from the invoices. Returns the number of clients with purchases."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            self._rebuild_client_stats(cursor)
+            self._rebuild_client_sales_daily(cursor)
+            conn.commit()
+            cursor.execute("SELECT COUNT(*) FROM client_stats")
+            return cursor.fetchone()[0]
+
+    def get_client_stats(self, client_id) -> Optional[ClientStats]:
+        """Lifetime statistics of one client (None if they never bought)."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {CLIENT_STATS_COLUMNS} FROM client_stats WHERE client_id = ?", (client_id,))
+            return as_record(ClientStats, cursor.fetchone())
+
+    def get_client_stats_by_ids(self, client_ids) -> List[ClientStats]:
+        rows = []
+        client_ids = list(client_ids)
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            for i in range(0, len(client_ids), 500):
+                chunk = client_ids[i:i + 500]
+                cursor.execute(f"""
+                    SELECT {CLIENT_STATS_COLUMNS} FROM client_stats
+                    WHERE client_id IN ({','.join('?' * len(chunk))})
+                """, chunk)
+                rows.extend(as_records(ClientStats, cursor.fetchall()))
+        return rows
+
+    def get_all_client_stats(self) -> List[ClientStats]:
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {CLIENT_STATS_COLUMNS} FROM client_stats")
+            return as_records(ClientStats, cursor.fetchall())
+
+    def top_clients(self, limit=20) -> List[Tuple[Client, ClientStats]]:
+        """Best clients by lifetime total, read from the client_stats total index."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT {columns(Client, 'c')}, {columns(ClientStats, 's')}
+                FROM client_stats s JOIN clients c ON c.id = s.client_id
+                ORDER BY s.lifetime_total DESC
+                LIMIT ?
+            """, (limit,))
+            width = len(Client._fields)
+            return [(as_record(Client, row[:width]), as_record(ClientStats, row[width:]))
+                    for row in cursor.fetchall()]
+
     def add_invoice(self, client_id, client_name, date, subtotal, tax, total, file_path):
         with sqlite3.connect(self.db_name) as conn:
             cursor = conn.cursor()
@@ -286,89 +841,406 @@ class Database:
                 INSERT INTO invoices (client_id, client_name, date, subtotal, tax, total, file_path)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             """, (client_id, client_name, date, subtotal, tax, total, file_path))
+            invoice_id = cursor.lastrowid
+            self._add_client_sale(cursor, client_id, date, total)
+            self._add_client_sales_day(cursor, client_id, date, subtotal, tax, total)
             conn.commit()
-            return cursor.lastrowid
+            return invoice_id
 
     def get_all_invoices(self):
         with sqlite3.connect(self.db_name) as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM invoices ORDER BY date DESC")
-            return cursor.fetchall()
+            cursor.execute(f"SELECT {INVOICE_COLUMNS} FROM invoices ORDER BY date DESC")
+            return as_records(Invoice, cursor.fetchall())
+
+    def get_invoices_by_ids(self, ids):
+        return self._rows_by_ids("invoices", Invoice, ids, lambda i: i.date)
 
     def get_invoice_by_id(self, invoice_id):
-        with sqlite3.connect(self.db_name) as conn:
+        """An invoice, from the hot database or else from the archived years."""
+        with connect_with_archives(self.db_name) as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM invoices WHERE id = ?", (invoice_id,))
-            return cursor.fetchone()
+            schemas = self._partitions_of(cursor, "invoices", invoice_id)
+            cursor.execute(union_all(schemas, f"SELECT {INVOICE_COLUMNS} FROM {{schema}}.invoices WHERE id = :id"),
+                           {"id": invoice_id})
+            return as_record(Invoice, cursor.fetchone())
+
+    def _partitions_of(self, cursor, table, row_id):
+        """Only the hot database if the row is there, otherwise it and every archived year."""
+        cursor.execute(f"SELECT 1 FROM {table} WHERE id = ?", (row_id,))
+        if cursor.fetchone() is not None:
+            return ["main"]
+        return attach_archives(cursor, self.db_name)
 
     def search_invoices(self, search_term, search_type):
         """Search invoices based on the search term and type."""
         with sqlite3.connect(self.db_name) as conn:
             cursor = conn.cursor()
             if search_type == "Cliente":
-                cursor.execute("SELECT * FROM invoices WHERE client_name LIKE ?", (f"%{search_term}%",))
+                cursor.execute(f"SELECT {INVOICE_COLUMNS} FROM invoices WHERE client_name LIKE ?", (f"%{search_term}%",))
             else:  # ID Factura
                 try:
                     invoice_id = int(search_term)
-                    cursor.execute("SELECT * FROM invoices WHERE id = ?", (invoice_id,))
+                    cursor.execute(f"SELECT {INVOICE_COLUMNS} FROM invoices WHERE id = ?", (invoice_id,))
                 except ValueError:
                     return []
-            return cursor.fetchall()
+            return as_records(Invoice, cursor.fetchall())
 
     def delete_invoice(self, invoice_id):
-        """Delete an invoice from the database."""
+        """
+        Delete an invoice, its line items and its share of the sales rollup and client statistics.
+        Invoices with credit notes are kept (returns are undone with their own records).
+        """
         try:
             with sqlite3.connect(self.db_name) as conn:
                 cursor = conn.cursor()
-                cursor.execute("DELETE FROM invoices WHERE id = ?", (invoice_id,))
+                cursor.execute("SELECT 1 FROM credit_notes WHERE invoice_id = ? LIMIT 1", (invoice_id,))
+                if cursor.fetchone() is not None:
+                    return False
+                # Archived invoices are read-only
+                cursor.execute("SELECT 1 FROM invoices WHERE id = ?", (invoice_id,))
+                if cursor.fetchone() is None:
+                    return False
+                self._delete_invoice(cursor, invoice_id)
                 conn.commit()
                 return True
         except sqlite3.Error:
             return False
 
+    def _delete_invoice(self, cursor, invoice_id):
+        """Body of delete_invoice, inside the caller's transaction."""
+        cursor.execute("SELECT client_id, total, date, subtotal, tax FROM invoices WHERE id = ?", (invoice_id,))
+        invoice = cursor.fetchone()
+        cursor.execute("""
+            SELECT i.product_id, date(v.date), SUM(i.quantity), SUM(i.subtotal)
+            FROM invoice_items i JOIN invoices v ON v.id = i.invoice_id
+            WHERE i.invoice_id = ? AND i.product_id IS NOT NULL
+            GROUP BY i.product_id, date(v.date)
+        """, (invoice_id,))
+        sold = cursor.fetchall()
+        cursor.executemany("""
+            UPDATE product_sales_daily SET units = units - ?, revenue = revenue - ?
+            WHERE product_id = ? AND day = ?
+        """, [(units, revenue, product_id, day) for product_id, day, units, revenue in sold])
+        cursor.executemany("""
+            UPDATE product_sales_monthly SET units = units - ?, revenue = revenue - ?
+            WHERE product_id = ? AND month = substr(?, 1, 7)
+        """, [(units, revenue, product_id, day) for product_id, day, units, revenue in sold])
+        # Only the keys this invoice touched; days with only returns keep their (negative) row
+        cursor.executemany("""
+            DELETE FROM product_sales_daily
+            WHERE product_id = ? AND day = ? AND units = 0 AND ABS(revenue) < 0.005
+        """, [(product_id, day) for product_id, day, _, _ in sold])
+        cursor.executemany("""
+            DELETE FROM product_sales_monthly
+            WHERE product_id = ? AND month = ? AND units = 0 AND ABS(revenue) < 0.005
+        """, sorted({(product_id, day[:7]) for product_id, day, _, _ in sold}))
+        cursor.execute("DELETE FROM invoice_items WHERE invoice_id = ?", (invoice_id,))
+        cursor.execute("DELETE FROM invoices WHERE id = ?", (invoice_id,))
+        if invoice is not None:
+            client_id, total, date, subtotal, tax = invoice
+            self._remove_client_sale(cursor, client_id, total)
+            self._add_client_sales_day(cursor, client_id, date, subtotal, tax, total, sign=-1)
+
+    # --- Credit notes (returns) ---
+    def _returnable_items(self, cursor, invoice_id):
+        cursor.execute("""
+            SELECT i.product_id, MIN(i.serial_number), MIN(i.name), SUM(i.quantity),
+                   COALESCE((SELECT SUM(c.quantity) FROM credit_note_items c
+                             JOIN credit_notes n ON n.id = c.credit_note_id
+                             WHERE n.invoice_id = i.invoice_id AND c.product_id = i.product_id), 0),
+                   SUM(i.subtotal) / SUM(i.quantity), SUM(i.cost) / SUM(i.quantity)
+            FROM invoice_items i
+            WHERE i.invoice_id = ? AND i.product_id IS NOT NULL
+            GROUP BY i.product_id
+            ORDER BY MIN(i.id)
+        """, (invoice_id,))
+        return cursor.fetchall()
+
+    def returnable_items(self, invoice_id):
+        """Products of an invoice: [(product_id, serial, name, sold, already returned, unit price, unit cost)]."""
+        with sqlite3.connect(self.db_name) as conn:
+            return self._returnable_items(conn.cursor(), invoice_id)
+
+    def create_credit_note(self, invoice_id, lines=None, reason="", date=None):
+        """
+        Return goods of an invoice. lines: [(product_id, quantity)], None for everything not
+        returned yet. In one transaction the items go back to stock (as a cost layer at the
+        cost they were sold at), and the note is taken out of the sales rollups and client
+        statistics on its own date; tax is prorated as on the invoice.
+        Returns (True, credit note id) or (False, error message).
+        """
+        date = date or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            with sqlite3.connect(self.db_name) as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute("SELECT client_id, client_name, subtotal, tax FROM invoices WHERE id = ?", (invoice_id,))
+                invoice = cursor.fetchone()
+                if invoice is None:
+                    conn.rollback()
+                    return False, f"Factura {invoice_id} no encontrada."
+                client_id, client_name, invoice_subtotal, invoice_tax = invoice
+                items = {row[0]: row for row in self._returnable_items(cursor, invoice_id)}
+                if lines is None:
+                    lines = [(product_id, sold - returned) for product_id, _, _, sold, returned, _, _ in items.values()]
+                returned_lines = []
+                for product_id, quantity in lines:
+                    if quantity <= 0:
+                        continue
+                    if product_id not in items:
+                        conn.rollback()
+                        return False, f"El producto {product_id} no está en la factura {invoice_id}."
+                    _, serial, name, sold, returned, price, unit_cost = items[product_id]
+                    if quantity > sold - returned:
+                        conn.rollback()
+                        return False, f"Solo quedan {sold - returned} unidades de '{name}' por devolver."
+                    returned_lines.append((product_id, serial, name, quantity, price,
+                                           round(quantity * price, 2), quantity * unit_cost))
+                if not returned_lines:
+                    conn.rollback()
+                    return False, "No hay cantidades para devolver."
+                subtotal = round(sum(line[5] for line in returned_lines), 2)
+                tax = round(subtotal * invoice_tax / invoice_subtotal, 2) if invoice_subtotal else 0.0
+                total = round(subtotal + tax, 2)
+                credit_note_id = self._insert_credit_note(cursor, invoice_id, client_id, client_name, date,
+                                                          subtotal, tax, total, reason, returned_lines)
+                # Restock the products that still exist, at the cost they left with
+                restocked = []
+                for product_id, _, _, quantity, _, _, cost in returned_lines:
+                    cursor.execute("SELECT quantity FROM products WHERE id = ?", (product_id,))
+                    row = cursor.fetchone()
+                    if row is None:
+                        continue
+                    ensure_opening_layer(cursor, product_id, row[0])
+                    add_cost_layer(cursor, product_id, quantity, cost / quantity, "return", date)
+                    restocked.append((product_id, quantity))
+                cursor.executemany("UPDATE products SET quantity = quantity + ? WHERE id = ?",
+                                   [(quantity, product_id) for product_id, quantity in restocked])
+                record_movements(cursor, restocked, "return", f"NC {credit_note_id}")
+                conn.commit()
+                return True, credit_note_id
+        except sqlite3.Error as e:
+            return False, str(e)
+
+    def _insert_credit_note(self, cursor, invoice_id, client_id, client_name, date, subtotal, tax, total, reason,
+                            lines):
+        """
+        Add a credit note with its lines (product_id, serial, name, quantity, price, subtotal,
+        cost) and take it out of the sales rollups and client statistics (stock is untouched).
+        """
+        cursor.execute("""
+            INSERT INTO credit_notes (invoice_id, client_id, client_name, date, subtotal, tax, total, reason)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (invoice_id, client_id, client_name, date, subtotal, tax, total, reason))
+        credit_note_id = cursor.lastrowid
+        cursor.executemany("""
+            INSERT INTO credit_note_items (credit_note_id, product_id, serial_number, name, quantity, price, subtotal, cost)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(credit_note_id,) + tuple(line) for line in lines])
+        self._add_product_sales(cursor, [(product_id, date, -quantity, -line_subtotal)
+                                         for product_id, _, _, quantity, _, line_subtotal, _ in lines
+                                         if product_id is not None])
+        if client_id is not None:
+            cursor.execute("UPDATE client_stats SET lifetime_total = lifetime_total - ? WHERE client_id = ?",
+                           (total, client_id))
+        self._add_client_sales_day(cursor, client_id, date, subtotal, tax, total, sign=-1, invoices=0)
+        return credit_note_id
+
+    def get_credit_notes_by_invoice(self, invoice_id):
+        with connect_with_archives(self.db_name) as conn:
+            cursor = conn.cursor()
+            schemas = self._partitions_of(cursor, "invoices", invoice_id)
+            cursor.execute(union_all(schemas, f"""
+                SELECT {CREDIT_NOTE_COLUMNS} FROM {{schema}}.credit_notes WHERE invoice_id = :id
+            """) + " ORDER BY id", {"id": invoice_id})
+            return as_records(CreditNote, cursor.fetchall())
+
+    def get_credit_notes_by_date_range(self, start, end):
+        """Credit notes between start and end date (inclusive), from the date index of each year needed."""
+        with connect_with_archives(self.db_name) as conn:
+            cursor = conn.cursor()
+            schemas = attach_archives(cursor, self.db_name, start, end)
+            cursor.execute(union_all(schemas, f"""
+                SELECT {CREDIT_NOTE_COLUMNS} FROM {{schema}}.credit_notes
+                WHERE date >= date(:start) AND date < date(:end, '+1 day')
+            """) + " ORDER BY date ASC", {"start": start, "end": end})
+            return as_records(CreditNote, cursor.fetchall())
+
+    def get_credit_note_items(self, credit_note_id):
+        """[(product_id, serial, name, quantity, price, subtotal)] of a credit note."""
+        with connect_with_archives(self.db_name) as conn:
+            cursor = conn.cursor()
+            schemas = self._partitions_of(cursor, "credit_notes", credit_note_id)
+            cursor.execute(union_all(schemas, """
+                SELECT id, product_id, serial_number, name, quantity, price, subtotal FROM {schema}.credit_note_items
+                WHERE credit_note_id = :id
+            """) + " ORDER BY id", {"id": credit_note_id})
+            return [row[1:] for row in cursor.fetchall()]
+
+    def _invoices_in_range(self, cursor, start, end):
+        """Run the date range query over the hot database and the archived years it reaches."""
+        schemas = attach_archives(cursor, self.db_name, start, end)
+        cursor.execute(union_all(schemas, f"""
+            SELECT {INVOICE_COLUMNS} FROM {{schema}}.invoices WHERE date(date) >= date(:start) AND date(date) <= date(:end)
+        """) + " ORDER BY date ASC", {"start": start, "end": end})
+
     def get_invoices_by_date_range(self, start, end):
         """Get all invoices between start and end date (inclusive)."""
-        with sqlite3.connect(self.db_name) as conn:
+        with connect_with_archives(self.db_name) as conn:
             cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM invoices WHERE date(date) >= date(?) AND date(date) <= date(?) ORDER BY date ASC
-            """, (start, end))
-            return cursor.fetchall()
+            self._invoices_in_range(cursor, start, end)
+            return as_records(Invoice, cursor.fetchall())
+
+    def _client_invoices(self, cursor, client_id):
+        """Run the client's invoice query; archived years are attached only if the client has invoices there."""
+        cursor.execute("SELECT 1 FROM archived_client_totals WHERE client_id = ? AND invoices > 0", (client_id,))
+        schemas = attach_archives(cursor, self.db_name) if cursor.fetchone() is not None else ["main"]
+        cursor.execute(union_all(schemas, f"""
+            SELECT {INVOICE_COLUMNS} FROM {{schema}}.invoices WHERE client_id = :client
+        """) + " ORDER BY date ASC", {"client": client_id})
 
     def get_invoices_by_client(self, client_id):
         """Get all invoices for a specific client."""
-        with sqlite3.connect(self.db_name) as conn:
+        with connect_with_archives(self.db_name) as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM invoices WHERE client_id = ? ORDER BY date ASC", (client_id,))
-            return cursor.fetchall()
+            self._client_invoices(cursor, client_id)
+            return as_records(Invoice, cursor.fetchall())
 
-    def process_invoice_and_update_stock(self, client_id, client_name, date, items, subtotal, tax, total, file_path):
+    def process_invoice_and_update_stock(self, client_id, client_name, date, items, subtotal, tax, total, file_path,
+                                         costing_method="average"):
         """
-        items: list of dicts with keys: product_id, quantity
+        items: list of dicts with keys: product_id, quantity and optionally price
+        (the current product price is used when missing).
+        costing_method: 'average' or 'fifo', used to cost the items from their stock layers.
         Returns (True, invoice_id) on success, (False, error_message) on failure.
         """
         try:
             with sqlite3.connect(self.db_name) as conn:
                 cursor = conn.cursor()
-                # Check stock for all items
-                for item in items:
-                    cursor.execute("SELECT quantity, name FROM products WHERE id = ?", (item['product_id'],))
-                    row = cursor.fetchone()
-                    if row is None:
-                        return False, f"Producto con ID {item['product_id']} no encontrado."
-                    available_qty, prod_name = row
-                    if item['quantity'] > available_qty:
-                        return False, f"Stock insuficiente para '{prod_name}'. Disponible: {available_qty}, solicitado: {item['quantity']}"
-                # Subtract quantities
-                for item in items:
-                    cursor.execute("UPDATE products SET quantity = quantity - ? WHERE id = ?", (item['quantity'], item['product_id']))
-                # Add invoice
-                cursor.execute("""
-                    INSERT INTO invoices (client_id, client_name, date, subtotal, tax, total, file_path)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (client_id, client_name, date, subtotal, tax, total, file_path))
-                invoice_id = cursor.lastrowid
-                conn.commit()
-                return True, invoice_id
+                success, result = self._process_invoice(cursor, client_id, client_name, date, items,
+                                                        subtotal, tax, total, file_path, costing_method)
+                if success:
+                    conn.commit()
+                return success, result
         except Exception as e:
-            return False, str(e) 
\ No newline at end of file
+            return False, str(e)
+
+    def _process_invoice(self, cursor, client_id, client_name, date, items, subtotal, tax, total, file_path,
+                         costing_method):
+        # Check stock for all items
+        lines = []
+        for item in items:
+            cursor.execute("SELECT quantity, name, serial_number, price FROM products WHERE id = ?", (item['product_id'],))
+            row = cursor.fetchone()
+            if row is None:
+                return False, f"Producto con ID {item['product_id']} no encontrado."
+            available_qty, prod_name, serial, price = row
+            if item['quantity'] > available_qty:
+                return False, f"Stock insuficiente para '{prod_name}'. Disponible: {available_qty}, solicitado: {item['quantity']}"
+            price = item.get('price', price)
+            lines.append((item['product_id'], serial, prod_name, item['quantity'], price, item['quantity'] * price))
+        # Cost the sale from the stock layers, then subtract quantities
+        for n, item in enumerate(lines):
+            cost = consume_layers(cursor, item[0], item[3], costing_method)
+            lines[n] = item + (cost,)
+        for item in items:
+            cursor.execute("UPDATE products SET quantity = quantity - ? WHERE id = ?", (item['quantity'], item['product_id']))
+        invoice_id = self._insert_invoice(cursor, client_id, client_name, date, subtotal, tax, total, file_path, lines)
+        record_movements(cursor, [(item['product_id'], -item['quantity']) for item in items], "sale", invoice_id)
+        return True, invoice_id
+
+    def _insert_invoice(self, cursor, client_id, client_name, date, subtotal, tax, total, file_path, lines):
+        """Add an invoice with its lines to the table, the sales rollups and the client statistics (stock is untouched)."""
+        cursor.execute("""
+            INSERT INTO invoices (client_id, client_name, date, subtotal, tax, total, file_path)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (client_id, client_name, date, subtotal, tax, total, file_path))
+        invoice_id = cursor.lastrowid
+        self._record_invoice_items(cursor, invoice_id, date, lines)
+        self._add_client_sale(cursor, client_id, date, total)
+        self._add_client_sales_day(cursor, client_id, date, subtotal, tax, total)
+        return invoice_id
+
+    def record_sale(self, store, prefix, date, client_id, client_name, detail, items, subtotal, tax, total,
+                    costing_method="average"):
+        """
+        Process a sale and save its document (header plus the detail lines) in the invoice store,
+        named after the invoice number. Returns (success, invoice_id or error message, document reference).
+        """
+        return self.record_sales(store, [{
+            "prefix": prefix, "date": date, "client_id": client_id, "client_name": client_name,
+            "detail": detail, "items": items, "subtotal": subtotal, "tax": tax, "total": total,
+            "costing_method": costing_method,
+        }])[0]
+
+    def record_sales(self, store, sales):
+        """
+        Record several sales (dicts with the arguments of record_sale) in one transaction, so
+        they share a single commit. Each sale runs under its own savepoint: one that fails
+        (e.g. insufficient stock) is undone alone. Returns a (success, result, reference) per sale.
+        """
+        results = []
+        orphans = []  # Documents saved for sales that were undone
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")  # Savepoints below must not commit on release
+            for sale in sales:
+                cursor.execute("SAVEPOINT sale")
+                file_path = None
+                try:
+                    success, result = self._process_invoice(
+                        cursor, sale["client_id"], sale["client_name"], sale["date"], sale["items"],
+                        sale["subtotal"], sale["tax"], sale["total"], "", sale.get("costing_method", "average"))
+                    if success:
+                        # The document is named after the number the invoice actually got
+                        lines = [
+                            f"Factura N°: {result}",
+                            f"Fecha: {sale['date']}",
+                            f"Cliente: {sale['client_name']} (ID: {sale['client_id']})",
+                        ] + list(sale["detail"])
+                        file_path = store.save(f"{sale.get('prefix', 'FAC')}_{result:05d}.txt", "\n".join(lines),
+                                               sale["date"], cursor=cursor)
+                        cursor.execute("UPDATE invoices SET file_path = ? WHERE id = ?", (file_path, result))
+                except Exception as e:
+                    success, result = False, str(e)
+                if success:
+                    cursor.execute("RELEASE sale")
+                else:
+                    cursor.execute("ROLLBACK TO sale")
+                    cursor.execute("RELEASE sale")
+                    if file_path is not None:
+                        orphans.append(file_path)
+                        file_path = None
+                results.append((success, result, file_path))
+            conn.commit()
+        for ref in orphans:
+            store.delete(ref)
+        return results
+
+    def _record_invoice_items(self, cursor, invoice_id, date, lines):
+        """Store invoice lines and add them to the daily and monthly product sales rollups."""
+        cursor.executemany("""
+            INSERT INTO invoice_items (invoice_id, product_id, serial_number, name, quantity, price, subtotal, cost)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(invoice_id,) + line for line in lines])
+        self._add_product_sales(cursor, [(product_id, date, qty, line_subtotal)
+                                         for product_id, serial, name, qty, price, line_subtotal, cost in lines
+                                         if product_id is not None])
+
+    def _add_product_sales(self, cursor, sold):
+        """Add (product_id, date, units, revenue) to the daily and monthly product sales rollups."""
+        cursor.executemany("""
+            INSERT INTO product_sales_daily (product_id, day, units, revenue)
+            VALUES (?, date(?), ?, ?)
+            ON CONFLICT(product_id, day) DO UPDATE SET
+                units = units + excluded.units,
+                revenue = revenue + excluded.revenue
+        """, sold)
+        cursor.executemany("""
+            INSERT INTO product_sales_monthly (product_id, month, units, revenue)
+            VALUES (?, substr(date(?), 1, 7), ?, ?)
+            ON CONFLICT(product_id, month) DO UPDATE SET
+                units = units + excluded.units,
+                revenue = revenue + excluded.revenue
+        """, sold)
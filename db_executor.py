@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor
+from PyQt6.QtCore import QObject, pyqtSignal
+from database import Database
+
+
+class DbFuture(QObject):
+    """
+    Result of a call submitted to the DatabaseExecutor. Callbacks registered with then()
+    run on the GUI thread once the call finishes (immediately if it already has).
+    """
+    _finished = pyqtSignal(object, object)  # result, exception
+
+    def __init__(self, executor):
+        super().__init__()
+        self.executor = executor
+        self.done = False
+        self.result = None
+        self.error = None
+        self._callbacks = []
+        self._errbacks = []
+        self._finished.connect(self._deliver)  # Queued: the future lives on the GUI thread
+
+    def then(self, callback=None, error=None):
+        """callback(result) on success, error(exception) on failure; returns the future for chaining."""
+        if self.done:
+            if self.error is None and callback:
+                callback(self.result)
+            elif self.error is not None:
+                self._report(self.error, [error] if error else [])
+            return self
+        if callback:
+            self._callbacks.append(callback)
+        if error:
+            self._errbacks.append(error)
+        return self
+
+    def _deliver(self, result, error):
+        self.done = True
+        self.result = result
+        self.error = error
+        self.executor._pending.discard(self)
+        if error is None:
+            for callback in self._callbacks:
+                callback(result)
+        else:
+            self._report(error, self._errbacks)
+
+    def _report(self, error, errbacks):
+        if errbacks:
+            for errback in errbacks:
+                errback(error)
+        else:
+            self.executor.failed.emit(str(error))
+
+
+class DatabaseExecutor(QObject):
+    """
+    Runs database calls off the GUI thread. Writes go through a single writer thread, so
+    they are applied one at a time in submission order; reads run concurrently on a small
+    pool (the database is in WAL mode, so readers never wait for the writer). Long jobs
+    that take the write lock only in short steps run on their own background thread, so
+    queued writes are not held up behind them.
+    """
+    failed = pyqtSignal(str)  # Errors of calls submitted without an error callback
+
+    _instance = None
+
+    @classmethod
+    def instance(cls, db_name="inventory.db", db=None):
+        """Process-wide executor, created on first use (from the GUI thread)."""
+        if cls._instance is None:
+            cls._instance = cls(db_name, db=db)
+        return cls._instance
+
+    def __init__(self, db_name="inventory.db", readers=4, db=None):
+        super().__init__()
+        self.db = db or Database(db_name)  # Or a RemoteDatabase in server mode
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-background")
+        self._pending = set()  # Futures not yet delivered, kept alive until then
+
+    def _submit(self, pool, fn, args, kwargs):
+        future = DbFuture(self)
+        self._pending.add(future)
+
+        def run():
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                future._finished.emit(None, e)
+            else:
+                future._finished.emit(result, None)
+        pool.submit(run)
+        return future
+
+    def read(self, fn, *args, **kwargs):
+        """Run a read-only call, e.g. read(db.get_all_invoices).then(show)."""
+        return self._submit(self._readers, fn, args, kwargs)
+
+    def write(self, fn, *args, **kwargs):
+        """Run a call that modifies the database, after every write submitted before it."""
+        return self._submit(self._writer, fn, args, kwargs)
+
+    def background(self, fn, *args, **kwargs):
+        """Run a long job (e.g. database maintenance) that writes in short transactions of its own."""
+        return self._submit(self._background, fn, args, kwargs)
+
+    def submit(self, fn, *args, write=False, **kwargs):
+        return self._submit(self._writer if write else self._readers, fn, args, kwargs)
+
+    def shutdown(self):
+        """Finish the queued writes (reads in flight are dropped) and stop the threads."""
+        self._readers.shutdown(wait=False, cancel_futures=True)
+        self._background.shutdown(wait=False, cancel_futures=True)
+        self._writer.shutdown(wait=True)
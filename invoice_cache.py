@@ -0,0 +1,161 @@
+import threading
+from collections import OrderedDict
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+def render_invoice_html(content):
+    """Build the printable HTML for an invoice text file."""
+    lines = content.splitlines()
+    factura_num = lines[0].split(':', 1)[-1].strip()
+    fecha = lines[1].split(':', 1)[-1].strip()
+    cliente = lines[2].split(':', 1)[-1].strip()
+    # Find product table start
+    prod_start = 5
+    prod_lines = []
+    for i in range(prod_start + 1, len(lines)):
+        if lines[i].strip() == '' or lines[i].startswith('-'):
+            break
+        prod_lines.append(lines[i])
+    # Totals
+    subtotal = lines[-3].split(':', 1)[-1].strip()
+    isv = lines[-2].split(':', 1)[-1].strip()
+    total = lines[-1].split(':', 1)[-1].strip()
+    parts = [f'''
+    <html>
+    <head>
+    <style>
+        body {{ font-family: Arial, sans-serif; color: #222; }}
+        .header {{ font-size: 22px; font-weight: bold; margin-bottom: 10px; }}
+        .meta {{ margin-bottom: 10px; }}
+        .meta span {{ margin-right: 30px; }}
+        table {{ border-collapse: collapse; width: 100%; margin-bottom: 20px; }}
+        th, td {{ border: 1px solid #ccc; padding: 6px 10px; text-align: left; }}
+        th {{ background: #f0f0f0; }}
+        .totals td {{ border: none; font-size: 16px; }}
+        .totals tr td:first-child {{ text-align: right; }}
+    </style>
+    </head>
+    <body>
+        <div class="header">Factura N°: {factura_num}</div>
+        <div class="meta">
+            <span><b>Fecha:</b> {fecha}</span>
+            <span><b>Cliente:</b> {cliente}</span>
+        </div>
+        <table>
+            <tr><th>Cantidad</th><th>Nombre</th><th>N° Serie</th><th>Precio</th><th>Subtotal</th></tr>
+    ''']
+    for prod in prod_lines:
+        cols = prod.split()
+        if len(cols) < 5:
+            continue
+        qty = cols[0]
+        name = ' '.join(cols[1:-3])
+        serial = cols[-3]
+        price = cols[-2] + ' ' + cols[-1] if cols[-2].startswith('LPS') else cols[-2]
+        line_subtotal = cols[-1] if cols[-1].startswith('LPS') else ''
+        parts.append(f'<tr><td>{qty}</td><td>{name}</td><td>{serial}</td><td>{price}</td><td>{line_subtotal}</td></tr>')
+    parts.append(f'''
+        </table>
+        <table class="totals">
+            <tr><td><b>Subtotal:</b></td><td>{subtotal}</td></tr>
+            <tr><td><b>ISV (15%):</b></td><td>{isv}</td></tr>
+            <tr><td><b>Total:</b></td><td>{total}</td></tr>
+        </table>
+    </body>
+    </html>
+    ''')
+    return ''.join(parts)
+
+
+class RenderedInvoice:
+    """Text and printable HTML of one invoice document."""
+    __slots__ = ("invoice_id", "version", "text", "_html")
+
+    def __init__(self, invoice_id, version, text):
+        self.invoice_id = invoice_id
+        self.version = version
+        self.text = text
+        self._html = None
+
+    @property
+    def html(self):
+        # Parsing is only needed for printing, so it is done on first use
+        if self._html is None:
+            self._html = render_invoice_html(self.text)
+        return self._html
+
+
+class _PrefetchTask(QRunnable):
+    def __init__(self, cache, invoice_id, ref):
+        super().__init__()
+        self.cache = cache
+        self.invoice_id = invoice_id
+        self.ref = ref
+
+    def run(self):
+        try:
+            rendered = self.cache.load(self.invoice_id, self.ref)
+            rendered.html  # Render while we are off the GUI thread
+        except Exception:
+            pass  # The GUI will report the error if the user opens it
+        finally:
+            self.cache.prefetch_done(self.invoice_id)
+
+
+class InvoicePreviewCache(QObject):
+    """Bounded LRU cache of rendered invoices keyed by (invoice id, document version)."""
+    prefetched = pyqtSignal(int)  # Emitted when a background prefetch finishes
+
+    def __init__(self, store, max_entries=64):
+        super().__init__()
+        self.store = store
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = QThreadPool.globalInstance()
+
+    def get(self, invoice_id, ref):
+        """Return the rendered invoice, reading the document only if it changed."""
+        version = self.store.version(ref)
+        with self._lock:
+            entry = self._entries.get(invoice_id)
+            if entry is not None and entry.version == version:
+                self._entries.move_to_end(invoice_id)
+                return entry
+        return self.load(invoice_id, ref, version)
+
+    def load(self, invoice_id, ref, version=None):
+        """Read an invoice document and store it in the cache."""
+        if version is None:
+            version = self.store.version(ref)
+        rendered = RenderedInvoice(invoice_id, version, self.store.load_invoice(invoice_id, ref))
+        with self._lock:
+            self._entries[invoice_id] = rendered
+            self._entries.move_to_end(invoice_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rendered
+
+    def prefetch(self, invoices):
+        """Load (invoice_id, document reference) pairs in the background if not cached."""
+        for invoice_id, ref in invoices:
+            with self._lock:
+                if invoice_id in self._entries or invoice_id in self._pending:
+                    continue
+                self._pending.add(invoice_id)
+            self._pool.start(_PrefetchTask(self, invoice_id, ref))
+
+    def prefetch_done(self, invoice_id):
+        with self._lock:
+            self._pending.discard(invoice_id)
+        self.prefetched.emit(invoice_id)
+
+    def discard(self, invoice_id):
+        """Drop an invoice from the cache (e.g. after deleting it)."""
+        with self._lock:
+            self._entries.pop(invoice_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,272 @@
+import os
+import sqlite3
+import tempfile
+import hashlib
+import zlib
+import datetime
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+BLOB_PREFIX = "blob:"
+
+
+def atomic_write(file_path, text):
+    """Write a text file atomically (temporary file in the same folder plus rename)."""
+    folder = os.path.dirname(file_path) or "."
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=folder)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class InvoiceStore(ABC):
+    """Base document store. References stored in invoices.file_path are file paths."""
+
+    @abstractmethod
+    def save(self, name, text, date=None, cursor=None):
+        """
+        Store an invoice document and return its reference. Stores that keep documents in
+        the database write through cursor when given (inside the caller's transaction).
+        """
+
+    @abstractmethod
+    def is_native(self, ref):
+        """Whether a reference already uses this store's layout."""
+
+    @abstractmethod
+    def owns(self, ref):
+        """Whether a reference points inside this store (a blob key or a path under its folder)."""
+
+    def load(self, ref):
+        with open(ref, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def load_invoice(self, invoice_id, ref):
+        """Document of an invoice whose invoices.file_path is ref."""
+        return self.load(ref)
+
+    def version(self, ref):
+        """Cheap content version of a document (used by the preview cache)."""
+        stat = os.stat(ref)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def exists(self, ref):
+        return os.path.exists(ref)
+
+    def delete(self, ref):
+        if os.path.exists(ref):
+            os.remove(ref)
+
+
+class FlatDirectoryStore(InvoiceStore):
+    """All documents in a single folder (the original layout)."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path_for(self, name, date=None):
+        return os.path.join(self.folder, name)
+
+    def save(self, name, text, date=None, cursor=None):
+        file_path = self.path_for(name, date)
+        atomic_write(file_path, text)
+        return file_path
+
+    def is_native(self, ref):
+        return not ref.startswith(BLOB_PREFIX) and os.path.dirname(os.path.normpath(ref)) == os.path.normpath(self.folder)
+
+    def owns(self, ref):
+        return not ref.startswith(BLOB_PREFIX) and _is_under(ref, self.folder)
+
+
+class ShardedDirectoryStore(FlatDirectoryStore):
+    """Documents sharded in year/month sub-folders, e.g. invoices/2025/05/FAC_00015.txt."""
+
+    def path_for(self, name, date=None):
+        date = _parse_date(date)
+        return os.path.join(self.folder, f"{date.year:04d}", f"{date.month:02d}", name)
+
+    def is_native(self, ref):
+        if ref.startswith(BLOB_PREFIX):
+            return False
+        parts = os.path.normpath(ref).split(os.sep)
+        root = os.path.normpath(self.folder).split(os.sep)
+        return (len(parts) == len(root) + 3 and parts[:len(root)] == root
+                and parts[-3].isdigit() and parts[-2].isdigit())
+
+
+class SQLiteBlobStore(InvoiceStore):
+    """
+    Compressed, content-addressed documents in the invoice_documents table. folder is
+    where documents saved before the switch to blobs still are, if known.
+    """
+
+    def __init__(self, db_name, folder=None):
+        self.db_name = db_name
+        self.folder = folder
+
+    def save(self, name, text, date=None, cursor=None):
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        row = (digest, name, len(data), zlib.compress(data, 6), datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        # Identical documents are stored once
+        insert = """
+            INSERT OR IGNORE INTO invoice_documents (hash, name, size, data, created)
+            VALUES (?, ?, ?, ?, ?)
+        """
+        if cursor is not None:
+            cursor.execute(insert, row)  # Committed (or rolled back) with the caller's invoice
+        else:
+            with sqlite3.connect(self.db_name) as conn:
+                conn.execute(insert, row)
+                conn.commit()
+        return BLOB_PREFIX + digest
+
+    def is_native(self, ref):
+        return ref.startswith(BLOB_PREFIX)
+
+    def owns(self, ref):
+        if ref.startswith(BLOB_PREFIX):
+            return True
+        return self.folder is not None and _is_under(ref, self.folder)
+
+    def load(self, ref):
+        if not ref.startswith(BLOB_PREFIX):
+            return super().load(ref)
+        with sqlite3.connect(self.db_name) as conn:
+            row = conn.execute("SELECT data FROM invoice_documents WHERE hash = ?",
+                               (ref[len(BLOB_PREFIX):],)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"Documento no encontrado: {ref}")
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def version(self, ref):
+        if not ref.startswith(BLOB_PREFIX):
+            return super().version(ref)
+        return ref  # Content-addressed documents never change
+
+    def name_of(self, ref):
+        """Original file name of a document."""
+        if not ref.startswith(BLOB_PREFIX):
+            return os.path.basename(ref)
+        with sqlite3.connect(self.db_name) as conn:
+            row = conn.execute("SELECT name FROM invoice_documents WHERE hash = ?",
+                               (ref[len(BLOB_PREFIX):],)).fetchone()
+        return row[0] if row else None
+
+    def exists(self, ref):
+        if not ref.startswith(BLOB_PREFIX):
+            return super().exists(ref)
+        with sqlite3.connect(self.db_name) as conn:
+            return conn.execute("SELECT 1 FROM invoice_documents WHERE hash = ?",
+                                (ref[len(BLOB_PREFIX):],)).fetchone() is not None
+
+    def delete(self, ref):
+        if not ref.startswith(BLOB_PREFIX):
+            return super().delete(ref)
+        with sqlite3.connect(self.db_name) as conn:
+            # Only remove the blob when no remaining invoice points to it
+            conn.execute("""
+                DELETE FROM invoice_documents WHERE hash = ?
+                AND NOT EXISTS (SELECT 1 FROM invoices WHERE file_path = ?)
+            """, (ref[len(BLOB_PREFIX):], ref))
+            conn.commit()
+
+
+def _is_under(path, folder):
+    """Whether path resolves (links included) to a file inside folder."""
+    path, folder = os.path.realpath(path), os.path.realpath(folder)
+    return path != folder and os.path.commonpath([path, folder]) == folder
+
+
+def _parse_date(date):
+    if isinstance(date, datetime.datetime):
+        return date
+    if date:
+        try:
+            return datetime.datetime.strptime(str(date)[:10], "%Y-%m-%d")
+        except ValueError:
+            pass
+    return datetime.datetime.now()
+
+
+def create_invoice_store(storage, folder, db_name):
+    """Create the store for a storage type: 'flat', 'sharded' or 'blob'."""
+    if storage == "flat":
+        return FlatDirectoryStore(folder)
+    if storage == "blob":
+        return SQLiteBlobStore(db_name, folder)
+    return ShardedDirectoryStore(folder)
+
+
+def open_invoice_store(settings_manager, db_name="inventory.db"):
+    """Create the invoice store configured in the settings (the server's documents in server mode)."""
+    if settings_manager.get_setting("database_backend", "local") == "server":
+        from remote_database import RemoteDatabase, RemoteInvoiceStore
+        return RemoteInvoiceStore(RemoteDatabase(settings_manager.get_setting("server_url", "http://127.0.0.1:8765")))
+    return create_invoice_store(
+        settings_manager.get_setting("invoice_storage", "sharded"),
+        settings_manager.get_setting("invoice_folder", "invoices"),
+        db_name
+    )
+
+
+def _document_name(invoice_id, name):
+    """
+    Target file name of an invoice's document. Checkout names documents <prefix>_<id>.txt;
+    any other name gets the invoice id in front, so documents of two invoices that share a
+    file name do not overwrite each other in a flat or sharded folder.
+    """
+    if not name:
+        return f"FAC_{invoice_id:05d}.txt"
+    if os.path.splitext(name)[0].endswith(f"_{invoice_id:05d}"):
+        return name
+    return f"{invoice_id:05d}_{name}"
+
+
+def migrate_documents(db_name, target, workers=4, batch_size=500, progress=None):
+    """
+    Move every invoice document into the target store.
+    Documents are copied in parallel, invoices.file_path is updated in batches and
+    the old file is only removed after the new reference has been committed.
+    Returns (migrated, failed).
+    """
+    source = SQLiteBlobStore(db_name)  # Reads both file paths and blob references
+    with sqlite3.connect(db_name) as conn:
+        rows = conn.execute("SELECT id, date, file_path FROM invoices ORDER BY id").fetchall()
+    pending = [row for row in rows if not target.is_native(row[2])]
+    total = len(pending)
+
+    def copy(row):
+        invoice_id, date, ref = row
+        try:
+            text = source.load(ref)
+            name = _document_name(invoice_id, source.name_of(ref))
+            return invoice_id, ref, target.save(name, text, date)
+        except Exception:
+            return invoice_id, ref, None
+
+    migrated = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, total, batch_size):
+            results = list(executor.map(copy, pending[start:start + batch_size]))
+            done = [(new_ref, invoice_id) for invoice_id, old_ref, new_ref in results if new_ref]
+            failed += len(results) - len(done)
+            with sqlite3.connect(db_name) as conn:
+                conn.executemany("UPDATE invoices SET file_path = ? WHERE id = ?", done)
+                conn.commit()
+            for invoice_id, old_ref, new_ref in results:
+                if new_ref and new_ref != old_ref:
+                    source.delete(old_ref)
+            migrated += len(done)
+            if progress:
+                progress(migrated + failed, total)
+    return migrated, failed
@@ -4,17 +4,39 @@ from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                             QLineEdit, QComboBox, QTableWidget, QTableWidgetItem,
                             QHeaderView, QMessageBox, QFormLayout, QSpinBox, QDoubleSpinBox, 
                             QStyledItemDelegate, QDialog, QDateEdit, QScrollArea, QGroupBox, 
-                            QCheckBox, QColorDialog, QFileDialog)
-from PyQt6.QtCore import Qt, QDate
+                            QCheckBox, QColorDialog, QFileDialog, QTableView, QInputDialog,
+                            QProgressDialog)
+from PyQt6.QtCore import Qt, QDate, QTimer, pyqtSignal
 from PyQt6.QtGui import QFont, QIcon, QTextDocument, QPainter, QPixmap, QColor
 from PyQt6.QtPrintSupport import QPrinter, QPrintDialog
 from login import LoginWindow
 from database import Database
 from settings_manager import SettingsManager
-from backup_manager import BackupManager
+from backup_manager import BackupManager, MaintenanceManager
 from currency_formatter import CurrencyFormatter
+from invoice_cache import InvoicePreviewCache
+from invoice_store import open_invoice_store
+from report_printer import PagedReport, ReportPrintJob, pdf_printer
+from analytics import SalesAnalytics
+from valuation import InventoryValuation
+from stock_ledger import StockLedger
+from stocktake import StocktakeManager
+from purchasing import PurchaseOrders, read_lines_csv
+from replenishment import ReplenishmentPlanner, SERVICE_LEVELS
+from change_bus import ChangeBus, RemoteChangeBus
+from catalog import Catalog
+from records import Product
+from client_selector import ClientSelector
+from pivot import PivotEngine, DIMENSIONS, MEASURES
+from pivot_view import PivotModel, PivotJob
+from sales_chart import SalesChart
+from report_cache import ReportCache
+from db_executor import DatabaseExecutor
+from remote_database import RemoteDatabase, open_database
+from migrations import Migrator
 import datetime
 import os
+import threading
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -28,10 +50,77 @@ class CurrencyDelegate(QStyledItemDelegate):
         except Exception:
             return str(value)
 
+def format_invoice_row(inv):
+    """Printable cells and total of an Invoice."""
+    return ([inv.id, inv.client_name, inv.date,
+             f"LPS {float(inv.subtotal):,.2f}", f"LPS {float(inv.tax):,.2f}", f"LPS {float(inv.total):,.2f}"],
+            float(inv.total))
+
+def numeric_item(value, text=None):
+    """Table item that sorts by its numeric value, optionally showing formatted text."""
+    item = QTableWidgetItem()
+    item.setData(Qt.ItemDataRole.DisplayRole, value)
+    if text is not None:
+        item.setText(text)
+    return item
+
+def set_invoice_row(table, row, invoice):
+    """Write an Invoice into the ID, Cliente, Fecha, Subtotal, ISV, Total columns; returns the ID cell."""
+    table.setItem(row, 0, numeric_item(int(invoice.id)))
+    table.setItem(row, 1, QTableWidgetItem(str(invoice.client_name)))
+    table.setItem(row, 2, QTableWidgetItem(str(invoice.date)))
+    for col, amount in ((3, invoice.subtotal), (4, invoice.tax), (5, invoice.total)):
+        try:
+            table.setItem(row, col, numeric_item(float(amount), f"LPS {float(amount):,.2f}"))
+        except (ValueError, TypeError):
+            table.setItem(row, col, QTableWidgetItem(str(amount)))
+    return table.item(row, 0)
+
+def shown_rows(table, records):
+    """Records in the order the table shows them (its ID column follows the user's sorting)."""
+    by_id = {int(record.id): record for record in records}
+    rows = []
+    for row in range(table.rowCount()):
+        item = table.item(row, 0)
+        record = by_id.get(int(item.data(Qt.ItemDataRole.DisplayRole))) if item else None
+        if record is not None:
+            rows.append(record)
+    return rows
+
+def patch_table(table, row_items, op, ids, fetch, fill_row):
+    """
+    Apply a ChangeBus event to a table whose rows are keyed by record id.
+    row_items maps id -> the row's id cell (its row() follows sorting); fetch(ids) returns
+    the changed records and fill_row(row, record) writes one row and returns its id cell.
+    """
+    sorting = table.isSortingEnabled()
+    table.setSortingEnabled(False)
+    if op == "delete":
+        for record_id in ids:
+            item = row_items.pop(record_id, None)
+            if item is not None:
+                table.removeRow(item.row())
+    else:
+        for record in fetch(ids):
+            item = row_items.get(record.id)
+            if item is None:
+                row = table.rowCount()
+                table.insertRow(row)
+            else:
+                row = item.row()
+            row_items[record.id] = fill_row(row, record)
+    table.setSortingEnabled(sorting)
+
 class InventoryTab(QWidget):
-    def __init__(self):
+    # Editable columns and the Product field each one edits
+    EDITABLE_COLUMNS = {1: "serial_number", 2: "name", 3: "quantity", 4: "cost", 5: "price"}
+    EDITED_COLOR = QColor("#fff3cd")
+
+    def __init__(self, settings_manager):
         super().__init__()
-        self.db = Database()
+        self.settings_manager = settings_manager
+        self.executor = DatabaseExecutor.instance()
+        self.db = self.executor.db  # Local file or inventory server
         layout = QVBoxLayout(self)
         layout.setSpacing(20)
         
@@ -101,9 +190,34 @@ class InventoryTab(QWidget):
             }
         """)
         self.refresh_btn.clicked.connect(self.load_products)
+
+        # Inline edits are kept per cell and saved together
+        self.save_btn = QPushButton("Guardar Cambios")
+        self.save_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #2980b9;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #1c5d99;
+            }
+        """)
+        self.save_btn.clicked.connect(self.save_changes)
+        self.save_btn.setEnabled(False)
+        self.discard_btn = QPushButton("Descartar")
+        self.discard_btn.clicked.connect(self.discard_changes)
+        self.discard_btn.setEnabled(False)
+        self.adjust_btn = QPushButton("Ajustar Precios %")
+        self.adjust_btn.clicked.connect(self.adjust_prices)
         
         top_bar.addLayout(search_layout)
         top_bar.addWidget(self.refresh_btn)
+        top_bar.addWidget(self.save_btn)
+        top_bar.addWidget(self.discard_btn)
+        top_bar.addWidget(self.adjust_btn)
         top_bar.addStretch()
         
         # Table
@@ -150,52 +264,216 @@ class InventoryTab(QWidget):
         self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
         self.table.verticalHeader().setVisible(False)
         self.table.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
-        self.table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.table.setEditTriggers(QTableWidget.EditTrigger.DoubleClicked | QTableWidget.EditTrigger.EditKeyPressed)
         self.table.setSortingEnabled(True)
         
         # Set custom delegate for Costo and Precio columns
         currency_delegate = CurrencyDelegate(self.table)
         self.table.setItemDelegateForColumn(4, currency_delegate)
         self.table.setItemDelegateForColumn(5, currency_delegate)
+        self.table.itemChanged.connect(self.on_item_changed)
+
+        self.edit_status = QLabel("Doble clic en una celda para editarla; los cambios se guardan juntos.")
+        self.edit_status.setStyleSheet("color: #7f8c8d; font-size: 13px;")
         
         # Add widgets to main layout
         layout.addLayout(top_bar)
         layout.addWidget(self.table)
+        layout.addWidget(self.edit_status)
         
         # Load initial data
+        self.row_items = {}  # product id -> ID cell
+        self.products = {}   # product id -> Product as last loaded
+        self.edits = {}      # product id -> {column: edited value}, not saved yet
+        self.filling = False  # Rows being written by code, not edited
+        self.catalog = Catalog.instance(self.db.db_name)
         self.load_products()
+        self.catalog.changed.connect(self.on_data_changed)
     
     def load_products(self):
-        """Load all products from the database."""
-        products = self.db.get_all_products()
+        """Load all products from the shared catalog."""
+        products = self.catalog.products()
         self.update_table(products)
     
+    def on_data_changed(self, table, op, ids):
+        """Patch only the changed products instead of reloading the table."""
+        if table != "products":
+            return
+        if self.search_bar.text():
+            self.search_products()  # Changed rows may enter or leave the filter
+            return
+        patch_table(self.table, self.row_items, op, ids, self.catalog.products_by_ids, self.set_row)
+    
     def search_products(self):
         """Search products based on the search term and type."""
         search_term = self.search_bar.text()
         search_type = self.search_type.currentText()
         
         if search_term:
-            products = self.db.search_products(search_term, search_type)
+            products = self.catalog.search_products(search_term, search_type)
         else:
-            products = self.db.get_all_products()
+            products = self.catalog.products()
         
         self.update_table(products)
     
     def update_table(self, products):
         """Update the table with the given products."""
+        self.table.setSortingEnabled(False)
         self.table.setRowCount(len(products))
+        self.row_items = {}
         for row, product in enumerate(products):
-            for col, value in enumerate(product):
-                item = QTableWidgetItem()
-                # Numeric columns: 0 (ID), 3 (Cantidad), 4 (Costo), 5 (Precio)
-                if col in [0, 3]:
-                    item.setData(Qt.ItemDataRole.DisplayRole, int(value))
-                elif col in [4, 5]:
-                    item.setData(Qt.ItemDataRole.DisplayRole, float(value))
-                else:
-                    item.setText(str(value))
-                self.table.setItem(row, col, item)
+            self.row_items[product.id] = self.set_row(row, product)
+        self.table.setSortingEnabled(True)
+    
+    def set_row(self, row, product):
+        """Write one product into a table row and return its ID cell; unsaved edits stay shown."""
+        self.filling = True
+        self.products[product.id] = product
+        id_item = numeric_item(int(product.id))
+        id_item.setFlags(id_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
+        self.table.setItem(row, 0, id_item)
+        self.table.setItem(row, 1, QTableWidgetItem(str(product.serial_number)))
+        self.table.setItem(row, 2, QTableWidgetItem(str(product.name)))
+        self.table.setItem(row, 3, numeric_item(int(product.quantity)))
+        self.table.setItem(row, 4, numeric_item(float(product.cost)))
+        self.table.setItem(row, 5, numeric_item(float(product.price)))
+        edits = self.edits.get(product.id, {})
+        for col, value in list(edits.items()):
+            if value == getattr(product, self.EDITABLE_COLUMNS[col]):
+                del edits[col]  # The saved value caught up with the edit
+                continue
+            item = self.table.item(row, col)
+            item.setData(Qt.ItemDataRole.DisplayRole, value)
+            item.setBackground(self.EDITED_COLOR)
+        if product.id in self.edits and not edits:
+            del self.edits[product.id]
+        self.filling = False
+        return id_item
+
+    def parse_cell(self, col, value):
+        """Validated value of an edited cell, or raise ValueError with the reason."""
+        if col in (1, 2):
+            text = str(value).strip()
+            if not text:
+                raise ValueError("El número de serie y el nombre no pueden quedar vacíos.")
+            return text
+        if col == 3:
+            try:
+                quantity = int(value)
+            except (TypeError, ValueError):
+                raise ValueError("La cantidad debe ser un número entero.")
+            if quantity < 0:
+                raise ValueError("La cantidad no puede ser negativa.")
+            return quantity
+        try:
+            amount = round(float(value), 2)
+        except (TypeError, ValueError):
+            raise ValueError("El costo y el precio deben ser números.")
+        if amount <= 0:
+            raise ValueError("El costo y el precio deben ser mayores que cero.")
+        return amount
+
+    def on_item_changed(self, item):
+        """Track an edited cell: validate it and mark it while it differs from the loaded value."""
+        col = item.column()
+        if self.filling or col not in self.EDITABLE_COLUMNS:
+            return
+        product_id = int(self.table.item(item.row(), 0).data(Qt.ItemDataRole.DisplayRole))
+        original = getattr(self.products[product_id], self.EDITABLE_COLUMNS[col])
+        edits = self.edits.setdefault(product_id, {})
+        try:
+            value = self.parse_cell(col, item.data(Qt.ItemDataRole.DisplayRole))
+        except ValueError as e:
+            self.edit_status.setText(str(e))
+            value = edits.get(col, original)
+            self.filling = True
+            item.setData(Qt.ItemDataRole.DisplayRole, value)
+            self.filling = False
+        self.filling = True
+        if value == original:
+            edits.pop(col, None)
+            item.setData(Qt.ItemDataRole.BackgroundRole, None)
+        else:
+            edits[col] = value
+            item.setBackground(self.EDITED_COLOR)
+        self.filling = False
+        if not edits:
+            del self.edits[product_id]
+        self.update_edit_buttons()
+
+    def update_edit_buttons(self):
+        count = len(self.edits)
+        self.save_btn.setText(f"Guardar Cambios ({count})" if count else "Guardar Cambios")
+        self.save_btn.setEnabled(count > 0)
+        self.discard_btn.setEnabled(count > 0)
+
+    def save_changes(self):
+        """Save every edited product in one batched transaction."""
+        if not self.edits:
+            return
+        rows = []
+        for product_id, edits in self.edits.items():
+            product = self.products[product_id]._replace(
+                **{self.EDITABLE_COLUMNS[col]: value for col, value in edits.items()})
+            rows.append(tuple(product))
+        self.save_btn.setEnabled(False)
+        self.executor.write(self.db.update_products, rows,
+                            self.settings_manager.get_setting("costing_method", "average")).then(
+            lambda result, saved=rows: self.on_changes_saved(result, saved), self.on_save_failed)
+
+    def on_changes_saved(self, result, rows):
+        success, value = result
+        if not success:
+            self.on_save_failed(value)
+            return
+        # Rows must not move while they are written (the sort column may be one just saved)
+        sorting = self.table.isSortingEnabled()
+        self.table.setSortingEnabled(False)
+        for row in rows:
+            product = Product(*row)
+            self.edits.pop(product.id, None)
+            item = self.row_items.get(product.id)
+            if item is not None:
+                # Clears the marks until the change event arrives; set_row replaces the ID cell
+                self.row_items[product.id] = self.set_row(item.row(), product)
+        self.table.setSortingEnabled(sorting)
+        self.update_edit_buttons()
+        self.edit_status.setText(f"{value} productos guardados.")
+
+    def on_save_failed(self, error):
+        self.update_edit_buttons()
+        QMessageBox.warning(self, "Guardar Cambios", f"No se guardó ningún cambio: {error}")
+
+    def discard_changes(self):
+        self.edits = {}
+        self.update_edit_buttons()
+        self.search_products()
+
+    def adjust_prices(self):
+        """Raise or lower price or cost by a percentage for every product matching the search."""
+        if self.edits:
+            QMessageBox.warning(self, "Ajustar Precios", "Guarde o descarte primero los cambios pendientes.")
+            return
+        field, ok = QInputDialog.getItem(self, "Ajustar Precios", "Campo:", ["Precio", "Costo"], 0, False)
+        if not ok:
+            return
+        percent, ok = QInputDialog.getDouble(self, "Ajustar Precios", "Porcentaje (negativo para bajar):",
+                                             0.0, -90.0, 1000.0, 2)
+        if not ok or percent == 0:
+            return
+        term, search_type = self.search_bar.text(), self.search_type.currentText()
+        scope = f"los productos que coinciden con \"{term}\"" if term else "todos los productos"
+        reply = QMessageBox.question(
+            self, "Ajustar Precios",
+            f"¿Cambiar el {field.lower()} de {scope} en {percent:+.2f}%?",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+            QMessageBox.StandardButton.No
+        )
+        if reply != QMessageBox.StandardButton.Yes:
+            return
+        self.executor.write(self.db.adjust_prices, percent, "price" if field == "Precio" else "cost",
+                            term, search_type).then(
+            lambda changed: self.edit_status.setText(f"{field} ajustado en {changed} productos."))
 
 class WelcomeTab(QWidget):
     def __init__(self):
@@ -227,7 +505,9 @@ class WelcomeTab(QWidget):
 class AddProductTab(QWidget):
     def __init__(self):
         super().__init__()
-        self.db = Database()
+        self.executor = DatabaseExecutor.instance()
+        self.db = self.executor.db  # Local file or inventory server
+        self.catalog = Catalog.instance(self.db.db_name)
         layout = QVBoxLayout(self)
         layout.setAlignment(Qt.AlignmentFlag.AlignTop)
         form_layout = QFormLayout()
@@ -303,14 +583,20 @@ class AddProductTab(QWidget):
             return
 
         # Check if product exists
-        existing = self.db.search_products(serial, "Número de Serie")
+        existing = self.catalog.product_by_serial(serial)
         if existing:
             self.feedback.setText("Error: El número de serie ya existe. Use 'Actualizar producto' para modificarlo.")
             self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
             return
 
-        added = self.db.add_product(serial, name, quantity, cost, price)
+        self.add_btn.setEnabled(False)
+        self.executor.write(self.db.add_product, serial, name, quantity, cost, price).then(
+            lambda added: self.on_product_added(added, name), self.on_write_failed)
+
+    def on_product_added(self, added, name):
+        self.add_btn.setEnabled(True)
         if added:
+            self.catalog.refresh()
             self.feedback.setText(f"Producto '{name}' añadido exitosamente.")
             self.feedback.setStyleSheet("color: #27ae60; font-weight: bold; margin-top: 10px;")
             self.clear_form()
@@ -318,6 +604,11 @@ class AddProductTab(QWidget):
             self.feedback.setText("Error al añadir el producto.")
             self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
 
+    def on_write_failed(self, error):
+        self.add_btn.setEnabled(True)
+        self.feedback.setText(f"Error al añadir el producto: {error}")
+        self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
+
     def clear_form(self):
         self.serial_input.clear()
         self.name_input.clear()
@@ -326,9 +617,12 @@ class AddProductTab(QWidget):
         self.price_input.setValue(0.00)
 
 class UpdateProductTab(QWidget):
-    def __init__(self):
+    def __init__(self, settings_manager):
         super().__init__()
-        self.db = Database()
+        self.executor = DatabaseExecutor.instance()
+        self.db = self.executor.db  # Local file or inventory server
+        self.catalog = Catalog.instance(self.db.db_name)
+        self.settings_manager = settings_manager
         layout = QVBoxLayout(self)
         layout.setAlignment(Qt.AlignmentFlag.AlignTop)
 
@@ -476,7 +770,7 @@ class UpdateProductTab(QWidget):
             self.update_btn.setEnabled(False)
             self.delete_btn.setEnabled(False)
             return
-        products = self.db.search_products(search_term, search_type)
+        products = self.catalog.search_products(search_term, search_type)
         if not products:
             self.feedback.setText("Producto no encontrado.")
             self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
@@ -485,12 +779,12 @@ class UpdateProductTab(QWidget):
             self.clear_form()
             return
         prod = products[0]
-        self.id_label.setText(str(prod[0]))
-        self.serial_input.setText(prod[1])
-        self.name_input.setText(prod[2])
-        self.quantity_input.setValue(prod[3])
-        self.cost_input.setValue(prod[4])
-        self.price_input.setValue(prod[5])
+        self.id_label.setText(str(prod.id))
+        self.serial_input.setText(prod.serial_number)
+        self.name_input.setText(prod.name)
+        self.quantity_input.setValue(prod.quantity)
+        self.cost_input.setValue(prod.cost)
+        self.price_input.setValue(prod.price)
         self.feedback.setText("Producto cargado. Puede editar los campos y actualizar.")
         self.feedback.setStyleSheet("color: #2980b9; font-weight: bold; margin-top: 10px;")
         self.update_btn.setEnabled(True)
@@ -511,19 +805,24 @@ class UpdateProductTab(QWidget):
             )
             
             if reply == QMessageBox.StandardButton.Yes:
-                if self.db.delete_product(product_id):
-                    self.feedback.setText(f"Producto '{product_name}' eliminado exitosamente.")
-                    self.feedback.setStyleSheet("color: #27ae60; font-weight: bold; margin-top: 10px;")
-                    self.clear_form()
-                    self.update_btn.setEnabled(False)
-                    self.delete_btn.setEnabled(False)
-                else:
-                    self.feedback.setText("Error al eliminar el producto.")
-                    self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
+                self.update_btn.setEnabled(False)
+                self.delete_btn.setEnabled(False)
+                self.executor.write(self.db.delete_product, product_id).then(
+                    lambda deleted: self.on_product_deleted(deleted, product_name),
+                    lambda e: self.on_write_failed(f"Error al eliminar el producto: {e}"))
         except Exception as e:
             self.feedback.setText(f"Error al eliminar el producto: {str(e)}")
             self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
 
+    def on_product_deleted(self, deleted, product_name):
+        if deleted:
+            self.catalog.refresh()
+            self.feedback.setText(f"Producto '{product_name}' eliminado exitosamente.")
+            self.feedback.setStyleSheet("color: #27ae60; font-weight: bold; margin-top: 10px;")
+            self.clear_form()
+        else:
+            self.on_write_failed("Error al eliminar el producto.")
+
     def update_product(self):
         try:
             product_id = int(self.id_label.text())
@@ -540,13 +839,28 @@ class UpdateProductTab(QWidget):
             self.feedback.setText("Por favor, complete todos los campos correctamente.")
             self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
             return
-        updated = self.db.update_product(product_id, serial, name, quantity, cost, price)
+        self.update_btn.setEnabled(False)
+        self.delete_btn.setEnabled(False)
+        self.executor.write(self.db.update_product, product_id, serial, name, quantity, cost, price,
+                            self.settings_manager.get_setting("costing_method", "average")).then(
+            self.on_product_updated, lambda e: self.on_write_failed(f"Error al actualizar el producto: {e}"))
+
+    def on_product_updated(self, updated):
         if updated:
+            self.catalog.refresh()
+            self.update_btn.setEnabled(True)
+            self.delete_btn.setEnabled(True)
             self.feedback.setText("Producto actualizado exitosamente.")
             self.feedback.setStyleSheet("color: #27ae60; font-weight: bold; margin-top: 10px;")
         else:
-            self.feedback.setText("Error al actualizar el producto. ¿El número de serie ya existe?")
-            self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
+            self.on_write_failed("Error al actualizar el producto. ¿El número de serie ya existe?")
+
+    def on_write_failed(self, message):
+        """Show a failed update/delete and let the user try again."""
+        self.update_btn.setEnabled(True)
+        self.delete_btn.setEnabled(True)
+        self.feedback.setText(message)
+        self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
 
     def clear_form(self):
         self.id_label.setText("")
@@ -559,7 +873,8 @@ class UpdateProductTab(QWidget):
 class ClientsTab(QWidget):
     def __init__(self):
         super().__init__()
-        self.db = Database()
+        self.executor = DatabaseExecutor.instance()
+        self.db = self.executor.db  # Local file or inventory server
         layout = QVBoxLayout(self)
         layout.setSpacing(20)
         
@@ -630,15 +945,37 @@ class ClientsTab(QWidget):
         """)
         self.refresh_btn.clicked.connect(self.load_clients)
         
+        # Top clients button (reads the client_stats total index)
+        self.top_btn = QPushButton("Mejores Clientes")
+        self.top_btn.setCheckable(True)
+        self.top_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #2980b9;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #1c5d99;
+            }
+            QPushButton:checked {
+                background-color: #f39c12;
+            }
+        """)
+        self.top_btn.toggled.connect(self.search_clients)
+        
         top_bar.addLayout(search_layout)
         top_bar.addWidget(self.refresh_btn)
+        top_bar.addWidget(self.top_btn)
         top_bar.addStretch()
         
         # Table
         self.table = QTableWidget()
-        self.table.setColumnCount(7)
+        self.table.setColumnCount(11)
         self.table.setHorizontalHeaderLabels([
-            "ID", "Nombre", "ID Personal", "RTN", "Teléfono", "Email", "Ciudad"
+            "ID", "Nombre", "ID Personal", "RTN", "Teléfono", "Email", "Ciudad",
+            "Facturas", "Total Comprado", "Ticket Promedio", "Última Compra"
         ])
         
         # Set table style
@@ -689,44 +1026,108 @@ class ClientsTab(QWidget):
         layout.addWidget(self.table)
         
         # Load initial data
+        self.row_items = {}  # client id -> ID cell
+        self.stats = {}      # client id -> ClientStats
+        self.catalog = Catalog.instance(self.db.db_name)
         self.load_clients()
+        self.catalog.changed.connect(self.on_data_changed)
     
     def load_clients(self):
-        """Load all clients from the database."""
-        clients = self.db.get_all_clients()
-        self.update_table(clients)
+        """Load all clients from the shared catalog; their statistics follow from a reader thread."""
+        self.search_clients()
+        self.executor.read(self.db.get_all_client_stats).then(self.on_stats_loaded)
+    
+    def on_stats_loaded(self, stats):
+        self.stats = {s.client_id: s for s in stats}
+        self.search_clients()
+    
+    def on_data_changed(self, table, op, ids):
+        """Patch only the changed clients instead of reloading the table."""
+        if table == "client_stats":
+            if op == "delete":
+                self.on_stats_changed(ids, [])
+            else:
+                self.executor.read(self.db.get_client_stats_by_ids, ids).then(
+                    lambda stats: self.on_stats_changed(ids, stats))
+            return
+        if table != "clients":
+            return
+        if self.search_bar.text() or self.top_btn.isChecked():
+            self.search_clients()
+            return
+        patch_table(self.table, self.row_items, op, ids, self.catalog.clients_by_ids, self.set_row)
+    
+    def on_stats_changed(self, ids, stats):
+        for client_id in ids:
+            self.stats.pop(client_id, None)
+        self.stats.update((s.client_id, s) for s in stats)
+        if self.top_btn.isChecked():
+            self.search_clients()
+            return
+        patch_table(self.table, self.row_items, "update", [i for i in ids if i in self.row_items],
+                    self.catalog.clients_by_ids, self.set_row)
     
     def search_clients(self):
         """Search clients based on the search term and type."""
         search_term = self.search_bar.text()
         search_type = self.search_type.currentText()
         
+        if self.top_btn.isChecked():
+            self.executor.read(self.db.top_clients, 50).then(self.show_top_clients)
+            return
         if search_term:
-            clients = self.db.search_clients(search_term, search_type)
+            clients = self.catalog.search_clients(search_term, search_type)
         else:
-            clients = self.db.get_all_clients()
+            clients = self.catalog.clients()
         
         self.update_table(clients)
     
+    def show_top_clients(self, top):
+        if not self.top_btn.isChecked():
+            return  # Switched back to the full list while loading
+        self.stats.update((stats.client_id, stats) for client, stats in top)
+        clients = [client for client, stats in top]
+        search_term = self.search_bar.text()
+        if search_term:
+            matches = {c.id for c in self.catalog.search_clients(search_term, self.search_type.currentText())}
+            clients = [c for c in clients if c.id in matches]
+        self.update_table(clients)
+    
     def update_table(self, clients):
         """Update the table with the given clients."""
         self.table.setSortingEnabled(False)  # Disable sorting while updating
         self.table.setRowCount(len(clients))
         self.table.clearContents()  # Clear previous contents to avoid stale data
+        self.row_items = {}
         for row, client in enumerate(clients):
-            for col, value in enumerate(client):
-                if col == 0:  # ID column
-                    item = QTableWidgetItem()
-                    item.setData(Qt.ItemDataRole.DisplayRole, int(value))
-                else:
-                    item = QTableWidgetItem(str(value) if value is not None else "")
-                self.table.setItem(row, col, item)
+            self.row_items[client.id] = self.set_row(row, client)
         self.table.setSortingEnabled(True)  # Re-enable sorting
+    
+    def set_row(self, row, client):
+        """Write one client into a table row and return its ID cell."""
+        self.table.setItem(row, 0, numeric_item(int(client.id)))
+        for col, value in enumerate((client.name, client.identity_id, client.rtn,
+                                     client.phone, client.email, client.city), 1):
+            self.table.setItem(row, col, QTableWidgetItem(str(value) if value is not None else ""))
+        stats = self.stats.get(client.id)
+        if stats is not None:
+            self.table.setItem(row, 7, numeric_item(stats.invoice_count))
+            self.table.setItem(row, 8, numeric_item(stats.lifetime_total, f"LPS {stats.lifetime_total:,.2f}"))
+            self.table.setItem(row, 9, numeric_item(stats.average_ticket, f"LPS {stats.average_ticket:,.2f}"))
+            self.table.setItem(row, 10, QTableWidgetItem(str(stats.last_purchase)))
+        else:
+            self.table.setItem(row, 7, numeric_item(0))
+            self.table.setItem(row, 8, numeric_item(0.0, "LPS 0.00"))
+            self.table.setItem(row, 9, numeric_item(0.0, "LPS 0.00"))
+            self.table.setItem(row, 10, QTableWidgetItem(""))
+        return self.table.item(row, 0)
 
 class AddClientTab(QWidget):
     def __init__(self):
         super().__init__()
-        self.db = Database()
+        self.executor = DatabaseExecutor.instance()
+        self.db = self.executor.db  # Local file or inventory server
+        self.catalog = Catalog.instance(self.db.db_name)
         layout = QVBoxLayout(self)
         layout.setAlignment(Qt.AlignmentFlag.AlignTop)
         form_layout = QFormLayout()
@@ -804,14 +1205,20 @@ class AddClientTab(QWidget):
             return
 
         # Check if client exists
-        existing = self.db.search_clients(identity_id, "ID")
+        existing = self.catalog.client_by_identity(identity_id)
         if existing:
             self.feedback.setText("Error: El ID Personal ya existe. Use 'Actualizar cliente' para modificarlo.")
             self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
             return
 
-        added = self.db.add_client(name, identity_id, rtn, phone, email, city)
+        self.add_btn.setEnabled(False)
+        self.executor.write(self.db.add_client, name, identity_id, rtn, phone, email, city).then(
+            lambda added: self.on_client_added(added, name), self.on_write_failed)
+
+    def on_client_added(self, added, name):
+        self.add_btn.setEnabled(True)
         if added:
+            self.catalog.refresh()
             self.feedback.setText(f"Cliente '{name}' añadido exitosamente.")
             self.feedback.setStyleSheet("color: #27ae60; font-weight: bold; margin-top: 10px;")
             self.clear_form()
@@ -819,6 +1226,11 @@ class AddClientTab(QWidget):
             self.feedback.setText("Error al añadir el cliente. ¿El RTN ya existe?")
             self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
 
+    def on_write_failed(self, error):
+        self.add_btn.setEnabled(True)
+        self.feedback.setText(f"Error al añadir el cliente: {error}")
+        self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
+
     def clear_form(self):
         self.name_input.clear()
         self.identity_input.clear()
@@ -830,7 +1242,9 @@ class AddClientTab(QWidget):
 class UpdateClientTab(QWidget):
     def __init__(self):
         super().__init__()
-        self.db = Database()
+        self.executor = DatabaseExecutor.instance()
+        self.db = self.executor.db  # Local file or inventory server
+        self.catalog = Catalog.instance(self.db.db_name)
         layout = QVBoxLayout(self)
         layout.setAlignment(Qt.AlignmentFlag.AlignTop)
 
@@ -973,7 +1387,7 @@ class UpdateClientTab(QWidget):
             self.update_btn.setEnabled(False)
             self.delete_btn.setEnabled(False)
             return
-        clients = self.db.search_clients(search_term, search_type)
+        clients = self.catalog.search_clients(search_term, search_type)
         if not clients:
             self.feedback.setText("Cliente no encontrado.")
             self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
@@ -982,13 +1396,13 @@ class UpdateClientTab(QWidget):
             self.clear_form()
             return
         client = clients[0]
-        self.id_label.setText(str(client[0]))
-        self.name_input.setText(client[1])
-        self.identity_input.setText(client[2])
-        self.rtn_input.setText(client[3] if client[3] else "")
-        self.phone_input.setText(client[4] if client[4] else "")
-        self.email_input.setText(client[5] if client[5] else "")
-        self.city_input.setText(client[6])
+        self.id_label.setText(str(client.id))
+        self.name_input.setText(client.name)
+        self.identity_input.setText(client.identity_id)
+        self.rtn_input.setText(client.rtn or "")
+        self.phone_input.setText(client.phone or "")
+        self.email_input.setText(client.email or "")
+        self.city_input.setText(client.city)
         self.feedback.setText("Cliente cargado. Puede editar los campos y actualizar.")
         self.feedback.setStyleSheet("color: #2980b9; font-weight: bold; margin-top: 10px;")
         self.update_btn.setEnabled(True)
@@ -997,11 +1411,21 @@ class UpdateClientTab(QWidget):
     def delete_client(self):
         try:
             client_id = int(self.id_label.text())
-            client_name = self.name_input.text()
-            
-            # Check if client has associated invoices
-            invoices = self.db.get_invoices_by_client(client_id)
-            if invoices:
+        except ValueError:
+            self.feedback.setText("ID de cliente inválido.")
+            self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
+            return
+        client_name = self.name_input.text()
+        # Check if client has associated invoices, then ask for confirmation
+        self.delete_btn.setEnabled(False)
+        self.executor.read(self.db.get_client_stats, client_id).then(
+            lambda stats: self.confirm_delete(client_id, client_name, stats is not None),
+            lambda e: self.on_write_failed(f"Error al eliminar el cliente: {e}"))
+
+    def confirm_delete(self, client_id, client_name, has_invoices):
+        self.delete_btn.setEnabled(True)
+        try:
+            if has_invoices:
                 reply = QMessageBox.warning(
                     self,
                     "Cliente con Facturas",
@@ -1019,19 +1443,24 @@ class UpdateClientTab(QWidget):
                 )
             
             if reply == QMessageBox.StandardButton.Yes:
-                if self.db.delete_client(client_id):
-                    self.feedback.setText(f"Cliente '{client_name}' eliminado exitosamente.")
-                    self.feedback.setStyleSheet("color: #27ae60; font-weight: bold; margin-top: 10px;")
-                    self.clear_form()
-                    self.update_btn.setEnabled(False)
-                    self.delete_btn.setEnabled(False)
-                else:
-                    self.feedback.setText("Error al eliminar el cliente.")
-                    self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
+                self.update_btn.setEnabled(False)
+                self.delete_btn.setEnabled(False)
+                self.executor.write(self.db.delete_client, client_id).then(
+                    lambda deleted: self.on_client_deleted(deleted, client_name),
+                    lambda e: self.on_write_failed(f"Error al eliminar el cliente: {e}"))
         except Exception as e:
             self.feedback.setText(f"Error al eliminar el cliente: {str(e)}")
             self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
 
+    def on_client_deleted(self, deleted, client_name):
+        if deleted:
+            self.catalog.refresh()
+            self.feedback.setText(f"Cliente '{client_name}' eliminado exitosamente.")
+            self.feedback.setStyleSheet("color: #27ae60; font-weight: bold; margin-top: 10px;")
+            self.clear_form()
+        else:
+            self.on_write_failed("Error al eliminar el cliente.")
+
     def update_client(self):
         try:
             client_id = int(self.id_label.text())
@@ -1051,13 +1480,27 @@ class UpdateClientTab(QWidget):
             self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
             return
 
-        updated = self.db.update_client(client_id, name, identity_id, rtn, phone, email, city)
+        self.update_btn.setEnabled(False)
+        self.delete_btn.setEnabled(False)
+        self.executor.write(self.db.update_client, client_id, name, identity_id, rtn, phone, email, city).then(
+            self.on_client_updated, lambda e: self.on_write_failed(f"Error al actualizar el cliente: {e}"))
+
+    def on_client_updated(self, updated):
         if updated:
+            self.catalog.refresh()
+            self.update_btn.setEnabled(True)
+            self.delete_btn.setEnabled(True)
             self.feedback.setText("Cliente actualizado exitosamente.")
             self.feedback.setStyleSheet("color: #27ae60; font-weight: bold; margin-top: 10px;")
         else:
-            self.feedback.setText("Error al actualizar el cliente. ¿El ID Personal o RTN ya existe?")
-            self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
+            self.on_write_failed("Error al actualizar el cliente. ¿El ID Personal o RTN ya existe?")
+
+    def on_write_failed(self, message):
+        """Show a failed update/delete and let the user try again."""
+        self.update_btn.setEnabled(True)
+        self.delete_btn.setEnabled(True)
+        self.feedback.setText(message)
+        self.feedback.setStyleSheet("color: #e74c3c; font-weight: bold; margin-top: 10px;")
 
     def clear_form(self):
         self.id_label.setText("")
@@ -1071,17 +1514,18 @@ class UpdateClientTab(QWidget):
 class GenerateInvoiceTab(QWidget):
     def __init__(self, settings_manager):
         super().__init__()
-        self.db = Database()
+        self.executor = DatabaseExecutor.instance()
+        self.db = self.executor.db  # Local file or inventory server
+        self.catalog = Catalog.instance(self.db.db_name)
         self.settings_manager = settings_manager
         self.currency_formatter = CurrencyFormatter(settings_manager)
         layout = QVBoxLayout(self)
         layout.setSpacing(20)
         # --- Client selection ---
         client_layout = QHBoxLayout()
-        self.client_combo = QComboBox()
-        self.load_clients()
+        self.client_selector = ClientSelector(self.db.db_name)
         client_layout.addWidget(QLabel("Cliente:"))
-        client_layout.addWidget(self.client_combo)
+        client_layout.addWidget(self.client_selector)
         layout.addLayout(client_layout)
         # --- Product selection table ---
         self.products_table = QTableWidget()
@@ -1127,23 +1571,36 @@ class GenerateInvoiceTab(QWidget):
         layout.addWidget(self.feedback)
         self.setLayout(layout)
         self.selected_products = []  # (product_id, name, serial, qty, price, subtotal)
+        self.row_items = {}  # product id -> ID cell
         self.load_products()
+        self.catalog.changed.connect(self.on_data_changed)
 
     def load_products(self):
         self.products_table.setRowCount(0)
-        products = self.db.get_all_products()
+        self.row_items = {}
+        products = self.catalog.products()
         for row, prod in enumerate(products):
             self.products_table.insertRow(row)
-            # prod: (id, serial_number, name, quantity, cost, price)
-            # Table columns: ID, Nombre, Número de Serie, Precio, Disponible, Cantidad
-            self.products_table.setItem(row, 0, QTableWidgetItem(str(prod[0])))  # ID
-            self.products_table.setItem(row, 1, QTableWidgetItem(prod[2]))       # Nombre
-            self.products_table.setItem(row, 2, QTableWidgetItem(prod[1]))       # Número de Serie
-            self.products_table.setItem(row, 3, QTableWidgetItem(self.currency_formatter.format_amount(prod[5])))  # Precio
-            self.products_table.setItem(row, 4, QTableWidgetItem(str(prod[3])))  # Disponible
+            self.row_items[prod.id] = self.set_product_row(row, prod)
+
+    def set_product_row(self, row, prod):
+        # Table columns: ID, Nombre, Número de Serie, Precio, Disponible, Cantidad
+        self.products_table.setItem(row, 0, QTableWidgetItem(str(prod.id)))
+        self.products_table.setItem(row, 1, QTableWidgetItem(prod.name))
+        self.products_table.setItem(row, 2, QTableWidgetItem(prod.serial_number))
+        self.products_table.setItem(row, 3, QTableWidgetItem(self.currency_formatter.format_amount(prod.price)))
+        self.products_table.setItem(row, 4, QTableWidgetItem(str(prod.quantity)))
+        spin = self.products_table.cellWidget(row, 5)
+        if spin is None:
             spin = QSpinBox()
-            spin.setRange(0, int(prod[3]))
             self.products_table.setCellWidget(row, 5, spin)
+        spin.setRange(0, int(prod.quantity))  # Keeps a quantity being entered, clamped to the new stock
+        return self.products_table.item(row, 0)
+
+    def on_data_changed(self, table, op, ids):
+        """Patch the product rows touched by a change."""
+        if table == "products":
+            patch_table(self.products_table, self.row_items, op, ids, self.catalog.products_by_ids, self.set_product_row)
 
     def add_to_invoice(self):
         # Add selected products to invoice preview, now including serial number
@@ -1195,9 +1652,11 @@ class GenerateInvoiceTab(QWidget):
         if not self.selected_products:
             self.feedback.setText("Seleccione productos para la factura.")
             return
-        client_index = self.client_combo.currentIndex()
-        client_id = self.client_combo.itemData(client_index)
-        client_name = self.client_combo.currentText().split(' (ID:')[0]
+        client = self.client_selector.client()
+        if client is None:
+            self.feedback.setText("Seleccione un cliente de la lista.")
+            return
+        client_id, client_name = client.id, client.name
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         subtotal = sum(sub for *_, sub in self.selected_products)
         tax_rate = self.settings_manager.get_setting("tax_rate") / 100
@@ -1206,57 +1665,164 @@ class GenerateInvoiceTab(QWidget):
         # Prepare items for DB
         items = []
         for prod_id, name, serial, qty, price, sub in self.selected_products:
-            items.append({'product_id': prod_id, 'quantity': qty})
-        # Generate invoice text
-        import sqlite3
-        with sqlite3.connect(self.db.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT MAX(id) FROM invoices")
-            row = cursor.fetchone()
-            invoice_id = (row[0] or 0) + 1
-        invoice_folder = self.settings_manager.get_setting("invoice_folder")
-        os.makedirs(invoice_folder, exist_ok=True)
-        filename = f"{invoice_folder}/{self.settings_manager.get_setting('invoice_prefix')}_{invoice_id:05d}.txt"
-        lines = [
-            f"Factura N°: {invoice_id}",
-            f"Fecha: {now}",
-            f"Cliente: {client_name} (ID: {client_id})",
+            items.append({'product_id': prod_id, 'quantity': qty, 'price': price})
+        # Generate invoice text (the header needs the invoice number, assigned on the writer)
+        detail = [
             "\nDetalle de productos:",
             f"{'Cantidad':<10}{'Nombre':<30}{'N° Serie':<15}{'Precio':<15}{'Subtotal':<15}",
             "-"*85
         ]
         for prod_id, name, serial, qty, price, sub in self.selected_products:
-            lines.append(f"{qty:<10}{name:<30}{serial:<15}{self.currency_formatter.format_amount(price):<15}{self.currency_formatter.format_amount(sub):<15}")
-        lines.extend([
+            detail.append(f"{qty:<10}{name:<30}{serial:<15}{self.currency_formatter.format_amount(price):<15}{self.currency_formatter.format_amount(sub):<15}")
+        detail.extend([
             "-"*85,
             f"Subtotal: {self.currency_formatter.format_amount(subtotal)}",
             f"ISV ({self.settings_manager.get_setting('tax_rate')}%): {self.currency_formatter.format_amount(tax)}",
             f"Total: {self.currency_formatter.format_amount(total)}"
         ])
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write("\n".join(lines))
-        # Process invoice and update stock atomically
-        success, result = self.db.process_invoice_and_update_stock(
-            client_id, client_name, now, items, subtotal, tax, total, filename
-        )
+        prefix = self.settings_manager.get_setting('invoice_prefix')
+        costing_method = self.settings_manager.get_setting("costing_method", "average")
+        invoice_store = open_invoice_store(self.settings_manager, self.db.db_name)
+
+        # On the writer thread (or the server's write queue), so two sales never take the same number
+        self.generate_btn.setEnabled(False)
+        self.executor.write(self.db.record_sale, invoice_store, prefix, now, client_id, client_name, detail,
+                            items, subtotal, tax, total, costing_method).then(
+            self.on_invoice_processed, self.on_checkout_failed)
+
+    def on_invoice_processed(self, outcome):
+        success, result, filename = outcome
+        self.generate_btn.setEnabled(True)
         if success:
             self.selected_products = []
             self.update_invoice_table()
             self.feedback.setText(f"Factura generada exitosamente: {filename}")
-            self.load_products()  # Refresh inventory table
+            self.catalog.refresh()  # Publish the stock changes to this and other open tabs
         else:
             self.feedback.setText(f"Error: {result}")
 
-    def load_clients(self):
-        self.client_combo.clear()
-        clients = self.db.get_all_clients()
-        for c in clients:
-            self.client_combo.addItem(f"{c[1]} (ID: {c[0]})", c[0])
+    def on_checkout_failed(self, error):
+        self.generate_btn.setEnabled(True)
+        self.feedback.setText(f"Error: {error}")
+
+class CreditNoteDialog(QDialog):
+    """Choose the items of an invoice being returned and register the credit note."""
+
+    def __init__(self, parent, invoice):
+        super().__init__(parent)
+        self.executor = DatabaseExecutor.instance()
+        self.db = self.executor.db
+        self.invoice = invoice
+        self.items = []
+        self.setWindowTitle(f"Nota de Crédito - Factura #{invoice.id}")
+        self.resize(760, 420)
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel(f"Cliente: {invoice.client_name}    Fecha: {invoice.date}    "
+                                f"Total: LPS {float(invoice.total):,.2f}"))
+        self.table = QTableWidget()
+        self.table.setColumnCount(6)
+        self.table.setHorizontalHeaderLabels(["Número de Serie", "Nombre", "Vendido", "Devuelto", "Precio", "Devolver"])
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        layout.addWidget(self.table)
+        reason_layout = QHBoxLayout()
+        reason_layout.addWidget(QLabel("Motivo:"))
+        self.reason_input = QLineEdit()
+        reason_layout.addWidget(self.reason_input)
+        layout.addLayout(reason_layout)
+        self.total_label = QLabel("")
+        self.total_label.setStyleSheet("font-size: 14px; padding: 6px;")
+        layout.addWidget(self.total_label)
+        btn_layout = QHBoxLayout()
+        all_btn = QPushButton("Devolver Todo")
+        all_btn.clicked.connect(self.return_all)
+        btn_layout.addWidget(all_btn)
+        btn_layout.addStretch()
+        self.save_btn = QPushButton("Registrar Nota de Crédito")
+        self.save_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #27ae60;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #219150;
+            }
+        """)
+        self.save_btn.clicked.connect(self.save)
+        btn_layout.addWidget(self.save_btn)
+        cancel_btn = QPushButton("Cancelar")
+        cancel_btn.clicked.connect(self.reject)
+        btn_layout.addWidget(cancel_btn)
+        layout.addLayout(btn_layout)
+        self.save_btn.setEnabled(False)
+        self.executor.read(self.db.returnable_items, invoice.id).then(self.show_items, self.on_failed)
+
+    def show_items(self, items):
+        self.items = items
+        self.table.setRowCount(len(items))
+        for row, (product_id, serial, name, sold, returned, price, cost) in enumerate(items):
+            self.table.setItem(row, 0, QTableWidgetItem(serial))
+            self.table.setItem(row, 1, QTableWidgetItem(name))
+            self.table.setItem(row, 2, numeric_item(int(sold)))
+            self.table.setItem(row, 3, numeric_item(int(returned)))
+            self.table.setItem(row, 4, numeric_item(float(price), f"LPS {float(price):,.2f}"))
+            spin = QSpinBox()
+            spin.setRange(0, int(sold - returned))
+            spin.valueChanged.connect(self.update_total)
+            self.table.setCellWidget(row, 5, spin)
+        self.save_btn.setEnabled(any(sold > returned for _, _, _, sold, returned, _, _ in items))
+        if not self.save_btn.isEnabled():
+            self.total_label.setText("Todos los productos de esta factura ya fueron devueltos.")
+
+    def return_all(self):
+        for row in range(self.table.rowCount()):
+            spin = self.table.cellWidget(row, 5)
+            spin.setValue(spin.maximum())
+
+    def lines(self):
+        return [(self.items[row][0], self.table.cellWidget(row, 5).value())
+                for row in range(self.table.rowCount()) if self.table.cellWidget(row, 5).value() > 0]
+
+    def update_total(self):
+        subtotal = sum(self.table.cellWidget(row, 5).value() * self.items[row][5]
+                       for row in range(self.table.rowCount()))
+        self.total_label.setText(f"Subtotal a acreditar: LPS {subtotal:,.2f} (más el ISV proporcional)")
+
+    def save(self):
+        lines = self.lines()
+        if not lines:
+            QMessageBox.warning(self, "Nota de Crédito", "Indique las cantidades devueltas.")
+            return
+        self.save_btn.setEnabled(False)
+        self.executor.write(self.db.create_credit_note, self.invoice.id, lines,
+                            self.reason_input.text().strip()).then(self.on_saved, self.on_failed)
+
+    def on_saved(self, result):
+        success, value = result
+        if not success:
+            self.save_btn.setEnabled(True)
+            QMessageBox.warning(self, "Nota de Crédito", value)
+            return
+        QMessageBox.information(self, "Nota de Crédito",
+                                f"Nota de crédito #{value} registrada; los productos volvieron al inventario.")
+        self.accept()
+
+    def on_failed(self, error):
+        self.save_btn.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"Error en la nota de crédito: {error}")
 
 class ManageInvoicesTab(QWidget):
-    def __init__(self):
+    def __init__(self, settings_manager):
         super().__init__()
-        self.db = Database()
+        self.executor = DatabaseExecutor.instance()
+        self.db = self.executor.db  # Local file or inventory server
+        self.query = 0  # Number of the latest listing query; older results are dropped
+        self.settings_manager = settings_manager
+        self.invoice_store = open_invoice_store(settings_manager, self.db.db_name)
         layout = QVBoxLayout(self)
         layout.setSpacing(20)
         
@@ -1407,6 +1973,21 @@ class ManageInvoicesTab(QWidget):
             }
         """)
         self.delete_btn.clicked.connect(self.delete_invoice)
+        self.credit_btn = QPushButton("Nota de Crédito")
+        self.credit_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #f39c12;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #d68910;
+            }
+        """)
+        self.credit_btn.clicked.connect(self.create_credit_note)
+        btn_layout.addWidget(self.credit_btn)
         btn_layout.addWidget(self.delete_btn)
         btn_layout.addStretch()
         layout.addLayout(btn_layout)
@@ -1425,141 +2006,122 @@ class ManageInvoicesTab(QWidget):
         self.invoice_display.setWordWrap(True)
         layout.addWidget(self.invoice_display)
         self.setLayout(layout)
+        # Rendered invoices for quick browsing; rows around the selection are prefetched
+        self.preview_cache = InvoicePreviewCache(self.invoice_store, max_entries=64)
+        self.prefetch_radius = 3
+        self.invoice_rows = {}  # invoice id -> row as loaded in the table
+        self.table.currentCellChanged.connect(self.on_current_row_changed)
+        self.row_items = {}  # invoice id -> ID cell
         self.load_invoices()
+        self.change_bus = ChangeBus.instance(self.db.db_name)
+        self.change_bus.changed.connect(self.on_data_changed)
+    def on_data_changed(self, table, op, ids):
+        """Patch only the changed invoices instead of reloading the table."""
+        if table != "invoices":
+            return
+        for invoice_id in ids:
+            if op != "insert":
+                self.preview_cache.discard(invoice_id)
+            if op == "delete":
+                self.invoice_rows.pop(invoice_id, None)
+        if self.search_bar.text():
+            self.search_invoices()
+            return
+        patch_table(self.table, self.row_items, op, ids, self.db.get_invoices_by_ids, self.set_row)
     def load_invoices(self):
-        invoices = self.db.get_all_invoices()
-        self.update_table(invoices)
+        self.query_invoices(self.db.get_all_invoices)
     def search_invoices(self):
         search_term = self.search_bar.text()
         search_type = self.search_type.currentText()
         if search_term:
-            invoices = self.db.search_invoices(search_term, search_type)
+            self.query_invoices(self.db.search_invoices, search_term, search_type)
         else:
-            invoices = self.db.get_all_invoices()
-        self.update_table(invoices)
+            self.query_invoices(self.db.get_all_invoices)
+    def query_invoices(self, fn, *args):
+        """Run a listing query on a reader thread; only the latest one fills the table."""
+        self.query += 1
+        query = self.query
+
+        def show(invoices):
+            if query == self.query:  # Typing faster than the queries finish
+                self.update_table(invoices)
+        self.executor.read(fn, *args).then(show)
     def update_table(self, invoices):
+        self.invoice_rows = {}
+        self.row_items = {}
+        self.table.setSortingEnabled(False)
         self.table.setRowCount(len(invoices))
         self.table.clearContents()
         for row, invoice in enumerate(invoices):
-            # invoice format: (id, client_id, client_name, date, subtotal, tax, total, file_path)
-            for col, value in enumerate(invoice):  # Process all columns
-                if col >= 7:  # Skip file_path
-                    continue
-                    
-                item = QTableWidgetItem()
-                if col == 0:  # ID
-                    item.setData(Qt.ItemDataRole.DisplayRole, int(value))
-                    self.table.setItem(row, 0, item)
-                elif col == 1:  # Skip client_id
-                    continue
-                elif col == 2:  # Client name
-                    item.setText(str(value))
-                    self.table.setItem(row, 1, item)
-                elif col == 3:  # Date
-                    item.setText(str(value))
-                    self.table.setItem(row, 2, item)
-                elif col in [4, 5, 6]:  # Subtotal, ISV, Total
-                    try:
-                        float_value = float(value)
-                        item.setData(Qt.ItemDataRole.DisplayRole, float_value)
-                        item.setText(f"LPS {float_value:,.2f}")
-                        self.table.setItem(row, col - 1, item)  # Adjust column index
-                    except (ValueError, TypeError):
-                        item.setText(str(value))
-                        self.table.setItem(row, col - 1, item)
+            self.row_items[invoice.id] = self.set_row(row, invoice)
+        self.table.setSortingEnabled(True)
+    def set_row(self, row, invoice):
+        """Write one invoice into a table row and return its ID cell."""
+        self.invoice_rows[invoice.id] = invoice
+        return set_invoice_row(self.table, row, invoice)
+    def invoice_at_row(self, row):
+        item = self.table.item(row, 0)
+        if item is None:
+            return None
+        invoice_id = int(item.text())
+        # Rows loaded in the table already carry the file path; only query when missing
+        invoice = self.invoice_rows.get(invoice_id)
+        if invoice is None:
+            invoice = self.db.get_invoice_by_id(invoice_id)
+        return invoice
     def get_selected_invoice(self):
         selected = self.table.currentRow()
         if selected < 0:
             return None
-        # Get the invoice ID from the first column
-        invoice_id = int(self.table.item(selected, 0).text())
-        invoice = self.db.get_invoice_by_id(invoice_id)
-        return invoice
+        return self.invoice_at_row(selected)
+    def on_current_row_changed(self, row, column, previous_row, previous_column):
+        """Prefetch the invoices around the selected row in the background."""
+        if row < 0:
+            return
+        neighbours = []
+        first = max(0, row - self.prefetch_radius)
+        last = min(self.table.rowCount() - 1, row + self.prefetch_radius)
+        for r in range(first, last + 1):
+            invoice = self.invoice_at_row(r)
+            if invoice:
+                neighbours.append((invoice.id, invoice.file_path))
+        self.preview_cache.prefetch(neighbours)
     def view_invoice(self):
         invoice = self.get_selected_invoice()
         if not invoice:
             self.invoice_display.setText("Seleccione una factura para ver.")
             return
-        file_path = invoice[-1]
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            self.invoice_display.setText(content)
+            rendered = self.preview_cache.get(invoice.id, invoice.file_path)
+            self.invoice_display.setText(rendered.text)
         except Exception as e:
             self.invoice_display.setText(f"No se pudo abrir la factura: {e}")
+            return
+        self.executor.read(self.db.get_credit_notes_by_invoice, invoice.id).then(
+            lambda notes: self.show_credit_notes(invoice.id, rendered.text, notes))
+    def show_credit_notes(self, invoice_id, text, notes):
+        selected = self.get_selected_invoice()
+        if not notes or selected is None or selected.id != invoice_id:
+            return
+        lines = [f"Nota de crédito #{n.id} - {n.date} - LPS {n.total:,.2f}" + (f" ({n.reason})" if n.reason else "")
+                 for n in notes]
+        self.invoice_display.setText(text + "\n\n--- Devoluciones ---\n" + "\n".join(lines))
+    def create_credit_note(self):
+        invoice = self.get_selected_invoice()
+        if not invoice:
+            QMessageBox.warning(self, "Nota de Crédito", "Seleccione la factura de la devolución.")
+            return
+        if CreditNoteDialog(self, invoice).exec() == QDialog.DialogCode.Accepted:
+            self.view_invoice()
     def print_invoice(self):
         invoice = self.get_selected_invoice()
         if not invoice:
             QMessageBox.warning(self, "Imprimir", "Seleccione una factura para imprimir.")
             return
-        file_path = invoice[-1]
         try:
-            # Load invoice text
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            # Parse invoice data from text (simple parsing for demo)
-            lines = content.splitlines()
-            factura_num = lines[0].split(':', 1)[-1].strip()
-            fecha = lines[1].split(':', 1)[-1].strip()
-            cliente = lines[2].split(':', 1)[-1].strip()
-            # Find product table start
-            prod_start = 5
-            prod_lines = []
-            for i in range(prod_start+1, len(lines)):
-                if lines[i].strip() == '':
-                    break
-                prod_lines.append(lines[i])
-            # Totals
-            subtotal = lines[-3].split(':', 1)[-1].strip()
-            isv = lines[-2].split(':', 1)[-1].strip()
-            total = lines[-1].split(':', 1)[-1].strip()
-            # Build HTML
-            html = f'''
-            <html>
-            <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; color: #222; }}
-                .header {{ font-size: 22px; font-weight: bold; margin-bottom: 10px; }}
-                .meta {{ margin-bottom: 10px; }}
-                .meta span {{ margin-right: 30px; }}
-                table {{ border-collapse: collapse; width: 100%; margin-bottom: 20px; }}
-                th, td {{ border: 1px solid #ccc; padding: 6px 10px; text-align: left; }}
-                th {{ background: #f0f0f0; }}
-                .totals td {{ border: none; font-size: 16px; }}
-                .totals tr td:first-child {{ text-align: right; }}
-            </style>
-            </head>
-            <body>
-                <div class="header">Factura N°: {factura_num}</div>
-                <div class="meta">
-                    <span><b>Fecha:</b> {fecha}</span>
-                    <span><b>Cliente:</b> {cliente}</span>
-                </div>
-                <table>
-                    <tr><th>Cantidad</th><th>Nombre</th><th>N° Serie</th><th>Precio</th><th>Subtotal</th></tr>
-            '''
-            for prod in prod_lines:
-                cols = prod.split()
-                if len(cols) < 5:
-                    continue
-                qty = cols[0]
-                name = ' '.join(cols[1:-3])
-                serial = cols[-3]
-                price = cols[-2] + ' ' + cols[-1] if cols[-2].startswith('LPS') else cols[-2]
-                subtotal = cols[-1] if cols[-1].startswith('LPS') else ''
-                html += f'<tr><td>{qty}</td><td>{name}</td><td>{serial}</td><td>{price}</td><td>{subtotal}</td></tr>'
-            html += f'''
-                </table>
-                <table class="totals">
-                    <tr><td><b>Subtotal:</b></td><td>{subtotal}</td></tr>
-                    <tr><td><b>ISV (15%):</b></td><td>{isv}</td></tr>
-                    <tr><td><b>Total:</b></td><td>{total}</td></tr>
-                </table>
-            </body>
-            </html>
-            '''
+            rendered = self.preview_cache.get(invoice.id, invoice.file_path)
             doc = QTextDocument()
-            doc.setHtml(html)
+            doc.setHtml(rendered.html)
             printer = QPrinter()
             dialog = QPrintDialog(printer)
             if dialog.exec() == QDialog.DialogCode.Accepted:
@@ -1575,29 +2137,43 @@ class ManageInvoicesTab(QWidget):
             return
         reply = QMessageBox.question(
             self, 'Confirmar eliminación',
-            f'¿Está seguro que desea eliminar la factura #{invoice[0]}?',
+            f'¿Está seguro que desea eliminar la factura #{invoice.id}?\n'
+            'Eliminarla no devuelve los productos al inventario; para una devolución use "Nota de Crédito".',
             QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
             QMessageBox.StandardButton.No
         )
         if reply == QMessageBox.StandardButton.Yes:
-            try:
-                import os
-                file_path = invoice[-1]
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                if self.db.delete_invoice(invoice[0]):
-                    self.load_invoices()
-                    self.invoice_display.setText("")
-                    QMessageBox.information(self, "Éxito", "Factura eliminada correctamente.")
-                else:
-                    QMessageBox.critical(self, "Error", "Error al eliminar la factura de la base de datos.")
-            except Exception as e:
-                QMessageBox.critical(self, "Error", f"Error al eliminar la factura: {str(e)}")
+            self.preview_cache.discard(invoice.id)
+
+            def delete():
+                if self.db.get_credit_notes_by_invoice(invoice.id):
+                    return None  # Kept with its returns
+                if not self.db.delete_invoice(invoice.id):
+                    return False
+                # Removed after the row so shared blobs are only dropped when unreferenced
+                self.invoice_store.delete(invoice.file_path)
+                return True
+            self.delete_btn.setEnabled(False)
+            self.executor.write(delete).then(self.on_invoice_deleted, self.on_delete_failed)
+    def on_invoice_deleted(self, deleted):
+        self.delete_btn.setEnabled(True)
+        if deleted:
+            self.change_bus.poll()
+            self.invoice_display.setText("")
+            QMessageBox.information(self, "Éxito", "Factura eliminada correctamente.")
+        elif deleted is None:
+            QMessageBox.warning(self, "Eliminar", "La factura tiene notas de crédito y no se puede eliminar.")
+        else:
+            QMessageBox.critical(self, "Error", "Error al eliminar la factura de la base de datos.")
+    def on_delete_failed(self, error):
+        self.delete_btn.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"Error al eliminar la factura: {error}")
 
 class SalesReportTab(QWidget):
     def __init__(self):
         super().__init__()
         self.db = Database()
+        self.executor = DatabaseExecutor.instance(self.db.db_name)
         layout = QVBoxLayout(self)
         layout.setSpacing(20)
         # --- Filters ---
@@ -1640,10 +2216,29 @@ class SalesReportTab(QWidget):
             }
         """)
         self.print_btn.clicked.connect(self.print_report)
+        self.pdf_btn = QPushButton("Exportar PDF")
+        self.pdf_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #8e44ad;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #71368a;
+            }
+        """)
+        self.pdf_btn.clicked.connect(self.export_pdf)
         filter_layout.addWidget(self.generate_btn)
         filter_layout.addWidget(self.print_btn)
+        filter_layout.addWidget(self.pdf_btn)
         filter_layout.addStretch()
         layout.addLayout(filter_layout)
+        # --- Trend chart (wheel: zoom, drag: pan, double click: whole period) ---
+        self.chart = SalesChart(self.db.db_name)
+        self.chart.failed.connect(lambda error: QMessageBox.critical(self, "Error", f"Error al cargar el gráfico: {error}"))
+        layout.addWidget(self.chart)
         # --- Results table ---
         self.table = QTableWidget()
         self.table.setColumnCount(6)
@@ -1664,115 +2259,242 @@ class SalesReportTab(QWidget):
         self.setLayout(layout)
         self.current_report = []
         self.current_total = 0
+        self.report_cache = ReportCache.instance(self.db.db_name)
+        self.shown = None  # cache key of the report in the table
+        self.shown_period = None  # (start, end) of the report in the table
     def generate_report(self):
         start = self.start_date.date().toString("yyyy-MM-dd")
         end = self.end_date.date().toString("yyyy-MM-dd")
-        invoices = self.db.get_invoices_by_date_range(start, end)
+        self.chart.set_range(self.start_date.date().toPyDate(), self.end_date.date().toPyDate())
+        shown = self.shown
+
+        def load():
+            key = self.report_cache.key("sales_report", (start, end))
+            if key == shown:
+                return key, (start, end), None  # Same period and no changes since: the table is already up to date
+            return key, (start, end), self.report_cache.get("sales_report", (start, end),
+                                                            lambda: self.load_report(start, end))
+        self.generate_btn.setEnabled(False)
+        self.executor.read(load).then(self.show_report, self.on_report_failed)
+    def show_report(self, outcome):
+        self.generate_btn.setEnabled(True)
+        key, period, report = outcome
+        if report is None:
+            return
+        invoices, total_sales, credit_notes = report
         self.current_report = invoices
+        self.shown_period = period
+        self.table.setSortingEnabled(False)
         self.table.setRowCount(len(invoices))
-        total_sales = 0
         for row, inv in enumerate(invoices):
-            # inv format: (id, client_id, client_name, date, subtotal, tax, total, file_path)
-            for col, value in enumerate(inv):  # Process all columns
-                if col >= 7:  # Skip file_path
-                    continue
-                    
-                item = QTableWidgetItem()
-                if col == 0:  # ID
-                    item.setData(Qt.ItemDataRole.DisplayRole, int(value))
-                    self.table.setItem(row, 0, item)
-                elif col == 1:  # Skip client_id
-                    continue
-                elif col == 2:  # Client name
-                    item.setText(str(value))
-                    self.table.setItem(row, 1, item)
-                elif col == 3:  # Date
-                    item.setText(str(value))
-                    self.table.setItem(row, 2, item)
-                elif col in [4, 5, 6]:  # Subtotal, ISV, Total
-                    try:
-                        float_value = float(value)
-                        item.setData(Qt.ItemDataRole.DisplayRole, float_value)
-                        item.setText(f"LPS {float_value:,.2f}")
-                        self.table.setItem(row, col - 1, item)  # Adjust column index
-                        if col == 6:  # Total
-                            total_sales += float_value
-                    except (ValueError, TypeError):
-                        item.setText(str(value))
-                        self.table.setItem(row, col - 1, item)
+            set_invoice_row(self.table, row, inv)
+        self.table.setSortingEnabled(True)
         self.current_total = total_sales
-        self.summary_label.setText(f"Total de facturas: {len(invoices)} | Ventas totales: LPS {total_sales:,.2f}")
-    def print_report(self):
-        from PyQt6.QtGui import QTextDocument, QPainter
-        from PyQt6.QtPrintSupport import QPrinter, QPrintDialog
-        start = self.start_date.date().toString("yyyy-MM-dd")
-        end = self.end_date.date().toString("yyyy-MM-dd")
-        invoices = self.current_report
-        total_sales = self.current_total
-        html = f'''
-        <html>
-        <head>
-        <style>
-            body {{ font-family: Arial, sans-serif; color: #222; }}
-            .header {{ font-size: 22px; font-weight: bold; margin-bottom: 10px; }}
-            .meta {{ margin-bottom: 10px; }}
-            .meta span {{ margin-right: 30px; }}
-            table {{ border-collapse: collapse; width: 100%; margin-bottom: 20px; }}
-            th, td {{ border: 1px solid #ccc; padding: 6px 10px; text-align: left; }}
-            th {{ background: #f0f0f0; }}
-            .totals td {{ border: none; font-size: 16px; }}
-            .totals tr td:first-child {{ text-align: right; }}
-        </style>
-        </head>
-        <body>
-            <div class="header">Reporte de Ventas</div>
-            <div class="meta">
-                <span><b>Del:</b> {start}</span>
-                <span><b>Al:</b> {end}</span>
-            </div>
-            <table>
-                <tr><th>ID Factura</th><th>Cliente</th><th>Fecha</th><th>Subtotal</th><th>ISV</th><th>Total</th></tr>
-        '''
+        self.shown = key
+        returns = sum(note.total for note in credit_notes)
+        self.summary_label.setText(f"Total de facturas: {len(invoices)} | Ventas totales: LPS {total_sales:,.2f} | "
+                                   f"Devoluciones ({len(credit_notes)}): LPS {returns:,.2f} | "
+                                   f"Ventas netas: LPS {total_sales - returns:,.2f}")
+    def on_report_failed(self, error):
+        self.generate_btn.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"Error al generar el reporte: {error}")
+    def load_report(self, start, end):
+        invoices = self.db.get_invoices_by_date_range(start, end)
+        total_sales = 0
         for inv in invoices:
-            html += f'<tr>'
-            html += f'<td>{inv[0]}</td>'
-            html += f'<td>{inv[2]}</td>'
-            html += f'<td>{inv[3]}</td>'
-            html += f'<td>LPS {float(inv[4]):,.2f}</td>'
-            html += f'<td>LPS {float(inv[5]):,.2f}</td>'
-            html += f'<td>LPS {float(inv[6]):,.2f}</td>'
-            html += f'</tr>'
-        html += f'''
-            </table>
-            <table class="totals">
-                <tr><td><b>Total de facturas:</b></td><td>{len(invoices)}</td></tr>
-                <tr><td><b>Ventas totales:</b></td><td>LPS {total_sales:,.2f}</td></tr>
-            </table>
-        </body>
-        </html>
-        '''
-        doc = QTextDocument()
-        doc.setHtml(html)
-        printer = QPrinter()
-        dialog = QPrintDialog(printer)
+            try:
+                total_sales += float(inv.total)
+            except (ValueError, TypeError):
+                pass
+        return invoices, total_sales, self.db.get_credit_notes_by_date_range(start, end)
+    def build_print_report(self):
+        """Describe the sales report shown in the table (its rows and order) for the paged print engine."""
+        start, end = self.shown_period
+        rows = shown_rows(self.table, self.current_report)
+        return PagedReport(
+            "Reporte de Ventas",
+            ["ID Factura", "Cliente", "Fecha", "Subtotal", "ISV", "Total"],
+            lambda: rows,
+            format_invoice_row,
+            meta=[f"Del: {start}    Al: {end}"],
+            widths=[1, 3, 2, 2, 2, 2],
+            total_label="Ventas totales",
+            count_label="Facturas",
+            total_rows=len(rows)
+        )
+    def print_report(self):
+        if self.shown_period is None:
+            QMessageBox.warning(self, "Imprimir", "Genere el reporte antes de imprimirlo.")
+            return
+        printer = QPrinter(QPrinter.PrinterMode.HighResolution)
+        dialog = QPrintDialog(printer, self)
         if dialog.exec() == QDialog.DialogCode.Accepted:
-            painter = QPainter(printer)
-            doc.drawContents(painter)
-            painter.end()
+            self.start_print_job(printer)
+    def export_pdf(self):
+        if self.shown_period is None:
+            QMessageBox.warning(self, "Exportar", "Genere el reporte antes de exportarlo.")
+            return
+        file_name, _ = QFileDialog.getSaveFileName(self, "Guardar Reporte", "reporte_ventas.pdf", "PDF (*.pdf)")
+        if file_name:
+            self.start_print_job(pdf_printer(file_name))
+    def start_print_job(self, printer):
+        self.print_job = ReportPrintJob(self, printer, self.build_print_report())
+        self.print_job.failed.connect(lambda error: QMessageBox.critical(self, "Error", f"Error al imprimir el reporte: {error}"))
+        self.print_job.start()
 
-class PurchaseHistoryTab(QWidget):
+class PivotTab(QWidget):
     def __init__(self):
         super().__init__()
         self.db = Database()
+        self.engine = PivotEngine(self.db.db_name)
+        self.job = None
+        self.result = None
         layout = QVBoxLayout(self)
         layout.setSpacing(20)
-        # --- Client selector ---
+        # --- Dimensions ---
+        dims_layout = QHBoxLayout()
+        dims_layout.addWidget(QLabel("Filas:"))
+        self.row_combo = QComboBox()
+        self.row_combo2 = QComboBox()
+        self.column_combo = QComboBox()
+        self.row_combo2.addItem("(ninguna)", None)
+        self.column_combo.addItem("(ninguna)", None)
+        for name, label in DIMENSIONS.items():
+            self.row_combo.addItem(label, name)
+            self.row_combo2.addItem(label, name)
+            self.column_combo.addItem(label, name)
+        self.column_combo.setCurrentIndex(self.column_combo.findData("month"))
+        dims_layout.addWidget(self.row_combo)
+        dims_layout.addWidget(QLabel("y"))
+        dims_layout.addWidget(self.row_combo2)
+        dims_layout.addWidget(QLabel("Columnas:"))
+        dims_layout.addWidget(self.column_combo)
+        dims_layout.addWidget(QLabel("Medidas:"))
+        self.measure_checks = {}
+        for name, label in MEASURES.items():
+            check = QCheckBox(label)
+            check.setChecked(name in ("count", "total"))
+            self.measure_checks[name] = check
+            dims_layout.addWidget(check)
+        dims_layout.addStretch()
+        layout.addLayout(dims_layout)
+        # --- Period and actions ---
         filter_layout = QHBoxLayout()
-        filter_layout.addWidget(QLabel("Cliente:"))
-        self.client_combo = QComboBox()
-        self.load_clients()
-        filter_layout.addWidget(self.client_combo)
-        self.generate_btn = QPushButton("Ver Historial")
+        today = QDate.currentDate()
+        filter_layout.addWidget(QLabel("Desde:"))
+        self.start_date = QDateEdit()
+        self.start_date.setCalendarPopup(True)
+        self.start_date.setDate(QDate(today.year(), today.month(), 1).addMonths(-11))
+        filter_layout.addWidget(self.start_date)
+        filter_layout.addWidget(QLabel("Hasta:"))
+        self.end_date = QDateEdit()
+        self.end_date.setCalendarPopup(True)
+        self.end_date.setDate(QDate(today.year(), today.month(), today.daysInMonth()))
+        filter_layout.addWidget(self.end_date)
+        self.generate_btn = QPushButton("Generar Tabla")
+        self.generate_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #2980b9;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #1c5d99;
+            }
+        """)
+        self.generate_btn.clicked.connect(self.generate_pivot)
+        filter_layout.addWidget(self.generate_btn)
+        self.csv_btn = QPushButton("Exportar CSV")
+        self.csv_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #27ae60;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #219150;
+            }
+        """)
+        self.csv_btn.clicked.connect(self.export_csv)
+        filter_layout.addWidget(self.csv_btn)
+        filter_layout.addStretch()
+        layout.addLayout(filter_layout)
+        # --- Results grid (model based: cells are not copied into items) ---
+        self.model = PivotModel(self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setAlternatingRowColors(True)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setSelectionBehavior(QTableView.SelectionBehavior.SelectRows)
+        self.table.setSortingEnabled(True)
+        layout.addWidget(self.table)
+        # --- Summary ---
+        self.summary_label = QLabel("")
+        self.summary_label.setStyleSheet("font-size: 15px; padding: 10px;")
+        layout.addWidget(self.summary_label)
+        self.setLayout(layout)
+    def generate_pivot(self):
+        rows = [self.row_combo.currentData()]
+        if self.row_combo2.currentData() and self.row_combo2.currentData() not in rows:
+            rows.append(self.row_combo2.currentData())
+        columns = [self.column_combo.currentData()] if self.column_combo.currentData() else []
+        measures = [name for name, check in self.measure_checks.items() if check.isChecked()]
+        if not measures:
+            QMessageBox.warning(self, "Tabla Dinámica", "Seleccione al menos una medida.")
+            return
+        if set(rows) & set(columns):
+            QMessageBox.warning(self, "Tabla Dinámica", "Una dimensión no puede estar en filas y columnas a la vez.")
+            return
+        self.generate_btn.setEnabled(False)
+        self.summary_label.setText("Calculando...")
+        # Computed on a worker thread; long line-item pivots do not freeze the window
+        self.job = PivotJob(self.engine, rows=rows, columns=columns, measures=measures,
+                            start=self.start_date.date().toString("yyyy-MM-dd"),
+                            end=self.end_date.date().toString("yyyy-MM-dd"))
+        self.job.signals.finished.connect(self.on_pivot_ready)
+        self.job.signals.failed.connect(self.on_pivot_failed)
+        self.job.start()
+    def on_pivot_ready(self, result, seconds):
+        self.generate_btn.setEnabled(True)
+        self.result = result
+        self.model.set_result(result)
+        self.table.horizontalHeader().resizeSections(QHeaderView.ResizeMode.ResizeToContents)
+        self.summary_label.setText(f"Filas: {len(result.row_keys)} | Columnas: {len(result.column_keys)} | "
+                                   f"Calculado en {seconds * 1000:,.0f} ms")
+    def on_pivot_failed(self, error):
+        self.generate_btn.setEnabled(True)
+        self.summary_label.setText("")
+        QMessageBox.critical(self, "Error", f"No se pudo generar la tabla: {error}")
+    def export_csv(self):
+        if self.result is None:
+            QMessageBox.warning(self, "Exportar", "Genere la tabla primero.")
+            return
+        file_name, _ = QFileDialog.getSaveFileName(self, "Guardar Tabla", "tabla_dinamica.csv", "CSV (*.csv)")
+        if not file_name:
+            return
+        try:
+            self.result.write_csv(file_name)
+            QMessageBox.information(self, "Exportar", "Tabla exportada correctamente.")
+        except OSError as e:
+            QMessageBox.critical(self, "Error", f"Error al exportar la tabla: {str(e)}")
+
+class PurchaseHistoryTab(QWidget):
+    def __init__(self):
+        super().__init__()
+        self.db = Database()
+        self.executor = DatabaseExecutor.instance(self.db.db_name)
+        layout = QVBoxLayout(self)
+        layout.setSpacing(20)
+        # --- Client selector ---
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(QLabel("Cliente:"))
+        self.client_selector = ClientSelector(self.db.db_name)
+        filter_layout.addWidget(self.client_selector)
+        self.generate_btn = QPushButton("Ver Historial")
         self.generate_btn.setStyleSheet("""
             QPushButton {
                 background-color: #2980b9;
@@ -1802,6 +2524,21 @@ class PurchaseHistoryTab(QWidget):
         """)
         self.print_btn.clicked.connect(self.print_history)
         filter_layout.addWidget(self.print_btn)
+        self.pdf_btn = QPushButton("Exportar PDF")
+        self.pdf_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #8e44ad;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #71368a;
+            }
+        """)
+        self.pdf_btn.clicked.connect(self.export_pdf)
+        filter_layout.addWidget(self.pdf_btn)
         filter_layout.addStretch()
         layout.addLayout(filter_layout)
         # --- Results table ---
@@ -1824,105 +2561,1094 @@ class PurchaseHistoryTab(QWidget):
         self.setLayout(layout)
         self.current_history = []
         self.current_total = 0
-    def load_clients(self):
-        self.client_combo.clear()
-        clients = self.db.get_all_clients()
-        for c in clients:
-            self.client_combo.addItem(f"{c[1]} (ID: {c[0]})", c[0])
+        self.report_cache = ReportCache.instance(self.db.db_name)
+        self.shown = None  # cache key of the history in the table
+        self.shown_client = None  # label of the client whose history is in the table
     def generate_history(self):
-        client_index = self.client_combo.currentIndex()
-        client_id = self.client_combo.itemData(client_index)
-        invoices = self.db.get_invoices_by_client(client_id)
+        client_id = self.client_selector.client_id()
+        if client_id is None:
+            QMessageBox.warning(self, "Historial", "Seleccione un cliente de la lista.")
+            return
+        client_name = ClientSelector.label(self.client_selector.client())
+        shown = self.shown
+
+        def load():
+            key = self.report_cache.key("purchase_history", client_id)
+            if key == shown:
+                return key, client_name, None
+            # Summary comes from the maintained client_stats row, not from summing the invoices
+            return key, client_name, self.report_cache.get(
+                "purchase_history", client_id,
+                lambda: (self.db.get_invoices_by_client(client_id), self.db.get_client_stats(client_id)))
+        self.generate_btn.setEnabled(False)
+        self.executor.read(load).then(self.show_history, self.on_history_failed)
+    def show_history(self, outcome):
+        self.generate_btn.setEnabled(True)
+        key, client_name, history = outcome
+        if history is None:
+            return
+        invoices, stats = history
         self.current_history = invoices
+        self.shown_client = client_name
+        self.table.setSortingEnabled(False)
         self.table.setRowCount(len(invoices))
-        total_spent = 0
         for row, inv in enumerate(invoices):
-            # inv format: (id, client_id, client_name, date, subtotal, tax, total, file_path)
-            for col, value in enumerate(inv):  # Process all columns
-                if col >= 7:  # Skip file_path
-                    continue
-                    
+            set_invoice_row(self.table, row, inv)
+        self.table.setSortingEnabled(True)
+        self.shown = key
+        if stats is None:
+            self.current_total = 0
+            self.summary_label.setText("Total de compras: 0 | Total gastado: LPS 0.00")
+            return
+        self.current_total = stats.lifetime_total
+        self.summary_label.setText(
+            f"Total de compras: {stats.invoice_count} | Total gastado: LPS {stats.lifetime_total:,.2f} | "
+            f"Ticket promedio: LPS {stats.average_ticket:,.2f} | "
+            f"Primera compra: {stats.first_purchase} | Última compra: {stats.last_purchase}")
+    def on_history_failed(self, error):
+        self.generate_btn.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"Error al cargar el historial: {error}")
+    def build_print_report(self):
+        """Describe the purchase history shown in the table for the paged print engine."""
+        rows = shown_rows(self.table, self.current_history)
+        return PagedReport(
+            "Historial de Compras",
+            ["ID Factura", "Cliente", "Fecha", "Subtotal", "ISV", "Total"],
+            lambda: rows,
+            format_invoice_row,
+            meta=[f"Cliente: {self.shown_client}"],
+            widths=[1, 3, 2, 2, 2, 2],
+            total_label="Total gastado",
+            count_label="Compras",
+            total_rows=len(rows)
+        )
+    def print_history(self):
+        if self.shown_client is None:
+            QMessageBox.warning(self, "Imprimir", "Genere el historial antes de imprimirlo.")
+            return
+        printer = QPrinter(QPrinter.PrinterMode.HighResolution)
+        dialog = QPrintDialog(printer, self)
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            self.start_print_job(printer)
+    def export_pdf(self):
+        if self.shown_client is None:
+            QMessageBox.warning(self, "Exportar", "Genere el historial antes de exportarlo.")
+            return
+        file_name, _ = QFileDialog.getSaveFileName(self, "Guardar Historial", "historial_compras.pdf", "PDF (*.pdf)")
+        if file_name:
+            self.start_print_job(pdf_printer(file_name))
+    def start_print_job(self, printer):
+        self.print_job = ReportPrintJob(self, printer, self.build_print_report())
+        self.print_job.failed.connect(lambda error: QMessageBox.critical(self, "Error", f"Error al imprimir el historial: {error}"))
+        self.print_job.start()
+
+class ProductAnalyticsTab(QWidget):
+    def __init__(self):
+        super().__init__()
+        self.db = Database()
+        self.executor = DatabaseExecutor.instance(self.db.db_name)
+        self.analytics = SalesAnalytics(self.db.db_name)
+        layout = QVBoxLayout(self)
+        layout.setSpacing(20)
+        # --- Filters ---
+        filter_layout = QHBoxLayout()
+        self.report_type = QComboBox()
+        self.report_type.addItems(["Más vendidos", "Velocidad de venta", "Inventario sin movimiento"])
+        self.report_type.currentTextChanged.connect(self.update_filters)
+        filter_layout.addWidget(QLabel("Reporte:"))
+        filter_layout.addWidget(self.report_type)
+        self.start_label = QLabel("Fecha inicio:")
+        filter_layout.addWidget(self.start_label)
+        self.start_date = QDateEdit()
+        self.start_date.setCalendarPopup(True)
+        self.start_date.setDate(QDate.currentDate().addMonths(-1))
+        filter_layout.addWidget(self.start_date)
+        self.end_label = QLabel("Fecha fin:")
+        filter_layout.addWidget(self.end_label)
+        self.end_date = QDateEdit()
+        self.end_date.setCalendarPopup(True)
+        self.end_date.setDate(QDate.currentDate())
+        filter_layout.addWidget(self.end_date)
+        self.rank_by = QComboBox()
+        self.rank_by.addItems(["Ingresos", "Unidades"])
+        filter_layout.addWidget(self.rank_by)
+        self.limit_spin = QSpinBox()
+        self.limit_spin.setRange(1, 1000)
+        self.limit_spin.setValue(20)
+        self.limit_spin.setPrefix("Top ")
+        filter_layout.addWidget(self.limit_spin)
+        self.days_spin = QSpinBox()
+        self.days_spin.setRange(1, 3650)
+        self.days_spin.setValue(90)
+        self.days_spin.setSuffix(" días sin ventas")
+        filter_layout.addWidget(self.days_spin)
+        self.generate_btn = QPushButton("Generar Reporte")
+        self.generate_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #2980b9;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #1c5d99;
+            }
+        """)
+        self.generate_btn.clicked.connect(self.generate_report)
+        filter_layout.addWidget(self.generate_btn)
+        filter_layout.addStretch()
+        layout.addLayout(filter_layout)
+        # --- Results table ---
+        self.table = QTableWidget()
+        self.table.setAlternatingRowColors(True)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.table.setSortingEnabled(True)
+        layout.addWidget(self.table)
+        # --- Summary ---
+        self.summary_label = QLabel("")
+        self.summary_label.setStyleSheet("font-size: 15px; padding: 10px;")
+        layout.addWidget(self.summary_label)
+        self.setLayout(layout)
+        self.update_filters()
+    def update_filters(self):
+        report = self.report_type.currentText()
+        by_dates = report == "Más vendidos"
+        for widget in (self.start_label, self.start_date, self.end_label, self.end_date, self.rank_by, self.limit_spin):
+            widget.setVisible(by_dates)
+        self.days_spin.setVisible(report == "Inventario sin movimiento")
+    def generate_report(self):
+        report = self.report_type.currentText()
+        start = self.start_date.date().toString("yyyy-MM-dd")
+        end = self.end_date.date().toString("yyyy-MM-dd")
+        by = "units" if self.rank_by.currentText() == "Unidades" else "revenue"
+        limit, days = self.limit_spin.value(), self.days_spin.value()
+
+        def load():
+            if report == "Más vendidos":
+                rows = self.analytics.top_products(start, end, limit, by)
+                headers = ["ID", "Número de Serie", "Nombre", "Unidades", "Ingresos"]
+                kinds = ["int", "text", "text", "int", "money"]
+                total = sum(r[4] for r in rows)
+                summary = f"Productos: {len(rows)} | Ingresos: LPS {total:,.2f}"
+            elif report == "Velocidad de venta":
+                rows = [r[:4] + tuple(r[4:7]) + (r[7] if r[7] is not None else "",) for r in self.analytics.sales_velocity()]
+                headers = ["ID", "Número de Serie", "Nombre", "Disponible", "Unid./día (7d)", "Unid./día (30d)", "Unid./día (90d)", "Días de cobertura"]
+                kinds = ["int", "text", "text", "int", "rate", "rate", "rate", "rate"]
+                summary = f"Productos con ventas en 90 días: {len(rows)}"
+            else:
+                rows = [r[:5] + (r[5] or "Nunca",) for r in self.analytics.dead_stock(days)]
+                headers = ["ID", "Número de Serie", "Nombre", "Disponible", "Valor al costo", "Última venta"]
+                kinds = ["int", "text", "text", "int", "money", "text"]
+                total = sum(r[4] for r in rows)
+                summary = f"Productos sin movimiento: {len(rows)} | Valor inmovilizado: LPS {total:,.2f}"
+            return headers, kinds, rows, summary
+        self.generate_btn.setEnabled(False)
+        self.executor.read(load).then(self.show_report, self.on_report_failed)
+    def show_report(self, report):
+        self.generate_btn.setEnabled(True)
+        headers, kinds, rows, summary = report
+        self.show_rows(headers, kinds, rows)
+        self.summary_label.setText(summary)
+    def on_report_failed(self, error):
+        self.generate_btn.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"Error al generar el reporte: {error}")
+    def show_rows(self, headers, kinds, rows):
+        self.table.setSortingEnabled(False)
+        self.table.clear()
+        self.table.setColumnCount(len(headers))
+        self.table.setHorizontalHeaderLabels(headers)
+        self.table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for col, value in enumerate(values):
                 item = QTableWidgetItem()
-                if col == 0:  # ID
+                if value == "" or kinds[col] == "text":
+                    item.setText(str(value))
+                elif kinds[col] == "int":
                     item.setData(Qt.ItemDataRole.DisplayRole, int(value))
-                    self.table.setItem(row, 0, item)
-                elif col == 1:  # Skip client_id
-                    continue
-                elif col == 2:  # Client name
+                elif kinds[col] == "money":
+                    item.setData(Qt.ItemDataRole.DisplayRole, float(value))
+                    item.setText(f"LPS {float(value):,.2f}")
+                else:
+                    item.setData(Qt.ItemDataRole.DisplayRole, round(float(value), 2))
+                self.table.setItem(row, col, item)
+        self.table.setSortingEnabled(True)
+
+class ReplenishmentTab(QWidget):
+    def __init__(self):
+        super().__init__()
+        self.db = Database()
+        self.executor = DatabaseExecutor.instance(self.db.db_name)
+        self.planner = ReplenishmentPlanner(self.db.db_name)
+        layout = QVBoxLayout(self)
+        layout.setSpacing(20)
+        # --- Parameters ---
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(QLabel("Tiempo de entrega:"))
+        self.lead_time_spin = QSpinBox()
+        self.lead_time_spin.setRange(1, 365)
+        self.lead_time_spin.setValue(7)
+        self.lead_time_spin.setSuffix(" días")
+        filter_layout.addWidget(self.lead_time_spin)
+        filter_layout.addWidget(QLabel("Revisión cada:"))
+        self.review_spin = QSpinBox()
+        self.review_spin.setRange(1, 365)
+        self.review_spin.setValue(7)
+        self.review_spin.setSuffix(" días")
+        filter_layout.addWidget(self.review_spin)
+        filter_layout.addWidget(QLabel("Nivel de servicio:"))
+        self.service_combo = QComboBox()
+        for level in sorted(SERVICE_LEVELS):
+            self.service_combo.addItem(f"{level:.0%}", level)
+        self.service_combo.setCurrentIndex(1)
+        filter_layout.addWidget(self.service_combo)
+        self.only_needed = QCheckBox("Solo productos a reabastecer")
+        self.only_needed.setChecked(True)
+        filter_layout.addWidget(self.only_needed)
+        self.generate_btn = QPushButton("Calcular Sugerencias")
+        self.generate_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #2980b9;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #1c5d99;
+            }
+        """)
+        self.generate_btn.clicked.connect(self.generate_suggestions)
+        filter_layout.addWidget(self.generate_btn)
+        filter_layout.addStretch()
+        layout.addLayout(filter_layout)
+        # --- Results table ---
+        self.headers = ["ID", "Número de Serie", "Nombre", "Disponible", "Demanda diaria",
+                        "Prom. 7d", "Prom. 28d", "Punto de reorden", "Cantidad sugerida"]
+        self.table = QTableWidget()
+        self.table.setColumnCount(len(self.headers))
+        self.table.setHorizontalHeaderLabels(self.headers)
+        self.table.setAlternatingRowColors(True)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.table.setSortingEnabled(True)
+        layout.addWidget(self.table)
+        # --- Summary ---
+        self.summary_label = QLabel("")
+        self.summary_label.setStyleSheet("font-size: 15px; padding: 10px;")
+        layout.addWidget(self.summary_label)
+        self.setLayout(layout)
+    def generate_suggestions(self):
+        self.generate_btn.setEnabled(False)
+        self.executor.read(self.planner.suggestions, self.lead_time_spin.value(), self.review_spin.value(),
+                           self.service_combo.currentData(), self.only_needed.isChecked()).then(
+            self.show_suggestions, self.on_suggestions_failed)
+    def on_suggestions_failed(self, error):
+        self.generate_btn.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"No se pudieron calcular las sugerencias: {error}")
+    def show_suggestions(self, rows):
+        self.generate_btn.setEnabled(True)
+        self.table.setSortingEnabled(False)
+        self.table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for col, value in enumerate(values):
+                item = QTableWidgetItem()
+                if col in (1, 2):
                     item.setText(str(value))
-                    self.table.setItem(row, 1, item)
-                elif col == 3:  # Date
+                elif col in (4, 5, 6):
+                    item.setData(Qt.ItemDataRole.DisplayRole, round(value, 2))
+                else:
+                    item.setData(Qt.ItemDataRole.DisplayRole, int(value))
+                if col == 8 and value > 0:
+                    item.setForeground(QColor("#c0392b"))
+                self.table.setItem(row, col, item)
+        self.table.setSortingEnabled(True)
+        needed = sum(1 for r in rows if r[8] > 0)
+        units = sum(r[8] for r in rows)
+        self.summary_label.setText(f"Productos a reabastecer: {needed} | Unidades sugeridas: {units}")
+
+class ValuationTab(QWidget):
+    def __init__(self):
+        super().__init__()
+        self.db = Database()
+        self.executor = DatabaseExecutor.instance(self.db.db_name)
+        self.valuation = InventoryValuation(self.db.db_name)
+        layout = QVBoxLayout(self)
+        layout.setSpacing(20)
+        # --- Filters ---
+        filter_layout = QHBoxLayout()
+        self.report_type = QComboBox()
+        self.report_type.addItems(["Margen bruto por mes", "Margen por producto"])
+        filter_layout.addWidget(QLabel("Reporte:"))
+        filter_layout.addWidget(self.report_type)
+        filter_layout.addWidget(QLabel("Desde:"))
+        self.start_date = QDateEdit()
+        self.start_date.setCalendarPopup(True)
+        self.start_date.setDate(QDate.currentDate().addMonths(-5))
+        filter_layout.addWidget(self.start_date)
+        filter_layout.addWidget(QLabel("Hasta:"))
+        self.end_date = QDateEdit()
+        self.end_date.setCalendarPopup(True)
+        self.end_date.setDate(QDate.currentDate())
+        filter_layout.addWidget(self.end_date)
+        self.generate_btn = QPushButton("Generar Reporte")
+        self.generate_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #2980b9;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #1c5d99;
+            }
+        """)
+        self.generate_btn.clicked.connect(self.generate_report)
+        filter_layout.addWidget(self.generate_btn)
+        self.close_btn = QPushButton("Cerrar Mes Anterior")
+        self.close_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #27ae60;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #219150;
+            }
+        """)
+        self.close_btn.clicked.connect(self.close_period)
+        filter_layout.addWidget(self.close_btn)
+        filter_layout.addStretch()
+        layout.addLayout(filter_layout)
+        # --- Results table ---
+        self.table = QTableWidget()
+        self.table.setAlternatingRowColors(True)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.table.setSortingEnabled(True)
+        layout.addWidget(self.table)
+        # --- Summary ---
+        self.summary_label = QLabel("")
+        self.summary_label.setStyleSheet("font-size: 15px; padding: 10px;")
+        layout.addWidget(self.summary_label)
+        self.setLayout(layout)
+    def generate_report(self):
+        by_month = self.report_type.currentText() == "Margen bruto por mes"
+        start, end = self.start_date.date(), self.end_date.date()
+
+        def load():
+            if by_month:
+                rows = self.valuation.gross_margin(start.toString("yyyy-MM"), end.toString("yyyy-MM"))
+                headers = ["Mes", "Ventas", "Costo de Ventas", "Margen Bruto", "Margen %",
+                           "Compras", "Inventario Inicial", "Inventario Final", "Cerrado"]
+                rows = [r[:8] + ("Sí" if r[8] else "No",) for r in rows]
+                kinds = ["text", "money", "money", "money", "percent", "money", "money", "money", "text"]
+                revenue = sum(r[1] for r in rows)
+                margin = sum(r[3] for r in rows)
+            else:
+                rows = self.valuation.product_margins(start.toString("yyyy-MM-dd"), end.toString("yyyy-MM-dd"))
+                headers = ["ID", "Número de Serie", "Nombre", "Unidades", "Ventas", "Costo de Ventas", "Margen Bruto"]
+                kinds = ["int", "text", "text", "int", "money", "money", "money"]
+                revenue = sum(r[4] for r in rows)
+                margin = sum(r[6] for r in rows)
+            return headers, kinds, rows, revenue, margin, self.valuation.current_value()
+        self.generate_btn.setEnabled(False)
+        self.executor.read(load).then(self.show_report, self.on_report_failed)
+    def show_report(self, report):
+        self.generate_btn.setEnabled(True)
+        headers, kinds, rows, revenue, margin, current_value = report
+        self.show_rows(headers, kinds, rows)
+        percent = margin / revenue * 100 if revenue else 0.0
+        self.summary_label.setText(
+            f"Ventas: LPS {revenue:,.2f} | Margen bruto: LPS {margin:,.2f} ({percent:.1f}%) | "
+            f"Inventario actual: LPS {current_value:,.2f}"
+        )
+    def on_report_failed(self, error):
+        self.generate_btn.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"Error al generar el reporte: {error}")
+    def show_rows(self, headers, kinds, rows):
+        self.table.setSortingEnabled(False)
+        self.table.clear()
+        self.table.setColumnCount(len(headers))
+        self.table.setHorizontalHeaderLabels(headers)
+        self.table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for col, value in enumerate(values):
+                item = QTableWidgetItem()
+                if value is None:
+                    item.setText("")
+                elif kinds[col] == "int":
+                    item.setData(Qt.ItemDataRole.DisplayRole, int(value))
+                elif kinds[col] == "money":
+                    item.setData(Qt.ItemDataRole.DisplayRole, float(value))
+                    item.setText(f"LPS {float(value):,.2f}")
+                elif kinds[col] == "percent":
+                    item.setData(Qt.ItemDataRole.DisplayRole, round(float(value), 1))
+                else:
                     item.setText(str(value))
-                    self.table.setItem(row, 2, item)
-                elif col in [4, 5, 6]:  # Subtotal, ISV, Total
-                    try:
-                        float_value = float(value)
-                        item.setData(Qt.ItemDataRole.DisplayRole, float_value)
-                        item.setText(f"LPS {float_value:,.2f}")
-                        self.table.setItem(row, col - 1, item)  # Adjust column index
-                        if col == 6:  # Total
-                            total_spent += float_value
-                    except (ValueError, TypeError):
-                        item.setText(str(value))
-                        self.table.setItem(row, col - 1, item)
-        self.current_total = total_spent
-        self.summary_label.setText(f"Total de compras: {len(invoices)} | Total gastado: LPS {total_spent:,.2f}")
-    def print_history(self):
-        from PyQt6.QtGui import QTextDocument, QPainter
-        from PyQt6.QtPrintSupport import QPrinter, QPrintDialog
-        client_index = self.client_combo.currentIndex()
-        client_name = self.client_combo.currentText()
-        invoices = self.current_history
-        total_spent = self.current_total
-        html = f'''
-        <html>
-        <head>
-        <style>
-            body {{ font-family: Arial, sans-serif; color: #222; }}
-            .header {{ font-size: 22px; font-weight: bold; margin-bottom: 10px; }}
-            .meta {{ margin-bottom: 10px; }}
-            .meta span {{ margin-right: 30px; }}
-            table {{ border-collapse: collapse; width: 100%; margin-bottom: 20px; }}
-            th, td {{ border: 1px solid #ccc; padding: 6px 10px; text-align: left; }}
-            th {{ background: #f0f0f0; }}
-            .totals td {{ border: none; font-size: 16px; }}
-            .totals tr td:first-child {{ text-align: right; }}
-        </style>
-        </head>
-        <body>
-            <div class="header">Historial de Compras</div>
-            <div class="meta">
-                <span><b>Cliente:</b> {client_name}</span>
-            </div>
-            <table>
-                <tr><th>ID Factura</th><th>Cliente</th><th>Fecha</th><th>Subtotal</th><th>ISV</th><th>Total</th></tr>
-        '''
-        for inv in invoices:
-            html += f'<tr>'
-            html += f'<td>{inv[0]}</td>'
-            html += f'<td>{inv[2]}</td>'
-            html += f'<td>{inv[3]}</td>'
-            html += f'<td>LPS {float(inv[4]):,.2f}</td>'
-            html += f'<td>LPS {float(inv[5]):,.2f}</td>'
-            html += f'<td>LPS {float(inv[6]):,.2f}</td>'
-            html += f'</tr>'
-        html += f'''
-            </table>
-            <table class="totals">
-                <tr><td><b>Total de compras:</b></td><td>{len(invoices)}</td></tr>
-                <tr><td><b>Total gastado:</b></td><td>LPS {total_spent:,.2f}</td></tr>
-            </table>
-        </body>
-        </html>
-        '''
-        doc = QTextDocument()
-        doc.setHtml(html)
-        printer = QPrinter()
-        dialog = QPrintDialog(printer)
-        if dialog.exec() == QDialog.DialogCode.Accepted:
-            painter = QPainter(printer)
-            doc.drawContents(painter)
-            painter.end()
+                self.table.setItem(row, col, item)
+        self.table.setSortingEnabled(True)
+    def close_period(self):
+        period = self.valuation.closable_period()
+        reply = QMessageBox.question(
+            self, "Cerrar Mes",
+            f"¿Desea registrar el cierre de {period}? El inventario final es el actual sin los movimientos de este mes.",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+            QMessageBox.StandardButton.No
+        )
+        if reply == QMessageBox.StandardButton.Yes:
+            self.close_btn.setEnabled(False)
+            self.executor.write(self.valuation.close_period, period).then(
+                lambda value: self.on_period_closed(period, value), self.on_close_failed)
+    def on_period_closed(self, period, value):
+        self.close_btn.setEnabled(True)
+        QMessageBox.information(self, "Cerrar Mes", f"Cierre de {period} registrado. Inventario: LPS {value:,.2f}")
+        self.generate_report()
+    def on_close_failed(self, error):
+        self.close_btn.setEnabled(True)
+        if isinstance(error, ValueError):
+            QMessageBox.warning(self, "Cerrar Mes", str(error))
+        else:
+            QMessageBox.critical(self, "Error", f"Error al cerrar el mes: {error}")
+
+class StocktakeTab(QWidget):
+    # Counts still in memory are saved to the session this often while counting
+    CHECKPOINT_MS = 30000
+
+    def __init__(self, settings_manager):
+        super().__init__()
+        self.settings_manager = settings_manager
+        self.executor = DatabaseExecutor.instance()
+        self.manager = StocktakeManager(self.executor.db.db_name)
+        self.index = {}  # Scans are resolved without a query each
+        self.count = None
+        self.rows = {}  # product_id -> row of the counts table
+        layout = QVBoxLayout(self)
+        layout.setSpacing(15)
+        # --- Session and counter ---
+        session_layout = QHBoxLayout()
+        session_layout.addWidget(QLabel("Sesión:"))
+        self.session_combo = QComboBox()
+        self.session_combo.setMinimumWidth(260)
+        session_layout.addWidget(self.session_combo)
+        self.new_session_btn = QPushButton("Nueva Sesión")
+        self.new_session_btn.clicked.connect(self.new_session)
+        session_layout.addWidget(self.new_session_btn)
+        session_layout.addWidget(QLabel("Contador:"))
+        self.counter_input = QLineEdit()
+        self.counter_input.setPlaceholderText("Nombre de quien cuenta")
+        session_layout.addWidget(self.counter_input)
+        self.open_btn = QPushButton("Comenzar a Contar")
+        self.open_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #2980b9;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #1c5d99;
+            }
+        """)
+        self.open_btn.clicked.connect(self.open_count)
+        session_layout.addWidget(self.open_btn)
+        session_layout.addStretch()
+        layout.addLayout(session_layout)
+        # --- Scanning ---
+        scan_layout = QHBoxLayout()
+        self.scan_input = QLineEdit()
+        self.scan_input.setPlaceholderText("Escanee o escriba el número de serie y presione Enter")
+        self.scan_input.returnPressed.connect(self.scan)
+        self.scan_input.setEnabled(False)
+        scan_layout.addWidget(self.scan_input)
+        scan_layout.addWidget(QLabel("Cantidad:"))
+        self.quantity_spin = QSpinBox()
+        self.quantity_spin.setRange(0, 1000000)
+        self.quantity_spin.setValue(1)
+        scan_layout.addWidget(self.quantity_spin)
+        self.replace_check = QCheckBox("Reemplazar lo contado")
+        scan_layout.addWidget(self.replace_check)
+        self.save_btn = QPushButton("Guardar Conteo")
+        self.save_btn.clicked.connect(self.checkpoint)
+        scan_layout.addWidget(self.save_btn)
+        layout.addLayout(scan_layout)
+        self.scan_feedback = QLabel("")
+        self.scan_feedback.setStyleSheet("font-size: 14px; color: #7f8c8d;")
+        layout.addWidget(self.scan_feedback)
+        self.counts_table = QTableWidget()
+        self.counts_table.setColumnCount(3)
+        self.counts_table.setHorizontalHeaderLabels(["Número de Serie", "Nombre", "Contado"])
+        self.counts_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.counts_table.verticalHeader().setVisible(False)
+        self.counts_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        layout.addWidget(self.counts_table)
+        # --- Variance and adjustments ---
+        variance_layout = QHBoxLayout()
+        self.uncounted_check = QCheckBox("Conteo completo (lo no contado cuenta como 0)")
+        variance_layout.addWidget(self.uncounted_check)
+        self.variance_btn = QPushButton("Ver Diferencias")
+        self.variance_btn.clicked.connect(self.show_variance)
+        variance_layout.addWidget(self.variance_btn)
+        self.apply_btn = QPushButton("Aplicar Ajustes")
+        self.apply_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #27ae60;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #219150;
+            }
+        """)
+        self.apply_btn.clicked.connect(self.apply_adjustments)
+        variance_layout.addWidget(self.apply_btn)
+        variance_layout.addStretch()
+        layout.addLayout(variance_layout)
+        self.variance_headers = ["ID", "Número de Serie", "Nombre", "Esperado", "Contado", "Diferencia", "Valor"]
+        self.variance_table = QTableWidget()
+        self.variance_table.setColumnCount(len(self.variance_headers))
+        self.variance_table.setHorizontalHeaderLabels(self.variance_headers)
+        self.variance_table.setAlternatingRowColors(True)
+        self.variance_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.variance_table.verticalHeader().setVisible(False)
+        self.variance_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.variance_table.setSortingEnabled(True)
+        layout.addWidget(self.variance_table)
+        self.summary_label = QLabel("")
+        self.summary_label.setStyleSheet("font-size: 15px; padding: 10px;")
+        layout.addWidget(self.summary_label)
+        self.setLayout(layout)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.checkpoint)
+        self.timer.start(self.CHECKPOINT_MS)
+        self.executor.read(self.manager.product_index).then(self.set_index)
+        self.load_sessions()
+
+    def set_index(self, index):
+        self.index = index
+
+    def load_sessions(self, select=None):
+        self.executor.read(self.manager.sessions).then(lambda sessions: self.show_sessions(sessions, select))
+
+    def show_sessions(self, sessions, select=None):
+        self.session_combo.clear()
+        for session_id, name, started_at, status, closed_at in sessions:
+            self.session_combo.addItem(f"{session_id} - {name} ({started_at[:10]})", session_id)
+        if select is not None:
+            self.session_combo.setCurrentIndex(self.session_combo.findData(select))
+
+    def new_session(self):
+        name, ok = QInputDialog.getText(self, "Nueva Sesión", "Nombre del conteo:",
+                                        text=f"Conteo {QDate.currentDate().toString('yyyy-MM-dd')}")
+        if ok and name.strip():
+            self.executor.write(self.manager.start_session, name.strip()).then(
+                lambda session_id: self.load_sessions(select=session_id))
+
+    def open_count(self):
+        session_id = self.session_combo.currentData()
+        counter = self.counter_input.text().strip()
+        if session_id is None or not counter:
+            QMessageBox.warning(self, "Conteo Físico", "Seleccione una sesión e indique el nombre de quien cuenta.")
+            return
+        self.checkpoint()  # Counts of the previous session or counter
+        self.count = None
+        self.scan_input.setEnabled(False)
+        self.open_btn.setEnabled(False)
+        # On the writer, so the saved counts are read after the checkpoint just queued
+        self.executor.write(self.manager.open_count, session_id, counter).then(
+            self.show_open_count, self.on_open_failed)
+
+    def on_open_failed(self, error):
+        self.open_btn.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"No se pudo abrir el conteo: {error}")
+
+    def show_open_count(self, count):
+        self.open_btn.setEnabled(True)
+        self.count = count
+        products = {product_id: (serial, name) for serial, (product_id, name) in self.index.items()}
+        self.rows = {}
+        self.counts_table.setRowCount(0)
+        for product_id, quantity in self.count.counts.items():
+            serial, name = products.get(product_id, ("", ""))
+            self.show_count(product_id, serial, name, quantity)
+        self.scan_input.setEnabled(True)
+        self.scan_input.setFocus()
+        self.scan_feedback.setText(f"Contando en la sesión {count.session_id} como {count.counter}")
+
+    def scan(self):
+        serial = self.scan_input.text().strip()
+        self.scan_input.clear()
+        if not serial or self.count is None:
+            return
+        quantity, replace = self.quantity_spin.value(), self.replace_check.isChecked()
+        if serial in self.index:
+            self.record_scan(serial, quantity, replace)
+        else:
+            # Products added since the index was loaded
+            self.executor.read(self.manager.product_index).then(
+                lambda index: self.on_index_reloaded(index, serial, quantity, replace))
+
+    def on_index_reloaded(self, index, serial, quantity, replace):
+        self.index = index
+        if serial not in index:
+            self.scan_feedback.setText(f"Número de serie no encontrado: {serial}")
+            return
+        self.record_scan(serial, quantity, replace)
+
+    def record_scan(self, serial, quantity, replace):
+        if self.count is None:
+            return  # The count was closed or another one opened meanwhile
+        product_id, name = self.index[serial]
+        if replace:
+            total = self.count.set(product_id, quantity)
+        else:
+            total = self.count.add(product_id, quantity)
+        self.show_count(product_id, serial, name, total)
+        self.quantity_spin.setValue(1)
+        self.scan_feedback.setText(f"{name}: {total}")
+
+    def show_count(self, product_id, serial, name, quantity):
+        row = self.rows.get(product_id)
+        if row is None:
+            row = self.rows[product_id] = self.counts_table.rowCount()
+            self.counts_table.insertRow(row)
+            self.counts_table.setItem(row, 0, QTableWidgetItem(serial))
+            self.counts_table.setItem(row, 1, QTableWidgetItem(name))
+        item = QTableWidgetItem()
+        item.setData(Qt.ItemDataRole.DisplayRole, int(quantity))
+        self.counts_table.setItem(row, 2, item)
+        self.counts_table.scrollToItem(item)
+
+    def checkpoint(self):
+        """Save the counts changed since the last checkpoint, on the writer thread."""
+        count = self.count
+        if count is None or not count.pending():
+            return
+        rows = count.checkpoint_rows()
+        self.executor.write(self.manager.save_counts, count.session_id, count.counter, rows).then(
+            lambda saved: self.scan_feedback.setText(f"Conteo guardado ({saved} productos)"),
+            lambda error: self.on_checkpoint_failed(count, [r[0] for r in rows], error))
+
+    def on_checkpoint_failed(self, count, product_ids, error):
+        count.mark_unsaved(product_ids)
+        self.scan_feedback.setText(f"No se pudo guardar el conteo, se reintentará: {error}")
+
+    def hideEvent(self, event):
+        self.checkpoint()  # Tab switched or closed
+        super().hideEvent(event)
+
+    def show_variance(self):
+        session_id = self.session_combo.currentData()
+        if session_id is None:
+            return
+        self.checkpoint()
+        # On the writer, so it runs after the checkpoint just queued
+        self.executor.write(self.manager.variance, session_id, self.uncounted_check.isChecked()).then(
+            self.show_variance_rows)
+
+    def show_variance_rows(self, rows):
+        self.variance_table.setSortingEnabled(False)
+        self.variance_table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for col, value in enumerate(values):
+                item = QTableWidgetItem()
+                if col in (1, 2):
+                    item.setText(str(value))
+                elif col == 6:
+                    item.setData(Qt.ItemDataRole.DisplayRole, float(value))
+                    item.setText(f"LPS {float(value):,.2f}")
+                else:
+                    item.setData(Qt.ItemDataRole.DisplayRole, int(value))
+                if col == 5:
+                    item.setForeground(QColor("#c0392b" if value < 0 else "#27ae60"))
+                self.variance_table.setItem(row, col, item)
+        self.variance_table.setSortingEnabled(True)
+        value = sum(r[6] for r in rows)
+        self.summary_label.setText(f"Productos con diferencia: {len(rows)} | Valor neto: LPS {value:,.2f}")
+
+    def apply_adjustments(self):
+        session_id = self.session_combo.currentData()
+        if session_id is None:
+            return
+        reply = QMessageBox.question(
+            self, "Aplicar Ajustes",
+            "¿Desea ajustar las existencias según el conteo y cerrar la sesión?",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+            QMessageBox.StandardButton.No
+        )
+        if reply != QMessageBox.StandardButton.Yes:
+            return
+        self.checkpoint()
+        self.apply_btn.setEnabled(False)
+        self.executor.write(self.manager.apply, session_id, None, self.uncounted_check.isChecked(),
+                            self.settings_manager.get_setting("costing_method", "average")).then(
+            self.on_adjustments_applied, self.on_adjustments_failed)
+
+    def on_adjustments_applied(self, result):
+        self.apply_btn.setEnabled(True)
+        success, value = result
+        if not success:
+            QMessageBox.warning(self, "Aplicar Ajustes", value)
+            return
+        QMessageBox.information(self, "Aplicar Ajustes", f"Existencias ajustadas en {value} productos.")
+        self.count = None
+        self.scan_input.setEnabled(False)
+        self.counts_table.setRowCount(0)
+        self.rows = {}
+        self.load_sessions()
+
+    def on_adjustments_failed(self, error):
+        self.apply_btn.setEnabled(True)
+        QMessageBox.critical(self, "Error", f"No se pudieron aplicar los ajustes: {error}")
+
+class PurchasesTab(QWidget):
+    # Emitted from the writer thread while a receipt is posted; delivered on the GUI thread
+    receive_progress = pyqtSignal(int, int)
+
+    # Columns of the order lines table
+    RECEIVE_COL, COST_COL = 6, 7
+
+    def __init__(self, settings_manager):
+        super().__init__()
+        self.settings_manager = settings_manager
+        self.executor = DatabaseExecutor.instance()
+        self.orders = PurchaseOrders(self.executor.db.db_name)
+        self.index = {}  # Lines are resolved without a query each
+        self.new_lines = {}  # product_id -> [quantity, unit cost] of the order being written
+        self.receipt_cancelled = False
+        self.progress_dialog = None
+        layout = QVBoxLayout(self)
+        layout.setSpacing(15)
+        # --- New order ---
+        new_group = QGroupBox("Nueva Orden de Compra")
+        new_layout = QVBoxLayout(new_group)
+        entry_layout = QHBoxLayout()
+        entry_layout.addWidget(QLabel("Proveedor:"))
+        self.supplier_input = QLineEdit()
+        entry_layout.addWidget(self.supplier_input)
+        self.serial_input = QLineEdit()
+        self.serial_input.setPlaceholderText("Número de serie")
+        self.serial_input.returnPressed.connect(self.add_line)
+        entry_layout.addWidget(self.serial_input)
+        entry_layout.addWidget(QLabel("Cantidad:"))
+        self.quantity_spin = QSpinBox()
+        self.quantity_spin.setRange(1, 1000000)
+        entry_layout.addWidget(self.quantity_spin)
+        entry_layout.addWidget(QLabel("Costo:"))
+        self.cost_spin = QDoubleSpinBox()
+        self.cost_spin.setRange(0, 1000000)
+        self.cost_spin.setDecimals(2)
+        self.cost_spin.setSpecialValueText("Actual")  # 0: the product's current cost
+        entry_layout.addWidget(self.cost_spin)
+        add_btn = QPushButton("Agregar")
+        add_btn.clicked.connect(self.add_line)
+        entry_layout.addWidget(add_btn)
+        import_btn = QPushButton("Importar CSV")
+        import_btn.clicked.connect(self.import_csv)
+        entry_layout.addWidget(import_btn)
+        self.create_btn = QPushButton("Crear Orden")
+        self.create_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #2980b9;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #1c5d99;
+            }
+        """)
+        self.create_btn.clicked.connect(self.create_order)
+        entry_layout.addWidget(self.create_btn)
+        new_layout.addLayout(entry_layout)
+        self.new_table = QTableWidget()
+        self.new_table.setColumnCount(4)
+        self.new_table.setHorizontalHeaderLabels(["Número de Serie", "Nombre", "Cantidad", "Costo"])
+        self.new_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.new_table.verticalHeader().setVisible(False)
+        self.new_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.new_table.setMaximumHeight(180)
+        new_layout.addWidget(self.new_table)
+        layout.addWidget(new_group)
+        # --- Orders ---
+        orders_layout = QHBoxLayout()
+        orders_layout.addWidget(QLabel("Mostrar:"))
+        self.status_combo = QComboBox()
+        self.status_combo.addItem("Pendientes", "pending")
+        self.status_combo.addItem("Todas", None)
+        self.status_combo.currentIndexChanged.connect(self.load_orders)
+        orders_layout.addWidget(self.status_combo)
+        orders_layout.addStretch()
+        layout.addLayout(orders_layout)
+        self.orders_table = QTableWidget()
+        self.orders_table.setColumnCount(7)
+        self.orders_table.setHorizontalHeaderLabels(["ID", "Proveedor", "Fecha", "Estado", "Líneas", "Pedido", "Recibido"])
+        self.orders_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.orders_table.verticalHeader().setVisible(False)
+        self.orders_table.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        self.orders_table.setSelectionMode(QTableWidget.SelectionMode.SingleSelection)
+        self.orders_table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.orders_table.setMaximumHeight(200)
+        self.orders_table.itemSelectionChanged.connect(self.load_order_lines)
+        layout.addWidget(self.orders_table)
+        # --- Receiving ---
+        receive_layout = QHBoxLayout()
+        receive_layout.addWidget(QLabel("Factura o guía:"))
+        self.reference_input = QLineEdit()
+        receive_layout.addWidget(self.reference_input)
+        fill_btn = QPushButton("Recibir Todo lo Pendiente")
+        fill_btn.clicked.connect(self.fill_pending)
+        receive_layout.addWidget(fill_btn)
+        self.receive_btn = QPushButton("Registrar Recepción")
+        self.receive_btn.setStyleSheet("""
+            QPushButton {
+                background-color: #27ae60;
+                color: white;
+                padding: 8px 18px;
+                border-radius: 6px;
+                font-size: 14px;
+            }
+            QPushButton:hover {
+                background-color: #219150;
+            }
+        """)
+        self.receive_btn.clicked.connect(self.receive)
+        receive_layout.addWidget(self.receive_btn)
+        cancel_btn = QPushButton("Cancelar Orden")
+        cancel_btn.clicked.connect(self.cancel_order)
+        receive_layout.addWidget(cancel_btn)
+        layout.addLayout(receive_layout)
+        self.lines_table = QTableWidget()
+        self.lines_table.setColumnCount(8)
+        self.lines_table.setHorizontalHeaderLabels(["ID", "Número de Serie", "Nombre", "Pedido", "Recibido",
+                                                    "Pendiente", "Recibir", "Costo"])
+        self.lines_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.lines_table.verticalHeader().setVisible(False)
+        self.lines_table.setItemDelegateForColumn(self.COST_COL, CurrencyDelegate(self.lines_table))
+        layout.addWidget(self.lines_table)
+        self.status_label = QLabel("Doble clic en Recibir o Costo para indicar lo que llegó.")
+        self.status_label.setStyleSheet("font-size: 14px; color: #7f8c8d;")
+        layout.addWidget(self.status_label)
+        self.setLayout(layout)
+        self.receive_progress.connect(self.on_receive_progress)
+        self.executor.read(self.orders.product_index).then(self.set_index)
+        self.load_orders()
+
+    def set_index(self, index):
+        self.index = index
+
+    def add_line(self):
+        serial = self.serial_input.text().strip()
+        if not serial:
+            return
+        quantity, cost = self.quantity_spin.value(), self.cost_spin.value()
+        if serial in self.index:
+            self.add_resolved_line(serial, quantity, cost)
+        else:
+            # Products added since the index was loaded
+            self.executor.read(self.orders.product_index).then(
+                lambda index: self.on_index_reloaded(index, serial, quantity, cost))
+
+    def on_index_reloaded(self, index, serial, quantity, cost):
+        self.index = index
+        if serial not in index:
+            QMessageBox.warning(self, "Orden de Compra", f"Número de serie no encontrado: {serial}")
+            return
+        self.add_resolved_line(serial, quantity, cost)
+
+    def add_resolved_line(self, serial, quantity, unit_cost):
+        product_id, name, cost = self.index[serial]
+        line = self.new_lines.setdefault(product_id, [0, cost])
+        line[0] += quantity
+        if unit_cost > 0:
+            line[1] = unit_cost
+        self.serial_input.clear()
+        self.quantity_spin.setValue(1)
+        self.show_new_lines()
+        self.serial_input.setFocus()
+
+    def import_csv(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Importar Líneas", "", "CSV (*.csv)")
+        if not path:
+            return
+
+        def load():
+            index = self.orders.product_index()
+            return index, read_lines_csv(path, index)
+        self.executor.read(load).then(self.on_csv_read,
+                                      lambda error: QMessageBox.warning(self, "Importar CSV", str(error)))
+
+    def on_csv_read(self, result):
+        self.index, (lines, unknown) = result
+        for product_id, quantity, unit_cost in lines:
+            line = self.new_lines.setdefault(product_id, [0, unit_cost])
+            line[0] += quantity
+            line[1] = unit_cost
+        self.show_new_lines()
+        if unknown:
+            QMessageBox.warning(self, "Importar CSV", f"{len(unknown)} números de serie no encontrados, "
+                                f"por ejemplo: {', '.join(unknown[:5])}")
+
+    def show_new_lines(self):
+        products = {product_id: (serial, name) for serial, (product_id, name, _) in self.index.items()}
+        self.new_table.setRowCount(len(self.new_lines))
+        for row, (product_id, (quantity, cost)) in enumerate(self.new_lines.items()):
+            serial, name = products.get(product_id, ("", ""))
+            self.new_table.setItem(row, 0, QTableWidgetItem(serial))
+            self.new_table.setItem(row, 1, QTableWidgetItem(name))
+            self.new_table.setItem(row, 2, numeric_item(int(quantity)))
+            self.new_table.setItem(row, 3, numeric_item(float(cost), f"LPS {float(cost):,.2f}"))
+
+    def create_order(self):
+        lines = [(product_id, quantity, cost) for product_id, (quantity, cost) in self.new_lines.items()]
+        self.executor.write(self.orders.create_order, self.supplier_input.text(), lines).then(self.on_order_created)
+
+    def on_order_created(self, result):
+        success, value = result
+        if not success:
+            QMessageBox.warning(self, "Orden de Compra", value)
+            return
+        self.new_lines = {}
+        self.new_table.setRowCount(0)
+        self.supplier_input.clear()
+        self.status_label.setText(f"Orden de compra {value} creada.")
+        self.load_orders(select=value)
+
+    def load_orders(self, *_, select=None):
+        status = self.status_combo.currentData()
+        self.executor.read(self.orders.orders).then(lambda rows: self.show_orders(rows, status, select))
+
+    def show_orders(self, rows, status, select=None):
+        rows = [r for r in rows if status is None or r[3] in ("open", "partial")]
+        labels = {"open": "Abierta", "partial": "Parcial", "received": "Recibida", "cancelled": "Cancelada"}
+        self.orders_table.setRowCount(len(rows))
+        for row, (order_id, supplier, created_at, state, lines, ordered, received) in enumerate(rows):
+            self.orders_table.setItem(row, 0, numeric_item(int(order_id)))
+            self.orders_table.setItem(row, 1, QTableWidgetItem(supplier))
+            self.orders_table.setItem(row, 2, QTableWidgetItem(created_at))
+            self.orders_table.setItem(row, 3, QTableWidgetItem(labels.get(state, state)))
+            self.orders_table.setItem(row, 4, numeric_item(int(lines)))
+            self.orders_table.setItem(row, 5, numeric_item(int(ordered)))
+            self.orders_table.setItem(row, 6, numeric_item(int(received)))
+            if order_id == select:
+                self.orders_table.selectRow(row)
+        if not rows:
+            self.lines_table.setRowCount(0)
+
+    def current_order(self):
+        row = self.orders_table.currentRow()
+        if row < 0 or not self.orders_table.selectedItems():
+            return None
+        return int(self.orders_table.item(row, 0).data(Qt.ItemDataRole.DisplayRole))
+
+    def load_order_lines(self):
+        order_id = self.current_order()
+        if order_id is None:
+            return
+        self.executor.read(self.orders.order_lines, order_id).then(self.show_order_lines)
+
+    def show_order_lines(self, rows):
+        self.lines_table.setRowCount(len(rows))
+        for row, (product_id, serial, name, ordered, received, unit_cost) in enumerate(rows):
+            values = [int(product_id), serial, name, int(ordered), int(received), int(ordered - received)]
+            for col, value in enumerate(values):
+                item = numeric_item(value) if isinstance(value, int) else QTableWidgetItem(value)
+                item.setFlags(item.flags() & ~Qt.ItemFlag.ItemIsEditable)
+                self.lines_table.setItem(row, col, item)
+            self.lines_table.setItem(row, self.RECEIVE_COL, numeric_item(0))
+            self.lines_table.setItem(row, self.COST_COL, numeric_item(float(unit_cost)))
+
+    def fill_pending(self):
+        for row in range(self.lines_table.rowCount()):
+            pending = self.lines_table.item(row, 5).data(Qt.ItemDataRole.DisplayRole)
+            self.lines_table.item(row, self.RECEIVE_COL).setData(Qt.ItemDataRole.DisplayRole, int(pending))
+
+    def receive(self):
+        order_id = self.current_order()
+        if order_id is None:
+            return
+        lines = []
+        for row in range(self.lines_table.rowCount()):
+            try:
+                quantity = int(self.lines_table.item(row, self.RECEIVE_COL).data(Qt.ItemDataRole.DisplayRole))
+                cost = float(self.lines_table.item(row, self.COST_COL).data(Qt.ItemDataRole.DisplayRole))
+            except (TypeError, ValueError):
+                QMessageBox.warning(self, "Recepción", f"Cantidad o costo no válido en la fila {row + 1}.")
+                return
+            if quantity > 0:
+                product_id = int(self.lines_table.item(row, 0).data(Qt.ItemDataRole.DisplayRole))
+                lines.append((product_id, quantity, cost))
+        if not lines:
+            QMessageBox.warning(self, "Recepción", "Indique en la columna Recibir las cantidades que llegaron.")
+            return
+        self.receipt_cancelled = False
+        self.receive_btn.setEnabled(False)
+        self.progress_dialog = QProgressDialog("Registrando recepción...", "Cancelar", 0, len(lines), self)
+        self.progress_dialog.setWindowTitle("Recepción")
+        self.progress_dialog.setWindowModality(Qt.WindowModality.WindowModal)
+        self.progress_dialog.setMinimumDuration(500)
+        self.progress_dialog.canceled.connect(self.cancel_receipt)
+        self.executor.write(self.orders.receive, order_id, lines, self.reference_input.text().strip(),
+                            progress=self.receive_progress.emit,
+                            is_cancelled=lambda: self.receipt_cancelled).then(
+            lambda result: self.on_received(order_id, result), self.on_receive_failed)
+
+    def cancel_receipt(self):
+        self.receipt_cancelled = True  # Checked by the writer between batches
+
+    def on_receive_progress(self, done, total):
+        if self.progress_dialog is not None:
+            self.progress_dialog.setValue(done)
+            self.progress_dialog.setLabelText(f"Registrando recepción... {done} de {total} líneas")
+
+    def close_progress(self):
+        self.receive_btn.setEnabled(True)
+        if self.progress_dialog is not None:
+            self.progress_dialog.reset()
+            self.progress_dialog = None
+
+    def on_received(self, order_id, result):
+        self.close_progress()
+        success, value = result
+        if not success:
+            QMessageBox.warning(self, "Recepción", value)
+            return
+        self.reference_input.clear()
+        self.status_label.setText(f"Recepción {value} registrada.")
+        self.load_orders(select=order_id)
+        self.load_order_lines()
+
+    def on_receive_failed(self, error):
+        self.close_progress()
+        QMessageBox.critical(self, "Error", f"No se pudo registrar la recepción: {error}")
+
+    def cancel_order(self):
+        order_id = self.current_order()
+        if order_id is None:
+            return
+        reply = QMessageBox.question(
+            self, "Cancelar Orden",
+            f"¿Cancelar la orden {order_id}? Lo ya recibido se mantiene.",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+            QMessageBox.StandardButton.No
+        )
+        if reply == QMessageBox.StandardButton.Yes:
+            self.executor.write(self.orders.cancel_order, order_id).then(lambda _: self.load_orders())
+
 
 class SettingsTab(QWidget):
     def __init__(self, settings_manager, parent=None):
@@ -1987,14 +3713,40 @@ class SettingsTab(QWidget):
         self.invoice_folder = QLineEdit(self.settings_manager.get_setting("invoice_folder"))
         invoice_layout.addRow("Carpeta de Facturas:", self.invoice_folder)
         
+        self.invoice_storage = QComboBox()
+        self.invoice_storage.addItems(["sharded", "flat", "blob"])
+        self.invoice_storage.setCurrentText(self.settings_manager.get_setting("invoice_storage", "sharded"))
+        invoice_layout.addRow("Almacenamiento de Facturas:", self.invoice_storage)
+        
         self.tax_rate = QDoubleSpinBox()
         self.tax_rate.setRange(0, 100)
         self.tax_rate.setValue(self.settings_manager.get_setting("tax_rate"))
         invoice_layout.addRow("Tasa de ISV (%):", self.tax_rate)
         
+        self.costing_method = QComboBox()
+        self.costing_method.addItems(["average", "fifo"])
+        self.costing_method.setCurrentText(self.settings_manager.get_setting("costing_method", "average"))
+        invoice_layout.addRow("Método de Costeo:", self.costing_method)
+        
         invoice_group.setLayout(invoice_layout)
         scroll_layout.addWidget(invoice_group)
         
+        # Database Settings
+        database_group = QGroupBox("Base de Datos")
+        database_layout = QFormLayout()
+        
+        self.database_backend = QComboBox()
+        self.database_backend.addItems(["local", "server"])
+        self.database_backend.setCurrentText(self.settings_manager.get_setting("database_backend", "local"))
+        database_layout.addRow("Base de Datos:", self.database_backend)
+        
+        self.server_url = QLineEdit(self.settings_manager.get_setting("server_url", "http://127.0.0.1:8765"))
+        self.server_url.setPlaceholderText("http://servidor:8765 (python manage.py serve)")
+        database_layout.addRow("Servidor de Inventario:", self.server_url)
+        
+        database_group.setLayout(database_layout)
+        scroll_layout.addWidget(database_group)
+        
         # Backup Settings
         backup_group = QGroupBox("Configuración de Backup")
         backup_layout = QFormLayout()
@@ -2042,11 +3794,20 @@ class SettingsTab(QWidget):
         self.settings_manager.set_setting("company_phone", self.company_phone.text())
         self.settings_manager.set_setting("invoice_prefix", self.invoice_prefix.text())
         self.settings_manager.set_setting("invoice_folder", self.invoice_folder.text())
+        self.settings_manager.set_setting("invoice_storage", self.invoice_storage.currentText())
         self.settings_manager.set_setting("tax_rate", self.tax_rate.value())
+        self.settings_manager.set_setting("costing_method", self.costing_method.currentText())
         self.settings_manager.set_setting("backup_recipient_email", self.backup_recipient_email.text())
         self.settings_manager.set_setting("backup_frequency", self.backup_frequency.currentText())
+        database_changed = (self.database_backend.currentText() != self.settings_manager.get_setting("database_backend", "local")
+                            or self.server_url.text().strip() != self.settings_manager.get_setting("server_url"))
+        self.settings_manager.set_setting("database_backend", self.database_backend.currentText())
+        self.settings_manager.set_setting("server_url", self.server_url.text().strip())
         
-        QMessageBox.information(self, "Configuración", "Configuración guardada exitosamente.")
+        message = "Configuración guardada exitosamente."
+        if database_changed:
+            message += "\nReinicie la aplicación para usar la nueva base de datos."
+        QMessageBox.information(self, "Configuración", message)
 
     def create_backup(self):
         """Create a backup using the backup manager."""
@@ -2107,8 +3868,8 @@ class SettingsTab(QWidget):
                 # Create new database connection in main window
                 if self.main_window:
                     self.main_window.db = Database()
-                    # Refresh all tabs
-                    self.main_window.refresh_all_tabs()
+                    # Refresh all tabs (through the change bus reset signal)
+                    self.main_window.change_bus.resync()
 
                 QMessageBox.information(self, "Restauración", "Backup restaurado exitosamente.")
 
@@ -2116,6 +3877,12 @@ class SettingsTab(QWidget):
             QMessageBox.critical(self, "Error", f"Error al restaurar backup: {str(e)}")
 
 class MainWindow(QMainWindow):
+    # Reports that query the database file directly; not available against the inventory server
+    LOCAL_ONLY_TABS = {"Reabastecimiento", "Reportes de Ventas", "Tabla Dinámica", "Historial de Compras",
+                       "Análisis de Productos", "Valoración de Inventario", "Conteo Físico",
+                       "Compras"}
+    migration_progress = pyqtSignal(str)  # Emitted from the background thread running the backfills
+
     def __init__(self):
         super().__init__()
         self.settings_manager = SettingsManager()
@@ -2124,8 +3891,35 @@ class MainWindow(QMainWindow):
         self.backup_manager.backup_failed.connect(self.show_backup_error)
         self.backup_manager.start_backup_timer()
         
-        # Initialize database
-        self.db = Database()
+        # Initialize database: this computer's file, or the inventory server shared by several cashiers
+        self.db = open_database(self.settings_manager)
+        self.server_mode = isinstance(self.db, RemoteDatabase)
+        if self.server_mode:
+            RemoteChangeBus.install(self.db)
+        # Row-level change notifications for the open tabs; a full reload only after a restore
+        self.change_bus = ChangeBus.instance(self.db.db_name)
+        self.catalog = Catalog.instance(self.db.db_name, self.db)
+        self.catalog.reset.connect(self.refresh_all_tabs)  # After the catalog dropped its rows
+        # Tabs run their queries through this executor so the window never waits on the database
+        self.executor = DatabaseExecutor.instance(self.db.db_name, self.db)
+        self.executor.failed.connect(self.show_database_error)
+        QApplication.instance().aboutToQuit.connect(self.executor.shutdown)
+        if not self.server_mode:
+            # Periodic stock snapshots keep "stock as of a date" to a short range of movements
+            self.executor.write(StockLedger(self.db.db_name).snapshot_if_due)
+            # The month that just ended is closed as early as possible, before much new activity
+            self.executor.write(InventoryValuation(self.db.db_name).close_due_period)
+        # ANALYZE, incremental vacuum and WAL checkpoints while nobody is writing
+        self.maintenance_manager = MaintenanceManager(self.settings_manager, self.executor)
+        self.maintenance_manager.maintenance_failed.connect(self.show_database_error)
+        self.maintenance_manager.start_maintenance_timer()
+        if not self.server_mode:
+            # Data conversions of schema migrations, in chunks; stopped on exit and resumed on the next start
+            self.migrations_stop = threading.Event()
+            QApplication.instance().aboutToQuit.connect(self.migrations_stop.set)
+            self.migration_progress.connect(self.statusBar().showMessage)
+            self.executor.background(Migrator(self.db.db_name).run_backfills, self.report_migration_progress,
+                                     self.migrations_stop.is_set).then(self.on_backfills_finished)
         
         self.setWindowTitle("Sistema de Inventario")
         self.setMinimumSize(1200, 800)
@@ -2145,6 +3939,7 @@ class MainWindow(QMainWindow):
         buttons = [
             ("Inicio", "home"),
             ("Inventario", "box"),
+            ("Reabastecimiento", "shopping-cart"),
             ("Agregar Producto", "plus"),
             ("Actualizar Producto", "edit"),
             ("Clientes", "users"),
@@ -2153,13 +3948,21 @@ class MainWindow(QMainWindow):
             ("Generar Factura", "file-text"),
             ("Administrar Facturas", "file"),
             ("Reportes de Ventas", "bar-chart"),
-            ("Historial de Compras", "history")
+            ("Tabla Dinámica", "grid"),
+            ("Historial de Compras", "history"),
+            ("Análisis de Productos", "trending-up"),
+            ("Valoración de Inventario", "dollar-sign"),
+            ("Conteo Físico", "check-square"),
+            ("Compras", "truck")
         ]
         
         for text, icon in buttons:
             btn = QPushButton(text)
             btn.setIcon(QIcon(f"icons/{icon}.png"))
             btn.clicked.connect(lambda checked, t=text: self.open_tab(t))
+            if self.server_mode and text in self.LOCAL_ONLY_TABS:
+                btn.setEnabled(False)
+                btn.setToolTip("Disponible solo en el equipo con la base de datos local")
             menu_layout.addWidget(btn)
         
         # Add settings button at the bottom
@@ -2195,6 +3998,18 @@ class MainWindow(QMainWindow):
         """Show an error message for backup operations."""
         QMessageBox.critical(self, "Error de Backup", error)
 
+    def report_migration_progress(self, version, description, done, total):
+        """Called on the background thread after every chunk of a backfill."""
+        self.migration_progress.emit(f"Actualizando base de datos: {description} ({done}/{total})")
+
+    def on_backfills_finished(self, finished):
+        if finished:
+            self.statusBar().clearMessage()
+
+    def show_database_error(self, error):
+        """Show an error of a background database call that had no handler of its own."""
+        QMessageBox.critical(self, "Error de Base de Datos", error)
+
     def close_tab(self, index):
         if self.tab_widget.tabText(index) != "Inicio":
             self.tab_widget.removeTab(index)
@@ -2361,14 +4176,18 @@ class MainWindow(QMainWindow):
                 return
 
         # Create new tab
+        if self.server_mode and tab_name in self.LOCAL_ONLY_TABS:
+            return
         if tab_name == "Inicio":
             tab = WelcomeTab()
         elif tab_name == "Inventario":
-            tab = InventoryTab()
+            tab = InventoryTab(self.settings_manager)
+        elif tab_name == "Reabastecimiento":
+            tab = ReplenishmentTab()
         elif tab_name == "Agregar Producto":
             tab = AddProductTab()
         elif tab_name == "Actualizar Producto":
-            tab = UpdateProductTab()
+            tab = UpdateProductTab(self.settings_manager)
         elif tab_name == "Clientes":
             tab = ClientsTab()
         elif tab_name == "Agregar Cliente":
@@ -2378,11 +4197,21 @@ class MainWindow(QMainWindow):
         elif tab_name == "Generar Factura":
             tab = GenerateInvoiceTab(self.settings_manager)
         elif tab_name == "Administrar Facturas":
-            tab = ManageInvoicesTab()
+            tab = ManageInvoicesTab(self.settings_manager)
         elif tab_name == "Reportes de Ventas":
             tab = SalesReportTab()
+        elif tab_name == "Tabla Dinámica":
+            tab = PivotTab()
         elif tab_name == "Historial de Compras":
             tab = PurchaseHistoryTab()
+        elif tab_name == "Análisis de Productos":
+            tab = ProductAnalyticsTab()
+        elif tab_name == "Valoración de Inventario":
+            tab = ValuationTab()
+        elif tab_name == "Conteo Físico":
+            tab = StocktakeTab(self.settings_manager)
+        elif tab_name == "Compras":
+            tab = PurchasesTab(self.settings_manager)
         elif tab_name == "Settings":
             tab = SettingsTab(self.settings_manager, self)
             tab_name = "Configuración"
@@ -2394,7 +4223,9 @@ class MainWindow(QMainWindow):
         self.tab_widget.setCurrentWidget(tab)
 
     def refresh_all_tabs(self):
-        """Refresh all open tabs after restoring a backup."""
+        """Refresh all open tabs after the database was replaced (e.g. a restored backup)."""
+        # The restored change_log may reuse positions, so cached reports cannot be trusted
+        ReportCache.instance(self.db.db_name).clear()
         for i in range(self.tab_widget.count()):
             widget = self.tab_widget.widget(i)
             tab_text = self.tab_widget.tabText(i)
@@ -2407,12 +4238,14 @@ class MainWindow(QMainWindow):
             elif isinstance(widget, ManageInvoicesTab):
                 widget.load_invoices()
             elif isinstance(widget, GenerateInvoiceTab):
-                widget.load_clients()
+                widget.client_selector.clear_selection()
                 widget.load_products()
             elif isinstance(widget, SalesReportTab):
+                widget.shown = None
                 widget.generate_report()
             elif isinstance(widget, PurchaseHistoryTab):
-                widget.load_clients()
+                widget.shown = None
+                widget.client_selector.clear_selection()
 
 def main():
     app = QApplication(sys.argv)
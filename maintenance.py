@@ -0,0 +1,170 @@
+import os
+import time
+import sqlite3
+import datetime
+
+# Pages released per incremental_vacuum step; each step is one short write transaction
+VACUUM_SLICE_PAGES = 256
+# Pause between steps, so a queued write (a checkout) gets the lock in between
+VACUUM_PAUSE = 0.05
+# Seconds a run may spend vacuuming; what is left is freed by the next run
+VACUUM_BUDGET = 2.0
+# Rows ANALYZE samples per index (PRAGMA analysis_limit), so it stays fast on large tables
+ANALYSIS_LIMIT = 1000
+# Files up to this size are switched to incremental auto-vacuum on their own (one full VACUUM)
+AUTO_CONVERT_MAX_BYTES = 16 * 1024 * 1024
+# Seconds a maintenance statement waits for the lock; on a busy database the step is skipped
+LOCK_TIMEOUT = 0.25
+# Time between runs of optimize and vacuum
+FULL_RUN_INTERVAL = datetime.timedelta(days=1)
+# WAL size from which an idle check also checkpoints (SQLite's own checkpoints never shrink the file)
+CHECKPOINT_WAL_BYTES = 1024 * 1024
+
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+
+def _now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class DatabaseMaintenance:
+    """
+    Keeps the database file healthy without getting in the way of the cashiers: PRAGMA
+    optimize (ANALYZE with a sampling limit) so query plans follow the data, an
+    incremental vacuum in steps of a few hundred pages with pauses between them, and a WAL
+    checkpoint that gives up instead of waiting for readers and writers. Every task is
+    logged in maintenance_log with its duration and the file sizes before and after.
+    """
+
+    def __init__(self, db_name="inventory.db"):
+        self.db_name = db_name
+
+    def _connect(self, timeout=LOCK_TIMEOUT):
+        # Autocommit: every PRAGMA is its own short transaction, and VACUUM may run
+        return sqlite3.connect(self.db_name, timeout=timeout, isolation_level=None)
+
+    def sizes(self):
+        """(database bytes, WAL bytes)."""
+        wal = self.db_name + "-wal"
+        return os.path.getsize(self.db_name), os.path.getsize(wal) if os.path.exists(wal) else 0
+
+    def change_seq(self, conn=None):
+        """Last change_log sequence; unchanged between two checks means nothing was written."""
+        if conn is None:
+            with sqlite3.connect(self.db_name) as conn:
+                return self.change_seq(conn)
+        return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+
+    def _timed(self, conn, task, work):
+        """Run work(conn) -> detail, log it and return (task, seconds, size before, size after, detail)."""
+        started_at = _now()
+        before = self.sizes()
+        started = time.perf_counter()
+        try:
+            detail = work(conn)
+        except sqlite3.OperationalError as e:
+            detail = f"omitido: {e}"  # Typically "database is locked": left for the next run
+        duration = time.perf_counter() - started
+        after = self.sizes()
+        try:
+            conn.execute("""
+                INSERT INTO maintenance_log (started_at, task, duration, size_before, size_after,
+                                             wal_before, wal_after, detail)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (started_at, task, duration, before[0], after[0], before[1], after[1], detail))
+        except sqlite3.OperationalError:
+            pass
+        return task, duration, before[0] + before[1], after[0] + after[1], detail
+
+    def _optimize(self, conn):
+        conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is None:
+            conn.execute("ANALYZE")  # First run: PRAGMA optimize only re-analyzes tables it has seen change
+            return "ANALYZE"
+        conn.execute("PRAGMA optimize")
+        return "PRAGMA optimize"
+
+    def _vacuum(self, conn, budget):
+        mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if mode != 2:
+            # Switching needs one full VACUUM, which holds the write lock for all of it
+            if os.path.getsize(self.db_name) > AUTO_CONVERT_MAX_BYTES:
+                return (f"auto_vacuum = {AUTO_VACUUM_MODES.get(mode, mode)}: "
+                        "ejecute manage.py maintenance --enable-incremental-vacuum")
+            return self._full_vacuum(conn)
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        freed = 0
+        deadline = time.perf_counter() + budget
+        while free > 0 and time.perf_counter() < deadline:
+            try:
+                # executescript steps the pragma to the end; execute() would free a single page
+                conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_SLICE_PAGES})")
+            except sqlite3.OperationalError:
+                break  # Busy: the rest waits for the next run
+            left = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            freed += free - left
+            free = left
+            time.sleep(VACUUM_PAUSE)
+        return f"{freed} páginas liberadas, {free} pendientes"
+
+    def _full_vacuum(self, conn):
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return "auto_vacuum = incremental (VACUUM completo)"
+
+    def _checkpoint(self, conn):
+        # PASSIVE copies what it can without blocking anyone; TRUNCATE then empties the WAL
+        # file if, within LOCK_TIMEOUT, no reader or writer needs it
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        busy, log, done = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        return "WAL vaciado" if not busy else f"{done}/{log} páginas copiadas (en uso)"
+
+    def run(self, optimize=True, vacuum=True, checkpoint=True, budget=VACUUM_BUDGET):
+        """Run the selected tasks now; returns [(task, seconds, bytes before, bytes after, detail)]."""
+        results = []
+        conn = self._connect()
+        try:
+            if optimize:
+                results.append(self._timed(conn, "optimize", self._optimize))
+            if vacuum:
+                results.append(self._timed(conn, "vacuum", lambda c: self._vacuum(c, budget)))
+            if checkpoint:  # Last, so pages freed by the vacuum leave the file
+                results.append(self._timed(conn, "checkpoint", self._checkpoint))
+        finally:
+            conn.close()
+        return results
+
+    def run_if_idle(self, since_seq):
+        """
+        Scheduled run: only if nothing was written since change sequence since_seq (None
+        just takes the first reading). Optimize and vacuum once per FULL_RUN_INTERVAL, a
+        checkpoint then or when the WAL has grown. Returns (current sequence, results).
+        """
+        with sqlite3.connect(self.db_name) as conn:
+            seq = self.change_seq(conn)
+            if since_seq is None or seq != since_seq:
+                return seq, []
+            last = conn.execute("SELECT MAX(started_at) FROM maintenance_log WHERE task = 'optimize'").fetchone()[0]
+        due = last is None or (datetime.datetime.now() - datetime.datetime.strptime(last, "%Y-%m-%d %H:%M:%S")
+                               >= FULL_RUN_INTERVAL)
+        if not due and self.sizes()[1] < CHECKPOINT_WAL_BYTES:
+            return seq, []
+        return seq, self.run(optimize=due, vacuum=due)
+
+    def enable_incremental_vacuum(self):
+        """Switch the file to auto_vacuum=INCREMENTAL with a full VACUUM (blocks writers while it runs)."""
+        conn = self._connect(timeout=30)
+        try:
+            return self._timed(conn, "vacuum", self._full_vacuum)
+        finally:
+            conn.close()
+
+    def history(self, limit=20):
+        """[(started_at, task, seconds, size before, size after, WAL before, WAL after, detail)], newest first."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT started_at, task, duration, size_before, size_after, wal_before, wal_after, detail
+                FROM maintenance_log ORDER BY id DESC LIMIT ?
+            """, (limit,))
+            return cursor.fetchall()
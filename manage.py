@@ -0,0 +1,549 @@
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from database import Database
+from invoice_store import create_invoice_store, migrate_documents
+from analytics import SalesAnalytics
+
+
+def cmd_migrate_documents(args):
+    """Move existing invoice documents into the selected storage layout."""
+    db = Database(args.db)
+    target = create_invoice_store(args.storage, args.folder, db.db_name)
+
+    def progress(done, total):
+        print(f"\r{done}/{total} documentos", end="", flush=True)
+
+    migrated, failed = migrate_documents(db.db_name, target, workers=args.workers, progress=progress)
+    print(f"\nMigrados: {migrated} | Fallidos: {failed}")
+    return 1 if failed else 0
+
+
+def cmd_backfill_sales(args):
+    """Build line items and the sales rollup for invoices created before they were recorded."""
+    db = Database(args.db)
+
+    def progress(done, total):
+        print(f"\r{done}/{total} facturas", end="", flush=True)
+
+    filled, failed = SalesAnalytics(db.db_name).backfill_invoice_items(progress=progress)
+    print(f"\nFacturas completadas: {filled} | Sin detalle legible: {failed}")
+    return 0
+
+
+def cmd_rebuild_client_stats(args):
+    """Recompute the per-client lifetime statistics from the invoices."""
+    clients = Database(args.db).rebuild_client_stats()
+    print(f"Estadísticas recalculadas para {clients} clientes")
+    return 0
+
+
+def cmd_benchmark_records(args):
+    """Compare loading products as plain tuples and as Product records (same query as get_all_products)."""
+    from records import Product, as_records, columns
+
+    class SlotsProduct:
+        __slots__ = Product._fields
+
+        def __init__(self, cursor, row):
+            (self.id, self.serial_number, self.name, self.quantity, self.cost, self.price) = row
+
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("""
+            CREATE TABLE products (id INTEGER PRIMARY KEY, serial_number TEXT, name TEXT,
+                                   quantity INTEGER, cost REAL, price REAL)
+        """)
+        conn.executemany("INSERT INTO products VALUES (?, ?, ?, ?, ?, ?)",
+                         ((i, f"SN{i:07d}", f"Producto {(i * 7919) % args.rows}", i % 100, 1.5, 2.5)
+                          for i in range(1, args.rows + 1)))
+
+    def load(row_factory=None, wrap=None):
+        with sqlite3.connect(path) as conn:
+            conn.row_factory = row_factory
+            rows = conn.execute(f"SELECT {columns(Product)} FROM products ORDER BY name").fetchall()
+            return wrap(rows) if wrap else rows
+
+    variants = [
+        ("tuplas", lambda: load()),
+        ("Product (as_records)", lambda: load(wrap=lambda rows: as_records(Product, rows))),
+        ("clase __slots__ (row_factory)", lambda: load(row_factory=SlotsProduct)),
+    ]
+    print(f"{args.rows} productos, mejor de {args.repeat} ejecuciones")
+    for label, run in variants:
+        best = min(_timed(run) for _ in range(args.repeat))
+        tracemalloc.start()
+        rows = run()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del rows
+        print(f"{label:<32}{best * 1000:>9.1f} ms{memory / 1024 / 1024:>9.1f} MB")
+    os.remove(path)
+    return 0
+
+
+def cmd_serve(args):
+    """Run the inventory server for several cashier terminals until interrupted."""
+    import asyncio
+    from server import InventoryServer
+
+    server = InventoryServer(args.db, args.host, args.port, args.readers,
+                             create_invoice_store(args.storage, args.folder, args.db))
+
+    async def run():
+        await server.start()
+        print(f"Servidor de inventario en http://{args.host}:{server.port} (Ctrl+C para detener)", flush=True)
+        async with server.server:
+            await server.server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def cmd_benchmark_server(args):
+    """
+    Simulated cashiers against the inventory server. Each cashier looks up the products of
+    a sale and checks it out, in a loop; reports checkouts per second and latency percentiles.
+    Without --url a server with a temporary database is started on localhost.
+    """
+    import random
+    import socket
+    import subprocess
+    import threading
+    from remote_database import RemoteDatabase, ServerError
+
+    process = None
+    url = args.url
+    if url is None:
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "benchmark.db")
+        db = Database(path)
+        for i in range(args.products):
+            db.add_product(f"BENCH{i:05d}", f"Producto {i}", 10 ** 9, 1.0, 2.0)
+        for i in range(args.clients):
+            db.add_client(f"Cliente {i}", f"ID{i:06d}", f"RTN{i:06d}", "", "", "Tegucigalpa")
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--db", path, "serve",
+                                    "--port", str(port), "--folder", os.path.join(folder, "invoices")],
+                                   stdout=subprocess.DEVNULL)
+        url = f"http://127.0.0.1:{port}"
+    remote = RemoteDatabase(url)
+    try:
+        for _ in range(100):
+            try:
+                remote.health()
+                break
+            except ServerError:
+                time.sleep(0.1)
+        products = [p for p in remote.get_all_products() if p.quantity > 100]
+        clients = remote.get_all_clients()
+        if not products or not clients:
+            print("El servidor necesita productos con existencias y clientes")
+            return 1
+        deadline = time.perf_counter() + args.seconds
+        checkouts, lookups, errors = [], [], []
+
+        def cashier(seed):
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                client = rng.choice(clients)
+                chosen = rng.sample(products, rng.randint(1, min(5, len(products))))
+                started = time.perf_counter()
+                current = remote.get_products_by_ids([p.id for p in chosen])  # Scanning the items
+                lookups.append(time.perf_counter() - started)
+                items = [{"product_id": p.id, "quantity": 1, "price": p.price} for p in current]
+                subtotal = sum(p.price for p in current)
+                started = time.perf_counter()
+                try:
+                    success, result, _ = remote.record_sale(
+                        None, "BENCH", time.strftime("%Y-%m-%d %H:%M:%S"), client.id, client.name,
+                        [], items, subtotal, subtotal * 0.15, subtotal * 1.15)
+                except ServerError as e:
+                    success, result = False, str(e)
+                if success:
+                    checkouts.append(time.perf_counter() - started)
+                else:
+                    errors.append(result)
+
+        threads = [threading.Thread(target=cashier, args=(n,)) for n in range(args.cashiers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    print(f"{args.cashiers} cajeros, {args.seconds} s: {len(checkouts)} facturas "
+          f"({len(checkouts) / args.seconds:.1f} por segundo), {len(errors)} errores")
+    for label, samples in (("Factura", checkouts), ("Consulta", lookups)):
+        if samples:
+            samples.sort()
+            p50, p99 = (samples[min(len(samples) - 1, int(len(samples) * q))] * 1000 for q in (0.5, 0.99))
+            print(f"{label:<10}p50 {p50:>8.1f} ms   p99 {p99:>8.1f} ms")
+    if errors:
+        print(f"Primer error: {errors[0]}")
+    return 1 if errors else 0
+
+
+def _timed(run):
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def _product_by_serial(db, serial_number):
+    return next((p for p in db.search_products(serial_number, "Número de Serie")
+                 if p.serial_number == serial_number), None)
+
+
+def cmd_stock_history(args):
+    """Latest stock movements of a product, with the balance after each one."""
+    from stock_ledger import StockLedger
+    db = Database(args.db)
+    product = _product_by_serial(db, args.serial)
+    if product is None:
+        print(f"Producto {args.serial} no encontrado")
+        return 1
+    print(f"{product.serial_number} {product.name} (existencia actual: {product.quantity})")
+    for at, delta, kind, reference, balance in StockLedger(db.db_name).history(product.id, args.limit):
+        print(f"  {at}  {delta:+6d}  {kind:<10} {reference or '':<12} saldo {balance}")
+    return 0
+
+
+def cmd_stock_as_of(args):
+    """Stock of every product (or one) at a past date, from the ledger snapshots."""
+    from stock_ledger import StockLedger
+    db = Database(args.db)
+    products = db.get_all_products()
+    if args.serial:
+        products = [p for p in products if p.serial_number == args.serial]
+    stock = StockLedger(db.db_name).stock_as_of(args.date, [p.id for p in products])
+    for product in products:
+        print(f"{product.serial_number:<12} {product.name:<40} {stock.get(product.id, 0):>8}")
+    return 0
+
+
+def cmd_check_stock(args):
+    """Verify products.quantity against the stock ledger (only what changed since the last check)."""
+    from stock_ledger import StockLedger
+    mismatches = StockLedger(Database(args.db).db_name).check(full=args.full)
+    for product_id, serial_number, name, quantity, ledger in mismatches:
+        print(f"{serial_number} {name}: existencia {quantity}, según movimientos {ledger}")
+    print(f"Diferencias: {len(mismatches)}")
+    return 1 if mismatches else 0
+
+
+def cmd_stock_snapshot(args):
+    """Store the current stock balances (stock_as_of then only scans the movements after it)."""
+    from stock_ledger import StockLedger
+    print(f"Instantánea {StockLedger(Database(args.db).db_name).take_snapshot()} guardada")
+    return 0
+
+
+def cmd_purchase_order(args):
+    """Create a purchase order from a CSV of serial number, quantity and unit cost."""
+    from purchasing import PurchaseOrders, read_lines_csv
+    orders = PurchaseOrders(Database(args.db).db_name)
+    lines, unknown = read_lines_csv(args.file, orders.product_index())
+    for serial in unknown:
+        print(f"Número de serie no encontrado: {serial}")
+    if unknown and not args.skip_unknown:
+        return 1
+    success, result = orders.create_order(args.supplier, lines, args.notes or "")
+    if not success:
+        print(result)
+        return 1
+    print(f"Orden de compra {result}: {len(lines)} líneas")
+    return 0
+
+
+def cmd_receive(args):
+    """Post a goods receipt for an order: everything pending, or the lines of a CSV."""
+    from purchasing import PurchaseOrders, read_lines_csv
+    orders = PurchaseOrders(Database(args.db).db_name)
+    lines = None
+    if args.file:
+        lines, unknown = read_lines_csv(args.file, orders.product_index())
+        for serial in unknown:
+            print(f"Número de serie no encontrado: {serial}")
+        if unknown:
+            return 1
+        if args.order_cost:
+            lines = [(product_id, quantity) for product_id, quantity, _ in lines]
+
+    def progress(done, total):
+        print(f"\r{done}/{total} líneas", end="", flush=True)
+    success, result = orders.receive(args.order, lines, args.reference or "", progress=progress)
+    print()
+    if not success:
+        print(result)
+        return 1
+    print(f"Recepción {result} registrada")
+    for order_id, supplier, created_at, status, count, ordered, received in orders.orders():
+        if order_id == args.order:
+            print(f"Orden {order_id} ({supplier}): {received}/{ordered} unidades recibidas, estado {status}")
+    return 0
+
+
+def cmd_archive_year(args):
+    """Move the invoices and credit notes of a closed year to its archive file."""
+    from archive import InvoiceArchive
+    archive = InvoiceArchive(Database(args.db).db_name)
+
+    def progress(done, total):
+        print(f"\r{done}/{total} documentos", end="", flush=True)
+    started = time.perf_counter()
+    success, result = archive.archive_year(args.year, progress=progress)
+    print()
+    if not success:
+        print(result)
+        return 1
+    invoices, credit_notes = result
+    print(f"{invoices} facturas y {credit_notes} notas de crédito archivadas en "
+          f"{archive.path(args.year)} ({time.perf_counter() - started:.1f} s)")
+    return 0
+
+
+def cmd_archive_status(args):
+    """List archived years and the closed years still in the main database."""
+    from archive import InvoiceArchive
+    archive = InvoiceArchive(Database(args.db).db_name)
+    for year, path, archived_at, invoices, credit_notes in archive.archived():
+        print(f"{year}: archivado el {archived_at} en {path} ({invoices} facturas, {credit_notes} notas de crédito)")
+    for year, invoices, total in archive.archivable_years():
+        print(f"{year}: {invoices} facturas (LPS {total:,.2f}) por archivar")
+    return 0
+
+
+def cmd_maintenance(args):
+    """Run the database maintenance now, or show its log."""
+    from maintenance import DatabaseMaintenance, VACUUM_BUDGET
+    maintenance = DatabaseMaintenance(Database(args.db).db_name)
+    if args.history:
+        for started_at, task, duration, size_before, size_after, wal_before, wal_after, detail in maintenance.history():
+            print(f"{started_at} {task:<10} {duration:7.2f} s  {size_before / 1048576:8.1f} -> {size_after / 1048576:8.1f} MB"
+                  f"  WAL {wal_before / 1048576:6.1f} -> {wal_after / 1048576:6.1f} MB  {detail}")
+        return 0
+    if args.enable_incremental_vacuum:
+        results = [maintenance.enable_incremental_vacuum()]
+    else:
+        results = maintenance.run(budget=args.budget or VACUUM_BUDGET)
+    for task, duration, before, after, detail in results:
+        print(f"{task:<10} {duration:7.2f} s  {before / 1048576:8.1f} -> {after / 1048576:8.1f} MB  {detail}")
+    return 0
+
+
+def cmd_migrate(args):
+    """Apply the schema migrations and run their pending backfills (or show their state)."""
+    from migrations import Migrator
+    migrator = Migrator(Database(args.db).db_name)  # Opening the database applies the schema changes
+    if not args.status:
+        def progress(version, description, done, total):
+            print(f"\r{version}. {description}: {done}/{total}", end="", flush=True)
+        migrator.run_backfills(progress=progress)
+        print()
+    print(f"Versión de la base de datos: {migrator.version()} (última: {migrator.latest()})")
+    for version, description, applied_at, rows_done, finished_at in migrator.status():
+        state = f"terminada {finished_at}" if finished_at else f"pendiente ({rows_done} filas hechas)"
+        print(f"{version}. {description}: aplicada {applied_at}, {state}")
+    return 0
+
+
+def _sync_engine(args):
+    from sync import SyncEngine
+    db = Database(args.db)
+    return SyncEngine(db, create_invoice_store(args.storage, args.folder, db.db_name))
+
+
+def _print_sync_result(result):
+    print(f"Recibido de {result['site']}: {result['rows']} filas, {result['stock']} movimientos de stock")
+    for conflict in result["conflicts"]:
+        print(f"  Conflicto sin aplicar: {conflict}")
+
+
+def cmd_sync_init(args):
+    """Enable change tracking for branch synchronization and show this branch's id and peers."""
+    engine = _sync_engine(args)
+    if args.new_site:
+        engine.new_site()
+    status = engine.status()
+    print(f"Sucursal: {status['site']}")
+    for peer, pending, last_sync in status["peers"]:
+        print(f"  {peer}: {pending} cambios por enviar (última sincronización {last_sync})")
+    return 0
+
+
+def cmd_sync_export(args):
+    """Write the changes another branch has not received yet to a bundle file."""
+    from sync import write_bundle
+    engine = _sync_engine(args)
+    bundle = engine.export(args.peer)
+    output = args.output or f"sync_{bundle['site'][:8]}.json.gz"
+    write_bundle(bundle, output)
+    print(f"Paquete {output}: {len(bundle['rows'])} filas, {len(bundle['stock'])} movimientos de stock")
+    return 0
+
+
+def cmd_sync_import(args):
+    """Apply a bundle file received from another branch."""
+    from sync import read_bundle, SyncError
+    try:
+        _print_sync_result(_sync_engine(args).import_bundle(read_bundle(args.file)))
+    except SyncError as e:
+        print(e)
+        return 1
+    return 0
+
+
+def cmd_sync(args):
+    """Exchange changes with another branch's inventory server (both directions)."""
+    from sync import SyncError
+    from remote_database import RemoteDatabase, ServerError
+    remote = RemoteDatabase(args.url, timeout=args.timeout)
+    engine = _sync_engine(args)
+    try:
+        received = engine.import_bundle(remote.sync_export(engine.site()))
+        _print_sync_result(received)
+        sent = remote.sync_import(engine.export(received["site"]))
+    except (SyncError, ServerError) as e:
+        print(e)
+        return 1
+    print(f"Enviado: {sent['rows']} filas, {sent['stock']} movimientos de stock aplicados en {args.url}")
+    return 0
+
+
+def cmd_sync_stock(args):
+    """Stock of every branch (this one and what its movements say of the others)."""
+    engine = _sync_engine(args)
+    site = engine.site()
+    current = None
+    for serial_number, branch, quantity in engine.site_stock(args.serial):
+        if serial_number != current:
+            print(serial_number)
+            current = serial_number
+        print(f"  {branch}{' (esta sucursal)' if branch == site else ''}: {quantity}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Herramientas de mantenimiento de BizzTrackPro")
+    parser.add_argument("--db", default="inventory.db", help="Archivo de base de datos")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate = commands.add_parser("migrate-documents", help="Migrar facturas a otro almacenamiento")
+    migrate.add_argument("--storage", choices=["flat", "sharded", "blob"], default="sharded")
+    migrate.add_argument("--folder", default="invoices", help="Carpeta de facturas")
+    migrate.add_argument("--workers", type=int, default=4, help="Hilos de copia en paralelo")
+    migrate.set_defaults(func=cmd_migrate_documents)
+
+    backfill = commands.add_parser("backfill-sales", help="Generar el detalle de ventas de facturas antiguas")
+    backfill.set_defaults(func=cmd_backfill_sales)
+
+    stats = commands.add_parser("rebuild-client-stats", help="Recalcular estadísticas y totales de ventas por cliente")
+    stats.set_defaults(func=cmd_rebuild_client_stats)
+
+    benchmark = commands.add_parser("benchmark-records", help="Medir la carga de productos como registros")
+    benchmark.add_argument("--rows", type=int, default=100000)
+    benchmark.add_argument("--repeat", type=int, default=5)
+    benchmark.set_defaults(func=cmd_benchmark_records)
+
+    serve = commands.add_parser("serve", help="Servidor de inventario para varias cajas (API HTTP/JSON)")
+    serve.add_argument("--host", default="127.0.0.1", help="Dirección de escucha (sin autenticación: no use 0.0.0.0)")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--readers", type=int, default=4, help="Hilos de lectura en paralelo")
+    serve.add_argument("--storage", choices=["flat", "sharded", "blob"], default="sharded")
+    serve.add_argument("--folder", default="invoices", help="Carpeta de facturas")
+    serve.set_defaults(func=cmd_serve)
+
+    load = commands.add_parser("benchmark-server", help="Simular cajeros contra el servidor de inventario")
+    load.add_argument("--url", help="Servidor a medir (crea facturas reales); sin él se usa uno temporal")
+    load.add_argument("--cashiers", type=int, default=8)
+    load.add_argument("--seconds", type=int, default=10)
+    load.add_argument("--products", type=int, default=200)
+    load.add_argument("--clients", type=int, default=50)
+    load.set_defaults(func=cmd_benchmark_server)
+
+    history = commands.add_parser("stock-history", help="Movimientos de stock de un producto")
+    history.add_argument("serial", help="Número de serie")
+    history.add_argument("--limit", type=int, default=50)
+    history.set_defaults(func=cmd_stock_history)
+
+    as_of = commands.add_parser("stock-as-of", help="Existencias a una fecha pasada")
+    as_of.add_argument("date", help="AAAA-MM-DD (fin del día) o 'AAAA-MM-DD HH:MM:SS'")
+    as_of.add_argument("--serial", help="Solo este producto")
+    as_of.set_defaults(func=cmd_stock_as_of)
+
+    check = commands.add_parser("check-stock", help="Comparar existencias con el registro de movimientos")
+    check.add_argument("--full", action="store_true", help="Revisar todos los productos")
+    check.set_defaults(func=cmd_check_stock)
+
+    snapshot = commands.add_parser("stock-snapshot", help="Guardar una instantánea de existencias")
+    snapshot.set_defaults(func=cmd_stock_snapshot)
+
+    order = commands.add_parser("purchase-order", help="Crear una orden de compra desde un CSV")
+    order.add_argument("supplier", help="Proveedor")
+    order.add_argument("file", help="CSV: número de serie, cantidad, costo unitario")
+    order.add_argument("--notes", help="Notas de la orden")
+    order.add_argument("--skip-unknown", action="store_true", help="Omitir números de serie no encontrados")
+    order.set_defaults(func=cmd_purchase_order)
+
+    receive = commands.add_parser("receive", help="Registrar la recepción de una orden de compra")
+    receive.add_argument("order", type=int, help="Número de orden")
+    receive.add_argument("--file", help="CSV con lo recibido (sin él, todo lo pendiente)")
+    receive.add_argument("--order-cost", action="store_true", help="Usar el costo de la orden en lugar del CSV")
+    receive.add_argument("--reference", help="Factura o guía del proveedor")
+    receive.set_defaults(func=cmd_receive)
+
+    archive_year = commands.add_parser("archive-year", help="Archivar las facturas de un año cerrado")
+    archive_year.add_argument("year", help="Año, p. ej. 2023")
+    archive_year.set_defaults(func=cmd_archive_year)
+
+    archive_status = commands.add_parser("archive-status", help="Años archivados y por archivar")
+    archive_status.set_defaults(func=cmd_archive_status)
+
+    maintenance = commands.add_parser("maintenance", help="Optimizar, compactar y hacer checkpoint de la base de datos")
+    maintenance.add_argument("--budget", type=float, help="Segundos máximos de compactación incremental")
+    maintenance.add_argument("--enable-incremental-vacuum", action="store_true",
+                             help="Activar la compactación incremental (VACUUM completo; bloquea las escrituras)")
+    maintenance.add_argument("--history", action="store_true", help="Mostrar las últimas ejecuciones")
+    maintenance.set_defaults(func=cmd_maintenance)
+
+    upgrade = commands.add_parser("migrate", help="Actualizar el esquema y completar las conversiones de datos pendientes")
+    upgrade.add_argument("--status", action="store_true", help="Solo mostrar el estado de las migraciones")
+    upgrade.set_defaults(func=cmd_migrate)
+
+    init = commands.add_parser("sync-init", help="Activar la sincronización entre sucursales y ver su estado")
+    init.add_argument("--new-site", action="store_true",
+                      help="Nuevo identificador de sucursal (base de datos copiada de otra sucursal)")
+    export = commands.add_parser("sync-export", help="Guardar los cambios pendientes para otra sucursal")
+    export.add_argument("--peer", help="Identificador de la sucursal destino (sin él, todos los datos)")
+    export.add_argument("--output", help="Archivo del paquete (.json.gz)")
+    apply = commands.add_parser("sync-import", help="Aplicar un paquete recibido de otra sucursal")
+    apply.add_argument("file", help="Archivo del paquete (.json.gz)")
+    stock = commands.add_parser("sync-stock", help="Ver el stock de cada sucursal")
+    stock.add_argument("--serial", help="Número de serie del producto (sin él, todos)")
+    pull = commands.add_parser("sync", help="Sincronizar con el servidor de otra sucursal")
+    pull.add_argument("--url", required=True, help="Servidor de la otra sucursal, p. ej. http://10.0.0.5:8765")
+    pull.add_argument("--timeout", type=int, default=120, help="Segundos de espera por respuesta")
+    for command, func in ((init, cmd_sync_init), (export, cmd_sync_export), (apply, cmd_sync_import), (stock, cmd_sync_stock),
+                          (pull, cmd_sync)):
+        command.add_argument("--storage", choices=["flat", "sharded", "blob"], default="sharded")
+        command.add_argument("--folder", default="invoices", help="Carpeta de facturas")
+        command.set_defaults(func=func)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,445 @@
+import sqlite3
+import datetime
+from report_cache import log_rebuild
+from stock_ledger import record_opening_stock
+
+# Rows a backfill handles per transaction; the write lock is released between chunks
+BACKFILL_BATCH = 2000
+
+
+def _now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class Migration:
+    """
+    One versioned change. schema(cursor) holds the quick part (new tables, columns,
+    indexes) and runs in the same transaction that bumps PRAGMA user_version. A backfill
+    does the slow part afterwards in chunks: backfill(cursor, after, limit) handles the
+    rows with key > after (at most limit of them) and returns (last key handled, rows), or
+    (None, 0) when nothing is left; total(cursor) counts the rows, for progress.
+    """
+
+    def __init__(self, version, description, schema=None, backfill=None, total=None):
+        self.version = version
+        self.description = description
+        self.schema = schema
+        self.backfill = backfill
+        self.total = total
+
+
+def _normalized_date(value):
+    """'YYYY-MM-DD HH:MM:SS' of a date or datetime text (ISO 'T', no seconds, fractions, time zone)."""
+    try:
+        parsed = datetime.datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except (ValueError, AttributeError):
+        return None  # Unreadable: left as it is
+    return parsed.strftime("%Y-%m-%d %H:%M:%S")  # Time zones are dropped: dates are local wall time
+
+
+def normalize_dates(table):
+    """Backfill (as Migration keywords) putting the dates of a table in the format range queries compare with."""
+    def backfill(cursor, after, limit):
+        cursor.execute(f"SELECT id, date FROM {table} WHERE id > ? ORDER BY id LIMIT ?", (after or 0, limit))
+        rows = cursor.fetchall()
+        if not rows:
+            return None, 0
+        changes = []
+        for row_id, value in rows:
+            date = _normalized_date(value)
+            if date is not None and date != value:
+                changes.append((date, row_id))
+        cursor.executemany(f"UPDATE {table} SET date = ? WHERE id = ?", changes)
+        return rows[-1][0], len(rows)
+
+    def total(cursor):
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        return cursor.fetchone()[0]
+    return {"backfill": backfill, "total": total}
+
+
+def _count(cursor, sql):
+    cursor.execute(sql)
+    return cursor.fetchone()[0]
+
+
+# Days of archived years are kept by the rollup backfills: their invoices are no longer here
+NOT_ARCHIVED = "substr(day, 1, 4) NOT IN (SELECT year FROM invoice_archives)"
+
+
+def create_client_stats(cursor):
+    # Lifetime totals per client, kept up to date on checkout and invoice deletion
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS client_stats (
+            client_id INTEGER PRIMARY KEY,
+            invoice_count INTEGER NOT NULL,
+            lifetime_total REAL NOT NULL,
+            first_purchase TEXT NOT NULL,
+            last_purchase TEXT NOT NULL,
+            FOREIGN KEY(client_id) REFERENCES clients(id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_client_stats_total ON client_stats(lifetime_total)")
+
+
+def fill_client_stats(cursor, after, limit):
+    """Recompute client_stats for the next clients with invoices (here or archived)."""
+    bounds = {"after": after or 0, "limit": limit}
+    cursor.execute("""
+        SELECT client_id FROM (
+            SELECT DISTINCT client_id FROM invoices WHERE client_id > :after
+            UNION SELECT client_id FROM archived_client_totals WHERE client_id > :after
+        ) ORDER BY client_id LIMIT :limit
+    """, bounds)
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return None, 0
+    bounds["last"] = ids[-1]
+    cursor.execute("DELETE FROM client_stats WHERE client_id > :after AND client_id <= :last", bounds)
+    cursor.execute("""
+        INSERT INTO client_stats (client_id, invoice_count, lifetime_total, first_purchase, last_purchase)
+        SELECT client_id, SUM(invoices), SUM(total), MIN(first_purchase), MAX(last_purchase) FROM (
+            SELECT client_id, COUNT(*) AS invoices, SUM(total) AS total,
+                   MIN(date) AS first_purchase, MAX(date) AS last_purchase
+            FROM invoices WHERE client_id > :after AND client_id <= :last GROUP BY client_id
+            UNION ALL
+            SELECT client_id, 0, -SUM(total), NULL, NULL FROM credit_notes
+            WHERE client_id > :after AND client_id <= :last GROUP BY client_id
+            UNION ALL
+            SELECT client_id, invoices, total, first_purchase, last_purchase FROM archived_client_totals
+            WHERE client_id > :after AND client_id <= :last
+        )
+        GROUP BY client_id HAVING SUM(invoices) > 0
+    """, bounds)
+    return ids[-1], len(ids)
+
+
+def create_client_sales(cursor):
+    # Daily invoice totals per client (client_id 0 = no client), for city/client pivots
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS client_sales_daily (
+            client_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            invoices INTEGER NOT NULL,
+            subtotal REAL NOT NULL,
+            tax REAL NOT NULL,
+            total REAL NOT NULL,
+            PRIMARY KEY (client_id, day)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_client_sales_daily_day
+        ON client_sales_daily(day, client_id, invoices, subtotal, tax, total)
+    """)
+    # Monthly copy, so multi-year reports scan ~30x fewer rows
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS client_sales_monthly (
+            client_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            invoices INTEGER NOT NULL,
+            subtotal REAL NOT NULL,
+            tax REAL NOT NULL,
+            total REAL NOT NULL,
+            PRIMARY KEY (client_id, month)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_client_sales_monthly_month
+        ON client_sales_monthly(month, client_id, invoices, subtotal, tax, total)
+    """)
+
+
+def fill_client_sales(cursor, after, limit):
+    """Recompute both client rollups for the next clients; the first chunk also takes sales without client."""
+    cursor.execute("SELECT DISTINCT client_id FROM invoices WHERE client_id > ? ORDER BY client_id LIMIT ?",
+                   (after or 0, limit))
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids and after is not None:
+        return None, 0
+    bounds = {"after": -1 if after is None else after, "last": ids[-1] if ids else 0}
+    in_range = "(client_id > :after AND client_id <= :last OR :after < 0 AND client_id IS NULL)"
+    cursor.execute(f"DELETE FROM client_sales_daily WHERE client_id > :after AND client_id <= :last AND {NOT_ARCHIVED}",
+                   bounds)
+    cursor.execute(f"""
+        INSERT INTO client_sales_daily (client_id, day, invoices, subtotal, tax, total)
+        SELECT client_id, day, SUM(invoices), SUM(subtotal), SUM(tax), SUM(total) FROM (
+            SELECT COALESCE(client_id, 0) AS client_id, date(date) AS day, 1 AS invoices, subtotal, tax, total
+            FROM invoices WHERE {in_range}
+            UNION ALL
+            SELECT COALESCE(client_id, 0), date(date), 0, -subtotal, -tax, -total FROM credit_notes WHERE {in_range}
+        )
+        WHERE {NOT_ARCHIVED}
+        GROUP BY client_id, day
+    """, bounds)
+    cursor.execute("DELETE FROM client_sales_monthly WHERE client_id > :after AND client_id <= :last", bounds)
+    cursor.execute("""
+        INSERT INTO client_sales_monthly (client_id, month, invoices, subtotal, tax, total)
+        SELECT client_id, substr(day, 1, 7), SUM(invoices), SUM(subtotal), SUM(tax), SUM(total)
+        FROM client_sales_daily WHERE client_id > :after AND client_id <= :last
+        GROUP BY client_id, substr(day, 1, 7)
+    """, bounds)
+    log_rebuild(cursor, "client_sales_daily")
+    return bounds["last"], len(ids)
+
+
+def create_product_sales(cursor):
+    # Daily units/revenue per product, maintained on checkout for fast analytics
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS product_sales_daily (
+            product_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            units INTEGER NOT NULL,
+            revenue REAL NOT NULL,
+            PRIMARY KEY (product_id, day)
+        ) WITHOUT ROWID
+    """)
+    # Covering index so date-range aggregates never touch the table itself
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_product_sales_daily_day
+        ON product_sales_daily(day, product_id, units, revenue)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS product_sales_monthly (
+            product_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            units INTEGER NOT NULL,
+            revenue REAL NOT NULL,
+            PRIMARY KEY (product_id, month)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_product_sales_monthly_month
+        ON product_sales_monthly(month, product_id, units, revenue)
+    """)
+
+
+def fill_product_sales(cursor, after, limit):
+    """Recompute both product rollups for the next products sold, net of credit notes."""
+    cursor.execute("SELECT DISTINCT product_id FROM invoice_items WHERE product_id > ? ORDER BY product_id LIMIT ?",
+                   (after or 0, limit))
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return None, 0
+    bounds = {"after": after or 0, "last": ids[-1]}
+    cursor.execute(f"DELETE FROM product_sales_daily WHERE product_id > :after AND product_id <= :last AND {NOT_ARCHIVED}",
+                   bounds)
+    cursor.execute(f"""
+        INSERT INTO product_sales_daily (product_id, day, units, revenue)
+        SELECT product_id, day, SUM(units), SUM(revenue) FROM (
+            SELECT i.product_id, date(v.date) AS day, i.quantity AS units, i.subtotal AS revenue
+            FROM invoice_items i JOIN invoices v ON v.id = i.invoice_id
+            WHERE i.product_id > :after AND i.product_id <= :last
+            UNION ALL
+            SELECT c.product_id, date(n.date), -c.quantity, -c.subtotal
+            FROM credit_note_items c JOIN credit_notes n ON n.id = c.credit_note_id
+            WHERE c.product_id > :after AND c.product_id <= :last
+        )
+        WHERE {NOT_ARCHIVED}
+        GROUP BY product_id, day
+    """, bounds)
+    cursor.execute("DELETE FROM product_sales_monthly WHERE product_id > :after AND product_id <= :last", bounds)
+    cursor.execute("""
+        INSERT INTO product_sales_monthly (product_id, month, units, revenue)
+        SELECT product_id, substr(day, 1, 7), SUM(units), SUM(revenue)
+        FROM product_sales_daily WHERE product_id > :after AND product_id <= :last
+        GROUP BY product_id, substr(day, 1, 7)
+    """, bounds)
+    log_rebuild(cursor, "product_sales_daily")
+    return ids[-1], len(ids)
+
+
+def create_stock_ledger(cursor):
+    # Append-only ledger of stock changes, with periodic per-product snapshots (stock_ledger.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_movements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            at TEXT NOT NULL,
+            delta INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            reference TEXT
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_product ON stock_movements(product_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_at ON stock_movements(at)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_snapshot_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            taken_at TEXT NOT NULL,
+            upto_movement INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_snapshot_runs_taken ON stock_snapshot_runs(taken_at)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_snapshots (
+            snapshot_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (snapshot_id, product_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_checks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            checked_at TEXT NOT NULL,
+            upto_movement INTEGER NOT NULL,
+            products_checked INTEGER NOT NULL,
+            mismatches INTEGER NOT NULL,
+            full INTEGER NOT NULL
+        )
+    """)
+
+
+def fill_opening_stock(cursor, after, limit):
+    """Opening movements for the next products, with the stock they had when the ledger started."""
+    cursor.execute("SELECT id FROM products WHERE id > ? ORDER BY id LIMIT ?", (after or 0, limit))
+    ids = [row[0] for row in cursor.fetchall()]
+    if not ids:
+        return None, 0
+    record_opening_stock(cursor, after or 0, ids[-1])
+    return ids[-1], len(ids)
+
+
+# Applied in order on top of the tables Database.create_tables creates; append new ones at the end.
+# Backfills recompute whole keys (a client, a product) from the source rows, so what checkouts
+# add to a key before its chunk runs is counted once, and kept up to date by them afterwards.
+MIGRATIONS = [
+    Migration(1, "Fechas de facturas en formato AAAA-MM-DD HH:MM:SS", **normalize_dates("invoices")),
+    Migration(2, "Fechas de notas de crédito en formato AAAA-MM-DD HH:MM:SS", **normalize_dates("credit_notes")),
+    Migration(3, "Estadísticas de compras por cliente", schema=create_client_stats, backfill=fill_client_stats,
+              total=lambda cursor: _count(cursor, """
+                  SELECT COUNT(*) FROM (SELECT client_id FROM invoices WHERE client_id IS NOT NULL
+                                        UNION SELECT client_id FROM archived_client_totals)
+              """)),
+    Migration(4, "Ventas diarias y mensuales por cliente", schema=create_client_sales, backfill=fill_client_sales,
+              total=lambda cursor: _count(cursor, "SELECT COUNT(DISTINCT client_id) FROM invoices")),
+    Migration(5, "Ventas diarias y mensuales por producto", schema=create_product_sales, backfill=fill_product_sales,
+              total=lambda cursor: _count(cursor, "SELECT COUNT(DISTINCT product_id) FROM invoice_items")),
+    Migration(6, "Historial de existencias (existencia inicial por producto)", schema=create_stock_ledger,
+              backfill=fill_opening_stock, total=lambda cursor: _count(cursor, "SELECT COUNT(*) FROM products")),
+]
+
+
+class Migrator:
+    """
+    Brings a database up to the latest version. upgrade() applies the schema part of
+    every migration newer than PRAGMA user_version, one transaction each, and is quick
+    enough to run on every start. Backfills are recorded in schema_migrations and run
+    afterwards with run_backfills(), one committed chunk at a time, so the application
+    keeps working meanwhile and an interrupted backfill resumes where it stopped.
+    """
+
+    def __init__(self, db_name="inventory.db", migrations=None):
+        self.db_name = db_name
+        self.migrations = {m.version: m for m in (MIGRATIONS if migrations is None else migrations)}
+
+    def version(self):
+        with sqlite3.connect(self.db_name) as conn:
+            return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def latest(self):
+        return max(self.migrations, default=0)
+
+    def upgrade(self):
+        """Apply the pending schema changes; returns the versions applied."""
+        applied = []
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            if cursor.execute("PRAGMA user_version").fetchone()[0] >= self.latest():
+                return applied  # Up to date: the usual case, without taking the write lock
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TEXT NOT NULL,
+                    backfill_after INTEGER,
+                    rows_done INTEGER NOT NULL DEFAULT 0,
+                    finished_at TEXT
+                )
+            """)
+            conn.commit()
+            for version in sorted(self.migrations):
+                cursor.execute("BEGIN IMMEDIATE")
+                # Read inside the transaction: another process may have just applied it
+                if version <= cursor.execute("PRAGMA user_version").fetchone()[0]:
+                    conn.rollback()
+                    continue
+                migration = self.migrations[version]
+                if migration.schema:
+                    migration.schema(cursor)
+                cursor.execute("""
+                    INSERT OR REPLACE INTO schema_migrations (version, description, applied_at, finished_at)
+                    VALUES (?, ?, ?, ?)
+                """, (version, migration.description, _now(), None if migration.backfill else _now()))
+                cursor.execute(f"PRAGMA user_version = {int(version)}")
+                conn.commit()
+                applied.append(version)
+        return applied
+
+    def pending_backfills(self):
+        """[(version, description, rows done)] of backfills not finished yet, in order."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT version, description, rows_done FROM schema_migrations
+                WHERE finished_at IS NULL ORDER BY version
+            """)
+            return [row for row in cursor.fetchall() if row[0] in self.migrations]
+
+    def _run_chunk(self, cursor, version, batch_size):
+        """One committed chunk of a backfill; returns the rows done so far, or None once it has finished."""
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT backfill_after, rows_done FROM schema_migrations WHERE version = ?", (version,))
+        after, done = cursor.fetchone()
+        last, rows = self.migrations[version].backfill(cursor, after, batch_size)
+        if last is None:
+            cursor.execute("UPDATE schema_migrations SET finished_at = ? WHERE version = ?", (_now(), version))
+            cursor.connection.commit()
+            return None
+        cursor.execute("UPDATE schema_migrations SET backfill_after = ?, rows_done = ? WHERE version = ?",
+                       (last, done + rows, version))
+        cursor.connection.commit()
+        return done + rows
+
+    def run_backfills(self, progress=None, should_stop=None, batch_size=BACKFILL_BATCH):
+        """
+        Run the pending backfills in chunks. progress(version, description, rows done,
+        total) is called after each chunk and should_stop() checked before it. Returns
+        True once every backfill has finished, False if stopped (the next run resumes).
+        """
+        for version, description, _ in self.pending_backfills():
+            migration = self.migrations[version]
+            with sqlite3.connect(self.db_name) as conn:
+                cursor = conn.cursor()
+                total = migration.total(cursor) if migration.total else None
+                while True:
+                    if should_stop and should_stop():
+                        return False
+                    done = self._run_chunk(cursor, version, batch_size)
+                    if done is None:
+                        break
+                    if progress:
+                        progress(version, description, done, total)
+        return True
+
+    def backfill_step(self, batch_size=BACKFILL_BATCH):
+        """
+        Run one chunk of the first pending backfill, for callers that interleave them with
+        their own writes (the server's writer thread). Returns True when none is left.
+        """
+        pending = self.pending_backfills()
+        if not pending:
+            return True
+        with sqlite3.connect(self.db_name) as conn:
+            self._run_chunk(conn.cursor(), pending[0][0], batch_size)
+        return False
+
+    def status(self):
+        """[(version, description, applied_at, rows done, finished_at)] of the applied migrations."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT version, description, applied_at, rows_done, finished_at FROM schema_migrations
+                ORDER BY version
+            """)
+            return cursor.fetchall()
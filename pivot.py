@@ -0,0 +1,288 @@
+import csv
+import calendar
+import datetime
+from report_cache import ReportCache
+from archive import connect_with_archives, attach_archives, partition, INVOICE_FIELDS, INVOICE_ITEM_FIELDS
+
+# Dimension and measure names -> column headers
+DIMENSIONS = {
+    "city": "Ciudad",
+    "client": "Cliente",
+    "product": "Producto",
+    "year": "Año",
+    "month": "Mes",
+    "week": "Semana",
+    "day": "Día",
+}
+MEASURES = {
+    "count": "Facturas",
+    "units": "Unidades",
+    "subtotal": "Subtotal",
+    "tax": "ISV",
+    "total": "Total",
+}
+
+
+def time_dimensions(day):
+    """Grouping expressions for the time dimensions over an ISO 'YYYY-MM-DD' expression."""
+    return {
+        "day": day,
+        "week": f"strftime('%Y-W%W', {day})",
+        "month": f"substr({day}, 1, 7)",
+        "year": f"substr({day}, 1, 4)",
+    }
+
+
+def month_dimensions(month):
+    """Time dimensions available over a 'YYYY-MM' expression."""
+    return {"month": month, "year": f"substr({month}, 1, 4)"}
+
+
+CITY = "COALESCE(NULLIF(c.city, ''), '(sin ciudad)')"
+
+
+class PivotSource:
+    """A table (or join) the pivot can be computed from, with its dimension and measure expressions."""
+
+    def __init__(self, name, tables, date_filter, dimensions, measures, additive=True, monthly=False,
+                 scan_filter=None, partitioned=False):
+        self.name = name
+        self.tables = tables
+        self.date_filter = date_filter
+        self.scan_filter = scan_filter or date_filter  # For long ranges, where a full scan beats the index
+        self.dimensions = dimensions  # name -> label expression (rows are grouped by label)
+        self.measures = measures      # name -> aggregate expression
+        self.additive = additive      # False if 'count' cannot be summed across groups
+        self.monthly = monthly        # Only answers ranges made of whole months
+        self.partitioned = partitioned  # Reads invoice rows, which may be in archived years
+
+    def supports(self, dims, measures, whole_months):
+        if self.monthly and not whole_months:
+            return False
+        return all(d in self.dimensions for d in dims) and all(m in self.measures for m in measures)
+
+
+# Sources in order of preference, smallest first: monthly rollups, daily rollups, line items
+SOURCES = [
+    PivotSource(
+        "product_sales_monthly",
+        "product_sales_monthly s LEFT JOIN products p ON p.id = s.product_id",
+        "s.month BETWEEN substr(:start, 1, 7) AND substr(:end, 1, 7)",
+        dict(month_dimensions("s.month"), product="COALESCE(p.name, '(eliminado)')"),
+        {"units": "SUM(s.units)", "subtotal": "SUM(s.revenue)"},
+        monthly=True,
+    ),
+    PivotSource(
+        "client_sales_monthly",
+        "client_sales_monthly s LEFT JOIN clients c ON c.id = s.client_id",
+        "s.month BETWEEN substr(:start, 1, 7) AND substr(:end, 1, 7)",
+        dict(month_dimensions("s.month"),
+             client="COALESCE(c.name, '(sin cliente)')",
+             city=CITY),
+        {"count": "SUM(s.invoices)", "subtotal": "SUM(s.subtotal)", "tax": "SUM(s.tax)", "total": "SUM(s.total)"},
+        monthly=True,
+    ),
+    PivotSource(
+        "product_sales_daily",
+        "product_sales_daily s LEFT JOIN products p ON p.id = s.product_id",
+        "s.day BETWEEN date(:start) AND date(:end)",
+        dict(time_dimensions("s.day"), product="COALESCE(p.name, '(eliminado)')"),
+        {"units": "SUM(s.units)", "subtotal": "SUM(s.revenue)"},
+    ),
+    PivotSource(
+        "client_sales_daily",
+        "client_sales_daily s LEFT JOIN clients c ON c.id = s.client_id",
+        "s.day BETWEEN date(:start) AND date(:end)",
+        dict(time_dimensions("s.day"),
+             client="COALESCE(c.name, '(sin cliente)')",
+             city=CITY),
+        {"count": "SUM(s.invoices)", "subtotal": "SUM(s.subtotal)", "tax": "SUM(s.tax)", "total": "SUM(s.total)"},
+    ),
+    # Line items, for product x client/city pivots; tax and total are prorated by line subtotal
+    PivotSource(
+        "invoice_items",
+        """{invoice_items} i JOIN {invoices} v ON v.id = i.invoice_id
+           LEFT JOIN clients c ON c.id = v.client_id
+           LEFT JOIN products p ON p.id = i.product_id""",
+        "v.date >= date(:start) AND v.date < date(:end) || 'z'",  # 'z' sorts after any time of day
+        dict(time_dimensions("substr(v.date, 1, 10)"),
+             product="COALESCE(p.name, i.name)",
+             client="COALESCE(c.name, v.client_name)",
+             city=CITY),
+        {"count": "COUNT(DISTINCT i.invoice_id)",
+         "units": "SUM(i.quantity)",
+         "subtotal": "SUM(i.subtotal)",
+         "tax": "SUM(i.subtotal * v.tax / NULLIF(v.subtotal, 0))",
+         "total": "SUM(i.subtotal * v.total / NULLIF(v.subtotal, 0))"},
+        additive=False,
+        # Unary + keeps SQLite from driving the join through the date index
+        scan_filter="+v.date >= date(:start) AND +v.date < date(:end) || 'z'",
+        partitioned=True,
+    ),
+]
+
+
+# Ranges longer than this scan the line items instead of seeking by date
+SCAN_DAYS = 180
+
+
+def is_whole_months(start, end):
+    """True if start is the first day of a month and end the last day of one."""
+    return start.day == 1 and end.day == calendar.monthrange(end.year, end.month)[1]
+
+
+def choose_source(dims, measures, start, end):
+    whole_months = is_whole_months(start, end)
+    for source in SOURCES:
+        if source.supports(dims, measures, whole_months):
+            return source
+    raise ValueError("Combinación de dimensiones y medidas no soportada")
+
+
+def compile_query(source, dims, measures, long_range=False, schemas=("main",)):
+    """Grouped SQL for the given dimensions; returns labels first, then the measures."""
+    labels = [source.dimensions[d] for d in dims]
+    select = ", ".join(labels + [f"COALESCE({source.measures[m]}, 0)" for m in measures])
+    date_filter = source.scan_filter if long_range else source.date_filter
+    tables = source.tables
+    if source.partitioned:
+        tables = tables.format(invoice_items=partition(schemas, "invoice_items", INVOICE_ITEM_FIELDS),
+                               invoices=partition(schemas, "invoices", INVOICE_FIELDS))
+    sql = f"SELECT {select} FROM {tables} WHERE {date_filter}"
+    if labels:
+        sql += f" GROUP BY {', '.join(str(n) for n in range(1, len(labels) + 1))}"
+    return sql
+
+
+class PivotResult:
+    """
+    A computed pivot: one row per combination of the row dimensions, and for every
+    combination of the column dimensions one cell per measure, plus totals.
+    """
+
+    def __init__(self, rows, columns, measures, cells, row_totals, column_totals, grand_total, source):
+        self.rows = rows            # row dimension names
+        self.columns = columns      # column dimension names
+        self.measures = measures
+        self.cells = cells          # (row key, column key) -> measure values
+        self.row_totals = row_totals
+        self.column_totals = column_totals
+        self.grand_total = grand_total
+        self.source = source
+        self.row_keys = sorted(row_totals, key=_sort_key)
+        self.column_keys = sorted(column_totals, key=_sort_key) if columns else []
+
+    def headers(self):
+        headers = [DIMENSIONS[d] for d in self.rows]
+        for column_key in self.column_keys:
+            label = " / ".join(str(v) for v in column_key)
+            headers.extend(f"{label} · {MEASURES[m]}" for m in self.measures)
+        suffix = " (total)" if self.columns else ""
+        headers.extend(MEASURES[m] + suffix for m in self.measures)
+        return headers
+
+    def table(self):
+        """Flattened rows: dimension labels, then the cells of every column key, then the row totals."""
+        empty = (0,) * len(self.measures)
+        rows = []
+        for row_key in self.row_keys:
+            values = list(row_key)
+            for column_key in self.column_keys:
+                values.extend(self.cells.get((row_key, column_key), empty))
+            values.extend(self.row_totals[row_key])
+            rows.append(values)
+        return rows
+
+    def total_row(self):
+        values = ["Total"] + [""] * (len(self.rows) - 1)
+        for column_key in self.column_keys:
+            values.extend(self.column_totals[column_key])
+        values.extend(self.grand_total)
+        return values
+
+    def write_csv(self, path):
+        with open(path, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.headers())
+            writer.writerows(self.table())
+            writer.writerow(self.total_row())
+
+
+def _sort_key(key):
+    # Labels may be NULL or mix types; sort as text with None last
+    return tuple((v is None, str(v).lower() if v is not None else "") for v in key)
+
+
+def _add(a, b):
+    return tuple(x + y for x, y in zip(a, b))
+
+
+class PivotEngine:
+    """
+    Cross-tab reports over sales (e.g. city x month, client x product). Each request is
+    compiled to one grouped query over the smallest table that can answer it and the
+    result is kept in the shared ReportCache until the data changes.
+    """
+
+    def __init__(self, db_name="inventory.db"):
+        self.db_name = db_name
+        self.cache = ReportCache.instance(db_name)
+
+    def pivot(self, rows, columns=(), measures=("total",), start="0001-01-01", end="9999-12-31"):
+        """
+        rows/columns: dimension names from DIMENSIONS; measures: names from MEASURES;
+        start/end: inclusive ISO dates. Returns a PivotResult.
+        """
+        rows, columns, measures = tuple(rows), tuple(columns), tuple(measures)
+        if not rows or not measures:
+            raise ValueError("Seleccione al menos una dimensión de filas y una medida")
+        if set(rows) & set(columns):
+            raise ValueError("Una dimensión no puede estar en filas y columnas a la vez")
+        return self.cache.get("pivot", (rows, columns, measures, start, end),
+                              lambda: self._compute(rows, columns, measures, start, end))
+
+    def _compute(self, rows, columns, measures, start, end):
+        first, last = datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+        source = choose_source(rows + columns, measures, first, last)
+        long_range = (last - first).days > SCAN_DAYS
+        params = {"start": start, "end": end}
+        with connect_with_archives(self.db_name) as conn:
+            cursor = conn.cursor()
+            schemas = attach_archives(cursor, self.db_name, start, end) if source.partitioned else ["main"]
+
+            def grouped(dims, measures, source=source):
+                cursor.execute(compile_query(source, dims, measures, long_range, schemas), params)
+                width = len(dims)
+                return {tuple(r[:width]): tuple(r[width:]) for r in cursor.fetchall()}
+
+            n_rows = len(rows)
+            cells = {}
+            for values_key, values in grouped(rows + columns, measures).items():
+                cells[(values_key[:n_rows], values_key[n_rows:])] = values
+            # Totals are sums of the cells
+            zero = (0,) * len(measures)
+            row_totals, column_totals, grand_total = {}, {}, zero
+            for (row_key, column_key), values in cells.items():
+                row_totals[row_key] = _add(row_totals.get(row_key, zero), values)
+                column_totals[column_key] = _add(column_totals.get(column_key, zero), values)
+                grand_total = _add(grand_total, values)
+            if not source.additive and "count" in measures:
+                # An invoice with several products is in several cells; distinct counts
+                # for the totals need their own queries, over the cells' source so the
+                # labels match (the client rollups group walk-in sales under one label)
+                n = measures.index("count")
+
+                def count_by(dims):
+                    return grouped(dims, ("count",))
+
+                def with_count(values, count):
+                    return values[:n] + (count,) + values[n + 1:]
+                if columns:
+                    for row_key, (count,) in count_by(rows).items():
+                        if row_key in row_totals:
+                            row_totals[row_key] = with_count(row_totals[row_key], count)
+                    for column_key, (count,) in count_by(columns).items():
+                        if column_key in column_totals:
+                            column_totals[column_key] = with_count(column_totals[column_key], count)
+                grand_total = with_count(grand_total, count_by(())[()][0])
+        return PivotResult(rows, columns, measures, cells, row_totals, column_totals, grand_total, source.name)
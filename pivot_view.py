@@ -0,0 +1,104 @@
+import time
+from PyQt6.QtCore import Qt, QObject, QRunnable, QThreadPool, QAbstractTableModel, QModelIndex, pyqtSignal
+from PyQt6.QtGui import QFont
+
+
+class PivotModel(QAbstractTableModel):
+    """
+    Table model over a PivotResult. Cells are read from the result on demand, so large
+    pivots do not create one item object per cell. The total row stays last when sorting.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.result = None
+        self.headers = []
+        self.rows = []
+        self.total = None
+        self.kinds = []
+
+    def set_result(self, result):
+        self.beginResetModel()
+        self.result = result
+        self.headers = result.headers()
+        self.rows = result.table()
+        self.total = result.total_row()
+        dims = len(result.rows)
+        measures = result.measures
+        self.kinds = ["text"] * dims + [
+            "int" if measures[(col - dims) % len(measures)] in ("count", "units") else "money"
+            for col in range(dims, len(self.headers))
+        ]
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid() or self.result is None:
+            return 0
+        return len(self.rows) + 1
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+        values = self.rows[row] if row < len(self.rows) else self.total
+        kind = self.kinds[col]
+        if role == Qt.ItemDataRole.DisplayRole:
+            value = values[col]
+            if kind == "text" or value == "":
+                return "" if value is None else str(value)
+            if kind == "int":
+                return f"{int(value):,}"
+            return f"LPS {float(value):,.2f}"
+        if role == Qt.ItemDataRole.TextAlignmentRole and kind != "text":
+            return int(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        if role == Qt.ItemDataRole.FontRole and row == len(self.rows):
+            font = QFont()
+            font.setBold(True)
+            return font
+        return None
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.headers[section]
+        return None
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        if not self.rows:
+            return
+        self.layoutAboutToBeChanged.emit()
+        if self.kinds[column] == "text":
+            key = lambda r: str(r[column] or "").lower()
+        else:
+            key = lambda r: r[column]
+        self.rows.sort(key=key, reverse=order == Qt.SortOrder.DescendingOrder)
+        self.layoutChanged.emit()
+
+
+class _PivotSignals(QObject):
+    finished = pyqtSignal(object, float)  # PivotResult, seconds
+    failed = pyqtSignal(str)
+
+
+class PivotJob(QRunnable):
+    """Computes a pivot on the global thread pool; results arrive through signals on the GUI thread."""
+
+    def __init__(self, engine, **params):
+        super().__init__()
+        self.engine = engine
+        self.params = params
+        self.signals = _PivotSignals()
+
+    def start(self):
+        QThreadPool.globalInstance().start(self)
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            result = self.engine.pivot(**self.params)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.finished.emit(result, time.perf_counter() - started)
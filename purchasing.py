@@ -0,0 +1,244 @@
+import csv
+import sqlite3
+import datetime
+from stock_ledger import record_movements
+
+# Lines of a receipt handled per batch; progress is reported and cancellation checked between batches
+RECEIPT_BATCH = 500
+
+
+def _now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def read_lines_csv(path, index):
+    """
+    Order or receipt lines from a CSV of serial number, quantity and (optionally) unit
+    cost, with or without a header row. index: {serial number: (product_id, name, cost)};
+    a missing cost is the product's current one. Returns ([(product_id, quantity,
+    unit_cost)], [serial numbers not found]).
+    """
+    lines, unknown = [], []
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for n, row in enumerate(csv.reader(f)):
+            if len(row) < 2 or not row[0].strip():
+                continue
+            serial = row[0].strip()
+            try:
+                quantity = int(row[1])
+                unit_cost = float(row[2]) if len(row) > 2 and row[2].strip() else None
+            except ValueError:
+                if n == 0:
+                    continue  # Header
+                raise ValueError(f"Fila {n + 1}: cantidad o costo no válido")
+            if serial not in index:
+                unknown.append(serial)
+                continue
+            product_id, _, cost = index[serial]
+            lines.append((product_id, quantity, cost if unit_cost is None else unit_cost))
+    return lines, unknown
+
+
+class ReceiptCancelled(Exception):
+    """Raised inside receive() when the caller cancels; the transaction is rolled back."""
+
+
+class PurchaseOrders:
+    """
+    Purchase orders and goods receipts. A receipt posts any part of what an order still
+    has pending: the stock increments, cost layers, last costs, ledger movements and
+    received quantities are written in batches inside one transaction, so an interrupted
+    or cancelled receipt leaves nothing behind and can simply be received again.
+    """
+
+    def __init__(self, db_name="inventory.db"):
+        self.db_name = db_name
+
+    def create_order(self, supplier, lines, notes=""):
+        """
+        New order for [(product_id, quantity, unit_cost)]; lines of the same product are
+        added up. Returns (True, order id) or (False, error message).
+        """
+        merged = {}
+        for product_id, quantity, unit_cost in lines:
+            if quantity <= 0 or unit_cost < 0:
+                return False, "Las cantidades deben ser mayores que cero y los costos no negativos."
+            ordered, _ = merged.get(product_id, (0, unit_cost))
+            merged[product_id] = (ordered + quantity, unit_cost)
+        if not supplier.strip() or not merged:
+            return False, "Indique el proveedor y al menos un producto."
+        try:
+            with sqlite3.connect(self.db_name) as conn:
+                cursor = conn.cursor()
+                cursor.execute("INSERT INTO purchase_orders (supplier, created_at, status, notes) VALUES (?, ?, 'open', ?)",
+                               (supplier.strip(), _now(), notes))
+                order_id = cursor.lastrowid
+                cursor.executemany("""
+                    INSERT INTO purchase_order_lines (order_id, product_id, ordered, received, unit_cost)
+                    SELECT ?, id, ?, 0, ? FROM products WHERE id = ?
+                """, [(order_id, quantity, unit_cost, product_id)
+                      for product_id, (quantity, unit_cost) in merged.items()])
+                cursor.execute("SELECT COUNT(*) FROM purchase_order_lines WHERE order_id = ?", (order_id,))
+                if cursor.fetchone()[0] != len(merged):
+                    conn.rollback()
+                    return False, "La orden incluye productos que no existen."
+                conn.commit()
+                return True, order_id
+        except sqlite3.Error as e:
+            return False, str(e)
+
+    def product_index(self):
+        """{serial number: (product_id, name, cost)} for resolving order lines."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT serial_number, id, name, cost FROM products")
+            return {serial: (product_id, name, cost) for serial, product_id, name, cost in cursor.fetchall()}
+
+    def orders(self, status=None):
+        """[(id, supplier, created_at, status, lines, units ordered, units received)], newest first."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT o.id, o.supplier, o.created_at, o.status,
+                       COUNT(l.product_id), COALESCE(SUM(l.ordered), 0), COALESCE(SUM(l.received), 0)
+                FROM purchase_orders o LEFT JOIN purchase_order_lines l ON l.order_id = o.id
+                WHERE ? IS NULL OR o.status = ?
+                GROUP BY o.id ORDER BY o.id DESC
+            """, (status, status))
+            return cursor.fetchall()
+
+    def order_lines(self, order_id):
+        """[(product_id, serial number, name, ordered, received, unit cost)] of an order."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT l.product_id, COALESCE(p.serial_number, ''), COALESCE(p.name, '(eliminado)'),
+                       l.ordered, l.received, l.unit_cost
+                FROM purchase_order_lines l LEFT JOIN products p ON p.id = l.product_id
+                WHERE l.order_id = ? ORDER BY p.name
+            """, (order_id,))
+            return cursor.fetchall()
+
+    def receipts(self, order_id):
+        """[(id, received_at, reference, lines, units, cost)] of an order, oldest first."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, received_at, reference, lines, units, cost FROM goods_receipts
+                WHERE order_id = ? ORDER BY id
+            """, (order_id,))
+            return cursor.fetchall()
+
+    def receive(self, order_id, lines=None, reference="", progress=None, is_cancelled=None):
+        """
+        Post a goods receipt. lines: [(product_id, quantity)] or [(product_id, quantity,
+        unit_cost)] for a cost different from the order's; None receives everything still
+        pending. Lines of the same product are added up, at their average unit cost.
+        progress(lines done, total) and is_cancelled() are called between batches.
+        Returns (True, receipt id) or (False, error message); on error nothing is posted.
+        """
+        try:
+            with sqlite3.connect(self.db_name) as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute("SELECT status FROM purchase_orders WHERE id = ?", (order_id,))
+                row = cursor.fetchone()
+                if row is None or row[0] not in ("open", "partial"):
+                    conn.rollback()
+                    return False, "La orden no está pendiente de recibir."
+                cursor.execute("""
+                    SELECT l.product_id, l.ordered - l.received, l.unit_cost
+                    FROM purchase_order_lines l JOIN products p ON p.id = l.product_id
+                    WHERE l.order_id = ?
+                """, (order_id,))
+                pending = {product_id: (left, unit_cost) for product_id, left, unit_cost in cursor.fetchall()}
+                if lines is None:
+                    lines = [(product_id, left) for product_id, (left, _) in pending.items() if left > 0]
+                merged = {}  # product_id -> [units, their cost]
+                for line in lines:
+                    product_id, quantity = line[0], line[1]
+                    if quantity <= 0:
+                        continue
+                    if product_id not in pending:
+                        conn.rollback()
+                        return False, f"El producto {product_id} no está en la orden o ya no existe."
+                    unit_cost = line[2] if len(line) > 2 else pending[product_id][1]
+                    total = merged.setdefault(product_id, [0, 0.0])
+                    total[0] += quantity
+                    total[1] += quantity * unit_cost
+                receipt = []
+                for product_id, (quantity, cost) in merged.items():
+                    left = pending[product_id][0]
+                    if quantity > left:
+                        conn.rollback()
+                        return False, f"Se recibirían {quantity} unidades del producto {product_id} y solo quedan {left} pendientes."
+                    receipt.append((product_id, quantity, cost / quantity))
+                if not receipt:
+                    conn.rollback()
+                    return False, "No hay cantidades para recibir."
+                received_at = _now()
+                cursor.execute("""
+                    INSERT INTO goods_receipts (order_id, received_at, reference, lines, units, cost)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (order_id, received_at, reference, len(receipt), sum(r[1] for r in receipt),
+                      sum(r[1] * r[2] for r in receipt)))
+                receipt_id = cursor.lastrowid
+                for start in range(0, len(receipt), RECEIPT_BATCH):
+                    if is_cancelled and is_cancelled():
+                        raise ReceiptCancelled()
+                    self._post_batch(cursor, order_id, receipt_id, received_at, receipt[start:start + RECEIPT_BATCH])
+                    if progress:
+                        progress(min(start + RECEIPT_BATCH, len(receipt)), len(receipt))
+                cursor.execute("""
+                    UPDATE purchase_orders SET status = CASE
+                        WHEN EXISTS (SELECT 1 FROM purchase_order_lines WHERE order_id = ? AND received < ordered)
+                        THEN 'partial' ELSE 'received' END
+                    WHERE id = ?
+                """, (order_id, order_id))
+                conn.commit()
+                return True, receipt_id
+        except ReceiptCancelled:
+            return False, "Recepción cancelada; no se registró nada."
+        except sqlite3.Error as e:
+            return False, str(e)
+
+    def _post_batch(self, cursor, order_id, receipt_id, received_at, batch):
+        """Post (product_id, quantity, unit_cost) lines with one statement per table."""
+        ids = [product_id for product_id, _, _ in batch]
+        marks = ",".join("?" * len(ids))
+        # Stock that predates cost layers gets its opening layer first, as ensure_opening_layer does
+        cursor.execute(f"""
+            INSERT INTO cost_layers (product_id, received_at, quantity, remaining, unit_cost, source)
+            SELECT p.id, '0000-00-00 00:00:00', p.quantity - COALESCE(c.covered, 0),
+                   p.quantity - COALESCE(c.covered, 0), p.cost, 'opening'
+            FROM products p LEFT JOIN (
+                SELECT product_id, SUM(remaining) AS covered FROM cost_layers
+                WHERE remaining > 0 AND product_id IN ({marks}) GROUP BY product_id
+            ) c ON c.product_id = p.id
+            WHERE p.id IN ({marks}) AND p.quantity > COALESCE(c.covered, 0)
+        """, ids + ids)
+        source = f"OC {order_id}"
+        cursor.executemany("""
+            INSERT INTO cost_layers (product_id, received_at, quantity, remaining, unit_cost, source)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(product_id, received_at, quantity, quantity, unit_cost, source)
+              for product_id, quantity, unit_cost in batch])
+        cursor.executemany("UPDATE products SET quantity = quantity + ?, cost = ? WHERE id = ?",
+                           [(quantity, unit_cost, product_id) for product_id, quantity, unit_cost in batch])
+        cursor.executemany("""
+            UPDATE purchase_order_lines SET received = received + ? WHERE order_id = ? AND product_id = ?
+        """, [(quantity, order_id, product_id) for product_id, quantity, _ in batch])
+        cursor.executemany("""
+            INSERT INTO goods_receipt_lines (receipt_id, product_id, quantity, unit_cost) VALUES (?, ?, ?, ?)
+        """, [(receipt_id, product_id, quantity, unit_cost) for product_id, quantity, unit_cost in batch])
+        record_movements(cursor, [(product_id, quantity) for product_id, quantity, _ in batch],
+                         "receipt", f"recepción {receipt_id}")
+
+    def cancel_order(self, order_id):
+        """Close an order that will not be received (further); returns whether it was pending."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE purchase_orders SET status = 'cancelled' WHERE id = ? AND status IN ('open', 'partial')",
+                           (order_id,))
+            conn.commit()
+            return cursor.rowcount > 0
@@ -0,0 +1,49 @@
+from collections import namedtuple
+from functools import partial
+
+
+class Product(namedtuple("Product", "id serial_number name quantity cost price")):
+    """A row of the products table."""
+    __slots__ = ()
+
+
+class Client(namedtuple("Client", "id name identity_id rtn phone email city")):
+    """A row of the clients table."""
+    __slots__ = ()
+
+
+class Invoice(namedtuple("Invoice", "id client_id client_name date subtotal tax total file_path")):
+    """A row of the invoices table; file_path holds the document reference."""
+    __slots__ = ()
+
+
+class CreditNote(namedtuple("CreditNote", "id invoice_id client_id client_name date subtotal tax total reason")):
+    """A row of the credit_notes table (goods returned against an invoice)."""
+    __slots__ = ()
+
+
+class ClientStats(namedtuple("ClientStats", "client_id invoice_count lifetime_total first_purchase last_purchase")):
+    """A row of the client_stats table (lifetime purchases of one client)."""
+    __slots__ = ()
+
+    @property
+    def average_ticket(self):
+        return self.lifetime_total / self.invoice_count if self.invoice_count else 0.0
+
+
+def columns(record_type, alias=None):
+    """Column list for a SELECT matching the record's fields, e.g. "id, serial_number, ..."."""
+    prefix = f"{alias}." if alias else ""
+    return ", ".join(prefix + field for field in record_type._fields)
+
+
+def as_records(record_type, rows):
+    """
+    Turn fetched tuples into records. The rows are re-typed by tuple.__new__ in C,
+    with no Python-level call per row.
+    """
+    return list(map(partial(tuple.__new__, record_type), rows))
+
+
+def as_record(record_type, row):
+    return tuple.__new__(record_type, row) if row is not None else None
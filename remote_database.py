@@ -0,0 +1,233 @@
+import json
+import threading
+import http.client
+from urllib.parse import urlsplit, urlencode
+from records import Product, Client, Invoice, CreditNote, ClientStats, as_records, as_record
+
+
+class ServerError(Exception):
+    """The inventory server answered with an error or could not be reached."""
+
+
+class RemoteDatabase:
+    """
+    Client of the inventory server (server.py) with the same methods as Database for
+    products, clients, invoices and sales, so tabs can use either backend. Each thread
+    keeps its own keep-alive connection, so the DatabaseExecutor threads can share one
+    instance.
+    """
+
+    def __init__(self, url="http://127.0.0.1:8765", timeout=10):
+        parts = urlsplit(url)
+        self.url = url
+        self.db_name = url  # Stands in for the file name where tabs pass it along
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 8765
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return conn
+
+    def request(self, method, path, body=None, **query):
+        """Send one request and return its result; raises ServerError on failure."""
+        if query:
+            path += "?" + urlencode(query)
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json"} if data is not None else {}
+        for attempt in (1, 2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+                payload = json.loads(response.read() or b"{}")
+                break
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                self._local.conn = None
+                # A kept-alive connection may have been closed by the server: retry once on a new
+                # one, except a POST (a checkout must never be applied twice)
+                if attempt == 2 or method == "POST" or isinstance(e, TimeoutError):
+                    raise ServerError(f"No se pudo conectar con el servidor {self.url}: {e}") from e
+        if response.status != 200:
+            raise ServerError(payload.get("error", f"Error {response.status}"))
+        return payload.get("result")
+
+    @staticmethod
+    def _ids(ids):
+        return ",".join(str(i) for i in ids)
+
+    # --- Products ---
+    def get_all_products(self):
+        return as_records(Product, self.request("GET", "/products"))
+
+    def get_products_by_ids(self, ids):
+        ids = list(ids)
+        return as_records(Product, self.request("GET", "/products", ids=self._ids(ids))) if ids else []
+
+    def search_products(self, search_term, search_type):
+        return as_records(Product, self.request("GET", "/products", q=search_term, type=search_type))
+
+    def add_product(self, serial_number, name, quantity, cost, price):
+        return self.request("POST", "/products", {"serial_number": serial_number, "name": name,
+                                                  "quantity": quantity, "cost": cost, "price": price})
+
+    def update_product(self, product_id, serial_number, name, quantity, cost, price, costing_method="average"):
+        return self.request("PUT", f"/products/{product_id}", {
+            "serial_number": serial_number, "name": name, "quantity": quantity, "cost": cost,
+            "price": price, "costing_method": costing_method})
+
+    def update_products(self, products, costing_method="average"):
+        success, result = self.request("PUT", "/products", {"products": [list(p) for p in products],
+                                                            "costing_method": costing_method})
+        return success, result
+
+    def adjust_prices(self, percent, field="price", search_term="", search_type="Nombre"):
+        return self.request("POST", "/products/adjust-prices", {"percent": percent, "field": field,
+                                                                 "search_term": search_term,
+                                                                 "search_type": search_type})
+
+    def delete_product(self, product_id):
+        return self.request("DELETE", f"/products/{product_id}")
+
+    # --- Clients ---
+    def get_all_clients(self):
+        return as_records(Client, self.request("GET", "/clients"))
+
+    def get_clients_by_ids(self, ids):
+        ids = list(ids)
+        return as_records(Client, self.request("GET", "/clients", ids=self._ids(ids))) if ids else []
+
+    def search_clients(self, search_term, search_type):
+        return as_records(Client, self.request("GET", "/clients", q=search_term, type=search_type))
+
+    def find_clients_by_prefix(self, prefix, limit=20):
+        return as_records(Client, self.request("GET", "/clients", prefix=prefix, limit=limit))
+
+    def add_client(self, name, identity_id, rtn, phone, email, city):
+        return self.request("POST", "/clients", {"name": name, "identity_id": identity_id, "rtn": rtn,
+                                                 "phone": phone, "email": email, "city": city})
+
+    def update_client(self, client_id, name, identity_id, rtn, phone, email, city):
+        return self.request("PUT", f"/clients/{client_id}", {"name": name, "identity_id": identity_id, "rtn": rtn,
+                                                             "phone": phone, "email": email, "city": city})
+
+    def delete_client(self, client_id):
+        return self.request("DELETE", f"/clients/{client_id}")
+
+    def get_client_stats(self, client_id):
+        return as_record(ClientStats, self.request("GET", f"/clients/{client_id}/stats"))
+
+    def get_client_stats_by_ids(self, client_ids):
+        ids = list(client_ids)
+        return as_records(ClientStats, self.request("GET", "/clients/stats", ids=self._ids(ids))) if ids else []
+
+    def get_all_client_stats(self):
+        return as_records(ClientStats, self.request("GET", "/clients/stats"))
+
+    def top_clients(self, limit=20):
+        return [(as_record(Client, client), as_record(ClientStats, stats))
+                for client, stats in self.request("GET", "/clients/top", limit=limit)]
+
+    # --- Invoices and sales ---
+    def get_all_invoices(self):
+        return as_records(Invoice, self.request("GET", "/invoices"))
+
+    def get_invoices_by_ids(self, ids):
+        ids = list(ids)
+        return as_records(Invoice, self.request("GET", "/invoices", ids=self._ids(ids))) if ids else []
+
+    def get_invoice_by_id(self, invoice_id):
+        return as_record(Invoice, self.request("GET", f"/invoices/{invoice_id}"))
+
+    def search_invoices(self, search_term, search_type):
+        return as_records(Invoice, self.request("GET", "/invoices", q=search_term, type=search_type))
+
+    def get_invoices_by_date_range(self, start, end):
+        return as_records(Invoice, self.request("GET", "/invoices", start=start, end=end))
+
+    def get_invoices_by_client(self, client_id):
+        return as_records(Invoice, self.request("GET", f"/clients/{client_id}/invoices"))
+
+    def delete_invoice(self, invoice_id):
+        """Delete an invoice; the server also removes its document."""
+        return self.request("DELETE", f"/invoices/{invoice_id}")
+
+    def returnable_items(self, invoice_id):
+        return [tuple(row) for row in self.request("GET", f"/invoices/{invoice_id}/returnable")]
+
+    def create_credit_note(self, invoice_id, lines=None, reason="", date=None):
+        success, result = self.request("POST", f"/invoices/{invoice_id}/credit-notes", {
+            "lines": [list(line) for line in lines] if lines is not None else None,
+            "reason": reason, "date": date})
+        return success, result
+
+    def get_credit_notes_by_invoice(self, invoice_id):
+        return as_records(CreditNote, self.request("GET", f"/invoices/{invoice_id}/credit-notes"))
+
+    def get_credit_notes_by_date_range(self, start, end):
+        return as_records(CreditNote, self.request("GET", "/credit-notes", start=start, end=end))
+
+    def get_credit_note_items(self, credit_note_id):
+        return [tuple(row) for row in self.request("GET", f"/credit-notes/{credit_note_id}/items")]
+
+    def record_sale(self, store, prefix, date, client_id, client_name, detail, items, subtotal, tax, total,
+                    costing_method="average"):
+        """Same as Database.record_sale; the document is saved in the server's store (store is unused)."""
+        success, result, file_path = self.request("POST", "/checkout", {
+            "prefix": prefix, "date": date, "client_id": client_id, "client_name": client_name,
+            "detail": list(detail), "items": items, "subtotal": subtotal, "tax": tax, "total": total,
+            "costing_method": costing_method})
+        return success, result, file_path
+
+    def sales_report(self, start, end):
+        """(invoices, total sales) between two dates, cached on the server."""
+        report = self.request("GET", "/reports/sales", start=start, end=end)
+        return as_records(Invoice, report["invoices"]), report["total"]
+
+    def load_document(self, invoice_id):
+        return self.request("GET", f"/invoices/{invoice_id}/document")
+
+    def changes(self, after):
+        """{"first", "last", "changes": [[table, op, row_id], ...]} of the server's change_log."""
+        return self.request("GET", "/changes", after=after)
+
+    def sync_export(self, peer=None):
+        """The server's sync bundle for the branch `peer` (see sync.SyncEngine.export)."""
+        return self.request("GET", "/sync/export", **({"peer": peer} if peer else {}))
+
+    def sync_import(self, bundle):
+        return self.request("POST", "/sync/import", bundle)
+
+    def health(self):
+        return self.request("GET", "/health")
+
+
+class RemoteInvoiceStore:
+    """Read-only view of the server's invoice documents (they are written by the server at checkout)."""
+
+    def __init__(self, remote):
+        self.remote = remote
+
+    def load_invoice(self, invoice_id, ref):
+        return self.remote.load_document(invoice_id)  # The server reads the reference itself
+
+    def version(self, ref):
+        return ref  # Documents are never rewritten under the same reference
+
+    def save(self, name, text, date=None, cursor=None):
+        raise ServerError("Los documentos se guardan en el servidor")
+
+    def delete(self, ref):
+        pass  # Done by the server when the invoice is deleted
+
+
+def open_database(settings_manager):
+    """Database or RemoteDatabase, following the "database_backend" setting."""
+    if settings_manager.get_setting("database_backend", "local") == "server":
+        return RemoteDatabase(settings_manager.get_setting("server_url", "http://127.0.0.1:8765"))
+    from database import Database
+    return Database()
@@ -0,0 +1,146 @@
+import sqlite3
+import datetime
+import threading
+import numpy as np
+from report_cache import data_version
+
+# z-scores for the service levels offered in the UI
+SERVICE_LEVELS = {0.90: 1.2816, 0.95: 1.6449, 0.98: 2.0537, 0.99: 2.3263}
+
+
+class DemandForecast:
+    """Per-SKU demand statistics, as parallel NumPy arrays indexed like product_ids."""
+
+    def __init__(self, product_ids, smoothed, moving_averages, std, last_sale_age):
+        self.product_ids = product_ids
+        self.smoothed = smoothed                  # exponential smoothing, units/day
+        self.moving_averages = moving_averages    # {window days: units/day}
+        self.std = std                            # std. deviation of daily demand
+        self.last_sale_age = last_sale_age        # days since last sale (inf if never)
+
+
+def forecast_demand(product_ids, day_index, sku_index, units, history_days, alpha=0.1, windows=(7, 28)):
+    """
+    Forecast daily demand for all SKUs at once.
+    day_index/sku_index/units describe the non-zero cells of the SKU x day sales matrix
+    (day 0 is the oldest day of the history). Simple exponential smoothing is evaluated
+    in closed form, level_T = sum(alpha * (1 - alpha)^(T - 1 - t) * d_t), so every
+    statistic is one weighted bincount instead of a loop over SKUs or days.
+    """
+    n = len(product_ids)
+    age = (history_days - 1 - day_index).astype(np.float64)  # 0 = most recent day
+    weights = alpha * np.power(1.0 - alpha, age)
+    smoothed = np.bincount(sku_index, weights=units * weights, minlength=n)
+
+    moving_averages = {}
+    for w in windows:
+        recent = age < w
+        moving_averages[w] = np.bincount(sku_index[recent], weights=units[recent], minlength=n) / w
+
+    # Variance of daily demand over the longest window (days without sales count as 0)
+    span = max(windows)
+    recent = age < span
+    total = np.bincount(sku_index[recent], weights=units[recent], minlength=n)
+    squares = np.bincount(sku_index[recent], weights=units[recent] ** 2, minlength=n)
+    mean = total / span
+    std = np.sqrt(np.maximum(squares / span - mean ** 2, 0.0))
+
+    last_sale_age = np.full(n, np.inf)
+    np.minimum.at(last_sale_age, sku_index, age)
+    return DemandForecast(product_ids, smoothed, moving_averages, std, last_sale_age)
+
+
+def reorder_suggestions(forecast, quantities, lead_time_days=7, review_days=7, service_level=0.95):
+    """
+    Reorder point and suggested order quantity for every SKU (vectorized).
+    reorder point = demand during lead time + safety stock
+    order up to   = demand during lead time + review period + safety stock
+    Returns (reorder_point, suggested_quantity) arrays.
+    """
+    z = SERVICE_LEVELS.get(service_level, 1.6449)
+    demand = forecast.smoothed
+    safety = z * forecast.std * np.sqrt(lead_time_days)
+    reorder_point = np.ceil(demand * lead_time_days + safety)
+    order_up_to = np.ceil(demand * (lead_time_days + review_days) + safety)
+    suggested = np.where(quantities <= reorder_point, np.maximum(order_up_to - quantities, 0), 0)
+    return reorder_point.astype(np.int64), suggested.astype(np.int64)
+
+
+class ReplenishmentPlanner:
+    """Builds demand forecasts from the sales rollup and caches them until the data changes."""
+
+    def __init__(self, db_name="inventory.db", history_days=1095, alpha=0.1, windows=(7, 28)):
+        self.db_name = db_name
+        self.history_days = history_days
+        self.alpha = alpha
+        self.windows = windows
+        self._cache_key = None
+        self._forecast = None
+        self._lock = threading.Lock()
+
+    def _sales_version(self, cursor):
+        # change_log position: moves with invoices, credit notes, edits and rollup rebuilds
+        return data_version(cursor)
+
+    def forecast(self, as_of=None):
+        """Demand forecast for every product, recomputed only when sales changed."""
+        as_of = as_of or datetime.date.today()
+        start = as_of - datetime.timedelta(days=self.history_days - 1)
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            key = (self._sales_version(cursor), as_of, self.history_days, self.alpha, self.windows)
+            with self._lock:
+                if key == self._cache_key:
+                    return self._forecast
+            cursor.execute("SELECT id FROM products ORDER BY id")
+            product_ids = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+            # Rows come from the covering (day, product_id, units, revenue) index
+            cursor.execute("""
+                SELECT CAST(julianday(day) - julianday(?) AS INTEGER), product_id, units
+                FROM product_sales_daily
+                WHERE day >= ? AND day <= ?
+            """, (start.isoformat(), start.isoformat(), as_of.isoformat()))
+            cells = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 3)
+        day_index = cells[:, 0].astype(np.int64)
+        pids = cells[:, 1].astype(np.int64)
+        # Sales of deleted products are dropped
+        sku_index = np.minimum(np.searchsorted(product_ids, pids), max(len(product_ids) - 1, 0))
+        known = (product_ids[sku_index] == pids) if len(product_ids) else np.zeros(len(pids), dtype=bool)
+        forecast = forecast_demand(product_ids, day_index[known], sku_index[known], cells[known, 2],
+                                   self.history_days, self.alpha, self.windows)
+        with self._lock:
+            self._cache_key = key
+            self._forecast = forecast
+        return forecast
+
+    def suggestions(self, lead_time_days=7, review_days=7, service_level=0.95, only_needed=True):
+        """
+        Reorder suggestions against the current stock.
+        Returns rows (product_id, serial_number, name, quantity, daily demand,
+        moving averages..., reorder point, suggested quantity).
+        """
+        forecast = self.forecast()
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, serial_number, name, quantity FROM products ORDER BY id")
+            products = cursor.fetchall()
+        # Line the forecast up with the current products (some may be new or deleted)
+        ids = np.array([p[0] for p in products], dtype=np.int64)
+        known = forecast.product_ids
+        pos = np.minimum(np.searchsorted(known, ids), max(len(known) - 1, 0))
+        found = (known[pos] == ids) if len(known) else np.zeros(len(ids), dtype=bool)
+
+        def take(values):
+            return np.where(found, values[pos], 0.0) if len(known) else np.zeros(len(ids))
+        quantities = np.array([p[3] for p in products], dtype=np.float64)
+        smoothed = take(forecast.smoothed)
+        averages = [take(forecast.moving_averages[w]) for w in self.windows]
+        aligned = DemandForecast(None, smoothed, None, take(forecast.std), None)
+        reorder_point, suggested = reorder_suggestions(aligned, quantities, lead_time_days, review_days, service_level)
+        rows = []
+        for n in (np.nonzero(suggested)[0] if only_needed else range(len(products))):
+            p = products[n]
+            rows.append(p + (float(smoothed[n]),) + tuple(float(a[n]) for a in averages)
+                        + (int(reorder_point[n]), int(suggested[n])))
+        rows.sort(key=lambda r: r[-1], reverse=True)
+        return rows
@@ -0,0 +1,132 @@
+import sys
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Elements measured when estimating the size of a long list; the rest is extrapolated
+SAMPLE = 64
+
+
+def data_version(cursor):
+    """
+    Position of the last change in change_log. Triggers add an entry for every insert,
+    update and delete of products, clients, invoices, credit notes and client_stats, in
+    any process; rollup rebuilds add one too (log_rebuild).
+    """
+    cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log")
+    return cursor.fetchone()[0]
+
+
+def log_rebuild(cursor, table):
+    """
+    Add a change_log entry for a table rebuilt in bulk that has no row triggers (a rollup),
+    so the data version read by report caches and forecasts moves on. Views ignore it.
+    """
+    cursor.execute("INSERT INTO change_log (tbl, op, row_id) VALUES (?, 'rebuild', 0)", (table,))
+
+
+def estimate_size(value, depth=3):
+    """Approximate memory used by a report result (containers are sampled, not walked fully)."""
+    size = sys.getsizeof(value)
+    if depth == 0:
+        return size
+    if isinstance(value, dict):
+        items = list(value.items())
+        sample = items[:SAMPLE]
+        if sample:
+            sampled = sum(estimate_size(k, depth - 1) + estimate_size(v, depth - 1) for k, v in sample)
+            size += sampled * len(items) // len(sample)
+    elif isinstance(value, (list, tuple)):
+        sample = value[:SAMPLE]
+        if sample:
+            sampled = sum(estimate_size(v, depth - 1) for v in sample)
+            size += sampled * len(value) // len(sample)
+    elif hasattr(value, "__dict__"):
+        size += estimate_size(vars(value), depth - 1)
+    return size
+
+
+class ReportCache:
+    """
+    Process-wide LRU cache of report results keyed by (report, parameters, data version).
+    Any committed change moves the data version, so stale results are never returned;
+    entries of older versions are dropped as soon as a newer version is seen.
+    The total estimated size of the entries is kept under max_bytes.
+    """
+
+    _instance = None
+
+    @classmethod
+    def instance(cls, db_name="inventory.db"):
+        if cls._instance is None:
+            cls._instance = cls(db_name)
+        return cls._instance
+
+    def __init__(self, db_name="inventory.db", max_bytes=64 * 1024 * 1024):
+        self.db_name = db_name
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def version(self):
+        with sqlite3.connect(self.db_name) as conn:
+            return data_version(conn.cursor())
+
+    def key(self, report, params):
+        """Cache key for a report with the current data version."""
+        return (report, params, self.version())
+
+    def get(self, report, params, compute):
+        """Return the cached result of compute() for this report and parameters, computing it on a miss."""
+        key = self.key(report, params)
+        with self._lock:
+            if key[2] != self._version:
+                self._drop_old_versions(key[2])
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        with self._lock:
+            if key[2] != self._version:
+                if self._version is not None and key[2] < self._version:
+                    return  # Computed from data that has changed since
+                self._drop_old_versions(key[2])
+            if size > self.max_bytes:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def _drop_old_versions(self, version):
+        for key in [k for k in self._entries if k[2] != version]:
+            self._bytes -= self._entries.pop(key)[1]
+        self._version = version
+
+    def clear(self):
+        """Forget everything (e.g. after the database file was replaced)."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = None
+
+    def usage(self):
+        """(entries, estimated bytes)."""
+        with self._lock:
+            return len(self._entries), self._bytes
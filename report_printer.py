@@ -0,0 +1,221 @@
+from PyQt6.QtCore import Qt, QObject, QThread, QRectF, QPointF, pyqtSignal, pyqtSlot
+from PyQt6.QtGui import QFont, QFontMetricsF, QPainter, QPen, QColor
+from PyQt6.QtPrintSupport import QPrinter
+from PyQt6.QtWidgets import QProgressDialog
+
+
+class PagedReport:
+    """
+    Description of a tabular report to print page by page.
+    row_source: callable returning an iterable of rows; it is called on the print thread
+    so it can open its own database connection and stream rows.
+    format_row: callable turning a row into (list of cell strings, amount for subtotals).
+    """
+
+    def __init__(self, title, headers, row_source, format_row, meta=None, widths=None,
+                 total_label="Total", count_label="Registros", total_rows=0):
+        self.title = title
+        self.headers = headers
+        self.row_source = row_source
+        self.format_row = format_row
+        self.meta = meta or []
+        self.widths = widths or [1] * len(headers)
+        self.total_label = total_label
+        self.count_label = count_label
+        self.total_rows = total_rows
+
+
+def render_paged_report(printer, report, progress=None, is_cancelled=None):
+    """
+    Paint a report on the printer, one page at a time.
+    Only the current page is held in memory; the column header is repeated on every page
+    and each page ends with its own subtotal. Returns the number of pages printed.
+    """
+    painter = QPainter()
+    if not painter.begin(printer):
+        raise Exception("No se pudo iniciar la impresión")
+    try:
+        page = printer.pageLayout().paintRectPixels(printer.resolution())
+        left, top = 0.0, 0.0
+        width, bottom = float(page.width()), float(page.height())
+
+        title_font = QFont("Arial", 14, QFont.Weight.Bold)
+        header_font = QFont("Arial", 9, QFont.Weight.Bold)
+        body_font = QFont("Arial", 9)
+        body_metrics = QFontMetricsF(body_font, printer)
+        row_height = body_metrics.height() * 1.5
+        padding = body_metrics.averageCharWidth()
+        footer_height = row_height * 2
+
+        total_weight = float(sum(report.widths))
+        column_x = [left]
+        for w in report.widths:
+            column_x.append(column_x[-1] + width * w / total_weight)
+
+        pen = QPen(QColor("#cccccc"))
+        pen.setWidthF(max(1.0, printer.resolution() / 300))
+
+        def draw_cells(y, cells, font, fill=None):
+            painter.setFont(font)
+            metrics = QFontMetricsF(font, printer)
+            if fill is not None:
+                painter.fillRect(QRectF(left, y, width, row_height), fill)
+            for col, text in enumerate(cells):
+                x0, x1 = column_x[col], column_x[col + 1]
+                rect = QRectF(x0 + padding, y, x1 - x0 - 2 * padding, row_height)
+                text = metrics.elidedText(str(text), Qt.TextElideMode.ElideRight, rect.width())
+                painter.drawText(rect, Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignLeft, text)
+            painter.setPen(pen)
+            painter.drawLine(QPointF(left, y + row_height), QPointF(left + width, y + row_height))
+            painter.setPen(QColor("#222222"))
+
+        def start_page(page_number):
+            y = top
+            painter.setPen(QColor("#222222"))
+            if page_number == 1:
+                painter.setFont(title_font)
+                title_height = QFontMetricsF(title_font, printer).height() * 1.4
+                painter.drawText(QRectF(left, y, width, title_height), Qt.AlignmentFlag.AlignLeft, report.title)
+                y += title_height
+                painter.setFont(body_font)
+                for line in report.meta:
+                    painter.drawText(QRectF(left, y, width, row_height), Qt.AlignmentFlag.AlignLeft, line)
+                    y += row_height
+                y += row_height / 2
+            else:
+                painter.setFont(body_font)
+                painter.drawText(QRectF(left, y, width, row_height), Qt.AlignmentFlag.AlignLeft,
+                                 f"{report.title} (continuación)")
+                y += row_height
+            draw_cells(y, report.headers, header_font, QColor("#f0f0f0"))
+            return y + row_height
+
+        def finish_page(page_number, page_rows, page_amount):
+            y = bottom - footer_height
+            painter.setFont(body_font)
+            painter.drawText(QRectF(left, y, width, row_height), Qt.AlignmentFlag.AlignLeft,
+                             f"{report.count_label} en la página: {page_rows} | "
+                             f"Subtotal de la página: LPS {page_amount:,.2f}")
+            painter.drawText(QRectF(left, y + row_height, width, row_height), Qt.AlignmentFlag.AlignRight,
+                             f"Página {page_number}")
+
+        page_number = 1
+        y = start_page(page_number)
+        page_rows, page_amount = 0, 0.0
+        total_rows, total_amount = 0, 0.0
+        for row in report.row_source():
+            if is_cancelled and is_cancelled():
+                printer.abort()
+                return page_number
+            if y + row_height > bottom - footer_height:
+                finish_page(page_number, page_rows, page_amount)
+                printer.newPage()
+                page_number += 1
+                y = start_page(page_number)
+                page_rows, page_amount = 0, 0.0
+            cells, amount = report.format_row(row)
+            draw_cells(y, cells, body_font)
+            y += row_height
+            page_rows += 1
+            page_amount += amount
+            total_rows += 1
+            total_amount += amount
+            if progress and total_rows % 200 == 0:
+                progress(total_rows, page_number)
+
+        # Grand totals go below the last row, on a new page if they do not fit
+        if y + 3 * row_height > bottom - footer_height:
+            finish_page(page_number, page_rows, page_amount)
+            printer.newPage()
+            page_number += 1
+            y = start_page(page_number)
+            page_rows, page_amount = 0, 0.0
+        y += row_height / 2
+        painter.setFont(header_font)
+        painter.drawText(QRectF(left, y, width, row_height), Qt.AlignmentFlag.AlignRight,
+                         f"{report.count_label}: {total_rows}")
+        painter.drawText(QRectF(left, y + row_height, width, row_height), Qt.AlignmentFlag.AlignRight,
+                         f"{report.total_label}: LPS {total_amount:,.2f}")
+        finish_page(page_number, page_rows, page_amount)
+        if progress:
+            progress(total_rows, page_number)
+        return page_number
+    finally:
+        painter.end()
+
+
+class ReportPrintWorker(QObject):
+    progress = pyqtSignal(int, int)   # rows printed, pages printed
+    finished = pyqtSignal(int)        # total pages
+    failed = pyqtSignal(str)
+
+    def __init__(self, printer, report):
+        super().__init__()
+        self.printer = printer
+        self.report = report
+        self.cancelled = False
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            pages = render_paged_report(self.printer, self.report,
+                                        progress=self.progress.emit,
+                                        is_cancelled=lambda: self.cancelled)
+            self.finished.emit(pages)
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class ReportPrintJob(QObject):
+    """Runs a report print on a worker thread and shows its progress."""
+    finished = pyqtSignal(int)
+    failed = pyqtSignal(str)
+
+    def __init__(self, parent, printer, report):
+        super().__init__(parent)
+        self.printer = printer
+        self.thread = QThread()
+        self.worker = ReportPrintWorker(printer, report)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.finished.connect(self.on_finished)
+        self.worker.failed.connect(self.on_failed)
+        self.worker.progress.connect(self.on_progress)
+
+        self.dialog = QProgressDialog("Imprimiendo reporte...", "Cancelar", 0, max(report.total_rows, 0), parent)
+        self.dialog.setWindowTitle("Imprimir")
+        self.dialog.setWindowModality(Qt.WindowModality.WindowModal)
+        self.dialog.setMinimumDuration(500)
+        self.dialog.canceled.connect(self.cancel)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.worker.cancelled = True
+
+    def on_progress(self, rows, pages):
+        if self.dialog.maximum() > 0:
+            self.dialog.setValue(min(rows, self.dialog.maximum()))
+        self.dialog.setLabelText(f"Imprimiendo reporte... {rows} filas, {pages} páginas")
+
+    def on_finished(self, pages):
+        self._stop()
+        self.finished.emit(pages)
+
+    def on_failed(self, error):
+        self._stop()
+        self.failed.emit(error)
+
+    def _stop(self):
+        self.dialog.reset()
+        self.thread.quit()
+        self.thread.wait()
+
+
+def pdf_printer(file_name):
+    """Printer that writes a PDF file instead of going to a physical printer."""
+    printer = QPrinter(QPrinter.PrinterMode.HighResolution)
+    printer.setOutputFormat(QPrinter.OutputFormat.PdfFormat)
+    printer.setOutputFileName(file_name)
+    return printer
@@ -0,0 +1,192 @@
+from PyQt6.QtCore import Qt, QObject, QRunnable, QThreadPool, QTimer, QPointF, QRectF, pyqtSignal
+from PyQt6.QtGui import QPainter, QPen, QColor, QPolygonF
+from PyQt6.QtWidgets import QWidget
+from sales_trend import SalesTrend, to_seconds, from_seconds
+
+# Shortest visible span when zooming in
+MIN_SPAN = 6 * 3600
+LABELS = {"hour": "por hora", "day": "por día", "week": "por semana", "month": "por mes"}
+
+
+class _SeriesSignals(QObject):
+    ready = pyqtSignal(int, object)  # request number, SalesSeries
+    failed = pyqtSignal(int, str)
+
+
+class _SeriesTask(QRunnable):
+    def __init__(self, trend, request, start, end, max_points):
+        super().__init__()
+        self.trend = trend
+        self.request = request
+        self.start = start
+        self.end = end
+        self.max_points = max_points
+        self.signals = _SeriesSignals()
+
+    def run(self):
+        try:
+            series = self.trend.series(self.start, self.end, self.max_points)
+        except Exception as e:
+            self.signals.failed.emit(self.request, str(e))
+            return
+        self.signals.ready.emit(self.request, series)
+
+
+class SalesChart(QWidget):
+    """
+    Revenue (line) and invoice count (bars) over time. The wheel zooms around the cursor,
+    dragging pans and a double click shows the whole period again. After each zoom or pan
+    the visible range is re-aggregated on the thread pool at a granularity that gives
+    about one point per pixel; until it arrives the previous series is redrawn.
+    """
+    failed = pyqtSignal(str)
+
+    def __init__(self, db_name="inventory.db", parent=None):
+        super().__init__(parent)
+        self.trend = SalesTrend(db_name)
+        self.series = None
+        self.period = None    # (start, end) seconds set by set_range
+        self.view = None      # visible (start, end) seconds
+        self._request = 0
+        self._tasks = {}
+        self._drag = None
+        self.setMinimumHeight(240)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(120)
+        self.timer.timeout.connect(self.reload)
+
+    def set_range(self, start, end):
+        """Show the period between two dates (or datetimes)."""
+        self.period = (to_seconds(start), to_seconds(end) + 86400)
+        self.view = self.period
+        self.reload()
+
+    def reload(self):
+        """Aggregate the visible range (padded by half a screen on each side, for panning)."""
+        if self.view is None:
+            return
+        start, end = self.view
+        pad = (end - start) / 2
+        self._request += 1
+        task = _SeriesTask(self.trend, self._request, from_seconds(max(start - pad, 0)),
+                           from_seconds(end + pad), max(self.width(), 200) * 2)
+        task.signals.ready.connect(self.on_series)
+        task.signals.failed.connect(self.on_failed)
+        self._tasks[self._request] = task  # Keep the signals alive until the task reports back
+        QThreadPool.globalInstance().start(task)
+
+    def on_series(self, request, series):
+        self._tasks.pop(request, None)
+        if request == self._request:  # Older requests were superseded by later zooms
+            self.series = series
+            self.update()
+
+    def on_failed(self, request, error):
+        self._tasks.pop(request, None)
+        if request == self._request:
+            self.failed.emit(error)
+
+    # --- Interaction ---
+    def _x_to_seconds(self, x):
+        start, end = self.view
+        plot = self._plot_rect()
+        return start + (x - plot.left()) / max(plot.width(), 1) * (end - start)
+
+    def wheelEvent(self, event):
+        if self.view is None:
+            return
+        start, end = self.view
+        factor = 0.8 if event.angleDelta().y() > 0 else 1.25
+        anchor = self._x_to_seconds(event.position().x())
+        span = min(max((end - start) * factor, MIN_SPAN), (self.period[1] - self.period[0]) * 4)
+        ratio = (anchor - start) / (end - start)
+        self.view = (anchor - span * ratio, anchor + span * (1 - ratio))
+        self.update()
+        self.timer.start()
+
+    def mousePressEvent(self, event):
+        if self.view is not None and event.button() == Qt.MouseButton.LeftButton:
+            self._drag = (event.position().x(), self.view)
+
+    def mouseMoveEvent(self, event):
+        if self._drag is None:
+            return
+        x, (start, end) = self._drag
+        shift = (event.position().x() - x) / max(self._plot_rect().width(), 1) * (end - start)
+        self.view = (start - shift, end - shift)
+        self.update()
+        self.timer.start()
+
+    def mouseReleaseEvent(self, event):
+        self._drag = None
+
+    def mouseDoubleClickEvent(self, event):
+        if self.period is not None:
+            self.view = self.period
+            self.reload()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.timer.start()
+
+    # --- Drawing ---
+    def _plot_rect(self):
+        return QRectF(70, 25, max(self.width() - 140, 10), max(self.height() - 55, 10))
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.fillRect(self.rect(), QColor("white"))
+        plot = self._plot_rect()
+        painter.setPen(QPen(QColor("#bdc3c7")))
+        painter.drawRect(plot)
+        if self.view is None or self.series is None or len(self.series) == 0:
+            painter.setPen(QColor("#7f8c8d"))
+            painter.drawText(plot, Qt.AlignmentFlag.AlignCenter, "Sin ventas en el período")
+            return
+        start, end = self.view
+        s = self.series
+        visible = (s.x >= start) & (s.x <= end)
+        max_revenue = float(s.revenue[visible].max()) if visible.any() else 1.0
+        max_count = float(s.count[visible].max()) if visible.any() else 1.0
+        max_revenue = max_revenue or 1.0
+        max_count = max_count or 1.0
+
+        def px(seconds):
+            return plot.left() + (seconds - start) / (end - start) * plot.width()
+
+        # Invoice count as bars against the right axis
+        painter.setClipRect(plot)
+        bar = max(plot.width() / max(int(visible.sum()), 1) * 0.6, 1.0)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(QColor(52, 152, 219, 70))
+        for x, n in zip(s.x[visible], s.count[visible]):
+            h = n / max_count * plot.height()
+            painter.drawRect(QRectF(px(x) - bar / 2, plot.bottom() - h, bar, h))
+        # Revenue as a line against the left axis
+        painter.setPen(QPen(QColor("#27ae60"), 2))
+        painter.setBrush(Qt.BrushStyle.NoBrush)
+        painter.drawPolyline(QPolygonF([
+            QPointF(px(x), plot.bottom() - r / max_revenue * plot.height()) for x, r in zip(s.x, s.revenue)
+        ]))
+        painter.setClipping(False)
+        # Axes
+        painter.setPen(QColor("#2c3e50"))
+        painter.drawText(QRectF(0, plot.top() - 8, plot.left() - 5, 16),
+                         Qt.AlignmentFlag.AlignRight, f"{max_revenue:,.0f}")
+        painter.drawText(QRectF(0, plot.bottom() - 8, plot.left() - 5, 16), Qt.AlignmentFlag.AlignRight, "0")
+        painter.drawText(QRectF(plot.right() + 5, plot.top() - 8, 65, 16), Qt.AlignmentFlag.AlignLeft, f"{max_count:,.0f}")
+        fmt = "%Y-%m-%d %H:%M" if end - start < 3 * 86400 else "%Y-%m-%d"
+        for i in range(5):
+            seconds = start + (end - start) * i / 4
+            x = plot.left() + plot.width() * i / 4
+            painter.drawText(QRectF(x - 60, plot.bottom() + 5, 120, 16), Qt.AlignmentFlag.AlignHCenter,
+                             from_seconds(seconds).strftime(fmt))
+        painter.setPen(QColor("#27ae60"))
+        painter.drawText(QRectF(plot.left(), 3, 200, 18), Qt.AlignmentFlag.AlignLeft, "Ventas (LPS)")
+        painter.setPen(QColor("#3498db"))
+        painter.drawText(QRectF(plot.left() + 120, 3, 200, 18), Qt.AlignmentFlag.AlignLeft, "Facturas")
+        painter.setPen(QColor("#7f8c8d"))
+        painter.drawText(QRectF(plot.right() - 300, 3, 300, 18), Qt.AlignmentFlag.AlignRight,
+                         f"{LABELS[s.granularity]} · {len(s)} puntos de {s.buckets}")
@@ -0,0 +1,151 @@
+import sqlite3
+import datetime
+import numpy as np
+from report_cache import ReportCache
+from archive import connect_with_archives, attach_archives, union_all
+
+# Bucket sizes from finest to coarsest, in seconds (month is approximate, only used to choose)
+GRANULARITIES = [("hour", 3600), ("day", 86400), ("week", 7 * 86400), ("month", 30 * 86400)]
+
+# Buckets fetched per output point, so downsampling has detail to choose from
+OVERSAMPLE = 4
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_seconds(value):
+    """Seconds since 1970 of a naive datetime or date."""
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    return (value - EPOCH).total_seconds()
+
+
+def from_seconds(seconds):
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def choose_granularity(start, end, max_buckets):
+    """Finest bucket size giving at most max_buckets buckets between two datetimes."""
+    span = (end - start).total_seconds()
+    for name, seconds in GRANULARITIES:
+        if span / seconds <= max_buckets:
+            return name
+    return GRANULARITIES[-1][0]
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Returns the indices of the points kept:
+    the first and last point, plus in each bucket the point forming the largest triangle
+    with the previous kept point and the average of the next bucket.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], max(edges[i + 1], edges[i] + 1)
+        next_lo, next_hi = hi, (edges[i + 2] if i + 2 < len(edges) else n)
+        avg_x = x[next_lo:max(next_hi, next_lo + 1)].mean()
+        avg_y = y[next_lo:max(next_hi, next_lo + 1)].mean()
+        areas = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(areas))
+        kept[i + 1] = a
+    return kept
+
+
+class SalesSeries:
+    """Revenue and invoice count per time bucket, as parallel NumPy arrays."""
+
+    def __init__(self, granularity, x, revenue, count, buckets):
+        self.granularity = granularity
+        self.x = x                # bucket start, seconds since 1970
+        self.revenue = revenue
+        self.count = count
+        self.buckets = buckets    # buckets aggregated in SQL, before downsampling
+
+    def __len__(self):
+        return len(self.x)
+
+
+class SalesTrend:
+    """Sales time series aggregated in SQL at a granularity that fits the requested range."""
+
+    def __init__(self, db_name="inventory.db"):
+        self.db_name = db_name
+        self.cache = ReportCache.instance(db_name)
+
+    def extent(self):
+        """(first, last) invoice datetimes, or None without invoices."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            # Archived years are only in the rollup; MAX(date) and MIN(date) each use the index
+            cursor.execute("""
+                SELECT MIN(d), MAX(d) FROM (
+                    SELECT MIN(date) AS d FROM invoices
+                    UNION ALL SELECT MAX(date) FROM invoices
+                    UNION ALL SELECT MIN(day) FROM client_sales_daily
+                    WHERE substr(day, 1, 4) IN (SELECT year FROM invoice_archives)
+                )
+            """)
+            first, last = cursor.fetchone()
+        if first is None:
+            return None
+        return _parse(first), _parse(last)
+
+    def _buckets(self, cursor, granularity, start, end):
+        if granularity == "hour":
+            # Straight from the invoices, read in date order from idx_invoices_date
+            params = {"start": start.strftime("%Y-%m-%d %H"), "end": end.strftime("%Y-%m-%d %H:%M:%S")}
+            schemas = attach_archives(cursor, self.db_name, params["start"], params["end"])
+            cursor.execute("SELECT substr(date, 1, 13), COUNT(*), SUM(total) FROM (" + union_all(schemas, """
+                SELECT date, total FROM {schema}.invoices WHERE date >= :start AND date < :end
+            """) + ") GROUP BY 1", params)
+            return [(_parse(h + ":00:00"), n, total) for h, n, total in cursor.fetchall()]
+        if granularity == "month":
+            cursor.execute("""
+                SELECT month, SUM(invoices), SUM(total) FROM client_sales_monthly
+                WHERE month BETWEEN ? AND ?
+                GROUP BY month
+            """, (start.strftime("%Y-%m"), end.strftime("%Y-%m")))
+            return [(_parse(m + "-01"), n, total) for m, n, total in cursor.fetchall()]
+        bucket = "day" if granularity == "day" else "date(day, '-6 days', 'weekday 1')"
+        cursor.execute(f"""
+            SELECT {bucket}, SUM(invoices), SUM(total) FROM client_sales_daily
+            WHERE day BETWEEN ? AND ?
+            GROUP BY 1
+        """, (start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")))
+        return [(_parse(d), n, total) for d, n, total in cursor.fetchall()]
+
+    def series(self, start, end, max_points=2000):
+        """
+        Sales between two datetimes, at most max_points points. Buckets are chosen so SQL
+        returns about OVERSAMPLE * max_points rows, then reduced with LTTB on revenue.
+        """
+        return self.cache.get("sales_trend", (start, end, max_points),
+                              lambda: self._series(start, end, max_points))
+
+    def _series(self, start, end, max_points):
+        granularity = choose_granularity(start, end, max_points * OVERSAMPLE)
+        with connect_with_archives(self.db_name) as conn:
+            rows = self._buckets(conn.cursor(), granularity, start, end)
+        rows.sort()
+        x = np.array([to_seconds(r[0]) for r in rows], dtype=np.float64)
+        count = np.array([r[1] for r in rows], dtype=np.float64)
+        revenue = np.array([r[2] or 0.0 for r in rows], dtype=np.float64)
+        kept = lttb(x, revenue, max_points)
+        return SalesSeries(granularity, x[kept], revenue[kept], count[kept], len(rows))
+
+
+def _parse(value):
+    """datetime from 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM' or 'YYYY-MM-DD HH:MM:SS' text."""
+    value = value.strip()
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(value[:19], fmt)
+        except ValueError:
+            continue
+    return datetime.datetime.fromisoformat(value)
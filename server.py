@@ -0,0 +1,471 @@
+import asyncio
+import functools
+import json
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qsl
+from database import Database
+from migrations import Migrator
+from invoice_store import create_invoice_store
+from report_cache import ReportCache, data_version
+from sync import SyncEngine
+from stock_ledger import StockLedger
+from valuation import InventoryValuation
+
+# change_log entries kept for terminals that poll /changes (older ones are pruned)
+KEEP_CHANGES = 5000
+
+# Most checkouts committed together when several are waiting for the writer
+MAX_BATCH = 64
+
+# Largest request body accepted (a checkout with a few hundred lines is far below this;
+# sync bundles pushed by a branch are the largest requests)
+MAX_BODY = 64 * 1024 * 1024
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+ROUTES = []  # (method, path pattern, 'read' | 'write' | 'sale', handler)
+
+
+def route(method, path, kind="read"):
+    """Register a handler for e.g. route("GET", "/products/{id}"); path parameters are integers."""
+    pattern = re.compile("^" + re.sub(r"{(\w+)}", r"(?P<\1>\\d+)", path) + "$")
+
+    def register(handler):
+        ROUTES.append((method, pattern, kind, handler))
+        return handler
+    return register
+
+
+def _ids(query):
+    return [int(i) for i in query["ids"].split(",") if i]
+
+
+# --- Products ---
+@route("GET", "/products")
+def list_products(server, query, body):
+    if "ids" in query:
+        return server.db.get_products_by_ids(_ids(query))
+    if query.get("q"):
+        return server.db.search_products(query["q"], query.get("type", "Nombre"))
+    return server.db.get_all_products()
+
+
+@route("GET", "/products/{id}")
+def get_product(server, query, body, id):
+    products = server.db.get_products_by_ids([id])
+    return products[0] if products else None
+
+
+@route("POST", "/products", "write")
+def add_product(server, query, body):
+    return server.db.add_product(body["serial_number"], body["name"], int(body["quantity"]),
+                                 float(body["cost"]), float(body["price"]))
+
+
+@route("PUT", "/products/{id}", "write")
+def update_product(server, query, body, id):
+    return server.db.update_product(id, body["serial_number"], body["name"], int(body["quantity"]),
+                                    float(body["cost"]), float(body["price"]),
+                                    body.get("costing_method", "average"))
+
+
+@route("PUT", "/products", "write")
+def update_products(server, query, body):
+    """Batch edit: body has "products" ([[id, serial, name, quantity, cost, price], ...])."""
+    return server.db.update_products([(int(p[0]), p[1], p[2], int(p[3]), float(p[4]), float(p[5]))
+                                      for p in body["products"]], body.get("costing_method", "average"))
+
+
+@route("POST", "/products/adjust-prices", "write")
+def adjust_prices(server, query, body):
+    return server.db.adjust_prices(float(body["percent"]), body.get("field", "price"),
+                                   body.get("search_term", ""), body.get("search_type", "Nombre"))
+
+
+@route("DELETE", "/products/{id}", "write")
+def delete_product(server, query, body, id):
+    return server.db.delete_product(id)
+
+
+# --- Clients ---
+@route("GET", "/clients")
+def list_clients(server, query, body):
+    if "ids" in query:
+        return server.db.get_clients_by_ids(_ids(query))
+    if "prefix" in query:
+        return server.db.find_clients_by_prefix(query["prefix"], int(query.get("limit", 20)))
+    if query.get("q"):
+        return server.db.search_clients(query["q"], query.get("type", "Nombre"))
+    return server.db.get_all_clients()
+
+
+@route("GET", "/clients/top")
+def top_clients(server, query, body):
+    return server.db.top_clients(int(query.get("limit", 20)))
+
+
+@route("GET", "/clients/stats")
+def list_client_stats(server, query, body):
+    if "ids" in query:
+        return server.db.get_client_stats_by_ids(_ids(query))
+    return server.db.get_all_client_stats()
+
+
+@route("GET", "/clients/{id}")
+def get_client(server, query, body, id):
+    clients = server.db.get_clients_by_ids([id])
+    return clients[0] if clients else None
+
+
+@route("GET", "/clients/{id}/stats")
+def get_client_stats(server, query, body, id):
+    return server.db.get_client_stats(id)
+
+
+@route("GET", "/clients/{id}/invoices")
+def client_invoices(server, query, body, id):
+    return server.db.get_invoices_by_client(id)
+
+
+@route("POST", "/clients", "write")
+def add_client(server, query, body):
+    return server.db.add_client(body["name"], body["identity_id"], body.get("rtn", ""), body.get("phone", ""),
+                                body.get("email", ""), body["city"])
+
+
+@route("PUT", "/clients/{id}", "write")
+def update_client(server, query, body, id):
+    return server.db.update_client(id, body["name"], body["identity_id"], body.get("rtn", ""),
+                                   body.get("phone", ""), body.get("email", ""), body["city"])
+
+
+@route("DELETE", "/clients/{id}", "write")
+def delete_client(server, query, body, id):
+    return server.db.delete_client(id)
+
+
+# --- Invoices and checkout ---
+@route("GET", "/invoices")
+def list_invoices(server, query, body):
+    if "ids" in query:
+        return server.db.get_invoices_by_ids(_ids(query))
+    if "start" in query:
+        return server.db.get_invoices_by_date_range(query["start"], query["end"])
+    if query.get("q"):
+        return server.db.search_invoices(query["q"], query.get("type", "Cliente"))
+    return server.db.get_all_invoices()
+
+
+@route("GET", "/invoices/{id}")
+def get_invoice(server, query, body, id):
+    return server.db.get_invoice_by_id(id)
+
+
+@route("DELETE", "/invoices/{id}", "write")
+def delete_invoice(server, query, body, id):
+    invoice = server.db.get_invoice_by_id(id)
+    if invoice is None or not server.db.delete_invoice(id):
+        return False
+    # Removed after the row so shared blobs are only dropped when unreferenced
+    server.store.delete(invoice.file_path)
+    return True
+
+
+@route("GET", "/invoices/{id}/returnable")
+def returnable_items(server, query, body, id):
+    return server.db.returnable_items(id)
+
+
+@route("GET", "/invoices/{id}/credit-notes")
+def invoice_credit_notes(server, query, body, id):
+    return server.db.get_credit_notes_by_invoice(id)
+
+
+@route("POST", "/invoices/{id}/credit-notes", "write")
+def create_credit_note(server, query, body, id):
+    """Body: lines ([[product_id, quantity], ...], or null for everything), reason and optionally date."""
+    lines = body.get("lines")
+    if lines is not None:
+        lines = [(int(product_id), int(quantity)) for product_id, quantity in lines]
+    return server.db.create_credit_note(id, lines, body.get("reason", ""), body.get("date"))
+
+
+@route("GET", "/credit-notes")
+def list_credit_notes(server, query, body):
+    return server.db.get_credit_notes_by_date_range(query["start"], query["end"])
+
+
+@route("GET", "/credit-notes/{id}/items")
+def credit_note_items(server, query, body, id):
+    return server.db.get_credit_note_items(id)
+
+
+@route("GET", "/invoices/{id}/document")
+def get_document(server, query, body, id):
+    """
+    Text of an invoice's document. The reference is read from invoices.file_path, never
+    taken from the request, and must point inside the server's store.
+    """
+    invoice = server.db.get_invoice_by_id(id)
+    if invoice is None:
+        raise ValueError(f"factura {id} no encontrada")
+    if not server.store.owns(invoice.file_path):
+        raise ValueError(f"el documento de la factura {id} está fuera del almacenamiento")
+    return server.store.load(invoice.file_path)
+
+
+@route("POST", "/checkout", "sale")
+def checkout(server, query, body):
+    """
+    A sale for Database.record_sales: body has client_id, client_name, date, items
+    ([{product_id, quantity, price}]), subtotal, tax, total, the document detail lines
+    and optionally prefix and costing_method. Answered with [success, invoice id or error, document].
+    """
+    return {
+        "client_id": body["client_id"], "client_name": body["client_name"], "date": body["date"],
+        "items": [{"product_id": int(i["product_id"]), "quantity": int(i["quantity"]), "price": float(i["price"])}
+                  for i in body["items"]],
+        "subtotal": float(body["subtotal"]), "tax": float(body["tax"]), "total": float(body["total"]),
+        "detail": [str(line) for line in body.get("detail", [])],
+        "prefix": body.get("prefix", "FAC"), "costing_method": body.get("costing_method", "average"),
+    }
+
+
+# --- Reports and changes ---
+@route("GET", "/reports/sales")
+def sales_report(server, query, body):
+    start, end = query["start"], query["end"]
+
+    def compute():
+        invoices = server.db.get_invoices_by_date_range(start, end)
+        return {"invoices": invoices, "total": sum(inv.total or 0 for inv in invoices)}
+    return server.cache.get("sales_report", (start, end), compute)
+
+
+@route("GET", "/changes")
+def changes(server, query, body):
+    """change_log entries after a position, for clients that keep their views in step."""
+    after = int(query.get("after", 0))
+    with sqlite3.connect(server.db.db_name) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COALESCE(MIN(seq), 0), COALESCE(MAX(seq), 0) FROM change_log")
+        first, last = cursor.fetchone()
+        cursor.execute("SELECT tbl, op, row_id FROM change_log WHERE seq > ? AND seq <= ? ORDER BY seq",
+                       (after, last))
+        return {"first": first, "last": last, "changes": cursor.fetchall()}
+
+
+# --- Branch synchronization ---
+def _sync_engine(server):
+    if server.sync is None:
+        raise ValueError("sincronización no activada en el servidor (ejecute manage.py sync-init)")
+    return server.sync
+
+
+@route("GET", "/sync/export")
+def sync_export(server, query, body):
+    """Bundle of the changes the branch in ?peer= has not acknowledged (see sync.SyncEngine)."""
+    return _sync_engine(server).export(query.get("peer"))
+
+
+@route("POST", "/sync/import", "write")
+def sync_import(server, query, body):
+    return _sync_engine(server).import_bundle(body)
+
+
+@route("GET", "/health")
+def health(server, query, body):
+    with sqlite3.connect(server.db.db_name) as conn:
+        return {"status": "ok", "version": data_version(conn.cursor())}
+
+
+class InventoryServer:
+    """
+    HTTP/JSON API over Database for several cashier terminals sharing one database.
+    Writes are queued and applied one at a time by a single writer thread, in arrival
+    order; checkouts waiting together in the queue are committed in one transaction
+    (group commit), so under load they share the cost of the commit. Reads run
+    concurrently on a thread pool (the database is in WAL mode, so they never wait for
+    the writer). Responses are {"result": ...} or {"error": ...}; records are sent as
+    lists in field order.
+    """
+
+    def __init__(self, db_name="inventory.db", host="127.0.0.1", port=8765, readers=4, store=None):
+        self.db = Database(db_name)
+        self.host = host
+        self.port = port
+        self.store = store or create_invoice_store("sharded", "invoices", db_name)
+        self.cache = ReportCache.instance(db_name)
+        self.sync = None
+        self.ledger = StockLedger(db_name)
+        self.valuation = InventoryValuation(db_name)
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="server-reader")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="server-writer")
+        self.queue = None
+        self.server = None
+        self._tasks = []
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._write_loop()), asyncio.create_task(self._prune_loop()),
+                       asyncio.create_task(self._backfill_loop())]
+        if SyncEngine.enabled(self.db.db_name):
+            # Its tables and triggers are (re)created by the writer, before any request
+            self.sync = await self.write(lambda: SyncEngine(self.db, self.store))
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]  # Actual port when 0 was requested
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for task in self._tasks:
+            task.cancel()
+        self._readers.shutdown(wait=False)
+        self._writer.shutdown(wait=True)
+
+    # --- Execution ---
+    async def read(self, call):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, call)
+
+    async def write(self, call, sale=None):
+        """Queue a call (or a sale, see checkout) for the writer and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((call, sale, future))
+        return await future
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        held = None  # A call taken from the queue while collecting a batch of sales
+        while True:
+            call, sale, future = held or await self.queue.get()
+            held = None
+            if sale is None:
+                await self._run(loop, call, [future], single=True)
+                continue
+            sales, futures = [sale], [future]
+            while len(sales) < MAX_BATCH and not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item[1] is None:
+                    held = item  # Runs right after the sales queued before it
+                    break
+                sales.append(item[1])
+                futures.append(item[2])
+            await self._run(loop, functools.partial(self.db.record_sales, self.store, sales), futures)
+
+    async def _run(self, loop, call, futures, single=False):
+        try:
+            result = await loop.run_in_executor(self._writer, call)
+        except Exception as e:
+            for future in futures:
+                if not future.cancelled():
+                    future.set_exception(e)
+            return
+        for future, value in zip(futures, [result] if single else result):
+            if not future.cancelled():
+                future.set_result(value)
+
+    async def _prune_loop(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.write(self._prune_changes)
+                await self.write(self.ledger.snapshot_if_due)
+                await self.write(self.valuation.close_due_period)
+            except Exception:
+                pass  # Tried again at the next interval
+
+    async def _backfill_loop(self, retry=60):
+        """Data conversions of schema migrations, one chunk per turn of the writer so requests keep flowing."""
+        migrator = Migrator(self.db.db_name)
+        while True:
+            try:
+                if await self.write(migrator.backfill_step):
+                    return
+            except Exception:
+                await asyncio.sleep(retry)  # Resumed from the last committed chunk
+
+    def _prune_changes(self):
+        """Trim change_log; terminals that fell further behind reload everything."""
+        with sqlite3.connect(self.db.db_name) as conn:
+            conn.execute("DELETE FROM change_log WHERE seq <= (SELECT MAX(seq) FROM change_log) - ?",
+                         (KEEP_CHANGES,))
+            conn.commit()
+
+    async def dispatch(self, method, target, body):
+        """(status, payload) for one request."""
+        url = urlsplit(target)
+        path_found = False
+        for route_method, pattern, kind, handler in ROUTES:
+            match = pattern.match(url.path)
+            if match is None:
+                continue
+            path_found = True
+            if route_method == method:
+                break
+        else:
+            if path_found:
+                return 405, {"error": "Método no permitido"}
+            return 404, {"error": "Ruta no encontrada"}
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            return 400, {"error": "JSON inválido"}
+        params = {name: int(value) for name, value in match.groupdict().items()}
+        call = functools.partial(handler, self, dict(parse_qsl(url.query)), data, **params)
+        try:
+            if kind == "sale":
+                result = await self.write(None, sale=call())
+            else:
+                result = await (self.write(call) if kind == "write" else self.read(call))
+        except (KeyError, TypeError, ValueError) as e:
+            return 400, {"error": f"Parámetros inválidos: {e}"}
+        except Exception as e:
+            return 500, {"error": str(e)}
+        return 200, {"result": result}
+
+    async def _handle(self, reader, writer):
+        """One connection; requests are served in turn while the client keeps it open."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    status, payload = 413, {"error": "Solicitud demasiado grande"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = await self.dispatch(method, target, body)
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                head = [f"HTTP/1.1 {status} {REASONS[status]}",
+                        "Content-Type: application/json; charset=utf-8",
+                        f"Content-Length: {len(data)}"]
+                if not keep_alive:
+                    head.append("Connection: close")
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # Client went away or sent something that is not HTTP
+        finally:
+            writer.close()
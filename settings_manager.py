@@ -42,7 +42,13 @@ class SettingsManager(QObject):
             # Invoice Settings
             "invoice_prefix": "FAC",
             "invoice_folder": "invoices",
+            "invoice_storage": "sharded",  # flat, sharded (year/month) or blob (SQLite)
             "tax_rate": 15.0,
+            "costing_method": "average",  # average (weighted) or fifo
+
+            # Database: this computer's file, or an inventory server shared by several cashiers
+            "database_backend": "local",  # local or server
+            "server_url": "http://127.0.0.1:8765",
             
             # Backup settings
             "backup_recipient_email": "",  # User will set this in settings
@@ -0,0 +1,209 @@
+import sqlite3
+import datetime
+
+# Reasons a product's stock changes; "opening" is the stock found when the ledger started
+MOVEMENT_KINDS = ("opening", "sale", "receipt", "adjustment", "return", "sync")
+
+
+def _now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def record_movement(cursor, product_id, delta, kind, reference=None):
+    """Add a stock change to the ledger; call it next to the products.quantity update."""
+    if delta:
+        cursor.execute("""
+            INSERT INTO stock_movements (product_id, at, delta, kind, reference) VALUES (?, ?, ?, ?, ?)
+        """, (product_id, _now(), delta, kind, reference))
+
+
+def record_movements(cursor, changes, kind, reference=None):
+    """Several (product_id, delta) changes of the same kind, e.g. the lines of a sale."""
+    at = _now()
+    cursor.executemany("""
+        INSERT INTO stock_movements (product_id, at, delta, kind, reference) VALUES (?, ?, ?, ?, ?)
+    """, [(product_id, at, delta, kind, reference) for product_id, delta in changes if delta])
+
+
+def record_opening_stock(cursor, after=0, last=None):
+    """
+    Opening movement for the stock of every product (with id in (after, last]) that has
+    none in the ledger yet. Movements already recorded for it, e.g. sales made while a
+    migration was still filling the ledger, are discounted so the ledger adds up to the stock.
+    """
+    cursor.execute("""
+        INSERT INTO stock_movements (product_id, at, delta, kind)
+        SELECT id, :at, quantity - COALESCE((SELECT SUM(delta) FROM stock_movements m WHERE m.product_id = p.id), 0),
+               'opening'
+        FROM products p
+        WHERE id > :after AND (:last IS NULL OR id <= :last)
+        AND NOT EXISTS (SELECT 1 FROM stock_movements m WHERE m.product_id = p.id AND m.kind = 'opening')
+        AND quantity <> COALESCE((SELECT SUM(delta) FROM stock_movements m WHERE m.product_id = p.id), 0)
+    """, {"at": _now(), "after": after, "last": last})
+
+
+class StockLedger:
+    """
+    Stock history read from the append-only stock_movements ledger. Snapshots store the
+    balance of every product up to a movement, so the stock at a date is the last snapshot
+    before it plus the movements between both (a range scan on the movement time, which
+    is when the movement was recorded). The same snapshots make the consistency check
+    against products.quantity incremental.
+    """
+
+    def __init__(self, db_name="inventory.db"):
+        self.db_name = db_name
+
+    def _last_snapshot(self, cursor, before=None):
+        """(id, taken_at, upto_movement) of the latest snapshot (taken at or before a time), or (None, '', 0)."""
+        if before is None:
+            cursor.execute("SELECT id, taken_at, upto_movement FROM stock_snapshot_runs ORDER BY id DESC LIMIT 1")
+        else:
+            cursor.execute("""
+                SELECT id, taken_at, upto_movement FROM stock_snapshot_runs
+                WHERE taken_at <= ? ORDER BY taken_at DESC, id DESC LIMIT 1
+            """, (before,))
+        return cursor.fetchone() or (None, "", 0)
+
+    def stock_as_of(self, when, product_ids=None):
+        """
+        {product_id: quantity} at a date ('YYYY-MM-DD' means the end of that day) or
+        'YYYY-MM-DD HH:MM:SS' time. Products without stock at that time are left out.
+        """
+        if len(when) == 10:
+            when += " 23:59:59"
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            snapshot_id, taken_at, upto = self._last_snapshot(cursor, when)
+            stock = {}
+            if snapshot_id is not None:
+                cursor.execute("SELECT product_id, quantity FROM stock_snapshots WHERE snapshot_id = ?", (snapshot_id,))
+                stock = dict(cursor.fetchall())
+            cursor.execute("""
+                SELECT product_id, SUM(delta) FROM stock_movements
+                WHERE at >= ? AND at <= ? AND id > ?
+                GROUP BY product_id
+            """, (taken_at, when, upto))
+            for product_id, delta in cursor.fetchall():
+                stock[product_id] = stock.get(product_id, 0) + delta
+        if product_ids is not None:
+            wanted = set(product_ids)
+            stock = {k: v for k, v in stock.items() if k in wanted}
+        return {k: v for k, v in stock.items() if v}
+
+    def history(self, product_id, limit=200):
+        """Latest movements of a product, newest first: (at, delta, kind, reference, balance after)."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            balance = self._balances(cursor, [product_id]).get(product_id, 0)
+            cursor.execute("""
+                SELECT at, delta, kind, reference FROM stock_movements
+                WHERE product_id = ? ORDER BY id DESC LIMIT ?
+            """, (product_id, limit))
+            rows = []
+            for at, delta, kind, reference in cursor.fetchall():
+                rows.append((at, delta, kind, reference, balance))
+                balance -= delta
+            return rows
+
+    def _balances(self, cursor, product_ids=None):
+        """Ledger balance per product: the latest snapshot plus the movements after it."""
+        snapshot_id, _, upto = self._last_snapshot(cursor)
+        balances = {}
+        if product_ids is None:
+            cursor.execute("SELECT product_id, quantity FROM stock_snapshots WHERE snapshot_id = ?", (snapshot_id,))
+            balances.update(cursor.fetchall())
+            cursor.execute("SELECT product_id, SUM(delta) FROM stock_movements WHERE id > ? GROUP BY product_id",
+                           (upto,))
+            for product_id, delta in cursor.fetchall():
+                balances[product_id] = balances.get(product_id, 0) + delta
+            return balances
+        for product_id in product_ids:
+            cursor.execute("""
+                SELECT COALESCE((SELECT quantity FROM stock_snapshots WHERE snapshot_id = ? AND product_id = ?), 0)
+                     + COALESCE((SELECT SUM(delta) FROM stock_movements WHERE product_id = ? AND id > ?), 0)
+            """, (snapshot_id, product_id, product_id, upto))
+            balances[product_id] = cursor.fetchone()[0]
+        return balances
+
+    def take_snapshot(self):
+        """Store every product's balance up to the last movement. Returns the snapshot id."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            previous, _, upto = self._last_snapshot(cursor)
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM stock_movements")
+            last = cursor.fetchone()[0]
+            cursor.execute("INSERT INTO stock_snapshot_runs (taken_at, upto_movement) VALUES (?, ?)", (_now(), last))
+            snapshot_id = cursor.lastrowid
+            cursor.execute("""
+                INSERT INTO stock_snapshots (snapshot_id, product_id, quantity)
+                SELECT ?, product_id, SUM(quantity) FROM (
+                    SELECT product_id, quantity FROM stock_snapshots WHERE snapshot_id = ?
+                    UNION ALL
+                    SELECT product_id, delta FROM stock_movements WHERE id > ? AND id <= ?
+                )
+                GROUP BY product_id HAVING SUM(quantity) <> 0
+            """, (snapshot_id, previous, upto, last))
+            conn.commit()
+            return snapshot_id
+
+    def snapshot_if_due(self, max_movements=5000, max_days=7):
+        """Take a snapshot when enough movements or days have passed since the last one; returns whether it did."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            _, taken_at, upto = self._last_snapshot(cursor)
+            cursor.execute("SELECT COUNT(*), MAX(at) FROM stock_movements WHERE id > ?", (upto,))
+            pending, latest = cursor.fetchone()
+        if not pending:
+            return False
+        age = datetime.datetime.now() - datetime.datetime.strptime(taken_at or latest, "%Y-%m-%d %H:%M:%S")
+        if pending < max_movements and age < datetime.timedelta(days=max_days):
+            return False
+        self.take_snapshot()
+        return True
+
+    def check(self, full=False):
+        """
+        Compare products.quantity with the ledger. Incremental by default: products with
+        movements since the previous check, plus the total over all products (which
+        catches quantities changed without a movement); a full check follows when the
+        totals differ. Returns [(product_id, serial number, name, quantity, ledger balance)]
+        and logs the check in stock_checks.
+        """
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COALESCE(MAX(upto_movement), 0) FROM stock_checks")
+            checked = cursor.fetchone()[0]
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM stock_movements")
+            last = cursor.fetchone()[0]
+            if not full:
+                cursor.execute("SELECT COALESCE(SUM(quantity), 0) FROM products")
+                on_hand = cursor.fetchone()[0]
+                cursor.execute("SELECT id FROM products")
+                existing = {row[0] for row in cursor.fetchall()}
+                ledger = sum(q for product_id, q in self._balances(cursor).items() if product_id in existing)
+                full = on_hand != ledger
+            if full:
+                cursor.execute("SELECT id FROM products")
+            else:
+                cursor.execute("SELECT DISTINCT product_id FROM stock_movements WHERE id > ? AND id <= ?",
+                               (checked, last))
+            product_ids = [row[0] for row in cursor.fetchall()]
+            balances = self._balances(cursor) if full else self._balances(cursor, product_ids)
+            mismatches = []
+            for start in range(0, len(product_ids), 500):
+                chunk = product_ids[start:start + 500]
+                cursor.execute(f"""
+                    SELECT id, serial_number, name, quantity FROM products
+                    WHERE id IN ({",".join("?" * len(chunk))})
+                """, chunk)
+                for product_id, serial_number, name, quantity in cursor.fetchall():
+                    if quantity != balances.get(product_id, 0):
+                        mismatches.append((product_id, serial_number, name, quantity, balances.get(product_id, 0)))
+            cursor.execute("""
+                INSERT INTO stock_checks (checked_at, upto_movement, products_checked, mismatches, full)
+                VALUES (?, ?, ?, ?, ?)
+            """, (_now(), last, len(product_ids), len(mismatches), int(full)))
+            conn.commit()
+            return mismatches
@@ -0,0 +1,197 @@
+import sqlite3
+import datetime
+from valuation import add_cost_layer, consume_layers, ensure_opening_layer
+from stock_ledger import record_movements
+
+
+def _now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class StockCount:
+    """
+    Counts of one counter in a session, kept in memory while scanning. checkpoint_rows()
+    hands over the counts changed since the last checkpoint, to be saved with
+    StocktakeManager.save_counts.
+    """
+
+    def __init__(self, session_id, counter, counts=None):
+        self.session_id = session_id
+        self.counter = counter
+        self.counts = dict(counts or {})  # product_id -> units counted
+        self._dirty = set()
+
+    def add(self, product_id, quantity=1):
+        """Add scanned units; returns the product's count."""
+        self.counts[product_id] = self.counts.get(product_id, 0) + quantity
+        self._dirty.add(product_id)
+        return self.counts[product_id]
+
+    def set(self, product_id, quantity):
+        """Replace the product's count (a typed total or a correction)."""
+        self.counts[product_id] = quantity
+        self._dirty.add(product_id)
+        return quantity
+
+    def pending(self):
+        return len(self._dirty)
+
+    def checkpoint_rows(self):
+        """[(product_id, count)] changed since the last call."""
+        rows = [(product_id, self.counts[product_id]) for product_id in self._dirty]
+        self._dirty.clear()
+        return rows
+
+    def mark_unsaved(self, product_ids):
+        """Put back counts whose checkpoint failed, so the next one retries them."""
+        self._dirty.update(product_ids)
+
+
+class StocktakeManager:
+    """
+    Physical count sessions. Each counter saves its own counts for the session; the
+    variance report adds them up per product and compares them with the stock at the
+    start of the session (sales and receipts during the count are taken out using the
+    stock ledger), in one query. Approved differences are applied in one transaction.
+    """
+
+    def __init__(self, db_name="inventory.db"):
+        self.db_name = db_name
+
+    def start_session(self, name):
+        """Open a count session; returns its id."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO stocktake_sessions (name, started_at, start_movement, status)
+                VALUES (?, ?, (SELECT COALESCE(MAX(id), 0) FROM stock_movements), 'open')
+            """, (name, _now()))
+            conn.commit()
+            return cursor.lastrowid
+
+    def sessions(self, status="open"):
+        """[(id, name, started_at, status, closed_at)], newest first."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, name, started_at, status, closed_at FROM stocktake_sessions
+                WHERE ? IS NULL OR status = ? ORDER BY id DESC
+            """, (status, status))
+            return cursor.fetchall()
+
+    def product_index(self):
+        """{serial number: (product_id, name)} for resolving scans without a query each."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT serial_number, id, name FROM products")
+            return {serial: (product_id, name) for serial, product_id, name in cursor.fetchall()}
+
+    def open_count(self, session_id, counter):
+        """StockCount of a counter, with the counts it already saved in the session."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT product_id, quantity FROM stocktake_counts WHERE session_id = ? AND counter = ?",
+                           (session_id, counter))
+            return StockCount(session_id, counter, cursor.fetchall())
+
+    def save_counts(self, session_id, counter, rows):
+        """Checkpoint: store [(product_id, count)] of a counter. Returns the number of rows saved."""
+        if not rows:
+            return 0
+        counted_at = _now()
+        with sqlite3.connect(self.db_name) as conn:
+            conn.executemany("""
+                INSERT INTO stocktake_counts (session_id, product_id, counter, quantity, counted_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(session_id, product_id, counter) DO UPDATE SET
+                    quantity = excluded.quantity, counted_at = excluded.counted_at
+            """, [(session_id, product_id, counter, quantity, counted_at) for product_id, quantity in rows])
+            conn.commit()
+        return len(rows)
+
+    def counters(self, session_id):
+        """[(counter, products counted, units)] of a session."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT counter, COUNT(*), SUM(quantity) FROM stocktake_counts
+                WHERE session_id = ? GROUP BY counter ORDER BY counter
+            """, (session_id,))
+            return cursor.fetchall()
+
+    def _variance(self, cursor, session_id, include_uncounted):
+        counted = "LEFT JOIN" if include_uncounted else "JOIN"
+        cursor.execute(f"""
+            SELECT p.id, p.serial_number, p.name,
+                   p.quantity - COALESCE(m.moved, 0) AS expected,
+                   COALESCE(c.counted, 0) AS counted,
+                   COALESCE(c.counted, 0) - (p.quantity - COALESCE(m.moved, 0)) AS variance,
+                   (COALESCE(c.counted, 0) - (p.quantity - COALESCE(m.moved, 0))) * p.cost AS value
+            FROM products p
+            {counted} (
+                SELECT product_id, SUM(quantity) AS counted FROM stocktake_counts
+                WHERE session_id = ? GROUP BY product_id
+            ) c ON c.product_id = p.id
+            LEFT JOIN (
+                SELECT product_id, SUM(delta) AS moved FROM stock_movements
+                WHERE id > (SELECT start_movement FROM stocktake_sessions WHERE id = ?)
+                GROUP BY product_id
+            ) m ON m.product_id = p.id
+            WHERE variance <> 0
+            ORDER BY ABS(value) DESC
+        """, (session_id, session_id))
+        return cursor.fetchall()
+
+    def variance(self, session_id, include_uncounted=False):
+        """
+        Products whose count differs from the stock at the start of the session:
+        [(product_id, serial, name, expected, counted, variance, value at cost)], largest
+        value first. include_uncounted: products nobody counted are taken as 0 (full count).
+        """
+        with sqlite3.connect(self.db_name) as conn:
+            return self._variance(conn.cursor(), session_id, include_uncounted)
+
+    def apply(self, session_id, product_ids=None, include_uncounted=False, costing_method="average"):
+        """
+        Adjust the stock by the variances (all, or those of product_ids) and close the
+        session, in one transaction. Returns (True, products adjusted) or (False, error message).
+        """
+        try:
+            with sqlite3.connect(self.db_name) as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute("SELECT status FROM stocktake_sessions WHERE id = ?", (session_id,))
+                row = cursor.fetchone()
+                if row is None or row[0] != "open":
+                    conn.rollback()
+                    return False, "La sesión de conteo no está abierta."
+                approved = set(product_ids) if product_ids is not None else None
+                changes = [(product_id, variance) for product_id, _, _, _, _, variance, _
+                           in self._variance(cursor, session_id, include_uncounted)
+                           if approved is None or product_id in approved]
+                for product_id, variance in changes:
+                    # Keep the cost layers covering the quantity, as update_product does
+                    if variance > 0:
+                        cursor.execute("SELECT quantity, cost FROM products WHERE id = ?", (product_id,))
+                        quantity, cost = cursor.fetchone()
+                        ensure_opening_layer(cursor, product_id, quantity)
+                        add_cost_layer(cursor, product_id, variance, cost, "count")
+                    else:
+                        consume_layers(cursor, product_id, -variance, costing_method)
+                cursor.executemany("UPDATE products SET quantity = quantity + ? WHERE id = ?",
+                                   [(variance, product_id) for product_id, variance in changes])
+                record_movements(cursor, changes, "adjustment", f"conteo {session_id}")
+                cursor.execute("UPDATE stocktake_sessions SET status = 'closed', closed_at = ? WHERE id = ?",
+                               (_now(), session_id))
+                conn.commit()
+                return True, len(changes)
+        except sqlite3.Error as e:
+            return False, str(e)
+
+    def cancel(self, session_id):
+        """Close a session without adjusting anything."""
+        with sqlite3.connect(self.db_name) as conn:
+            conn.execute("UPDATE stocktake_sessions SET status = 'cancelled', closed_at = ? WHERE id = ? AND status = 'open'",
+                         (_now(), session_id))
+            conn.commit()
+            return conn.total_changes > 0
@@ -0,0 +1,536 @@
+import gzip
+import json
+import uuid
+import sqlite3
+import datetime
+
+BUNDLE_FORMAT = 1
+
+# Synchronized tables and the column that identifies a row in every branch (invoices and
+# credit notes by the branch that created them and their number there); applied in this order
+SYNC_KEYS = {"products": "serial_number", "clients": "identity_id", "invoices": None, "credit_notes": None}
+
+# Columns whose changes create a new row version (product quantity travels as stock movements)
+SYNC_FIELDS = {
+    "products": ("serial_number", "name", "cost", "price"),
+    "clients": ("name", "identity_id", "rtn", "phone", "email", "city"),
+}
+
+
+class SyncError(Exception):
+    """A bundle could not be applied to this database."""
+
+
+def write_bundle(bundle, path):
+    """Save a bundle as compressed JSON (the file sent to the other branch)."""
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(bundle, f, ensure_ascii=False)
+
+
+def read_bundle(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class SyncEngine:
+    """
+    Delta synchronization between branches that each run their own database.
+
+    Triggers keep one sync_rows entry per product, client and invoice with its version
+    (a Lamport clock), the branch that wrote it and the local sequence of the change;
+    deleted rows stay as tombstones. Stock changes are recorded separately in sync_stock
+    as movements (+/- units) identified by their branch and sequence. A bundle holds the
+    rows and movements changed since the last sequence the other branch acknowledged, so
+    its size follows the number of changes, not the size of the database.
+
+    Conflicts resolve the same way in every branch: for a row, the higher (version,
+    branch) wins, deletes included. Invoices are never edited, only created or deleted;
+    credit notes (with their lines) are only created, and refer to their invoice by its key.
+    Each branch keeps its own stock: products.quantity is this branch's, and the
+    movements of another branch only move that branch's balance in sync_site_stock.
+    """
+
+    def __init__(self, db, store=None):
+        self.db = db
+        self.db_name = db.db_name
+        self.store = store  # Invoice documents travel with their invoices when set
+        self.install()
+
+    @staticmethod
+    def enabled(db_name):
+        """Whether synchronization was activated in a database (sync-init or a first sync)."""
+        with sqlite3.connect(db_name) as conn:
+            return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sync_state'").fetchone() is not None
+
+    def install(self):
+        """Create the sync tables and triggers; on first use every existing row becomes version 1."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    site TEXT NOT NULL,
+                    clock INTEGER NOT NULL,
+                    seq INTEGER NOT NULL,
+                    applying INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sync_rows (
+                    tbl TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    row_id INTEGER,
+                    version INTEGER NOT NULL,
+                    site TEXT NOT NULL,
+                    deleted INTEGER NOT NULL,
+                    seq INTEGER NOT NULL,
+                    PRIMARY KEY (tbl, key)
+                ) WITHOUT ROWID
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_sync_rows_seq ON sync_rows(seq)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_sync_rows_row ON sync_rows(tbl, row_id)")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sync_stock (
+                    site TEXT NOT NULL,
+                    origin_seq INTEGER NOT NULL,
+                    serial_number TEXT NOT NULL,
+                    delta INTEGER NOT NULL,
+                    seq INTEGER NOT NULL,
+                    PRIMARY KEY (site, origin_seq)
+                ) WITHOUT ROWID
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_sync_stock_seq ON sync_stock(seq)")
+            # Stock of the other branches, from their movements (this branch's is products.quantity)
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sync_site_stock'")
+            seed_site_stock = cursor.fetchone() is None
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sync_site_stock (
+                    site TEXT NOT NULL,
+                    serial_number TEXT NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    PRIMARY KEY (site, serial_number)
+                ) WITHOUT ROWID
+            """)
+            # acked: our last sequence the branch confirmed; received: its last sequence applied here
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sync_peers (
+                    site TEXT PRIMARY KEY,
+                    acked INTEGER NOT NULL,
+                    received INTEGER NOT NULL,
+                    last_sync TEXT NOT NULL
+                )
+            """)
+            cursor.execute("SELECT 1 FROM sync_state")
+            if cursor.fetchone() is None:
+                self._bootstrap(cursor)
+            else:
+                self._track_new_tables(cursor)
+            if seed_site_stock:
+                # Movements received before balances were kept per branch
+                cursor.execute("""
+                    INSERT INTO sync_site_stock (site, serial_number, quantity)
+                    SELECT site, serial_number, SUM(delta) FROM sync_stock
+                    WHERE site <> (SELECT site FROM sync_state)
+                    GROUP BY site, serial_number
+                """)
+            self._create_triggers(cursor)
+            conn.commit()
+
+    def _bootstrap(self, cursor):
+        # Existing stock becomes this branch's opening movement per product, numbered by
+        # product id; the sequence starts after them so later movements never reuse a number
+        cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM products")
+        seq = cursor.fetchone()[0]
+        site = uuid.uuid4().hex
+        cursor.execute("INSERT INTO sync_state (id, site, clock, seq) VALUES (1, ?, 1, ?)", (site, seq))
+        for table, key in SYNC_KEYS.items():
+            key_expr = key or f"'{site}:' || id"
+            cursor.execute(f"""
+                INSERT INTO sync_rows (tbl, key, row_id, version, site, deleted, seq)
+                SELECT ?, {key_expr}, id, 1, ?, 0, ? FROM {table}
+            """, (table, site, seq))
+        cursor.execute("""
+            INSERT INTO sync_stock (site, origin_seq, serial_number, delta, seq)
+            SELECT ?, id, serial_number, quantity, ? FROM products WHERE quantity <> 0
+        """, (site, seq))
+
+    def _track_new_tables(self, cursor):
+        """Rows of tables synchronized since this branch was bootstrapped become version 1."""
+        for table, key in SYNC_KEYS.items():
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table}), EXISTS (SELECT 1 FROM sync_rows WHERE tbl = ?)",
+                           (table,))
+            if cursor.fetchone() != (1, 0):
+                continue
+            cursor.execute("UPDATE sync_state SET seq = seq + 1")
+            key_expr = key or "(SELECT site FROM sync_state) || ':' || id"
+            cursor.execute(f"""
+                INSERT INTO sync_rows (tbl, key, row_id, version, site, deleted, seq)
+                SELECT ?, {key_expr}, id, 1, (SELECT site FROM sync_state), 0, (SELECT seq FROM sync_state)
+                FROM {table}
+            """, (table,))
+
+    def _create_triggers(self, cursor):
+        local = "(SELECT applying FROM sync_state) = 0"
+        for table, key in SYNC_KEYS.items():
+            key_expr = f"NEW.{key}" if key else "(SELECT site FROM sync_state) || ':' || NEW.id"
+            upsert = f"""
+                INSERT INTO sync_rows (tbl, key, row_id, version, site, deleted, seq)
+                SELECT '{table}', {key_expr}, NEW.id, clock, site, 0, seq FROM sync_state WHERE 1
+                ON CONFLICT(tbl, key) DO UPDATE SET row_id = excluded.row_id, version = excluded.version,
+                    site = excluded.site, deleted = 0, seq = excluded.seq;
+            """
+            tombstone = f"""
+                UPDATE sync_rows SET deleted = 1, version = (SELECT clock FROM sync_state),
+                    site = (SELECT site FROM sync_state), seq = (SELECT seq FROM sync_state)
+                WHERE tbl = '{table}' AND row_id = OLD.id AND deleted = 0
+            """
+            tick = "UPDATE sync_state SET clock = clock + 1, seq = seq + 1;"
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_insert_sync AFTER INSERT ON {table}
+                WHEN {local}
+                BEGIN {tick} {upsert} END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_delete_sync AFTER DELETE ON {table}
+                WHEN {local}
+                BEGIN {tick} {tombstone}; END
+            """)
+            if table in SYNC_FIELDS:
+                changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in SYNC_FIELDS[table])
+                # A changed key leaves a tombstone under the old one
+                cursor.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {table}_update_sync AFTER UPDATE ON {table}
+                    WHEN {local} AND ({changed})
+                    BEGIN {tick} {tombstone} AND key IS NOT {key_expr}; {upsert} END
+                """)
+        movement = """
+            UPDATE sync_state SET seq = seq + 1;
+            INSERT INTO sync_stock (site, origin_seq, serial_number, delta, seq)
+            SELECT site, seq, NEW.serial_number, {delta}, seq FROM sync_state;
+        """
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS products_stock_insert_sync AFTER INSERT ON products
+            WHEN {local} AND NEW.quantity <> 0
+            BEGIN {movement.format(delta="NEW.quantity")} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS products_stock_update_sync AFTER UPDATE OF quantity ON products
+            WHEN {local} AND NEW.quantity <> OLD.quantity
+            BEGIN {movement.format(delta="NEW.quantity - OLD.quantity")} END
+        """)
+
+    def site(self):
+        """Id of this branch."""
+        with sqlite3.connect(self.db_name) as conn:
+            return conn.execute("SELECT site FROM sync_state").fetchone()[0]
+
+    def new_site(self):
+        """
+        Give this database a new branch id. Run it on a database copied from another
+        branch (a restored backup, a new branch set up from a copy), so both are not
+        taken for the same branch; the history they share is still recognised.
+        """
+        site = uuid.uuid4().hex
+        with sqlite3.connect(self.db_name) as conn:
+            conn.execute("UPDATE sync_state SET site = ?", (site,))
+            conn.commit()
+        return site
+
+    def site_stock(self, serial_number=None):
+        """[(serial number, branch, quantity)] of every branch, this one first, for one product or all."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT serial_number, site, quantity FROM (
+                    SELECT p.serial_number, s.site, p.quantity, 0 AS remote
+                    FROM products p, sync_state s
+                    UNION ALL
+                    SELECT serial_number, site, quantity, 1 FROM sync_site_stock
+                )
+                WHERE ? IS NULL OR serial_number = ?
+                ORDER BY serial_number, remote, site
+            """, (serial_number, serial_number))
+            return cursor.fetchall()
+
+    def status(self):
+        """{"site", "seq", "peers": [(site, changes not yet acknowledged, last sync)]}."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT site, seq FROM sync_state")
+            site, seq = cursor.fetchone()
+            cursor.execute("SELECT site, acked, last_sync FROM sync_peers ORDER BY last_sync DESC")
+            peers = []
+            for peer, acked, last_sync in cursor.fetchall():
+                cursor.execute("""
+                    SELECT (SELECT COUNT(*) FROM sync_rows WHERE seq > ? AND site <> ?)
+                         + (SELECT COUNT(*) FROM sync_stock WHERE seq > ? AND site <> ?)
+                """, (acked, peer, acked, peer))
+                peers.append((peer, cursor.fetchone()[0], last_sync))
+            return {"site": site, "seq": seq, "peers": peers}
+
+    # --- Export ---
+    def export(self, peer=None):
+        """
+        Bundle of the changes the branch `peer` has not acknowledged yet (everything for an
+        unknown branch). Changes that came from the peer itself are left out.
+        """
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")  # One snapshot for the whole bundle
+            cursor.execute("SELECT site, clock, seq FROM sync_state")
+            site, clock, upto = cursor.fetchone()
+            after, received = 0, 0
+            if peer:
+                cursor.execute("SELECT acked, received FROM sync_peers WHERE site = ?", (peer,))
+                row = cursor.fetchone()
+                if row is not None:
+                    after, received = row
+            rows = self._export_rows(cursor, after, peer or "")
+            cursor.execute("""
+                SELECT site, origin_seq, serial_number, delta FROM sync_stock
+                WHERE seq > ? AND site <> ? ORDER BY seq, origin_seq
+            """, (after, peer or ""))
+            stock = cursor.fetchall()
+            conn.rollback()
+        return {"format": BUNDLE_FORMAT, "site": site, "peer": peer, "clock": clock, "after": after,
+                "upto": upto, "ack": received, "rows": rows, "stock": stock}
+
+    def _export_rows(self, cursor, after, peer):
+        rows = []
+        cursor.execute("""
+            SELECT s.key, s.version, s.site, s.deleted, p.name, p.cost, p.price
+            FROM sync_rows s LEFT JOIN products p ON p.id = s.row_id
+            WHERE s.tbl = 'products' AND s.seq > ? AND s.site <> ?
+        """, (after, peer))
+        for key, version, site, deleted, *data in cursor.fetchall():
+            rows.append(["products", key, version, site, deleted, None if deleted else data])
+        cursor.execute("""
+            SELECT s.key, s.version, s.site, s.deleted, c.name, c.rtn, c.phone, c.email, c.city
+            FROM sync_rows s LEFT JOIN clients c ON c.id = s.row_id
+            WHERE s.tbl = 'clients' AND s.seq > ? AND s.site <> ?
+        """, (after, peer))
+        for key, version, site, deleted, *data in cursor.fetchall():
+            rows.append(["clients", key, version, site, deleted, None if deleted else data])
+        cursor.execute("""
+            SELECT s.key, s.version, s.site, s.deleted, s.row_id, c.identity_id,
+                   v.client_name, v.date, v.subtotal, v.tax, v.total, v.file_path
+            FROM sync_rows s LEFT JOIN invoices v ON v.id = s.row_id LEFT JOIN clients c ON c.id = v.client_id
+            WHERE s.tbl = 'invoices' AND s.seq > ? AND s.site <> ?
+        """, (after, peer))
+        invoices = cursor.fetchall()
+        live = [row[4] for row in invoices if not row[3]]
+        items = {}
+        for start in range(0, len(live), 500):
+            chunk = live[start:start + 500]
+            cursor.execute(f"""
+                SELECT invoice_id, serial_number, name, quantity, price, subtotal, cost FROM invoice_items
+                WHERE invoice_id IN ({",".join("?" * len(chunk))}) ORDER BY id
+            """, chunk)
+            for invoice_id, *line in cursor.fetchall():
+                items.setdefault(invoice_id, []).append(line)
+        for key, version, site, deleted, row_id, identity_id, name, date, subtotal, tax, total, ref in invoices:
+            data = None
+            if not deleted:
+                data = {"client": identity_id, "client_name": name, "date": date, "subtotal": subtotal,
+                        "tax": tax, "total": total, "items": items.get(row_id, []),
+                        "document": self._load_document(ref)}
+            rows.append(["invoices", key, version, site, deleted, data])
+        cursor.execute("""
+            SELECT s.key, s.version, s.site, s.deleted, s.row_id, i.key, c.identity_id,
+                   n.client_name, n.date, n.subtotal, n.tax, n.total, n.reason
+            FROM sync_rows s LEFT JOIN credit_notes n ON n.id = s.row_id
+            LEFT JOIN sync_rows i ON i.tbl = 'invoices' AND i.row_id = n.invoice_id
+            LEFT JOIN clients c ON c.id = n.client_id
+            WHERE s.tbl = 'credit_notes' AND s.seq > ? AND s.site <> ?
+        """, (after, peer))
+        for key, version, site, deleted, row_id, invoice, identity_id, name, date, subtotal, tax, total, reason \
+                in cursor.fetchall():
+            data = None
+            if not deleted:
+                cursor.execute("""
+                    SELECT serial_number, name, quantity, price, subtotal, cost FROM credit_note_items
+                    WHERE credit_note_id = ? ORDER BY id
+                """, (row_id,))
+                data = {"invoice": invoice, "client": identity_id, "client_name": name, "date": date,
+                        "subtotal": subtotal, "tax": tax, "total": total, "reason": reason,
+                        "items": cursor.fetchall()}
+            rows.append(["credit_notes", key, version, site, deleted, data])
+        return rows
+
+    def _load_document(self, ref):
+        if self.store is None or not ref:
+            return None
+        try:
+            return self.store.load(ref)
+        except Exception:
+            return None  # The invoice still travels without its document
+
+    # --- Import ---
+    def import_bundle(self, bundle):
+        """
+        Apply a bundle from another branch in one transaction. Returns {"site", "rows",
+        "stock", "conflicts"}: rows and movements applied, and rows that could not be
+        (e.g. a client whose RTN is already used by another client here).
+        """
+        if bundle.get("format") != BUNDLE_FORMAT:
+            raise SyncError("Formato de paquete de sincronización no reconocido")
+        peer = bundle["site"]
+        saved = []     # Documents of the new invoices, removed if the transaction fails
+        dropped = []   # Documents of deleted invoices, removed after the commit
+        applied = {"site": peer, "rows": 0, "stock": 0, "conflicts": []}
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT site FROM sync_state")
+            if cursor.fetchone()[0] == peer:
+                conn.rollback()
+                raise SyncError("El paquete es de esta misma sucursal (¿base de datos copiada? use sync-init --new-site)")
+            try:
+                cursor.execute("UPDATE sync_state SET applying = 1, seq = seq + 1, clock = MAX(clock, ?)",
+                               (bundle["clock"],))
+                cursor.execute("SELECT seq FROM sync_state")
+                seq = cursor.fetchone()[0]
+                for row in bundle["rows"]:
+                    cursor.execute("SAVEPOINT row")
+                    try:
+                        if self._apply_row(cursor, seq, *row, saved=saved, dropped=dropped):
+                            applied["rows"] += 1
+                        cursor.execute("RELEASE row")
+                    except sqlite3.IntegrityError as e:
+                        cursor.execute("ROLLBACK TO row")
+                        cursor.execute("RELEASE row")
+                        applied["conflicts"].append(f"{row[0]} {row[1]}: {e}")
+                for site, origin_seq, serial_number, delta in bundle["stock"]:
+                    if self._apply_movement(cursor, seq, site, origin_seq, serial_number, delta):
+                        applied["stock"] += 1
+                cursor.execute("UPDATE sync_state SET applying = 0")
+                cursor.execute("""
+                    INSERT INTO sync_peers (site, acked, received, last_sync) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(site) DO UPDATE SET acked = MAX(acked, excluded.acked),
+                        received = MAX(received, excluded.received), last_sync = excluded.last_sync
+                """, (peer, bundle["ack"] if bundle.get("peer") else 0, bundle["upto"],
+                      datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                for ref in saved:
+                    self.store.delete(ref)
+                raise
+        for ref in dropped:
+            self.store.delete(ref)
+        return applied
+
+    def _apply_row(self, cursor, seq, table, key, version, site, deleted, data, saved, dropped):
+        """Apply one row if its version wins over the local one; returns whether it did."""
+        if table not in SYNC_KEYS:
+            raise SyncError(f"Tabla desconocida en el paquete: {table}")
+        cursor.execute("SELECT row_id, version, site FROM sync_rows WHERE tbl = ? AND key = ?", (table, key))
+        local = cursor.fetchone()
+        if local is not None and (local[1], local[2]) >= (version, site):
+            return False
+        row_id = local[0] if local is not None else None
+        if table == "invoices":
+            row_id = self._apply_invoice(cursor, key, row_id, deleted, data, saved, dropped)
+        elif table == "credit_notes":
+            row_id = self._apply_credit_note(cursor, row_id, deleted, data)
+        elif table == "products":
+            cursor.execute("SELECT id FROM products WHERE serial_number = ?", (key,))
+            found = cursor.fetchone()
+            if deleted:
+                if found:
+                    cursor.execute("DELETE FROM products WHERE id = ?", (found[0],))
+            elif found:
+                cursor.execute("UPDATE products SET name = ?, cost = ?, price = ? WHERE id = ?", (*data, found[0]))
+            else:
+                # None of it here yet; the other branch's stock arrives as its movements
+                cursor.execute("INSERT INTO products (serial_number, name, quantity, cost, price) VALUES (?, ?, 0, ?, ?)",
+                               (key, *data))
+            row_id = found[0] if found else cursor.lastrowid
+        else:
+            cursor.execute("SELECT id FROM clients WHERE identity_id = ?", (key,))
+            found = cursor.fetchone()
+            if deleted:
+                if found:
+                    cursor.execute("DELETE FROM clients WHERE id = ?", (found[0],))
+            elif found:
+                cursor.execute("UPDATE clients SET name = ?, rtn = ?, phone = ?, email = ?, city = ? WHERE id = ?",
+                               (*data, found[0]))
+            else:
+                cursor.execute("INSERT INTO clients (name, identity_id, rtn, phone, email, city) VALUES (?, ?, ?, ?, ?, ?)",
+                               (data[0], key, *data[1:]))
+            row_id = found[0] if found else cursor.lastrowid
+        cursor.execute("""
+            INSERT INTO sync_rows (tbl, key, row_id, version, site, deleted, seq) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(tbl, key) DO UPDATE SET row_id = excluded.row_id, version = excluded.version,
+                site = excluded.site, deleted = excluded.deleted, seq = excluded.seq
+        """, (table, key, row_id, version, site, deleted, seq))
+        return True
+
+    def _apply_invoice(self, cursor, key, row_id, deleted, data, saved, dropped):
+        if deleted:
+            cursor.execute("SELECT 1 FROM credit_notes WHERE invoice_id = ? LIMIT 1", (row_id,))
+            if row_id is not None and cursor.fetchone() is None:  # Kept if returns were made here meanwhile
+                cursor.execute("SELECT file_path FROM invoices WHERE id = ?", (row_id,))
+                invoice = cursor.fetchone()
+                if invoice is not None:
+                    self.db._delete_invoice(cursor, row_id)
+                    if invoice[0] and self.store is not None:
+                        dropped.append(invoice[0])
+            return row_id
+        if row_id is not None:
+            return row_id  # Invoices never change once created
+        client_id = None
+        if data["client"] is not None:
+            cursor.execute("SELECT id FROM clients WHERE identity_id = ?", (data["client"],))
+            found = cursor.fetchone()
+            client_id = found[0] if found else None
+        lines = []
+        for serial_number, name, quantity, price, subtotal, cost in data["items"]:
+            cursor.execute("SELECT id FROM products WHERE serial_number = ?", (serial_number,))
+            found = cursor.fetchone()
+            lines.append((found[0] if found else None, serial_number, name, quantity, price, subtotal, cost))
+        # Stock is not touched: the units left the stock of the branch that sold them
+        invoice_id = self.db._insert_invoice(cursor, client_id, data["client_name"], data["date"], data["subtotal"],
+                                             data["tax"], data["total"], "", lines)
+        if data.get("document") and self.store is not None:
+            ref = self.store.save(f"FAC_{invoice_id:05d}.txt", data["document"], data["date"], cursor=cursor)
+            saved.append(ref)
+            cursor.execute("UPDATE invoices SET file_path = ? WHERE id = ?", (ref, invoice_id))
+        return invoice_id
+
+    def _apply_credit_note(self, cursor, row_id, deleted, data):
+        if deleted or row_id is not None:
+            return row_id  # Credit notes are never edited (nor deleted, archiving is not synchronized)
+        cursor.execute("SELECT row_id, deleted FROM sync_rows WHERE tbl = 'invoices' AND key = ?", (data["invoice"],))
+        invoice = cursor.fetchone()
+        if invoice is None or invoice[1]:
+            raise sqlite3.IntegrityError(f"factura {data['invoice']} desconocida")
+        cursor.execute("SELECT client_id FROM invoices WHERE id = ?", (invoice[0],))
+        found = cursor.fetchone()
+        if found is None:
+            raise sqlite3.IntegrityError(f"factura {data['invoice']} no está en la base de datos activa")
+        lines = []
+        for serial_number, name, quantity, price, subtotal, cost in data["items"]:
+            cursor.execute("SELECT id FROM products WHERE serial_number = ?", (serial_number,))
+            product = cursor.fetchone()
+            lines.append((product[0] if product else None, serial_number, name, quantity, price, subtotal, cost))
+        # Stock is not touched: the returned units went back to the stock of the branch that took them
+        return self.db._insert_credit_note(cursor, invoice[0], found[0], data["client_name"], data["date"],
+                                           data["subtotal"], data["tax"], data["total"], data["reason"], lines)
+
+    def _apply_movement(self, cursor, seq, site, origin_seq, serial_number, delta):
+        """
+        Record a movement of another branch once (movements already seen are skipped) and
+        move that branch's balance; this branch's stock is not touched. Returns whether it was new.
+        """
+        cursor.execute("""
+            INSERT OR IGNORE INTO sync_stock (site, origin_seq, serial_number, delta, seq) VALUES (?, ?, ?, ?, ?)
+        """, (site, origin_seq, serial_number, delta, seq))
+        if cursor.rowcount == 0:
+            return False
+        cursor.execute("""
+            INSERT INTO sync_site_stock (site, serial_number, quantity) VALUES (?, ?, ?)
+            ON CONFLICT(site, serial_number) DO UPDATE SET quantity = quantity + excluded.quantity
+        """, (site, serial_number, delta))
+        return True
@@ -0,0 +1,258 @@
+import sqlite3
+import datetime
+from archive import connect_with_archives, attach_archives, union_all
+
+COSTING_METHODS = ("average", "fifo")
+
+
+def add_cost_layer(cursor, product_id, quantity, unit_cost, source="receipt", received_at=None):
+    """Record received stock as a new cost layer."""
+    if quantity <= 0:
+        return
+    received_at = received_at or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute("""
+        INSERT INTO cost_layers (product_id, received_at, quantity, remaining, unit_cost, source)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (product_id, received_at, quantity, quantity, unit_cost, source))
+
+
+def ensure_opening_layer(cursor, product_id, stock_quantity):
+    """
+    Stock that predates cost layers (or was set directly) gets an opening layer at the
+    product's current cost, so layers always cover the quantity on hand.
+    """
+    cursor.execute("SELECT COALESCE(SUM(remaining), 0) FROM cost_layers WHERE product_id = ? AND remaining > 0",
+                   (product_id,))
+    covered = cursor.fetchone()[0]
+    if stock_quantity > covered:
+        cursor.execute("SELECT cost FROM products WHERE id = ?", (product_id,))
+        row = cursor.fetchone()
+        add_cost_layer(cursor, product_id, stock_quantity - covered, row[0] if row else 0.0, "opening",
+                       "0000-00-00 00:00:00")
+
+
+def consume_layers(cursor, product_id, quantity, method="average"):
+    """
+    Take `quantity` units out of the product's open cost layers and return their cost.
+    fifo: oldest layers first at their own cost.
+    average: open layers are first revalued at their weighted-average cost, so every
+    unit leaves at the same cost and the remaining value stays consistent.
+    Must run inside the caller's transaction, before the stock quantity is decremented.
+    """
+    if quantity <= 0:
+        return 0.0
+    cursor.execute("SELECT quantity FROM products WHERE id = ?", (product_id,))
+    row = cursor.fetchone()
+    ensure_opening_layer(cursor, product_id, max(row[0] if row else 0, quantity))
+    if method == "average":
+        cursor.execute("""
+            UPDATE cost_layers SET unit_cost = (
+                SELECT SUM(remaining * unit_cost) / SUM(remaining) FROM cost_layers
+                WHERE product_id = ? AND remaining > 0
+            )
+            WHERE product_id = ? AND remaining > 0
+        """, (product_id, product_id))
+    cursor.execute("""
+        SELECT id, remaining, unit_cost FROM cost_layers
+        WHERE product_id = ? AND remaining > 0 ORDER BY received_at, id
+    """, (product_id,))
+    left = quantity
+    cost = 0.0
+    updates = []
+    for layer_id, remaining, unit_cost in cursor.fetchall():
+        take = min(left, remaining)
+        cost += take * unit_cost
+        updates.append((remaining - take, layer_id))
+        left -= take
+        if left == 0:
+            break
+    cursor.executemany("UPDATE cost_layers SET remaining = ? WHERE id = ?", updates)
+    return cost
+
+
+def _month_bounds(period):
+    start = datetime.date(int(period[:4]), int(period[5:7]), 1)
+    end = (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return start.isoformat(), end.isoformat()
+
+
+def _previous_period(period):
+    start = datetime.date(int(period[:4]), int(period[5:7]), 1)
+    return (start - datetime.timedelta(days=1)).strftime("%Y-%m")
+
+
+class InventoryValuation:
+    """Inventory value, COGS and gross margin computed from cost layers and period snapshots."""
+
+    def __init__(self, db_name="inventory.db"):
+        self.db_name = db_name
+
+    def current_value(self):
+        """Value of the stock on hand at layer cost."""
+        with sqlite3.connect(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COALESCE(SUM(remaining * unit_cost), 0) FROM cost_layers WHERE remaining > 0")
+            return cursor.fetchone()[0]
+
+    def _period_activity(self, cursor, period, schemas=("main",)):
+        """Revenue, COGS and receipts of one month, from indexed date ranges of the given partitions."""
+        start, end = _month_bounds(period)
+        cursor.execute("SELECT COALESCE(SUM(subtotal), 0), COALESCE(SUM(cost), 0) FROM (" + union_all(schemas, """
+            SELECT i.subtotal, i.cost
+            FROM {schema}.invoices v JOIN {schema}.invoice_items i ON i.invoice_id = v.id
+            WHERE v.date >= :start AND v.date < :end
+        """) + ")", {"start": start, "end": end})
+        revenue, cogs = cursor.fetchone()
+        # Returns of the month come off its sales at the price and cost they were sold at
+        cursor.execute("SELECT COALESCE(SUM(subtotal), 0), COALESCE(SUM(cost), 0) FROM (" + union_all(schemas, """
+            SELECT c.subtotal, c.cost
+            FROM {schema}.credit_notes n JOIN {schema}.credit_note_items c ON c.credit_note_id = n.id
+            WHERE n.date >= :start AND n.date < :end
+        """) + ")", {"start": start, "end": end})
+        returned, returned_cost = cursor.fetchone()
+        revenue -= returned
+        cogs -= returned_cost
+        cursor.execute("""
+            SELECT COALESCE(SUM(quantity * unit_cost), 0) FROM cost_layers
+            WHERE received_at >= ? AND received_at < ? AND source NOT IN ('opening', 'return')
+        """, (start, end))
+        receipts = cursor.fetchone()[0]
+        return revenue, cogs, receipts
+
+    def closable_period(self):
+        """The month that can be closed: the one that just ended."""
+        return _previous_period(datetime.date.today().strftime("%Y-%m"))
+
+    def close_period(self, period=None):
+        """
+        Snapshot the layer state at the end of the month that just ended as its closing value.
+        The close may run some days into the new month, so what happened since is taken
+        back out of the current layers: stock received since the end is subtracted, and
+        stock sold or adjusted down since then is added back at the cost it left at (the
+        product's cost for adjustments, whose layer cost is not recorded). Layers only hold
+        their present state, so an earlier month cannot be rebuilt: any other period, or a
+        month already closed, raises ValueError. Only the month's own activity is read;
+        earlier months come from their snapshots.
+        """
+        closable = self.closable_period()
+        period = period or closable
+        if period != closable:
+            raise ValueError(f"Solo se puede cerrar el mes que acaba de terminar ({closable}).")
+        with connect_with_archives(self.db_name) as conn:
+            cursor = conn.cursor()
+            schemas = attach_archives(cursor, self.db_name, period, period)  # ATTACH is not allowed in a transaction
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT closed_at FROM valuation_periods WHERE period = ?", (period,))
+            row = cursor.fetchone()
+            if row is not None:
+                conn.rollback()
+                raise ValueError(f"El mes {period} ya fue cerrado el {row[0]}.")
+            revenue, cogs, receipts = self._period_activity(cursor, period, schemas)
+            cursor.execute("""
+                INSERT INTO valuation_snapshots (period, product_id, quantity, value)
+                SELECT :period, product_id, SUM(quantity), SUM(value) FROM (
+                    SELECT product_id, remaining AS quantity, remaining * unit_cost AS value
+                    FROM cost_layers WHERE remaining > 0
+                    UNION ALL
+                    SELECT product_id, -quantity, -quantity * unit_cost FROM cost_layers WHERE received_at >= :end
+                    UNION ALL
+                    SELECT i.product_id, i.quantity, i.cost
+                    FROM invoices v JOIN invoice_items i ON i.invoice_id = v.id
+                    WHERE v.date >= :end AND i.product_id IS NOT NULL
+                    UNION ALL
+                    SELECT m.product_id, -m.delta, -m.delta * p.cost
+                    FROM stock_movements m JOIN products p ON p.id = m.product_id
+                    WHERE m.at >= :end AND m.kind = 'adjustment' AND m.delta < 0
+                )
+                GROUP BY product_id HAVING SUM(quantity) > 0
+            """, {"period": period, "end": _month_bounds(period)[1]})
+            cursor.execute("SELECT COALESCE(SUM(value), 0) FROM valuation_snapshots WHERE period = ?", (period,))
+            closing_value = cursor.fetchone()[0]
+            cursor.execute("""
+                INSERT INTO valuation_periods (period, closed_at, revenue, cogs, receipts, closing_value)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (period, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                  revenue, cogs, receipts, closing_value))
+            conn.commit()
+            return closing_value
+
+    def close_due_period(self):
+        """
+        Close the month that just ended if it is still open; run at start and periodically
+        so the snapshot is taken as soon after the month's end as possible. Returns the
+        closing value, or None if there was nothing to close.
+        """
+        with sqlite3.connect(self.db_name) as conn:
+            if conn.execute("SELECT 1 FROM valuation_periods WHERE period = ?",
+                            (self.closable_period(),)).fetchone() is not None:
+                return None
+        try:
+            return self.close_period()
+        except ValueError:
+            return None  # Closed meanwhile by another terminal
+
+    def gross_margin(self, start_period, end_period):
+        """
+        Monthly gross margin between two periods ('YYYY-MM').
+        Closed months are read from valuation_periods; open months are computed live.
+        Returns (period, revenue, cogs, margin, margin %, receipts, opening value, closing value, closed).
+        """
+        periods = []
+        period = end_period
+        while period >= start_period:
+            periods.append(period)
+            period = _previous_period(period)
+        periods.reverse()
+        with connect_with_archives(self.db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT period, revenue, cogs, receipts, closing_value FROM valuation_periods
+                WHERE period BETWEEN ? AND ?
+            """, (_previous_period(start_period), end_period))
+            closed = {row[0]: row[1:] for row in cursor.fetchall()}
+            live_value = None
+            schemas = None  # Archives are attached only if an open month needs them
+            rows = []
+            opening = closed.get(_previous_period(start_period), (None,) * 4)[3]
+            for period in periods:
+                if period in closed:
+                    revenue, cogs, receipts, closing = closed[period]
+                    is_closed = True
+                else:
+                    if schemas is None:
+                        schemas = attach_archives(cursor, self.db_name, start_period, end_period)
+                    revenue, cogs, receipts = self._period_activity(cursor, period, schemas)
+                    if live_value is None:
+                        cursor.execute("SELECT COALESCE(SUM(remaining * unit_cost), 0) FROM cost_layers WHERE remaining > 0")
+                        live_value = cursor.fetchone()[0]
+                    closing = live_value if period == periods[-1] else None
+                    is_closed = False
+                margin = revenue - cogs
+                percent = margin / revenue * 100 if revenue else 0.0
+                rows.append((period, revenue, cogs, margin, percent, receipts, opening, closing, is_closed))
+                opening = closing
+            return rows
+
+    def product_margins(self, start, end):
+        """Revenue, COGS and margin per product between two dates (inclusive)."""
+        with connect_with_archives(self.db_name) as conn:
+            cursor = conn.cursor()
+            schemas = attach_archives(cursor, self.db_name, start, end)
+            cursor.execute("""
+                SELECT product_id, serial_number, name, SUM(quantity),
+                       SUM(subtotal), SUM(cost), SUM(subtotal) - SUM(cost)
+                FROM (
+            """ + union_all(schemas, """
+                    SELECT i.product_id, i.serial_number, i.name, i.quantity, i.subtotal, i.cost
+                    FROM {schema}.invoices v JOIN {schema}.invoice_items i ON i.invoice_id = v.id
+                    WHERE v.date >= date(:start) AND v.date < date(:end, '+1 day')
+                    UNION ALL
+                    SELECT c.product_id, c.serial_number, c.name, -c.quantity, -c.subtotal, -c.cost
+                    FROM {schema}.credit_notes n JOIN {schema}.credit_note_items c ON c.credit_note_id = n.id
+                    WHERE n.date >= date(:start) AND n.date < date(:end, '+1 day')
+            """) + """
+                )
+                GROUP BY product_id, serial_number, name
+                ORDER BY 7 DESC
+            """, {"start": start, "end": end})
+            return cursor.fetchall()